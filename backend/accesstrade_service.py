@@ -2,9 +2,12 @@ import httpx
 from typing import Any, Dict, List
 from sqlalchemy.orm import Session
 import crud
+import models
 import logging
-import json
 import os
+import json_codec
+import metrics
+import time
 from datetime import datetime, UTC
 
 logger = logging.getLogger("affiliate_api")
@@ -73,14 +76,19 @@ def _log_jsonl(filename: str, payload: dict) -> None:
         _maybe_rotate(fpath)
         data = dict(payload)
         data.setdefault("ts", datetime.now(UTC).isoformat())
-        with open(fpath, "a", encoding="utf-8") as f:
-            f.write(json.dumps(data, ensure_ascii=False) + "\n")
+        with open(fpath, "ab") as f:
+            f.write(json_codec.dumps_bytes(data) + b"\n")
     except Exception as e:
         logger.debug("rawlog error %s: %s", filename, e)
 
 
-def _get_at_config(db: Session):
-    cfg = crud.get_api_config(db, "accesstrade")
+def _get_at_config(db: "Session | models.APIConfig"):
+    # Endpoint dùng AsyncSession nạp sẵn APIConfig rồi truyền vào thay cho Session
+    cfg = (
+        db
+        if isinstance(db, models.APIConfig)
+        else crud.get_api_config(db, "accesstrade")
+    )
     if not cfg or not cfg.api_key or not cfg.base_url:
         raise ValueError("Chưa cấu hình APIConfig 'accesstrade'")
     return cfg
@@ -103,8 +111,73 @@ def _headers(api_key: str) -> Dict[str, str]:
     }
 
 
+class _MetricsTransport(httpx.AsyncBaseTransport):
+    """Bọc transport thật: giữ ngân sách `AT_MAX_CONCURRENCY` và đo latency mỗi request
+    Accesstrade theo endpoint + status (status="error" khi không có response: timeout, lỗi kết nối)."""
+
+    def __init__(self, inner: httpx.AsyncBaseTransport) -> None:
+        self._inner = inner
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        async with _at_budget():
+            t0 = time.perf_counter()
+            status = "error"
+            try:
+                resp = await self._inner.handle_async_request(request)
+                status = str(resp.status_code)
+                return resp
+            finally:
+                metrics.UPSTREAM_SECONDS.observe(
+                    time.perf_counter() - t0,
+                    endpoint=_endpoint_label(request.url.path),
+                    status=status,
+                )
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+def _endpoint_label(path: str) -> str:
+    """/v1/commission_policies -> commission_policies (bỏ version và id số)."""
+    parts = [p for p in path.split("/") if p and p != "v1" and not p.isdigit()]
+    return parts[-1] if parts else "/"
+
+
+def _at_client(*, http2: bool = False, **kw: Any) -> httpx.AsyncClient:
+    """AsyncClient cho API Accesstrade, có đo metrics upstream."""
+    return httpx.AsyncClient(
+        transport=_MetricsTransport(httpx.AsyncHTTPTransport(http2=http2)), **kw
+    )
+
+
 # --- Lấy toàn bộ campaign (song song theo "window" trang) ---
 import asyncio
+import contextvars
+import threading
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator
+
+# Ngân sách đồng thời chung cho mọi request tới Accesstrade trong cả tiến trình: fan-out
+# detail/commission/trang datafeeds cộng lại cũng không vượt quá số request đang bay này.
+# Job nền và _run_off_loop chạy event loop riêng (asyncio.run), nên dùng semaphore của
+# thread (dùng chung giữa các loop) thay vì asyncio.Semaphore gắn với 1 loop.
+AT_MAX_CONCURRENCY = max(1, int(os.getenv("AT_MAX_CONCURRENCY", "8") or 8))
+_at_slots = threading.BoundedSemaphore(AT_MAX_CONCURRENCY)
+
+
+@asynccontextmanager
+async def _at_budget() -> AsyncIterator[None]:
+    # acquire không chặn + sleep lùi dần: không chiếm thread của loop, và task bị huỷ
+    # khi đang chờ không giữ mất slot
+    delay = 0.005
+    while not _at_slots.acquire(blocking=False):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    try:
+        yield
+    finally:
+        _at_slots.release()
 
 
 async def fetch_campaigns_full_all(
@@ -209,9 +282,7 @@ async def fetch_campaigns_full_all(
                 curr_limit = max(20, curr_limit // 2)
         return []
 
-    async with httpx.AsyncClient(
-        timeout=timeout, follow_redirects=True, http2=True
-    ) as client:
+    async with _at_client(timeout=timeout, follow_redirects=True, http2=True) as client:
         page = 1
         while page <= max_pages:
             end = min(max_pages, page + int(window_pages) - 1)
@@ -270,7 +341,7 @@ async def fetch_products(
         if "merchant" in _params and "campaign" not in _params:
             _params["campaign"] = _params.pop("merchant")
 
-    async with httpx.AsyncClient(timeout=30) as client:
+    async with _at_client(timeout=30) as client:
         r = await client.get(url, headers=_headers(cfg.api_key), params=_params)
         ok = r.status_code == 200
         try:
@@ -292,6 +363,11 @@ async def fetch_products(
         )
         if not ok:
             r.raise_for_status()
+        if not isinstance(data, dict) or "data" not in data:
+            # 200 nhưng body hỏng: báo lỗi thay vì [] (caller coi [] là "hết dữ liệu")
+            raise ValueError(
+                f"Datafeeds trả body không hợp lệ (page={_params.get('page')})"
+            )
         return items or []
 
 
@@ -330,7 +406,7 @@ async def fetch_promotions(db: Session, merchant: str) -> List[Dict[str, Any]]:
             }
         ]
     url = cfg.base_url.rstrip("/") + "/v1/offers_informations"
-    async with httpx.AsyncClient(timeout=30) as client:
+    async with _at_client(timeout=30) as client:
         r = await client.get(
             url, headers=_headers(cfg.api_key), params={"merchant": merchant}
         )
@@ -393,7 +469,7 @@ async def fetch_top_products(
     if date_to:
         params["date_to"] = date_to
 
-    async with httpx.AsyncClient(timeout=30) as client:
+    async with _at_client(timeout=30) as client:
         r = await client.get(url, headers=_headers(cfg.api_key), params=params)
         ok = r.status_code == 200
         j = r.json() if ok else None
@@ -416,50 +492,152 @@ async def fetch_top_products(
 
 
 # --- Lấy danh sách campaign đang chạy ---
-async def fetch_active_campaigns(db: Session) -> Dict[str, str]:
+# Snapshot campaign đang chạy dùng chung cho mọi pha ingest trong TTL ngắn: 1 lần
+# ingest-refresh (sync → promotions → datafeeds → top-products/commissions) chỉ quét
+# danh sách này 1 lần. Campaigns sync gọi refresh_active_campaigns() để nạp lại ngay.
+ACTIVE_CAMPAIGNS_TTL_SEC = float(os.getenv("ACTIVE_CAMPAIGNS_TTL_SEC", "120") or 0)
+ACTIVE_CAMPAIGNS_PAGE_LIMIT = 100
+ACTIVE_CAMPAIGNS_MAX_PAGES = 200
+# (base_url, api_key) -> (monotonic lúc lấy, {campaign_id: merchant})
+_active_snapshot: Dict[tuple, tuple] = {}
+_active_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _active_key(cfg) -> tuple:
+    return (getattr(cfg, "base_url", None), getattr(cfg, "api_key", None))
+
+
+def _active_lock() -> asyncio.Lock:
+    loop = asyncio.get_running_loop()
+    lock = _active_locks.get(loop)
+    if lock is None:
+        lock = _active_locks[loop] = asyncio.Lock()
+    return lock
+
+
+def _active_entry(camp: Dict[str, Any]) -> tuple[str, str]:
+    camp_id = str(camp.get("campaign_id") or camp.get("id") or "").strip()
+    merchant = str(camp.get("merchant") or camp.get("name") or "").lower().strip()
+    return camp_id, merchant
+
+
+# TTL ghi đè trong phạm vi 1 lần chạy (vd. cả lần ingest-refresh dùng chung 1 snapshot)
+_active_ttl_override: contextvars.ContextVar[float | None] = contextvars.ContextVar(
+    "active_campaigns_ttl", default=None
+)
+
+
+@contextmanager
+def pin_active_campaigns(ttl_sec: float) -> Iterator[None]:
+    """Trong khối lệnh, snapshot campaign đang chạy được dùng lại tới `ttl_sec` giây."""
+    token = _active_ttl_override.set(float(ttl_sec))
+    try:
+        yield
+    finally:
+        _active_ttl_override.reset(token)
+
+
+def invalidate_active_campaigns() -> None:
+    """Bỏ snapshot campaign đang chạy; lần gọi fetch_active_campaigns kế tiếp sẽ quét lại."""
+    _active_snapshot.clear()
+
+
+async def fetch_active_campaigns(
+    db: Session, *, max_age: float | None = None
+) -> Dict[str, str]:
     """
-    Lấy toàn bộ campaign đang chạy từ Accesstrade.
-    Trả về dict {campaign_id: merchant_name_lower}.
+    Lấy toàn bộ campaign đang chạy từ Accesstrade (quét đủ các trang).
+    Trả về dict {campaign_id: merchant_name_lower}; dùng lại snapshot nếu chưa quá
+    `max_age` giây (mặc định ACTIVE_CAMPAIGNS_TTL_SEC, 0 = luôn quét lại).
     """
     cfg = _get_at_config(db)
     if _is_mock_cfg(cfg):
         return {"CAMP1": "shopee", "CAMP3": "tikivn"}
+    if max_age is None:
+        max_age = _active_ttl_override.get()
+    ttl = ACTIVE_CAMPAIGNS_TTL_SEC if max_age is None else max_age
+    key = _active_key(cfg)
+    async with _active_lock():
+        # Kiểm tra lại trong lock: các pha chạy song song chờ chung 1 lần quét
+        hit = _active_snapshot.get(key)
+        if hit and ttl > 0 and time.monotonic() - hit[0] < ttl:
+            return dict(hit[1])
+        result = await _fetch_active_pages(cfg)
+        if result is None:
+            # Lỗi API: không giữ snapshot rỗng thay cho dữ liệu thật
+            return {}
+        _active_snapshot[key] = (time.monotonic(), result)
+        return dict(result)
+
+
+async def _fetch_active_pages(cfg) -> Dict[str, str] | None:
+    """Quét /v1/campaigns?status=running theo trang; None nếu có trang lỗi (không dùng
+    snapshot thiếu campaign)."""
     url = cfg.base_url.rstrip("/") + "/v1/campaigns"
+    result: Dict[str, str] = {}
+    limit = ACTIVE_CAMPAIGNS_PAGE_LIMIT
+    async with _at_client(timeout=30) as client:
+        for page in range(1, ACTIVE_CAMPAIGNS_MAX_PAGES + 1):
+            r = await client.get(
+                url,
+                headers=_headers(cfg.api_key),
+                params={"status": "running", "page": str(page), "limit": str(limit)},
+            )
+            ok = r.status_code == 200
+            try:
+                raw = r.json() if ok else None
+            except Exception:
+                raw = None
+            data = raw.get("data") if isinstance(raw, dict) else None
+            # 200 nhưng body hỏng/thiếu 'data' cũng là trang lỗi
+            ok = ok and isinstance(data, list)
+            items = data if ok else []
+            before = len(result)
+            for camp in items:
+                camp_id, merchant = _active_entry(camp)
+                if camp_id and merchant:
+                    result[camp_id] = merchant
+
+            _log_jsonl(
+                "campaigns_active.jsonl",
+                {
+                    "endpoint": "campaigns_active",
+                    "page": page,
+                    "status_code": r.status_code,
+                    "ok": ok,
+                    "items_count": len(items),
+                    "raw": raw if ok else None,
+                },
+            )
+            if not ok:
+                return None
+            # Hết dữ liệu: trang thiếu, hoặc API bỏ qua page và trả lại cùng 1 trang
+            if len(items) < limit or len(result) == before:
+                break
+    return result
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.get(
-            url, headers=_headers(cfg.api_key), params={"status": "running"}
-        )
-        ok = r.status_code == 200
-        result: Dict[str, str] = {}
-        raw = None
-
-        if ok:
-            raw = r.json()
-            if isinstance(raw, dict):
-                for camp in raw.get("data", []):
-                    camp_id = str(
-                        camp.get("campaign_id") or camp.get("id") or ""
-                    ).strip()
-                    merchant = (
-                        str(camp.get("merchant") or camp.get("name") or "")
-                        .lower()
-                        .strip()
-                    )
-                    if camp_id and merchant:
-                        result[camp_id] = merchant
 
-        _log_jsonl(
-            "campaigns_active.jsonl",
-            {
-                "endpoint": "campaigns_active",
-                "status_code": r.status_code,
-                "ok": ok,
-                "items_count": len(result),
-                "raw": raw if ok else None,
-            },
-        )
-        return result
+async def refresh_active_campaigns(
+    db: Session, running: List[Dict[str, Any]] | None = None
+) -> Dict[str, str]:
+    """
+    Nạp lại snapshot sau campaigns sync. Truyền `running` (toàn bộ campaign status
+    running vừa quét được) để dựng snapshot không cần gọi API lần nữa.
+    """
+    cfg = _get_at_config(db)
+    if _is_mock_cfg(cfg):
+        return await fetch_active_campaigns(db)
+    if running is None:
+        return await fetch_active_campaigns(db, max_age=0)
+    result: Dict[str, str] = {}
+    for camp in running:
+        camp_id, merchant = _active_entry(camp)
+        if camp_id and merchant:
+            result[camp_id] = merchant
+    _active_snapshot[_active_key(cfg)] = (time.monotonic(), result)
+    return dict(result)
 
 
 # --- NEW: Lấy chi tiết 1 campaign (kèm trạng thái đăng ký của user nếu API trả về) ---
@@ -487,7 +665,7 @@ async def fetch_campaign_detail(db: Session, campaign_id: str) -> Dict[str, Any]
         }
     url = cfg.base_url.rstrip("/") + "/v1/campaigns"
     params = {"campaign_id": str(campaign_id)}
-    async with httpx.AsyncClient(timeout=30) as client:
+    async with _at_client(timeout=30) as client:
         r = await client.get(url, headers=_headers(cfg.api_key), params=params)
         ok = r.status_code == 200
         j = r.json() if ok else None
@@ -513,6 +691,26 @@ async def fetch_campaign_detail(db: Session, campaign_id: str) -> Dict[str, Any]
         return detail
 
 
+async def fetch_campaign_details(
+    db: Session, campaign_ids: List[str], concurrency: int | None = None
+) -> Dict[str, Dict[str, Any] | None]:
+    """Detail nhiều campaign song song (tối đa `concurrency`, không vượt ngân sách
+    AT_MAX_CONCURRENCY). Lỗi của 1 campaign -> None cho campaign đó."""
+    from ingest_pipeline import gather_limited
+
+    ids = list(dict.fromkeys(str(c) for c in campaign_ids if c))
+
+    async def _one(cid: str) -> Dict[str, Any] | None:
+        try:
+            return await fetch_campaign_detail(db, cid)
+        except Exception as e:
+            logger.debug("campaign detail %s failed: %s", cid, e)
+            return None
+
+    res = await gather_limited(_one, ids, limit=concurrency or AT_MAX_CONCURRENCY)
+    return dict(zip(ids, res))
+
+
 # --- NEW: Lấy commission policies theo campaign_id ---
 async def fetch_commission_policies(
     db: Session, campaign_id: str
@@ -535,7 +733,7 @@ async def fetch_commission_policies(
     async def _call(
         params: Dict[str, str]
     ) -> tuple[list[dict], int, dict | None, str | None]:
-        async with httpx.AsyncClient(timeout=30) as client:
+        async with _at_client(timeout=30) as client:
             r = await client.get(url, headers=_headers(cfg.api_key), params=params)
             ok = r.status_code == 200
             j = r.json() if ok else None
@@ -631,51 +829,56 @@ async def fetch_commission_policies(
 
 
 # --- Map sản phẩm ---
-def map_at_product_to_offer(
-    item: Dict[str, Any], commission: Any = None, promotion: Any = None
-) -> Dict[str, Any]:
+def _extract_product_id(it: Dict[str, Any]) -> str | None:
+    # product_id có thể là "322_2062448047" -> lấy phần sau cùng nếu cần
+    pid = it.get("product_id") or it.get("id") or it.get("sku")
+    if not pid:
+        return None
+    pid = str(pid)
+    if "_" in pid:
+        return pid.split("_")[-1]
+    return pid
+
+
+def _pick_commission(rec: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "sales_ratio": rec.get("sales_ratio") or rec.get("ratio"),
+        "sales_price": rec.get("sales_price"),
+        "reward_type": rec.get("reward_type"),
+        "target_month": rec.get("target_month"),
+    }
+
+
+def _pick_prom(rec: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "name": rec.get("name"),
+        "content": rec.get("content") or rec.get("description"),
+        "start_time": rec.get("start_time"),
+        "end_time": rec.get("end_time"),
+        "coupon": rec.get("coupon"),
+        "link": rec.get("link"),
+    }
+
+
+class _CommissionIndex:
     """
-    Chuẩn hoá commission & promotion TẠI ĐÂY để export đọc được ngay:
-    - commission_norm: dict có các key: sales_ratio, sales_price, reward_type, target_month
-    - promotion_norm: dict có các key: name, content, start_time, end_time, coupon, link
+    Chuẩn hoá nhiều dạng structure từ API commission_policies về dict phẳng.
+    Ưu tiên match theo product_id -> category -> default.
+    Nếu 'raw' đã là dict phẳng có keys target -> dùng luôn.
 
-    Chấp nhận commission/promotion truyền vào là dict hoặc list; tự chọn record phù hợp.
+    Index được dựng MỘT lần cho cả batch: product/category -> dict lookup,
+    phần không phụ thuộc item (flat/default/data/list) được tính sẵn.
     """
-    domain = (item.get("domain") or "").lower()
-    campaign = (item.get("campaign") or "").lower()
-    merchant = (
-        item.get("merchant")
-        or campaign
-        or (domain.split(".")[0] if domain else "")
-        or item.get("shop")
-        or "unknown"
-    ).lower()
 
-    price_val = item.get("price")
-    try:
-        price = float(price_val) if price_val not in (None, "") else None
-    except Exception:
-        price = None
+    __slots__ = ("by_product", "by_category", "fallback", "raw")
 
-    # ---- Helpers ----
-    def _extract_product_id(it: Dict[str, Any]) -> str | None:
-        # product_id có thể là "322_2062448047" -> lấy phần sau cùng nếu cần
-        pid = it.get("product_id") or it.get("id") or it.get("sku")
-        if not pid:
-            return None
-        pid = str(pid)
-        if "_" in pid:
-            return pid.split("_")[-1]
-        return pid
-
-    def _norm_commission(raw: Any, it: Dict[str, Any]) -> Dict[str, Any] | None:
-        """
-        Chuẩn hoá nhiều dạng structure từ API commission_policies về dict phẳng.
-        Ưu tiên match theo product_id -> category -> default.
-        Nếu 'raw' đã là dict phẳng có keys target -> dùng luôn.
-        """
+    def __init__(self, raw: Any) -> None:
+        self.raw = raw
+        self.by_product: Dict[str, Dict[str, Any]] = {}
+        self.by_category: Dict[str, Dict[str, Any]] = {}
+        self.fallback: Dict[str, Any] | None = None
         if raw is None:
-            return None
+            return
 
         # Nếu đã là dict phẳng (đúng keys)
         if isinstance(raw, dict) and (
@@ -684,163 +887,149 @@ def map_at_product_to_offer(
             or "reward_type" in raw
             or "sales_price" in raw
         ):
-            return {
-                "sales_ratio": raw.get("sales_ratio") or raw.get("ratio"),
-                "sales_price": raw.get("sales_price"),
-                "reward_type": raw.get("reward_type"),
-                "target_month": raw.get("target_month"),
-            }
-
-        # Nếu là dict kiểu policies tổng hợp: product/category/default
-        pid = _extract_product_id(it)
-        cate = it.get("cate") or it.get("category") or it.get("category_id")
+            self.fallback = _pick_commission(raw)
+            return
 
         if isinstance(raw, dict):
-            # product-level
+            # Nếu là dict kiểu policies tổng hợp: product/category/default
             prod_list = raw.get("product") or raw.get("products")
-            if isinstance(prod_list, list) and pid:
+            if isinstance(prod_list, list):
                 for rec in prod_list:
-                    if str(rec.get("product_id")) == str(pid):
-                        return {
-                            "sales_ratio": rec.get("sales_ratio") or rec.get("ratio"),
-                            "sales_price": rec.get("sales_price"),
-                            "reward_type": rec.get("reward_type"),
-                            "target_month": rec.get("target_month"),
-                        }
-            # category-level
+                    if isinstance(rec, dict):
+                        self.by_product.setdefault(
+                            str(rec.get("product_id")), _pick_commission(rec)
+                        )
             cat_list = raw.get("category") or raw.get("categories")
-            if isinstance(cat_list, list) and cate:
+            if isinstance(cat_list, list):
                 for rec in cat_list:
-                    if str(rec.get("category_id")) == str(cate):
-                        return {
-                            "sales_ratio": rec.get("sales_ratio") or rec.get("ratio"),
-                            "sales_price": rec.get("sales_price"),
-                            "reward_type": rec.get("reward_type"),
-                            "target_month": rec.get("target_month"),
-                        }
-            # default-level
-            default_val = raw.get("default")
-            if isinstance(default_val, list) and default_val:
-                rec = default_val[0]
-                return {
-                    "sales_ratio": rec.get("sales_ratio") or rec.get("ratio"),
-                    "sales_price": rec.get("sales_price"),
-                    "reward_type": rec.get("reward_type"),
-                    "target_month": rec.get("target_month"),
-                }
-            if isinstance(default_val, dict):
-                rec = default_val
-                return {
-                    "sales_ratio": rec.get("sales_ratio") or rec.get("ratio"),
-                    "sales_price": rec.get("sales_price"),
-                    "reward_type": rec.get("reward_type"),
-                    "target_month": rec.get("target_month"),
-                }
-
-            # Nếu dict không có các key trên nhưng có mảng "data"
-            data_block = raw.get("data")
-            if isinstance(data_block, list) and data_block:
-                rec = data_block[0]
-                return {
-                    "sales_ratio": rec.get("sales_ratio") or rec.get("ratio"),
-                    "sales_price": rec.get("sales_price"),
-                    "reward_type": rec.get("reward_type"),
-                    "target_month": rec.get("target_month"),
-                }
-            if isinstance(data_block, dict):
-                rec = data_block
-                return {
-                    "sales_ratio": rec.get("sales_ratio") or rec.get("ratio"),
-                    "sales_price": rec.get("sales_price"),
-                    "reward_type": rec.get("reward_type"),
-                    "target_month": rec.get("target_month"),
-                }
+                    if isinstance(rec, dict):
+                        self.by_category.setdefault(
+                            str(rec.get("category_id")), _pick_commission(rec)
+                        )
+            # default-level, rồi tới mảng/dict "data"
+            for key in ("default", "data"):
+                block = raw.get(key)
+                if isinstance(block, list) and block:
+                    self.fallback = _pick_commission(block[0])
+                    return
+                if isinstance(block, dict):
+                    self.fallback = _pick_commission(block)
+                    return
 
         # Nếu là list -> lấy phần tử đầu
-        if isinstance(raw, list) and raw:
-            rec = raw[0]
-            if isinstance(rec, dict):
-                return {
-                    "sales_ratio": rec.get("sales_ratio") or rec.get("ratio"),
-                    "sales_price": rec.get("sales_price"),
-                    "reward_type": rec.get("reward_type"),
-                    "target_month": rec.get("target_month"),
-                }
+        if isinstance(raw, list) and raw and isinstance(raw[0], dict):
+            self.fallback = _pick_commission(raw[0])
+
+    def lookup(self, it: Dict[str, Any]) -> Dict[str, Any] | None:
+        if self.by_product:
+            pid = _extract_product_id(it)
+            if pid:
+                hit = self.by_product.get(str(pid))
+                if hit is not None:
+                    return hit
+        if self.by_category:
+            cate = it.get("cate") or it.get("category") or it.get("category_id")
+            if cate:
+                hit = self.by_category.get(str(cate))
+                if hit is not None:
+                    return hit
+        if self.fallback is None and self.raw is not None:
+            # Debug: log dữ liệu commission thô để phân tích format thật
+            logger.debug(
+                "Commission raw for %s: %s",
+                it.get("id") or it.get("product_id") or it.get("name"),
+                self.raw,
+            )
+        return self.fallback
 
-        # Debug: log dữ liệu commission thô để phân tích format thật
-        logger.debug(
-            "Commission raw for %s: %s",
-            it.get("id") or it.get("product_id") or it.get("name"),
-            raw,
-        )
 
-        return None
+class _PromotionIndex:
+    """
+    Chuẩn hoá promotion:
+    - Nếu list: ưu tiên record có merchant/cate phù hợp, không có thì lấy phần tử đầu.
+    - Nếu dict: map về các keys chuẩn name/content/start_time/end_time/coupon/link
 
-    def _norm_promotion(raw: Any, it: Dict[str, Any]) -> Dict[str, Any] | None:
-        """
-        Chuẩn hoá promotion:
-        - Nếu list: ưu tiên record có merchant/cate phù hợp, không có thì lấy phần tử đầu.
-        - Nếu dict: map về các keys chuẩn name/content/start_time/end_time/coupon/link
-        """
-        if raw is None:
-            return None
+    Với list, dựng index merchant -> [(categories, promotion_norm)] một lần
+    thay vì quét toàn bộ danh sách cho từng item.
+    """
 
-        def _pick_prom(rec: Dict[str, Any]) -> Dict[str, Any]:
-            return {
-                "name": rec.get("name"),
-                "content": rec.get("content") or rec.get("description"),
-                "start_time": rec.get("start_time"),
-                "end_time": rec.get("end_time"),
-                "coupon": rec.get("coupon"),
-                "link": rec.get("link"),
-            }
+    __slots__ = ("by_merchant", "fallback")
 
+    def __init__(self, raw: Any) -> None:
+        self.by_merchant: Dict[str, List[tuple]] = {}
+        self.fallback: Dict[str, Any] | None = None
         if isinstance(raw, dict):
-            return _pick_prom(raw)
-
-        if isinstance(raw, list) and raw:
-            # cố gắng match theo merchant/category
-            it_merchant = (it.get("merchant") or "").lower()
-            it_cate = it.get("cate") or it.get("category") or it.get("category_id")
-            # ưu tiên match merchant
+            self.fallback = _pick_prom(raw)
+        elif isinstance(raw, list) and raw:
             for rec in raw:
-                if (
-                    isinstance(rec, dict)
-                    and (rec.get("merchant") or "").lower() == it_merchant
-                ):
+                if isinstance(rec, dict):
+                    key = (rec.get("merchant") or "").lower()
+                    self.by_merchant.setdefault(key, []).append(
+                        (rec.get("categories"), _pick_prom(rec))
+                    )
+            # không match được -> lấy phần tử đầu tiên
+            if isinstance(raw[0], dict):
+                self.fallback = self.by_merchant[
+                    (raw[0].get("merchant") or "").lower()
+                ][0][1]
+
+    def lookup(self, it: Dict[str, Any]) -> Dict[str, Any] | None:
+        if self.by_merchant:
+            recs = self.by_merchant.get((it.get("merchant") or "").lower())
+            if recs:
+                it_cate = it.get("cate") or it.get("category") or it.get("category_id")
+                for cats, prom in recs:
                     # nếu có categories trong promo, thử match với cate sản phẩm
-                    cats = rec.get("categories")
                     if not cats or (it_cate and it_cate in cats):
-                        return _pick_prom(rec)
-            # không match được -> lấy phần tử đầu tiên
-            first = raw[0]
-            if isinstance(first, dict):
-                return _pick_prom(first)
-        return None
+                        return prom
+        return self.fallback
 
-    # ---- Normalize commission/promotion ----
-    commission_norm = _norm_commission(commission, item)
-    promotion_norm = _norm_promotion(promotion, item)
 
-    # Chuẩn bị extra
-    extra = dict(item)
+def _build_extra(
+    item: Dict[str, Any],
+    commission_norm: Dict[str, Any] | None,
+    promotion_norm: Dict[str, Any] | None,
+) -> Dict[str, Any]:
+    # Giữ nguyên payload gốc (export đọc domain/sku/discount...) nhưng dựng extra
+    # trong một lần thay vì copy rồi gán từng key.
+    update_time_raw = item.get("update_time") or item.get("last_update")
+    norm: Dict[str, Any] = {}
     if commission_norm:
-        extra["commission"] = commission_norm
+        norm["commission"] = commission_norm
     if promotion_norm:
-        extra["promotion"] = promotion_norm
+        norm["promotion"] = promotion_norm
+    return {
+        **item,
+        **norm,
+        # Chuẩn hoá thêm một số trường thường cần khi export
+        "desc": item.get("desc") or item.get("description"),
+        "cate": item.get("cate") or item.get("category") or item.get("category_name"),
+        "shop_name": (
+            item.get("shop_name") or item.get("shop") or item.get("merchant_name")
+        ),
+        # Lưu thêm 'update_time_raw' để API/Export hiển thị thống nhất
+        "update_time_raw": update_time_raw,
+        # Giữ 'update_time' cho tương thích ngược
+        "update_time": update_time_raw,
+    }
 
-    # Chuẩn hoá thêm một số trường thường cần khi export
-    extra["desc"] = item.get("desc") or item.get("description")
-    extra["cate"] = (
-        item.get("cate") or item.get("category") or item.get("category_name")
-    )
-    extra["shop_name"] = (
-        item.get("shop_name") or item.get("shop") or item.get("merchant_name")
-    )
-    # Lưu thêm 'update_time_raw' để API/Export hiển thị thống nhất
-    extra["update_time_raw"] = item.get("update_time") or item.get("last_update")
-    # Giữ 'update_time' cho tương thích ngược
-    extra["update_time"] = extra["update_time_raw"]
+
+def _offer_fields(item: Dict[str, Any], extra_json: str) -> Dict[str, Any]:
+    domain = (item.get("domain") or "").lower()
+    campaign = (item.get("campaign") or "").lower()
+    merchant = (
+        item.get("merchant")
+        or campaign
+        or (domain.split(".")[0] if domain else "")
+        or item.get("shop")
+        or "unknown"
+    ).lower()
+
+    price_val = item.get("price")
+    try:
+        price = float(price_val) if price_val not in (None, "") else None
+    except Exception:
+        price = None
 
     return {
         "source": "accesstrade",
@@ -871,12 +1060,56 @@ def map_at_product_to_offer(
         "affiliate_link_available": bool(
             item.get("aff_link") or item.get("affiliate_url") or item.get("deeplink")
         ),
-        "extra": json.dumps(extra, ensure_ascii=False),
+        "extra": extra_json,
     }
 
 
+def map_at_products_to_offers(
+    items: List[Dict[str, Any]], commission: Any = None, promotion: Any = None
+) -> List[Dict[str, Any]]:
+    """
+    Batch version của map_at_product_to_offer cho một trang sản phẩm dùng chung
+    commission/promotion (cùng campaign/merchant):
+    - index commission (product/category) & promotion (merchant/category) dựng 1 lần
+    Output từng phần tử giống hệt map_at_product_to_offer.
+    """
+    if not items:
+        return []
+    comm_idx = _CommissionIndex(commission)
+    prom_idx = _PromotionIndex(promotion)
+    return [
+        _offer_fields(
+            item,
+            json_codec.dumps(
+                _build_extra(item, comm_idx.lookup(item), prom_idx.lookup(item))
+            ),
+        )
+        for item in items
+    ]
+
+
+def map_at_product_to_offer(
+    item: Dict[str, Any], commission: Any = None, promotion: Any = None
+) -> Dict[str, Any]:
+    """
+    Chuẩn hoá commission & promotion TẠI ĐÂY để export đọc được ngay:
+    - commission_norm: dict có các key: sales_ratio, sales_price, reward_type, target_month
+    - promotion_norm: dict có các key: name, content, start_time, end_time, coupon, link
+
+    Chấp nhận commission/promotion truyền vào là dict hoặc list; tự chọn record phù hợp.
+    """
+    return map_at_products_to_offers([item], commission, promotion)[0]
+
+
 # --- Kiểm tra link sống/chết ---
 async def _check_url_alive(url: str) -> bool:
+    alive, outcome = await _probe_url(url)
+    metrics.LINKCHECK.inc(outcome=outcome)
+    return alive
+
+
+async def _probe_url(url: str) -> tuple[bool, str]:
+    """(alive, outcome) với outcome ∈ alive/dead/error/skipped (cho metrics)."""
     try:
         # Test short-circuit: khi chạy trong môi trường mock hoặc test thì không gọi mạng thật
         import os
@@ -887,7 +1120,7 @@ async def _check_url_alive(url: str) -> bool:
             or os.getenv("TESTING") == "1"
             or os.getenv("FAST_TEST") == "1"
         ):
-            return True
+            return True, "skipped"
         # UA giống trình duyệt để tránh bị chặn HEAD/GET
         headers = {
             "User-Agent": (
@@ -901,15 +1134,14 @@ async def _check_url_alive(url: str) -> bool:
             timeout=timeout, follow_redirects=True, headers=headers
         ) as client:
             resp = await client.head(url)
-            # Chấp nhận 2xx, 3xx, thậm chí 401/403 (nhiều site chặn bot nhưng link vẫn sống)
-            if resp.status_code < 400 or resp.status_code in (401, 403):
-                return True
             if resp.status_code == 405:
                 resp = await client.get(url)
-                return resp.status_code < 400 or resp.status_code in (401, 403)
-            return False
+            # Chấp nhận 2xx, 3xx, thậm chí 401/403 (nhiều site chặn bot nhưng link vẫn sống)
+            if resp.status_code < 400 or resp.status_code in (401, 403):
+                return True, "alive"
+            return False, "dead"
     except Exception as e:
         # Trong môi trường container, nhiều site chặn/timeout -> coi là "không chắc chắn"
         # Để tránh loại nhầm, tạm thời coi là alive (True) nhưng vẫn log để theo dõi
         logger.debug("Check exception: %s -> %s", url, str(e))
-        return True
+        return True, "error"
@@ -1,11 +1,18 @@
 # backend/crud.py
+import logging
 from typing import List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from sqlalchemy import select
 from models import ProductOffer
 from sqlalchemy import delete as sa_delete
+from sqlalchemy.exc import DBAPIError
+import metrics
 import models
 import schemas
+from pagination import keyset_page
+
+logger = logging.getLogger("affiliate_api")
 
 
 # =====================================================
@@ -85,6 +92,14 @@ def get_api_config(db: Session, name: str) -> Optional[models.APIConfig]:
     return db.query(models.APIConfig).filter(models.APIConfig.name == name).first()
 
 
+async def aget_api_config(db: AsyncSession, name: str) -> Optional[models.APIConfig]:
+    """Bản AsyncSession của get_api_config."""
+    res = await db.execute(
+        select(models.APIConfig).where(models.APIConfig.name == name).limit(1)
+    )
+    return res.scalars().first()
+
+
 def get_ingest_policy(db: Session) -> bool:
     """
     Đọc ingest_policy từ DB, mặc định False (API ingest bỏ qua policy; policy chỉ áp dụng cho import Excel).
@@ -140,18 +155,26 @@ def get_policy_flags(db: Session) -> dict:
 def set_policy_flag(db: Session, key: str, value: str | int | bool) -> None:
     """
     Ghi 1 flag vào ingest_policy.model, giữ nguyên các flag còn lại.
+    Đọc-sửa-ghi chuỗi KV nằm trong 1 transaction độc quyền (`_select_for_update`): 2 worker
+    ghi 2 flag khác nhau cùng lúc (vd. linkcheck_cursor và check_urls) không làm mất key của nhau.
     """
-    cfg = get_api_config(db, "ingest_policy")
-    from schemas import APIConfigCreate
+    from sqlalchemy.exc import IntegrityError
 
+    cfg = _select_for_update(
+        db, select(models.APIConfig).where(models.APIConfig.name == "ingest_policy")
+    )
     if not cfg:
-        model = f"{key}={value}"
-        upsert_api_config_by_name(
-            db,
-            APIConfigCreate(
-                name="ingest_policy", base_url="-", api_key="-", model=model
-            ),
+        db.add(
+            models.APIConfig(
+                name="ingest_policy", base_url="-", api_key="-", model=f"{key}={value}"
+            )
         )
+        try:
+            db.commit()
+        except IntegrityError:
+            # worker khác vừa tạo dòng → ghi lại trên dòng đó
+            db.rollback()
+            set_policy_flag(db, key, value)
         return
     s = cfg.model or ""
     # Loại bỏ key cũ
@@ -161,108 +184,449 @@ def set_policy_flag(db: Session, key: str, value: str | int | bool) -> None:
         if p and not p.strip().lower().startswith(f"{key.lower()}=")
     ]
     parts.append(f"{key}={str(value).lower()}")
-    new_model = ";".join(parts)
-    upsert_api_config_by_name(
-        db,
-        APIConfigCreate(
-            name="ingest_policy",
-            base_url=cfg.base_url or "-",
-            api_key=cfg.api_key or "-",
-            model=new_model,
-        ),
-    )
+    cfg.model = ";".join(parts)
+    db.commit()
 
 
-# ---------------- Ingest-refresh mutex (lightweight, best-effort) ----------------
-def _get_policy_model_raw(db: Session) -> str:
-    from typing import cast
-
-    cfg = get_api_config(db, "ingest_policy")
-    # Cast to str for static type checkers; at runtime this is a plain string value
-    if cfg and getattr(cfg, "model", None) is not None:
-        return cast(str, cfg.model)  # type: ignore[return-value]
-    return ""
+# ---------------- Ingest-refresh mutex (bảng ingest_locks, chiếm nguyên tử) ----------------
+def _select_for_update(db: Session, stmt, *, skip_locked: bool = False):
+    """Chạy SELECT trong transaction ghi độc quyền, trả dòng đầu (hoặc None).
 
+    - Postgres: `SELECT ... FOR UPDATE [SKIP LOCKED]` — khoá dòng tới commit/rollback;
+      với skip_locked, dòng đang bị transaction khác giữ trả về None thay vì chờ.
+    - SQLite: không có khoá dòng → `BEGIN IMMEDIATE` giữ khoá ghi của cả DB, các writer
+      khác chờ (busy timeout) tới khi mình commit. Transaction đang mở của session được
+      commit trước để BEGIN có hiệu lực.
+    """
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
 
-def _parse_policy_kv(model_str: str) -> dict[str, str]:
-    out: dict[str, str] = {}
-    try:
-        for part in model_str.split(";"):
-            if not part:
-                continue
-            if "=" not in part:
-                continue
-            k, v = part.split("=", 1)
-            out[k.strip().lower()] = v.strip()
-    except Exception:
-        pass
-    return out
+    dialect = db.get_bind().dialect.name
+    stmt = stmt.execution_options(populate_existing=True)
+    if dialect == "sqlite":
+        db.commit()
+        try:
+            db.execute(text("BEGIN IMMEDIATE"))
+        except OperationalError as e:
+            # Connection dùng chung (StaticPool) đang có transaction → đã tuần tự sẵn
+            if "within a transaction" not in str(e):
+                raise
+        return db.execute(stmt).scalars().first()
+    return db.execute(stmt.with_for_update(skip_locked=skip_locked)).scalars().first()
+
+
+def _lock_row(db: Session, name: str, *, skip_locked: bool = False):
+    """Dòng ingest_locks[name] đã khoá để ghi (tạo dòng trống nếu chưa có)."""
+    from sqlalchemy.exc import IntegrityError
+
+    L = models.IngestLock
+    if db.get(L, name) is None:
+        db.add(L(name=name, ttl=0))
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()  # worker khác vừa tạo
+    return _select_for_update(
+        db, select(L).where(L.name == name), skip_locked=skip_locked
+    )
 
 
 def get_ingest_lock_status(db: Session, name: str = "ingest_refresh") -> dict:
-    """Trả trạng thái khoá ingest định kỳ. Dùng lưu trong api_configs.name=ingest_policy (model là chuỗi KV).
-    Keys:
-      - {name}_lock_owner: chuỗi owner (lowercase)
-      - {name}_lock_ts: epoch giây
-      - {name}_lock_ttl: TTL giây
-    """
-    s = _get_policy_model_raw(db).lower()
-    kv = _parse_policy_kv(s)
-    owner = kv.get(f"{name}_lock_owner") or ""
-    try:
-        ts = int(kv.get(f"{name}_lock_ts") or 0)
-    except Exception:
-        ts = 0
-    try:
-        ttl = int(kv.get(f"{name}_lock_ttl") or 0)
-    except Exception:
-        ttl = 0
+    """Trạng thái khoá: owner (None = trống), ts (lúc chiếm, epoch giây), ttl, expired,
+    heartbeat_at/expires_at (epoch giây; heartbeat đẩy expires_at lên mỗi lần gia hạn)."""
     import time as _time
 
-    expired = False
-    if ts and ttl:
-        expired = (_time.time() - ts) > ttl
-    elif ts and not ttl:
-        # Không có TTL → coi như luôn hết hạn để tránh kẹt khoá
-        expired = True
-    else:
-        expired = True
-    return {"owner": owner or None, "ts": ts, "ttl": ttl, "expired": expired}
+    row = db.get(models.IngestLock, name, populate_existing=True)
+    if row is None or not row.owner:
+        return {
+            "owner": None,
+            "ts": 0,
+            "ttl": 0,
+            "expired": True,
+            "heartbeat_at": None,
+            "expires_at": None,
+        }
+    return {
+        "owner": row.owner,
+        "ts": int(row.acquired_at or 0),
+        "ttl": int(row.ttl or 0),
+        "expired": (row.expires_at or 0) <= _time.time(),
+        "heartbeat_at": row.heartbeat_at,
+        "expires_at": row.expires_at,
+    }
 
 
 def acquire_ingest_lock(db: Session, owner: str, ttl_sec: int, name: str = "ingest_refresh") -> bool:
-    """Cố gắng chiếm khoá. Nếu đang có khoá và chưa hết hạn, trả False. Nếu hết hạn hoặc trống, đặt khoá mới.
-    Lưu ý: best-effort, không đảm bảo nguyên tử tuyệt đối giữa nhiều tiến trình.
+    """Chiếm khoá nếu đang trống hoặc đã hết hạn; ngược lại trả False (kể cả khi cùng owner:
+    khoá không re-entrant, 2 lần gọi trùng X-Worker-Id không chạy chồng nhau).
+    Kiểm tra + ghi nằm trong 1 transaction độc quyền (xem `_select_for_update`), nên 2 worker
+    gọi đồng thời chỉ 1 bên thành công. Người giữ khoá phải `renew_ingest_lock` trước khi hết TTL.
     """
     import time as _time
 
-    st = get_ingest_lock_status(db, name)
-    cur_owner = (st.get("owner") or "").strip().lower()
-    me = (owner or "").strip().lower()
-    if cur_owner and (not st.get("expired")) and cur_owner != me:
+    from sqlalchemy.exc import OperationalError
+
+    t0 = _time.perf_counter()
+    try:
+        row = _lock_row(db, name, skip_locked=True)
+    except OperationalError:
+        # SQLite: hết busy timeout khi chờ khoá ghi → coi như bận
+        row = None
+    now = _time.time()
+    if row is None or (row.owner and (row.expires_at or 0) > now):
+        db.rollback()
+        metrics.LOCK_WAIT_SECONDS.observe(
+            _time.perf_counter() - t0, name=name, outcome="busy"
+        )
         return False
-    # Đặt/ghi đè khoá
-    set_policy_flag(db, f"{name}_lock_owner", me or "")
-    set_policy_flag(db, f"{name}_lock_ts", int(_time.time()))
-    set_policy_flag(db, f"{name}_lock_ttl", max(1, int(ttl_sec or 60)))
+    ttl = max(1, int(ttl_sec or 60))
+    row.owner = owner
+    row.ttl = ttl
+    row.acquired_at = now
+    row.heartbeat_at = now
+    row.expires_at = now + ttl
+    db.commit()
+    metrics.LOCK_WAIT_SECONDS.observe(
+        _time.perf_counter() - t0, name=name, outcome="acquired"
+    )
     return True
 
 
+def renew_ingest_lock(
+    db: Session, owner: str, ttl_sec: int, name: str = "ingest_refresh"
+) -> bool:
+    """Heartbeat: gia hạn khoá thêm ttl_sec. False nếu owner không còn giữ khoá (đã hết hạn
+    và bị worker khác chiếm, hoặc bị admin force release)."""
+    import time as _time
+
+    from sqlalchemy import update
+
+    L = models.IngestLock
+    now = _time.time()
+    ttl = max(1, int(ttl_sec or 60))
+    res = db.execute(
+        update(L)
+        .where(L.name == name, L.owner == owner)
+        .values(ttl=ttl, heartbeat_at=now, expires_at=now + ttl)
+    )
+    db.commit()
+    return res.rowcount == 1
+
+
 def release_ingest_lock(db: Session, owner: str | None = None, name: str = "ingest_refresh") -> bool:
-    """Tháo khoá. Nếu truyền owner, chỉ cho phép khi trùng hoặc khoá đã hết hạn. Không truyền owner → force (dùng cho admin)."""
-    st = get_ingest_lock_status(db, name)
-    cur_owner = (st.get("owner") or "").strip().lower()
+    """Tháo khoá. Nếu truyền owner, chỉ cho phép khi trùng, khoá trống hoặc đã hết hạn.
+    Không truyền owner → force (dùng cho admin)."""
+    import time as _time
+
+    from sqlalchemy import or_, update
+
+    L = models.IngestLock
+    stmt = update(L).where(L.name == name)
     if owner is not None:
-        me = (owner or "").strip().lower()
-        if cur_owner and (not st.get("expired")) and cur_owner != me:
-            return False
-    # Reset bằng cách set owner="", ts=0
-    set_policy_flag(db, f"{name}_lock_owner", "")
-    set_policy_flag(db, f"{name}_lock_ts", 0)
-    set_policy_flag(db, f"{name}_lock_ttl", 0)
+        stmt = stmt.where(
+            or_(L.owner.is_(None), L.owner == owner, L.expires_at <= _time.time())
+        )
+    res = db.execute(
+        stmt.values(
+            owner=None, ttl=0, acquired_at=None, heartbeat_at=None, expires_at=None
+        )
+    )
+    db.commit()
+    if res.rowcount == 1:
+        return True
+    # Chưa từng có dòng khoá → coi như đã trống
+    return db.get(L, name) is None
+
+
+# ---------------- Ingest checkpoints (resume theo phase giữa các lần chạy) ----------------
+def get_ingest_checkpoint(
+    db: Session, name: str, phase: str
+) -> Optional[models.IngestCheckpoint]:
+    return (
+        db.query(models.IngestCheckpoint)
+        .filter(
+            models.IngestCheckpoint.name == name,
+            models.IngestCheckpoint.phase == phase,
+        )
+        .first()
+    )
+
+
+def save_ingest_checkpoint(
+    db: Session,
+    name: str,
+    phase: str,
+    merchant: str | None,
+    page: int | None = None,
+    state: dict | None = None,
+) -> models.IngestCheckpoint:
+    """Ghi con trỏ resume của 1 phase (merchant + trang chạy tiếp ở lần sau)."""
+    import json_codec
+
+    obj = get_ingest_checkpoint(db, name, phase)
+    if not obj:
+        obj = models.IngestCheckpoint(name=name, phase=phase)
+    obj.merchant = merchant
+    obj.page = page
+    obj.state = json_codec.dumps(state) if state else None
+    db.add(obj)
+    db.commit()
+    db.refresh(obj)
+    return obj
+
+
+def clear_ingest_checkpoint(db: Session, name: str, phase: str) -> bool:
+    """Xoá con trỏ khi phase đã chạy hết 1 vòng merchants."""
+    obj = get_ingest_checkpoint(db, name, phase)
+    if not obj:
+        return False
+    db.delete(obj)
+    db.commit()
     return True
 
 
+def list_ingest_checkpoints(db: Session, name: str) -> list[dict]:
+    import json_codec
+
+    rows = (
+        db.query(models.IngestCheckpoint)
+        .filter(models.IngestCheckpoint.name == name)
+        .order_by(models.IngestCheckpoint.phase)
+        .all()
+    )
+    return [
+        {
+            "phase": r.phase,
+            "merchant": r.merchant,
+            "page": r.page,
+            "state": json_codec.loads_dict(r.state),
+            "updated_at": r.updated_at.isoformat() if r.updated_at else None,
+        }
+        for r in rows
+    ]
+
+
+# ---------------- Ingest leases (shard merchants cho nhiều worker/node) ----------------
+def begin_lease_round(db: Session, name: str, shards: int) -> tuple[int, int]:
+    """Chuẩn bị vòng quét cho `name`: tạo đủ lease 0..shards-1 nếu chưa có; nếu mọi shard
+    của vòng hiện tại đã done thì mở vòng mới. Mở vòng là 1 UPDATE có điều kiện round=cur
+    (CAS) nên nhiều worker gọi cùng lúc chỉ mở đúng 1 lần. Trả về (round, shards).
+
+    Đổi số shard chỉ có hiệu lực khi không còn lease nào đang được giữ.
+    """
+    import time as _time
+
+    from sqlalchemy import update
+    from sqlalchemy.exc import IntegrityError
+
+    L = models.IngestLease
+    rows = db.query(L).filter(L.name == name).order_by(L.shard).all()
+    now = _time.time()
+    if rows and rows[0].shards != shards:
+        busy = any(r.status == "running" and (r.expires_at or 0) > now for r in rows)
+        if busy:
+            shards = rows[0].shards
+        else:
+            db.execute(sa_delete(L).where(L.name == name))
+            db.commit()
+            rows = []
+    if not rows:
+        for k in range(max(1, shards)):
+            db.add(L(name=name, shard=k, shards=shards, round=1, status="pending"))
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()  # worker khác vừa tạo cùng lúc
+        rows = db.query(L).filter(L.name == name).all()
+    cur = max(r.round for r in rows)
+    if all(r.status == "done" for r in rows):
+        db.execute(
+            update(L)
+            .where(L.name == name, L.round == cur, L.status == "done")
+            .values(
+                round=cur + 1,
+                status="pending",
+                owner=None,
+                attempts=0,
+                heartbeat_at=None,
+                expires_at=None,
+                finished_at=None,
+                result=None,
+            )
+        )
+        db.commit()
+        cur += 1
+    return cur, rows[0].shards
+
+
+def claim_lease(
+    db: Session, name: str, owner: str, ttl_sec: float, round_no: int
+) -> Optional[models.IngestLease]:
+    """Claim 1 shard của vòng round_no: ưu tiên shard pending, sau đó shard running đã hết
+    hạn heartbeat (work stealing: worker chết thì shard được worker khác nhận lại).
+    Mỗi lần thử là 1 UPDATE ... WHERE <còn claim được> nên không 2 worker nào cùng giữ 1 shard.
+    """
+    import random
+    import time as _time
+
+    from sqlalchemy import and_, or_, update
+
+    L = models.IngestLease
+    now = _time.time()
+    t0 = _time.perf_counter()
+    claimable = or_(
+        L.status == "pending", and_(L.status == "running", L.expires_at < now)
+    )
+    cands = db.execute(
+        select(L.shard, L.status).where(L.name == name, L.round == round_no, claimable)
+    ).all()
+    # shard pending trước; xáo trộn để các worker claim song song ít va nhau
+    random.shuffle(cands)
+    cands.sort(key=lambda c: c.status != "pending")
+    for shard, _ in cands:
+        res = db.execute(
+            update(L)
+            .where(L.name == name, L.shard == shard, L.round == round_no, claimable)
+            .values(
+                status="running",
+                owner=owner,
+                attempts=L.attempts + 1,
+                heartbeat_at=now,
+                expires_at=now + ttl_sec,
+            )
+        )
+        db.commit()
+        if res.rowcount == 1:
+            metrics.LOCK_WAIT_SECONDS.observe(
+                _time.perf_counter() - t0, name=f"lease:{name}", outcome="acquired"
+            )
+            return db.query(L).filter(L.name == name, L.shard == shard).first()
+    metrics.LOCK_WAIT_SECONDS.observe(
+        _time.perf_counter() - t0, name=f"lease:{name}", outcome="none"
+    )
+    return None
+
+
+def _lease_update(db: Session, name: str, shard: int, holder: str, **values) -> bool:
+    """UPDATE lease chỉ khi `holder` vẫn đang giữ nó (CAS theo owner)."""
+    from sqlalchemy import update
+
+    L = models.IngestLease
+    res = db.execute(
+        update(L)
+        .where(
+            L.name == name, L.shard == shard, L.owner == holder, L.status == "running"
+        )
+        .values(**values)
+    )
+    db.commit()
+    return res.rowcount == 1
+
+
+def renew_lease(db: Session, name: str, shard: int, owner: str, ttl_sec: float) -> bool:
+    """Heartbeat: gia hạn lease. False nếu lease đã bị worker khác lấy (hết hạn trước đó)."""
+    import time as _time
+
+    now = _time.time()
+    return _lease_update(
+        db, name, shard, owner, heartbeat_at=now, expires_at=now + ttl_sec
+    )
+
+
+def complete_lease(
+    db: Session, name: str, shard: int, owner: str, result: dict | None = None
+) -> bool:
+    import time as _time
+
+    import json_codec
+
+    return _lease_update(
+        db,
+        name,
+        shard,
+        owner,
+        status="done",
+        finished_at=_time.time(),
+        expires_at=None,
+        result=json_codec.dumps(result) if result else None,
+    )
+
+
+def release_lease(db: Session, name: str, shard: int, owner: str) -> bool:
+    """Trả shard về pending (vd. lỗi giữa chừng) để worker khác nhận ngay."""
+    return _lease_update(
+        db, name, shard, owner, status="pending", owner=None, expires_at=None
+    )
+
+
+def list_leases(db: Session, name: str) -> list[dict]:
+    import json_codec
+
+    rows = (
+        db.query(models.IngestLease)
+        .filter(models.IngestLease.name == name)
+        .order_by(models.IngestLease.shard)
+        .all()
+    )
+    return [
+        {
+            "shard": r.shard,
+            "shards": r.shards,
+            "round": r.round,
+            "status": r.status,
+            "owner": r.owner,
+            "attempts": r.attempts,
+            "heartbeat_at": r.heartbeat_at,
+            "expires_at": r.expires_at,
+            "finished_at": r.finished_at,
+            "result": json_codec.loads_dict(r.result) or None,
+        }
+        for r in rows
+    ]
+
+
+# ---------------- Jobs (tác vụ nền) ----------------
+def create_job(
+    db: Session, job_id: str, job_type: str, params: str | None, worker: str
+) -> models.Job:
+    obj = models.Job(
+        id=job_id, type=job_type, status="queued", params=params, worker=worker
+    )
+    db.add(obj)
+    db.commit()
+    db.refresh(obj)
+    return obj
+
+
+def get_job(db: Session, job_id: str) -> Optional[models.Job]:
+    return db.query(models.Job).filter(models.Job.id == job_id).first()
+
+
+def update_job(db: Session, job_id: str, **fields) -> Optional[models.Job]:
+    obj = get_job(db, job_id)
+    if not obj:
+        return None
+    for k, v in fields.items():
+        setattr(obj, k, v)
+    db.add(obj)
+    db.commit()
+    return obj
+
+
+def list_jobs(
+    db: Session,
+    job_type: str | None = None,
+    status: str | None = None,
+    limit: int = 50,
+) -> List[models.Job]:
+    q = db.query(models.Job)
+    if job_type:
+        q = q.filter(models.Job.type == job_type)
+    if status:
+        q = q.filter(models.Job.status == status)
+    return q.order_by(models.Job.created_at.desc()).limit(limit).all()
+
+
 def list_api_configs(db: Session) -> List[models.APIConfig]:
     return db.query(models.APIConfig).all()
 
@@ -436,6 +800,33 @@ def list_affiliate_templates(db: Session):
     return db.query(models.AffiliateTemplate).all()
 
 
+# Cột tách từ extra lúc ghi (models.ProductOffer) để đọc/lọc không cần parse JSON
+_OFFER_EXTRA_COLS = ("desc", "cate", "shop_name", "update_time_raw")
+
+
+def offer_extra_fields(extra) -> dict:
+    """extra (JSON str | dict) -> giá trị các cột tách từ extra; extra rỗng/hỏng -> toàn None."""
+    import json_codec
+
+    ex = extra if isinstance(extra, dict) else json_codec.loads_dict(extra)
+    vals = {
+        "desc": ex.get("desc"),
+        "cate": ex.get("cate"),
+        "shop_name": ex.get("shop_name"),
+        "update_time_raw": ex.get("update_time_raw") or ex.get("update_time"),
+    }
+    return {
+        k: (None if v in (None, "") else v if isinstance(v, str) else str(v))
+        for k, v in vals.items()
+    }
+
+
+def _set_offer_extra(obj: ProductOffer, extra) -> None:
+    obj.extra = extra
+    for k, v in offer_extra_fields(extra).items():
+        setattr(obj, k, v)
+
+
 # --- THÊM MỚI: upsert offer theo (source, source_id) ---
 def upsert_offer_by_source(db, data: "schemas.ProductOfferCreate"):
     stmt = select(ProductOffer).where(
@@ -444,6 +835,7 @@ def upsert_offer_by_source(db, data: "schemas.ProductOfferCreate"):
     )
     obj = db.execute(stmt).scalars().first()
     if obj:
+        old_price = obj.price
 
         def _set_if_not_blank(attr: str, val):
             # Không ghi đè nếu None hoặc chuỗi rỗng (sau strip)
@@ -492,7 +884,9 @@ def upsert_offer_by_source(db, data: "schemas.ProductOfferCreate"):
             obj.affiliate_link_available = getattr(data, "affiliate_link_available")
         _set_if_not_blank("product_id", getattr(data, "product_id", None))
         if getattr(data, "extra", None) is not None:
-            obj.extra = data.extra
+            _set_offer_extra(obj, data.extra)
+        obj.content_hash = None  # ghi ngoài bulk upsert: hash cũ không còn đúng
+        _record_price_change(db, obj, old_price)
         db.add(obj)
         db.commit()
         db.refresh(obj)
@@ -515,8 +909,10 @@ def upsert_offer_by_source(db, data: "schemas.ProductOfferCreate"):
         affiliate_link_available=getattr(data, "affiliate_link_available", False),
         product_id=getattr(data, "product_id", None),
         extra=data.extra,
+        **offer_extra_fields(data.extra),
     )
     db.add(obj)
+    _record_price_change(db, obj, None)
     db.commit()
     db.refresh(obj)
     return obj
@@ -565,7 +961,8 @@ def _apply_offer_update_fields(obj: ProductOffer, data: "schemas.ProductOfferCre
         obj.affiliate_link_available = getattr(data, "affiliate_link_available")
     _set_if_not_blank("product_id", getattr(data, "product_id", None))
     if getattr(data, "extra", None) is not None:
-        obj.extra = data.extra
+        _set_offer_extra(obj, data.extra)
+    obj.content_hash = None
 
 
 def upsert_offer_for_excel(
@@ -583,7 +980,9 @@ def upsert_offer_for_excel(
         stmt2 = select(ProductOffer).where(ProductOffer.source_id == data.source_id)
         obj = db.execute(stmt2).scalars().first()
     if obj:
+        old_price = obj.price
         _apply_offer_update_fields(obj, data)
+        _record_price_change(db, obj, old_price)
         db.add(obj)
         db.commit()
         db.refresh(obj)
@@ -606,13 +1005,427 @@ def upsert_offer_for_excel(
         affiliate_link_available=getattr(data, "affiliate_link_available", False),
         product_id=getattr(data, "product_id", None),
         extra=data.extra,
+        **offer_extra_fields(data.extra),
     )
     db.add(obj)
+    _record_price_change(db, obj, None)
     db.commit()
     db.refresh(obj)
     return obj
 
 
+# ---- Price history ----
+def _price_changed(old, new) -> bool:
+    return new is not None and (old is None or float(old) != float(new))
+
+
+def _record_price_change(db: Session, obj: ProductOffer, old_price) -> None:
+    """Thêm 1 dòng price_history nếu giá offer đổi so với old_price (chưa commit)."""
+    if not _price_changed(old_price, obj.price):
+        return
+    if obj.id is None:
+        db.flush()
+    db.add(models.PriceHistory(offer_id=obj.id, price=obj.price, currency=obj.currency))
+
+
+def _append_price_history(db: Session, rows: list[dict], ids: dict, at) -> int:
+    """Ghi price_history theo lô (1 INSERT) cho các offer vừa upsert có giá đổi.
+
+    ids: {(source, source_id): offer_id} đã biết; offer mới insert được tra thêm 1 query.
+    """
+    from sqlalchemy import insert
+
+    missing = {r["source_id"] for r in rows if (r["source"], r["source_id"]) not in ids}
+    if missing:
+        for oid, src, sid in db.execute(
+            select(ProductOffer.id, ProductOffer.source, ProductOffer.source_id).where(
+                ProductOffer.source_id.in_(missing)
+            )
+        ):
+            ids[(src, sid)] = oid
+    hist = [
+        {
+            "offer_id": ids[(r["source"], r["source_id"])],
+            "price": r["price"],
+            "currency": r["currency"],
+            "recorded_at": at,
+        }
+        for r in rows
+        if (r["source"], r["source_id"]) in ids
+    ]
+    if hist:
+        db.execute(insert(models.PriceHistory), hist)
+    return len(hist)
+
+
+def get_price_history(db: Session, offer_id: int, since=None) -> list[tuple]:
+    """[(recorded_at, price)] của 1 offer theo thời gian tăng dần (chỉ 2 cột)."""
+    q = select(models.PriceHistory.recorded_at, models.PriceHistory.price).where(
+        models.PriceHistory.offer_id == offer_id,
+        models.PriceHistory.price.is_not(None),
+    )
+    if since is not None:
+        q = q.where(models.PriceHistory.recorded_at >= since)
+    q = q.order_by(models.PriceHistory.recorded_at, models.PriceHistory.id)
+    return [tuple(r) for r in db.execute(q)]
+
+
+def delete_price_history(db: Session, offer_ids) -> None:
+    """Xoá lịch sử giá của các offer sắp bị xoá (FK price_history.offer_id; chưa commit).
+
+    offer_ids: list id hoặc subquery select id.
+    """
+    db.execute(
+        sa_delete(models.PriceHistory).where(
+            models.PriceHistory.offer_id.in_(offer_ids)
+        )
+    )
+
+
+# ---- Bulk upsert (set-based) ----
+# Cột chuỗi: chỉ ghi đè khi giá trị mới không rỗng (sau trim) — giống _set_if_not_blank
+_OFFER_TEXT_COLS = (
+    "title",
+    "url",
+    "affiliate_url",
+    "image_url",
+    "currency",
+    "merchant",
+    "campaign_id",
+    "approval_status",
+    "source_type",
+    "product_id",
+)
+# Cột số/bool/extra: ghi đè khi khác None (0/False vẫn ghi)
+_OFFER_VALUE_COLS = (
+    "price",
+    "eligible_commission",
+    "affiliate_link_available",
+    "extra",
+)
+
+
+def _offer_row(data) -> dict:
+    """ProductOfferCreate | dict -> dict cột của bảng product_offers (giống nhánh insert)."""
+    if hasattr(data, "model_dump"):
+        d = data.model_dump()
+    else:
+        d = dict(data)
+    url = d.get("url")
+    return {
+        "source": d.get("source") or "accesstrade",
+        "source_id": d.get("source_id"),
+        "merchant": d.get("merchant"),
+        "title": d.get("title"),
+        "url": str(url) if url is not None else None,
+        "affiliate_url": d.get("affiliate_url"),
+        "image_url": d.get("image_url"),
+        "price": d.get("price"),
+        "currency": d.get("currency") or "VND",
+        "campaign_id": d.get("campaign_id"),
+        "approval_status": d.get("approval_status"),
+        "eligible_commission": d.get("eligible_commission"),
+        "source_type": d.get("source_type"),
+        "affiliate_link_available": d.get("affiliate_link_available"),
+        "product_id": d.get("product_id"),
+        "extra": d.get("extra"),
+        **offer_extra_fields(d.get("extra")),
+    }
+
+
+def offer_content_hash(row: dict) -> str:
+    """Hash các cột ghi được của 1 payload offer (không gồm updated_at).
+
+    Chuỗi rỗng/None tương đương nhau vì upsert không ghi đè bằng giá trị rỗng.
+    Ghi lại đúng payload đã ghi lần trước là no-op, nên trùng hash -> bỏ qua.
+    """
+    import hashlib
+
+    import json_codec
+
+    vals = []
+    for col in _OFFER_TEXT_COLS:
+        v = row.get(col)
+        vals.append(None if isinstance(v, str) and v.strip() == "" else v)
+    for col in _OFFER_VALUE_COLS:
+        v = row.get(col)
+        vals.append(float(v) if col == "price" and v is not None else v)
+    raw = json_codec.dumps(vals).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def _merge_offer_rows(old: dict, new: dict) -> dict:
+    """Gộp 2 bản ghi trùng key trong cùng batch theo đúng ngữ nghĩa upsert tuần tự."""
+    out = dict(old)
+    for col in _OFFER_TEXT_COLS:
+        v = new.get(col)
+        if v is not None and not (isinstance(v, str) and v.strip() == ""):
+            out[col] = v
+    for col in _OFFER_VALUE_COLS:
+        if new.get(col) is not None:
+            out[col] = new[col]
+    if new.get("extra") is not None:
+        out.update({col: new.get(col) for col in _OFFER_EXTRA_COLS})
+    return out
+
+
+def missing_conflict_target(exc: DBAPIError) -> bool:
+    """Lỗi ON CONFLICT vì DB chưa có unique index khớp khoá (DB cũ chưa migrate xong).
+    Postgres: "no unique or exclusion constraint matching the ON CONFLICT specification";
+    SQLite: "ON CONFLICT clause does not match any PRIMARY KEY or UNIQUE constraint"."""
+    msg = str(getattr(exc, "orig", exc)).lower()
+    return "on conflict" in msg and "constraint" in msg
+
+
+def _offer_upsert_stmt(dialect: str):
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return None
+    from sqlalchemy import case, func
+
+    tbl = ProductOffer.__table__
+    stmt = dialect_insert(tbl)
+    ex = stmt.excluded
+    set_ = {}
+    for col in _OFFER_TEXT_COLS:
+        # CASE WHEN NULLIF(TRIM(excluded.col), '') IS NULL THEN col ELSE excluded.col END
+        set_[col] = case(
+            (func.nullif(func.trim(ex[col]), "").is_(None), tbl.c[col]),
+            else_=ex[col],
+        )
+    for col in _OFFER_VALUE_COLS:
+        set_[col] = func.coalesce(ex[col], tbl.c[col])
+    # Cột tách từ extra đi cùng extra: chỉ ghi khi lô có extra mới
+    for col in _OFFER_EXTRA_COLS:
+        set_[col] = case((ex["extra"].is_(None), tbl.c[col]), else_=ex[col])
+    set_["content_hash"] = ex["content_hash"]
+    set_["seen_run"] = func.coalesce(ex["seen_run"], tbl.c["seen_run"])
+    set_["retired_at"] = None  # offer xuất hiện lại -> hết retired
+    set_["updated_at"] = ex["updated_at"]
+    return stmt.on_conflict_do_update(
+        index_elements=[tbl.c.source, tbl.c.source_id], set_=set_
+    )
+
+
+def _touch_offers(db: Session, where, run_gen: int | None) -> None:
+    """Offer được thấy lại: seen_run=run_gen và bỏ retired, giữ nguyên updated_at."""
+    from sqlalchemy import update
+
+    values = {"retired_at": None, "updated_at": ProductOffer.updated_at}
+    if run_gen is not None:
+        values["seen_run"] = run_gen
+    db.execute(update(ProductOffer).where(where).values(**values))
+
+
+def retire_unseen_offers(
+    db: Session, run_gen: int, campaign_ids, source_type: str = "datafeeds"
+) -> int:
+    """Sweep (soft delete): offer của các campaign đã quét hết feed trong lần chạy run_gen
+    mà không được thấy (seen_run khác run_gen) -> retired_at = now. Trả về số offer."""
+    from datetime import datetime, UTC
+
+    from sqlalchemy import or_, update
+
+    cids = [c for c in set(campaign_ids or ()) if c]
+    if not cids:
+        return 0
+    res = db.execute(
+        update(ProductOffer)
+        .where(
+            ProductOffer.source_type == source_type,
+            ProductOffer.campaign_id.in_(cids),
+            ProductOffer.retired_at.is_(None),
+            or_(ProductOffer.seen_run.is_(None), ProductOffer.seen_run != run_gen),
+        )
+        .values(retired_at=datetime.now(UTC))
+    )
+    db.commit()
+    return int(res.rowcount or 0)
+
+
+def purge_retired_offers(db: Session, older_than, chunk_size: int = 500) -> int:
+    """Xoá hẳn offer retired trước older_than theo từng chunk id (mỗi chunk 1 commit,
+    xoá kèm price_history) để không giữ khoá/transaction dài. Trả về số offer đã xoá."""
+    total = 0
+    while True:
+        ids = (
+            db.execute(
+                select(ProductOffer.id)
+                .where(
+                    ProductOffer.retired_at.is_not(None),
+                    ProductOffer.retired_at < older_than,
+                )
+                .order_by(ProductOffer.id)
+                .limit(max(1, chunk_size))
+            )
+            .scalars()
+            .all()
+        )
+        if not ids:
+            return total
+        delete_price_history(db, ids)
+        db.execute(sa_delete(ProductOffer).where(ProductOffer.id.in_(ids)))
+        db.commit()
+        total += len(ids)
+
+
+def bulk_upsert_offers(
+    db: Session,
+    items,
+    *,
+    match_any_source: bool = False,
+    batch_size: int = 500,
+    run_gen: int | None = None,
+) -> dict:
+    """
+    Upsert theo lô: INSERT ... ON CONFLICT (source, source_id) DO UPDATE (Postgres/SQLite),
+    1 câu lệnh + 1 commit cho mỗi lô thay vì SELECT/commit/refresh từng dòng.
+    - Không ghi đè bằng giá trị rỗng (CASE/NULLIF cho chuỗi, COALESCE cho số/bool/extra).
+    - match_any_source=True: giống upsert_offer_for_excel — nếu source_id đã tồn tại dưới
+      source khác thì cập nhật record đó (ưu tiên source='excel').
+    - Dialect khác hoặc DB chưa có unique index -> fallback upsert từng dòng.
+    - Offer có content_hash trùng hash lưu trong DB bị bỏ qua (không UPDATE, không đổi
+      updated_at); hash lấy cùng query tra key của lô nên không tốn thêm round-trip.
+    - Offer mới hoặc đổi giá được ghi thêm price_history (1 INSERT cho cả lô, cùng commit).
+    - run_gen: đóng dấu seen_run cho mọi offer của lô (kể cả offer không đổi, bằng 1 UPDATE
+      theo id) để retire_unseen_offers quét được offer đã biến mất khỏi feed. Offer được
+      ghi lại luôn bỏ trạng thái retired.
+    Trả về {"inserted": n, "updated": m, "unchanged": k}.
+    """
+    from datetime import datetime, UTC
+
+    rows_all = [_offer_row(it) for it in items]
+    inserted = updated = unchanged = 0
+    dialect = db.get_bind().dialect.name
+    stmt = _offer_upsert_stmt(dialect)
+
+    for start in range(0, len(rows_all), max(1, batch_size)):
+        chunk = rows_all[start : start + max(1, batch_size)]
+        sids = {r["source_id"] for r in chunk if r["source_id"] is not None}
+        existing: dict[str, list[tuple[int, str]]] = {}
+        hashes: dict[tuple, str | None] = {}
+        prices: dict[tuple, float | None] = {}
+        ids: dict[tuple, int] = {}
+        retired: set[tuple] = set()
+        if sids:
+            for oid, src, sid, h, price, retired_at in db.execute(
+                select(
+                    ProductOffer.id,
+                    ProductOffer.source,
+                    ProductOffer.source_id,
+                    ProductOffer.content_hash,
+                    ProductOffer.price,
+                    ProductOffer.retired_at,
+                )
+                .where(ProductOffer.source_id.in_(sids))
+                .order_by(ProductOffer.id)
+            ):
+                existing.setdefault(sid, []).append((oid, src))
+                hashes[(src, sid)] = h
+                prices[(src, sid)] = price
+                ids[(src, sid)] = oid
+                if retired_at is not None:
+                    retired.add((src, sid))
+
+        now = datetime.now(UTC)
+        merged: dict[tuple, dict] = {}
+        loose: list[dict] = []  # source_id NULL: không thể conflict -> luôn insert
+        for r in chunk:
+            if r["source_id"] is None:
+                loose.append(r)
+                continue
+            if match_any_source and r["source_id"] in existing:
+                srcs = [src for _, src in existing[r["source_id"]]]
+                if "excel" in srcs:
+                    r["source"] = "excel"
+                elif r["source"] not in srcs:
+                    r["source"] = srcs[0]
+            key = (r["source"], r["source_id"])
+            merged[key] = _merge_offer_rows(merged[key], r) if key in merged else r
+        rows = []
+        touch: list[
+            int
+        ] = []  # offer không đổi nhưng cần đóng dấu seen_run / bỏ retired
+        for r in list(merged.values()) + loose:
+            key = (r["source"], r["source_id"])
+            r["content_hash"] = offer_content_hash(r)
+            if r["content_hash"] == hashes.get(key):
+                unchanged += 1
+                if run_gen is not None or key in retired:
+                    touch.append(ids[key])
+                continue
+            r["updated_at"] = now
+            r["seen_run"] = run_gen
+            r["retired_at"] = None
+            rows.append(r)
+        if touch:
+            _touch_offers(db, ProductOffer.id.in_(touch), run_gen)
+        if not rows:
+            db.commit()
+            continue
+
+        n_upd = sum(1 for r in rows if (r["source"], r["source_id"]) in hashes)
+
+        if stmt is not None:
+            try:
+                db.execute(stmt, rows)
+                repriced = [
+                    r
+                    for r in rows
+                    if r["source_id"] is not None
+                    and _price_changed(
+                        prices.get((r["source"], r["source_id"])), r["price"]
+                    )
+                ]
+                _append_price_history(db, repriced, ids, now)
+                db.commit()
+                inserted += len(rows) - n_upd
+                updated += n_upd
+                continue
+            except DBAPIError as e:
+                db.rollback()
+                # Chỉ fallback khi thiếu unique index (DB cũ chưa migrate); lỗi khác raise
+                if not missing_conflict_target(e):
+                    raise
+                logger.warning(
+                    "bulk_upsert_offers: thiếu unique index (source, source_id), "
+                    "fallback upsert từng dòng: %s",
+                    getattr(e, "orig", e),
+                )
+                stmt = None
+
+        for r in rows:
+            data = schemas.ProductOfferCreate(
+                **{
+                    k: v
+                    for k, v in r.items()
+                    if k
+                    not in (
+                        "updated_at",
+                        "content_hash",
+                        "seen_run",
+                        "retired_at",
+                        *_OFFER_EXTRA_COLS,
+                    )
+                }
+            )
+            if match_any_source:
+                upsert_offer_for_excel(db, data)
+            else:
+                upsert_offer_by_source(db, data)
+        fallback_sids = {r["source_id"] for r in rows if r["source_id"] is not None}
+        if fallback_sids:
+            _touch_offers(db, ProductOffer.source_id.in_(fallback_sids), run_gen)
+            db.commit()
+        inserted += len(rows) - n_upd
+        updated += n_upd
+
+    return {"inserted": inserted, "updated": updated, "unchanged": unchanged}
+
+
 def list_offers(
     db: Session,
     merchant: str | None = None,
@@ -620,21 +1433,38 @@ def list_offers(
     limit: int = 50,
     source_type: str | None = None,
     exclude_source_types: list[str] | None = None,
+    include_retired: bool = False,
+    cate: str | None = None,
+    shop_name: str | None = None,
+    sort: str = "id",
+    after: tuple | None = None,
 ):
     """
     List product offers with optional filters.
     - merchant: filter by merchant name
+    - cate / shop_name: khớp chính xác cột tách từ extra (có index)
+    - sort / after: thứ tự ổn định (id | updated_at | price, "-" = giảm dần) và vị trí keyset
+      từ pagination.decode_cursor; có `after` thì bỏ qua `skip`
     - source_type: exact match on ProductOffer.source_type
     - exclude_source_types: list of source_types to exclude
+    - include_retired: mặc định ẩn offer đã retired (biến mất khỏi feed)
     """
     q = db.query(models.ProductOffer)
+    if not include_retired:
+        q = q.filter(models.ProductOffer.retired_at.is_(None))
     if merchant:
         q = q.filter(models.ProductOffer.merchant == merchant)
     if source_type:
         q = q.filter(models.ProductOffer.source_type == source_type)
     if exclude_source_types:
         q = q.filter(models.ProductOffer.source_type.notin_(exclude_source_types))
-    return q.offset(skip).limit(limit).all()
+    if cate:
+        q = q.filter(models.ProductOffer.cate == cate)
+    if shop_name:
+        q = q.filter(models.ProductOffer.shop_name == shop_name)
+    return keyset_page(
+        q, models.ProductOffer, sort, after=after, limit=limit, skip=skip
+    )
 
 
 def get_offer_by_id(db: Session, offer_id: int):
@@ -643,6 +1473,10 @@ def get_offer_by_id(db: Session, offer_id: int):
     )
 
 
+async def aget_offer_by_id(db: AsyncSession, offer_id: int):
+    return await db.get(models.ProductOffer, offer_id)
+
+
 def update_offer(db: Session, offer_id: int, data: "schemas.ProductOfferUpdate"):
     obj = get_offer_by_id(db, offer_id)
     if not obj:
@@ -652,9 +1486,14 @@ def update_offer(db: Session, offer_id: int, data: "schemas.ProductOfferUpdate")
         if hasattr(data, "model_dump")
         else data.dict(exclude_unset=True)
     )
+    old_price = obj.price
     for k, v in payload.items():
         if v is not None:
             setattr(obj, k, str(v) if k == "url" else v)
+    if payload.get("extra") is not None:
+        _set_offer_extra(obj, payload["extra"])
+    obj.content_hash = None
+    _record_price_change(db, obj, old_price)
     db.add(obj)
     db.commit()
     db.refresh(obj)
@@ -665,12 +1504,14 @@ def delete_offer(db: Session, offer_id: int):
     obj = get_offer_by_id(db, offer_id)
     if not obj:
         return None
+    delete_price_history(db, [obj.id])
     db.delete(obj)
     db.commit()
     return obj
 
 
 def delete_all_offers(db: Session) -> int:
+    db.execute(sa_delete(models.PriceHistory))
     res = db.execute(sa_delete(models.ProductOffer))
     db.commit()
     return res.rowcount or 0
@@ -690,6 +1531,7 @@ def delete_offers_by_filter(
         q = q.filter(models.ProductOffer.source_type.notin_(exclude_source_types))
     if campaign_id:
         q = q.filter(models.ProductOffer.campaign_id == campaign_id)
+    delete_price_history(db, q.with_entities(models.ProductOffer.id).scalar_subquery())
     # Use SQLAlchemy delete() for efficiency
     res = q.delete(synchronize_session=False)
     db.commit()
@@ -705,6 +1547,48 @@ def get_campaign_by_cid(db: Session, campaign_id: str):
     )
 
 
+_CAMPAIGN_PLACEHOLDERS = {None, "", "API_MISSING", "NO_DATA"}
+
+
+def _norm_user_status(v) -> str | None:
+    """SUCCESSFUL -> APPROVED; uppercase, trim; rỗng -> None."""
+    from ingest_context import normalize_user_status
+
+    return normalize_user_status(v) or None
+
+
+def _campaign_update_values(data: "schemas.CampaignCreate") -> dict:
+    """Giá trị cập nhật cho campaign đã có: chỉ field được set, bỏ placeholder để giữ giá trị DB."""
+    payload = (
+        data.model_dump(exclude_unset=True)
+        if hasattr(data, "model_dump")
+        else data.dict(exclude_unset=True)
+    )
+    for k, v in list(payload.items()):
+        if v in _CAMPAIGN_PLACEHOLDERS:
+            payload.pop(k, None)
+    # Chuẩn hoá trạng thái user_registration_status theo chuẩn mới (SUCCESSFUL -> APPROVED; uppercase, trim)
+    if "user_registration_status" in payload:
+        us = _norm_user_status(payload["user_registration_status"])
+        if us is None:
+            payload.pop("user_registration_status", None)
+        else:
+            payload["user_registration_status"] = us
+    return payload
+
+
+def _campaign_insert_values(data: "schemas.CampaignCreate") -> dict:
+    payload = data.model_dump() if hasattr(data, "model_dump") else data.dict()
+    # Remove placeholders on insert as well
+    for k, v in list(payload.items()):
+        if v in _CAMPAIGN_PLACEHOLDERS:
+            payload[k] = None
+    payload["user_registration_status"] = _norm_user_status(
+        payload.get("user_registration_status")
+    )
+    return payload
+
+
 def upsert_campaign(db: Session, data: "schemas.CampaignCreate"):
     """Upsert campaign but NEVER persist placeholder strings.
 
@@ -712,60 +1596,49 @@ def upsert_campaign(db: Session, data: "schemas.CampaignCreate"):
     - Treat None/""/"API_MISSING"/"NO_DATA" as "no new information" and do not overwrite existing values.
     - Normalize user_registration_status (SUCCESSFUL -> APPROVED; uppercase; skip if empty).
     """
-    PLACEHOLDERS = {None, "", "API_MISSING", "NO_DATA"}
-
     obj = get_campaign_by_cid(db, data.campaign_id)
     if obj:
-        # cập nhật các trường có giá trị
-        payload = (
-            data.model_dump(exclude_unset=True)
-            if hasattr(data, "model_dump")
-            else data.dict(exclude_unset=True)
-        )
-
-        # Drop placeholders to preserve existing DB values
-        for k, v in list(payload.items()):
-            if v in PLACEHOLDERS:
-                payload.pop(k, None)
-
-        # Chuẩn hoá trạng thái user_registration_status theo chuẩn mới (SUCCESSFUL -> APPROVED; uppercase, trim)
-        if "user_registration_status" in payload:
-            us_val = payload.get("user_registration_status")
-            # Không ghi đè bằng None/"" → xoá khỏi payload để giữ nguyên giá trị hiện có trong DB
-            if us_val in (None, ""):
-                payload.pop("user_registration_status", None)
-            else:
-                us = str(us_val).strip().upper()
-                if us == "SUCCESSFUL":
-                    us = "APPROVED"
-                payload["user_registration_status"] = us
-        for k, v in payload.items():
+        for k, v in _campaign_update_values(data).items():
             setattr(obj, k, v)
         db.add(obj)
         db.commit()
         db.refresh(obj)
         return obj
-    payload = data.model_dump() if hasattr(data, "model_dump") else data.dict()
-    # Remove placeholders on insert as well
-    for k, v in list(payload.items()):
-        if v in (None, "", "API_MISSING", "NO_DATA"):
-            payload[k] = None
-    # Chuẩn hoá khi tạo mới
-    if (
-        "user_registration_status" in payload
-        and payload["user_registration_status"] is not None
-    ):
-        us = str(payload["user_registration_status"]).strip().upper()
-        if us == "SUCCESSFUL":
-            us = "APPROVED"
-        payload["user_registration_status"] = us
-    obj = models.Campaign(**payload)
+    obj = models.Campaign(**_campaign_insert_values(data))
     db.add(obj)
     db.commit()
     db.refresh(obj)
     return obj
 
 
+def bulk_upsert_campaigns(
+    db: Session, items: List["schemas.CampaignCreate"], chunk_size: int = 500
+) -> int:
+    """Upsert nhiều campaign cùng luật với `upsert_campaign`, nhưng 1 SELECT ... IN mỗi chunk
+    và 1 commit cho cả lô (thay vì SELECT + COMMIT từng campaign).
+    Trùng campaign_id trong lô: bản sau gộp đè lên bản trước. Trả về số campaign_id đã ghi.
+    """
+    if not items:
+        return 0
+    C = models.Campaign
+    cids = list(dict.fromkeys(str(d.campaign_id) for d in items))
+    rows: dict[str, models.Campaign] = {}
+    for i in range(0, len(cids), max(1, chunk_size)):
+        chunk = cids[i : i + chunk_size]
+        for obj in db.query(C).filter(C.campaign_id.in_(chunk)).all():
+            rows[obj.campaign_id] = obj
+    for data in items:
+        obj = rows.get(str(data.campaign_id))
+        if obj is None:
+            obj = rows[str(data.campaign_id)] = C(**_campaign_insert_values(data))
+            db.add(obj)
+        else:
+            for k, v in _campaign_update_values(data).items():
+                setattr(obj, k, v)
+    db.commit()
+    return len(cids)
+
+
 def list_campaigns(db: Session, status: str | None = None):
     q = db.query(models.Campaign)
     if status:
@@ -920,6 +1793,85 @@ def upsert_commission_policy(db: Session, data: "schemas.CommissionPolicyCreate"
     return obj
 
 
+def bulk_upsert_commission_policies(
+    db: Session, items: List["schemas.CommissionPolicyCreate"], batch_size: int = 500
+) -> int:
+    """Upsert theo lô: INSERT ... ON CONFLICT (campaign_id, COALESCE(reward_type,''),
+    COALESCE(target_month,'')) DO UPDATE — 1 câu lệnh + 1 commit mỗi lô (Postgres/SQLite).
+    - Cùng luật với upsert_commission_policy: không ghi đè bằng None (số 0 vẫn cập nhật).
+    - Trùng khoá trong lô được gộp trước (ON CONFLICT không cho cập nhật 1 dòng 2 lần).
+    - Dialect khác hoặc DB chưa có unique index -> fallback upsert từng dòng.
+    Trả về số policy đã ghi (sau khi gộp trùng).
+    """
+    from datetime import datetime, UTC
+
+    from sqlalchemy import func
+
+    def _blank(v):
+        return None if v is None or (isinstance(v, str) and not v.strip()) else v
+
+    merged: dict[tuple, dict] = {}
+    for it in items:
+        r = it.model_dump() if hasattr(it, "model_dump") else it.dict()
+        r = {k: _blank(v) for k, v in r.items()}
+        r["campaign_id"] = str(r["campaign_id"])
+        key = (r["campaign_id"], r["reward_type"] or "", r["target_month"] or "")
+        prev = merged.get(key)
+        merged[key] = (
+            {k: (v if v is not None else prev.get(k)) for k, v in r.items()}
+            if prev
+            else r
+        )
+    rows = list(merged.values())
+    if not rows:
+        return 0
+
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        dialect_insert = None
+
+    if dialect_insert is not None:
+        tbl = models.CommissionPolicy.__table__
+        stmt = dialect_insert(tbl)
+        ex = stmt.excluded
+        stmt = stmt.on_conflict_do_update(
+            index_elements=models.commission_policy_key(tbl),
+            set_={
+                "sales_ratio": func.coalesce(ex.sales_ratio, tbl.c.sales_ratio),
+                "sales_price": func.coalesce(ex.sales_price, tbl.c.sales_price),
+                "updated_at": ex.updated_at,
+            },
+        )
+        now = datetime.now(UTC)
+        try:
+            for start in range(0, len(rows), max(1, batch_size)):
+                chunk = [
+                    {**r, "updated_at": now}
+                    for r in rows[start : start + max(1, batch_size)]
+                ]
+                db.execute(stmt, chunk)
+                db.commit()
+            return len(rows)
+        except DBAPIError as e:
+            db.rollback()
+            # Chỉ fallback khi thiếu unique index (upsert lại là idempotent); lỗi khác raise
+            if not missing_conflict_target(e):
+                raise
+            logger.warning(
+                "bulk_upsert_commission_policies: thiếu unique index, "
+                "fallback upsert từng dòng: %s",
+                getattr(e, "orig", e),
+            )
+
+    for r in rows:
+        upsert_commission_policy(db, schemas.CommissionPolicyCreate(**r))
+    return len(rows)
+
+
 # ====== Update by ID helpers for Commissions & Promotions ======
 def update_commission_policy_by_id(
     db: Session, cid: int, data: "schemas.CommissionPolicyCreate"
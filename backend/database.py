@@ -1,9 +1,14 @@
 import os
 import sys
-from sqlalchemy import create_engine
+import threading
+import time
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy import inspect, text
 
+import metrics
+
 """
 Database configuration
 Priority:
@@ -44,13 +49,275 @@ if DATABASE_URL.startswith("postgresql"):
         )
         DATABASE_URL = "sqlite:///./test.db"
 
-# SQLite needs special connect_args for thread check
-connect_args = {}
-if DATABASE_URL.startswith("sqlite"):
-    connect_args = {"check_same_thread": False}
+# --- Engine profiles ---
+# Mỗi profile là bộ tham số pool/timeout; chọn bằng DB_PROFILE, ghi đè từng giá trị bằng
+# DB_POOL_SIZE / DB_MAX_OVERFLOW / DB_POOL_RECYCLE / DB_POOL_TIMEOUT / DB_STATEMENT_TIMEOUT_MS.
+# - web: nhiều request ngắn -> pool lớn, chờ connection ngắn, chặn query chạy quá lâu.
+# - worker: job ingest/scheduler -> ít connection, cho phép batch ghi chạy lâu.
+DB_PROFILES: dict[str, dict[str, int]] = {
+    "default": {
+        "pool_size": 5,
+        "max_overflow": 10,
+        "pool_recycle": 1800,
+        "pool_timeout": 30,
+        "statement_timeout_ms": 0,
+    },
+    "web": {
+        "pool_size": 10,
+        "max_overflow": 20,
+        "pool_recycle": 1800,
+        "pool_timeout": 10,
+        "statement_timeout_ms": 30000,
+    },
+    "worker": {
+        "pool_size": 4,
+        "max_overflow": 4,
+        "pool_recycle": 3600,
+        "pool_timeout": 60,
+        "statement_timeout_ms": 0,
+    },
+}
+DB_PROFILE = (os.getenv("DB_PROFILE") or "default").strip().lower()
+# SQLite: chờ khoá ghi tối đa bao lâu trước khi báo "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000") or 5000)
+
+
+def db_profile(name: str | None = None) -> dict[str, int]:
+    """Tham số của profile (mặc định DB_PROFILE) sau khi áp biến môi trường ghi đè."""
+    prof = dict(DB_PROFILES.get((name or DB_PROFILE), DB_PROFILES["default"]))
+    for key in prof:
+        raw = os.getenv("DB_" + key.upper())
+        if raw not in (None, ""):
+            prof[key] = int(raw)
+    return prof
+
+
+def _is_memory_sqlite(url: str) -> bool:
+    if not url.startswith("sqlite"):
+        return False
+    rest = url.split("://", 1)[1] if "://" in url else ""
+    return rest in ("", "/") or ":memory:" in rest or "mode=memory" in rest
+
+
+def _sqlite_exec(dbapi_conn, *stmts: str) -> None:
+    # cursor() có ở cả sqlite3 lẫn adapter aiosqlite của SQLAlchemy
+    cur = dbapi_conn.cursor()
+    try:
+        for sql in stmts:
+            cur.execute(sql)
+    finally:
+        cur.close()
+
+
+def _sqlite_busy_timeout(dbapi_conn, _record) -> None:
+    _sqlite_exec(dbapi_conn, f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT_MS)}")
+
+
+def _sqlite_pragmas(dbapi_conn, _record) -> None:
+    # WAL: đọc không chặn ghi (redirect ghi click song song với ingest); NORMAL đủ an toàn với WAL
+    _sqlite_exec(
+        dbapi_conn,
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT_MS)}",
+    )
+
+
+class PoolWaitStats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.count = 0
+        self.timeouts = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float, outcome: str = "ok") -> None:
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            if outcome == "timeout":
+                self.timeouts += 1
+        metrics.DB_POOL_WAIT_SECONDS.observe(seconds, outcome=outcome)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            avg = self.total / self.count if self.count else 0.0
+            return {
+                "count": self.count,
+                "timeouts": self.timeouts,
+                "avg_ms": round(avg * 1000, 3),
+                "max_ms": round(self.max * 1000, 3),
+            }
+
+
+POOL_WAIT = PoolWaitStats()
+
+
+class _TimedGet:
+    """Mixin đo thời gian chờ lấy connection của pool (hiện ở /health/db và /metrics)."""
+
+    def _do_get(self):
+        t0 = time.perf_counter()
+        outcome = "ok"
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            outcome = "timeout"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - t0, outcome)
+
+
+class TimedQueuePool(_TimedGet, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedGet, AsyncAdaptedQueuePool):
+    pass
+
+
+def _pool_options(url: str, prof: dict, poolclass) -> dict:
+    if _is_memory_sqlite(url):
+        return {}
+    return {
+        "poolclass": poolclass,
+        "pool_size": prof["pool_size"],
+        "max_overflow": prof["max_overflow"],
+        "pool_recycle": prof["pool_recycle"],
+        "pool_timeout": prof["pool_timeout"],
+    }
+
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True, connect_args=connect_args)
+def make_engine(url: str | None = None, profile: str | None = None, **kw):
+    """
+    Tạo engine theo profile.
+    - Postgres: QueuePool có đo thời gian chờ, pool_size/max_overflow/recycle/timeout theo
+      profile, statement_timeout đặt qua options của libpq.
+    - SQLite file: WAL + synchronous=NORMAL + busy_timeout cho mọi connection mới.
+    - SQLite :memory: giữ pool mặc định (1 connection/thread), chỉ đặt busy_timeout.
+    """
+    url = url or DATABASE_URL
+    prof = db_profile(profile)
+    opts: dict = {"pool_pre_ping": True}
+    connect_args: dict = {}
+    if url.startswith("sqlite"):
+        # SQLite needs special connect_args for thread check
+        connect_args = {"check_same_thread": False}
+    opts.update(_pool_options(url, prof, TimedQueuePool))
+    if url.startswith("postgresql") and prof["statement_timeout_ms"] > 0:
+        connect_args["options"] = f"-c statement_timeout={prof['statement_timeout_ms']}"
+    opts["connect_args"] = {**connect_args, **kw.pop("connect_args", {})}
+    opts.update(kw)
+    eng = create_engine(url, **opts)
+    if url.startswith("sqlite"):
+        memory = _is_memory_sqlite(url)
+        event.listen(
+            eng, "connect", _sqlite_busy_timeout if memory else _sqlite_pragmas
+        )
+    return eng
+
+
+def pool_status(eng) -> dict:
+    """Số liệu pool hiện tại (connection đang mượn, overflow, ...) + thời gian chờ lấy connection."""
+    pool = eng.pool
+    out: dict = {"class": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        out.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            overflow=max(0, pool.overflow()),
+            max_overflow=getattr(pool, "_max_overflow", None),
+            timeout=pool.timeout(),
+        )
+    out["wait"] = POOL_WAIT.snapshot()
+    return out
+
+
+def async_database_url(url: str) -> str:
+    """URL sync -> URL driver async: sqlite -> aiosqlite, postgresql -> asyncpg."""
+    scheme, sep, rest = url.partition("://")
+    base = scheme.split("+", 1)[0]
+    if base == "sqlite":
+        return f"sqlite+aiosqlite{sep}{rest}"
+    if base in ("postgresql", "postgres"):
+        return f"postgresql+asyncpg{sep}{rest}"
+    return url
+
+
+def make_async_engine(url: str | None = None, profile: str | None = None, **kw):
+    """
+    AsyncEngine cùng profile với make_engine() cho endpoint `async def` (asyncpg / aiosqlite).
+    Connection asyncpg gắn với event loop tạo ra nó: chỉ dùng trong loop của web server,
+    job nền (loop riêng mỗi job) tiếp tục dùng session sync.
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = async_database_url(url or DATABASE_URL)
+    prof = db_profile(profile)
+    opts: dict = {
+        "pool_pre_ping": True,
+        **_pool_options(url, prof, TimedAsyncQueuePool),
+    }
+    connect_args: dict = {}
+    if url.startswith("sqlite"):
+        connect_args = {"check_same_thread": False}
+    if url.startswith("postgresql") and prof["statement_timeout_ms"] > 0:
+        connect_args["server_settings"] = {
+            "statement_timeout": str(prof["statement_timeout_ms"])
+        }
+    opts["connect_args"] = {**connect_args, **kw.pop("connect_args", {})}
+    opts.update(kw)
+    eng = create_async_engine(url, **opts)
+    if url.startswith("sqlite"):
+        memory = _is_memory_sqlite(url)
+        event.listen(
+            eng.sync_engine,
+            "connect",
+            _sqlite_busy_timeout if memory else _sqlite_pragmas,
+        )
+    return eng
+
+
+engine = make_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Engine profile "worker" cho job nền / ingest chạy off-loop, tạo lười ở lần dùng đầu: không
+# chịu statement_timeout của profile web (sweep/purge/bulk upsert/backfill chạy lâu)
+_worker_sessionmaker = None
+
+
+def worker_session_factory():
+    """sessionmaker cho tác vụ nền (profile worker); dùng lại engine chính nếu tiến trình
+    đã chạy profile worker hoặc DB là SQLite :memory: (engine khác = DB khác)."""
+    global _worker_sessionmaker
+    if _worker_sessionmaker is None:
+        shared = DB_PROFILE == "worker" or _is_memory_sqlite(DATABASE_URL)
+        _worker_sessionmaker = sessionmaker(
+            autocommit=False,
+            autoflush=False,
+            bind=engine if shared else make_engine(DATABASE_URL, profile="worker"),
+        )
+    return _worker_sessionmaker
+
+# Engine async tạo lười ở lần dùng đầu: môi trường thiếu asyncpg/aiosqlite vẫn import được
+_async_sessionmaker = None
+
+
+def async_session_factory():
+    """async_sessionmaker dùng chung của app (engine async theo DATABASE_URL + DB_PROFILE)."""
+    global _async_sessionmaker
+    if _async_sessionmaker is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+
+        _async_sessionmaker = async_sessionmaker(
+            make_async_engine(DATABASE_URL), autoflush=False, expire_on_commit=False
+        )
+    return _async_sessionmaker
 Base = declarative_base()
 
 
@@ -68,6 +335,8 @@ def apply_simple_migrations(engine) -> None:
       - product_id (VARCHAR)
       - extra (TEXT)
       - updated_at (TIMESTAMP WITH TIME ZONE)
+      - content_hash (VARCHAR) — phát hiện offer không đổi khi bulk upsert
+      - seen_run (BIGINT), retired_at (TIMESTAMP) + index — mark-and-sweep offer hết hàng
 
     Notes:
     - CREATE TABLE IF NOT EXISTS is covered by Base.metadata.create_all elsewhere.
@@ -114,6 +383,17 @@ def apply_simple_migrations(engine) -> None:
             statements.append(
                 "ALTER TABLE product_offers ADD COLUMN updated_at TIMESTAMP"
             )
+    if "content_hash" not in cols:
+        statements.append("ALTER TABLE product_offers ADD COLUMN content_hash VARCHAR")
+    if "seen_run" not in cols:
+        statements.append("ALTER TABLE product_offers ADD COLUMN seen_run BIGINT")
+    if "retired_at" not in cols:
+        ts_type = "TIMESTAMPTZ" if engine.dialect.name == "postgresql" else "TIMESTAMP"
+        statements.append(f"ALTER TABLE product_offers ADD COLUMN retired_at {ts_type}")
+        statements.append(
+            "CREATE INDEX IF NOT EXISTS ix_product_offers_retired_at "
+            "ON product_offers (retired_at)"
+        )
 
     # Migrate affiliate_templates: add platform column if missing
     try:
@@ -134,6 +414,9 @@ def apply_simple_migrations(engine) -> None:
             )
 
     with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            # Tạo index/dedupe trên bảng lớn có thể vượt statement_timeout của profile web
+            conn.execute(text("SET LOCAL statement_timeout = 0"))
         # Apply column additions first (if any)
         for sql in statements + statements_tpl:
             try:
@@ -247,3 +530,8 @@ def apply_simple_migrations(engine) -> None:
         except Exception:
             # Non-fatal: cleanup may run on non-existent table or fail safely
             pass
+
+        # Unique (source, source_id) của product_offers: dọn trùng (gộp) + tạo index là bước
+        # migration có phiên bản riêng (migrations._offer_source_key_unique), không chạy ngầm ở đây.
+        # Unique (campaign_id, reward_type, target_month) của commission_policies: tương tự,
+        # bước migration migrations._commission_policy_key_unique.
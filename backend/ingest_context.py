@@ -0,0 +1,482 @@
+"""
+Ngữ cảnh cho 1 lần chạy ingest (per-run memoization).
+
+Các bước enrich (fetch campaign detail + upsert campaign, upsert promotions,
+commission...) chỉ phụ thuộc campaign_id/merchant chứ không phụ thuộc từng
+sản phẩm. `IngestRunContext.once(kind, key, factory)` đảm bảo mỗi (kind, key)
+chỉ chạy factory đúng 1 lần trong lần chạy, kể cả khi nhiều worker cùng hỏi
+một key (worker sau chờ kết quả của worker đầu thay vì gọi API lần nữa).
+
+`CampaignDirectory` nạp bảng campaigns bằng 1 query khi bắt đầu lần chạy để các
+quyết định theo từng item (APPROVED? eligible? merchant?) không cần query DB;
+gọi `refresh(row)` sau mỗi lần `crud.upsert_campaign` để giữ đồng bộ.
+
+`MerchantCursor` là con trỏ resume (merchant + trang) của 1 phase có deadline:
+lần chạy sau bắt đầu từ merchant bị dừng thay vì từ đầu bảng chữ cái.
+
+`MerchantResolver` map merchant -> campaign_id đang chạy (exact, alias, hậu tố, chứa) bằng
+index dựng 1 lần cho cả lần chạy; mọi endpoint ingest dùng chung để kết quả nhất quán.
+
+`SeenKeys` khử trùng key trong 1 lần chạy (set chính xác, quá ngưỡng thì Bloom filter):
+trang datafeeds chồng lấn khi dữ liệu dịch chuyển lúc phân trang không bị map/ghi 2 lần.
+
+`shard_of` chia merchants thành N shard ổn định giữa các tiến trình (crc32, không dùng
+hash() vì bị random hoá theo tiến trình); `LeaseHeartbeat` gia hạn lease của shard
+đang xử lý trong nền (xem crud.claim_lease / renew_lease).
+
+Ví dụ:
+    ctx = IngestRunContext(db, name="datafeeds_all")
+    camp = await ctx.once("campaign_detail", cid, lambda: load_detail(cid))
+    ctx.campaigns.is_approved(cid)
+    ctx.stats()  # {"campaign_detail": {"calls": 1, "hits": 99}}
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import inspect
+import logging
+import math
+import time
+import zlib
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Tuple
+
+logger = logging.getLogger("affiliate_api")
+
+
+def normalize_user_status(value: Any) -> str:
+    """user_registration_status chuẩn hoá: trim + upper, SUCCESSFUL -> APPROVED."""
+    us = str(value or "").strip().upper()
+    return "APPROVED" if us == "SUCCESSFUL" else us
+
+
+@dataclass(frozen=True)
+class CampaignEntry:
+    # Cùng tên thuộc tính với models.Campaign để dùng thay row ở các helper
+    campaign_id: str
+    merchant: str | None
+    status: str | None
+    user_registration_status: str | None  # đã chuẩn hoá; None nếu DB chưa có
+
+
+class CampaignDirectory:
+    """Bản chụp campaigns trong bộ nhớ cho 1 lần chạy ingest."""
+
+    def __init__(self, rows: Iterable[Any] = ()) -> None:
+        self._by_cid: Dict[str, CampaignEntry] = {}
+        for row in rows:
+            self.refresh(row)
+
+    @classmethod
+    def load(cls, db: Any) -> "CampaignDirectory":
+        """1 query duy nhất cho toàn bộ campaigns (chỉ các cột cần cho quyết định)."""
+        import models
+
+        q = db.query(
+            models.Campaign.campaign_id,
+            models.Campaign.merchant,
+            models.Campaign.status,
+            models.Campaign.user_registration_status,
+        )
+        return cls(q.all())
+
+    def refresh(self, row: Any) -> None:
+        """Cập nhật 1 campaign sau khi upsert (row ORM hoặc tuple cùng thứ tự cột)."""
+        if row is None:
+            return
+        if hasattr(row, "campaign_id"):  # ORM Campaign hoặc Row của query cột
+            cid, merchant, status, us = (
+                row.campaign_id,
+                row.merchant,
+                row.status,
+                row.user_registration_status,
+            )
+        else:
+            cid, merchant, status, us = row
+        if not cid:
+            return
+        self._by_cid[str(cid)] = CampaignEntry(
+            campaign_id=str(cid),
+            merchant=merchant,
+            status=status,
+            user_registration_status=normalize_user_status(us) or None,
+        )
+
+    def get(self, cid: Any) -> CampaignEntry | None:
+        return self._by_cid.get(str(cid)) if cid is not None else None
+
+    def __contains__(self, cid: Any) -> bool:
+        return self.get(cid) is not None
+
+    def __len__(self) -> int:
+        return len(self._by_cid)
+
+    def user_status(self, cid: Any) -> str:
+        e = self.get(cid)
+        return (e.user_registration_status or "") if e else ""
+
+    def is_approved(self, cid: Any) -> bool:
+        return self.user_status(cid) == "APPROVED"
+
+    def merchant_for(self, cid: Any) -> str | None:
+        e = self.get(cid)
+        return e.merchant if e else None
+
+    def is_running(self, cid: Any) -> bool:
+        e = self.get(cid)
+        return bool(e and (e.status or "").lower() == "running")
+
+    def eligible(self, cid: Any) -> bool:
+        """Đủ điều kiện hoa hồng: campaign running và user APPROVED."""
+        return self.is_running(cid) and self.is_approved(cid)
+
+
+class MerchantCursor:
+    """Con trỏ resume theo merchant/trang cho 1 phase ingest bị giới hạn thời gian.
+
+    - order(): merchants (sorted) xoay vòng bắt đầu từ merchant dừng ở lần trước, để
+      merchant cuối bảng chữ cái không bị bỏ đói khi ngân sách thời gian luôn hết sớm.
+    - start_page(m): trang chạy tiếp của merchant bị dừng giữa chừng (mặc định 1).
+    - expired(): đã quá deadline (epoch giây) chưa.
+    - done(m) / stopped(m, page) đánh dấu kết quả; state() trả con trỏ cho lần sau,
+      None nếu mọi merchant đã xong (hết 1 vòng).
+    """
+
+    def __init__(
+        self,
+        merchant: str | None = None,
+        pages: Dict[str, int] | None = None,
+        deadline: float | None = None,
+    ) -> None:
+        self.merchant = merchant
+        self.pages = {str(k): int(v) for k, v in (pages or {}).items()}
+        self.deadline = deadline
+        self._order: list[str] = []
+        self._done: set[str] = set()
+        self._stopped: Dict[str, int] = {}
+
+    @classmethod
+    def from_checkpoint(
+        cls, cp: Any, deadline: float | None = None
+    ) -> "MerchantCursor":
+        """Dựng từ models.IngestCheckpoint (hoặc None = chạy từ đầu)."""
+        if cp is None:
+            return cls(deadline=deadline)
+        import json_codec
+
+        pages = dict(json_codec.loads_dict(cp.state).get("pages") or {})
+        if cp.merchant and cp.page:
+            pages.setdefault(cp.merchant, cp.page)
+        return cls(cp.merchant, pages, deadline)
+
+    def order(self, merchants: Iterable[str]) -> list[str]:
+        ms = sorted(set(merchants))
+        if self.merchant:
+            i = bisect_left(ms, self.merchant)
+            ms = ms[i:] + ms[:i]
+        self._order = ms
+        return list(ms)
+
+    def start_page(self, merchant: str) -> int:
+        return max(1, self.pages.get(merchant, 1))
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def done(self, merchant: str) -> None:
+        self._done.add(merchant)
+        self._stopped.pop(merchant, None)
+
+    def stopped(self, merchant: str, page: int) -> None:
+        self._stopped[merchant] = int(page)
+
+    def state(self) -> dict | None:
+        pending = [m for m in self._order if m not in self._done]
+        if not pending:
+            return None
+        pages = {}
+        for m in pending:
+            pg = self._stopped.get(m) or self.pages.get(m)
+            if pg and pg > 1:
+                pages[m] = pg
+        return {
+            "merchant": pending[0],
+            "page": pages.get(pending[0], 1),
+            "pages": pages,
+            "pending": len(pending),
+            "done": len(self._done),
+        }
+
+
+# Slug merchant trong campaigns Accesstrade -> tên merchant dùng khi gọi datafeeds/promotions
+MERCHANT_ALIASES = {"lazadacps": "lazada", "tikivn": "tiki"}
+
+
+def merchant_alias(merchant: str) -> str:
+    return MERCHANT_ALIASES.get(merchant, merchant)
+
+
+class MerchantResolver:
+    """merchant -> campaign_id đang chạy, dựng 1 lần/lần chạy từ {campaign_id: merchant}.
+
+    Thứ tự ưu tiên (giống nhau ở mọi endpoint), thử lần lượt tên gốc rồi alias:
+    1. exact: merchant của campaign trùng tên;
+    2. suffix: merchant của campaign kết thúc bằng tên (vd. "shopee" -> "vn_shopee");
+    3. contains: "_<tên>" rồi "<tên>" nằm trong merchant của campaign.
+    exact/suffix tra dict O(1) (suffix index dựng sẵn từ mọi hậu tố); contains quét 1 lần
+    cho mỗi tên rồi nhớ kết quả. Khi nhiều campaign khớp, campaign đứng trước trong
+    `active` thắng.
+    """
+
+    def __init__(self, active: Dict[str, Any]) -> None:
+        self._exact: Dict[str, str] = {}
+        for cid, m in active.items():
+            key = str(m or "").strip().lower()
+            if key and key not in self._exact:
+                self._exact[key] = str(cid)
+        self._suffix: Dict[str, Tuple[str, str]] = {}
+        for key, cid in self._exact.items():
+            for i in range(1, len(key)):
+                self._suffix.setdefault(key[i:], (key, cid))
+        self._contains: Dict[str, Tuple[str | None, str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._exact)
+
+    def _fuzzy(self, name: str) -> Tuple[str | None, str]:
+        hit = self._suffix.get(name)
+        if hit:
+            return hit[1], f"suffix({hit[0]})"
+        if name not in self._contains:
+            found: Tuple[str | None, str] = (None, "")
+            for needle in (f"_{name}", name):
+                key = next((k for k in self._exact if needle in k), None)
+                if key:
+                    found = (self._exact[key], f"contains({key})")
+                    break
+            self._contains[name] = found
+        return self._contains[name]
+
+    def resolve(self, merchant: str | None) -> Tuple[str | None, str]:
+        """(campaign_id, cách khớp) — (None, "") nếu không campaign nào khớp."""
+        name = str(merchant or "").strip().lower()
+        if not name:
+            return None, ""
+        names = [name] if merchant_alias(name) == name else [name, merchant_alias(name)]
+        for n in names:
+            if n in self._exact:
+                return self._exact[n], "exact"
+        for n in names:
+            cid, how = self._fuzzy(n)
+            if cid:
+                return cid, how
+        return None, ""
+
+    def campaign_for(self, merchant: str | None) -> str | None:
+        return self.resolve(merchant)[0]
+
+
+def shard_of(key: Any, shards: int) -> int:
+    """Shard (0..shards-1) của 1 merchant; giống nhau trên mọi worker/node."""
+    return zlib.crc32(str(key).encode("utf-8")) % max(1, int(shards))
+
+
+class SeenKeys:
+    """
+    Tập key đã thấy trong 1 lần chạy (vd. (merchant, source_id) của datafeeds).
+
+    Tới `exact_max` key dùng set chính xác; vượt ngưỡng thì chuyển sang Bloom filter
+    (bitset + double hashing blake2b, mỗi tầng gấp đôi sức chứa khi đầy) để bộ nhớ
+    không tăng theo số sản phẩm. Ở chế độ Bloom `add()` có thể báo trùng nhầm với xác
+    suất ~`fp_rate`: `exact` = False cho caller biết kết quả chỉ là "có thể trùng".
+    """
+
+    def __init__(self, exact_max: int = 200_000, fp_rate: float = 1e-4) -> None:
+        self.exact_max = max(0, int(exact_max))
+        self.fp_rate = min(0.5, max(1e-9, float(fp_rate)))
+        self.duplicates = 0
+        self._set: set | None = set()
+        self._layers: list[tuple[bytearray, int, int, int]] = []  # (bits, m, k, cap)
+        self._count = 0  # số key trong tầng Bloom cuối
+
+    @property
+    def exact(self) -> bool:
+        return self._set is not None
+
+    def __len__(self) -> int:
+        if self._set is not None:
+            return len(self._set)
+        return sum(cap for _, _, _, cap in self._layers[:-1]) + self._count
+
+    def add(self, key: Hashable) -> bool:
+        """True nếu key mới (đã ghi nhận); False nếu đã thấy (tăng `duplicates`)."""
+        if self._set is not None:
+            if key in self._set:
+                self.duplicates += 1
+                return False
+            self._set.add(key)
+            if len(self._set) > self.exact_max:
+                self._to_bloom()
+            return True
+        h1, h2 = self._hashes(key)
+        if any(self._test(layer, h1, h2) for layer in self._layers):
+            self.duplicates += 1
+            return False
+        cap = self._layers[-1][3]
+        if self._count >= cap:
+            self._grow(cap * 2)
+            self._count = 0
+        self._set_bits(self._layers[-1], h1, h2)
+        self._count += 1
+        return True
+
+    def __contains__(self, key: Hashable) -> bool:
+        if self._set is not None:
+            return key in self._set
+        h1, h2 = self._hashes(key)
+        return any(self._test(layer, h1, h2) for layer in self._layers)
+
+    # --- Bloom ---
+    def _to_bloom(self) -> None:
+        keys, self._set = self._set or set(), None
+        self._grow(max(1024, len(keys) * 4))
+        for key in keys:
+            self._set_bits(self._layers[-1], *self._hashes(key))
+        self._count = len(keys)
+
+    def _grow(self, cap: int) -> None:
+        # m = -n·ln(p)/ln(2)^2, k = m/n·ln(2); mỗi tầng mới chặt hơn để tổng fp ~ fp_rate
+        p = self.fp_rate / (2 ** (len(self._layers) + 1))
+        m = max(64, int(-cap * math.log(p) / (math.log(2) ** 2)))
+        k = max(1, round(m / cap * math.log(2)))
+        self._layers.append((bytearray((m + 7) // 8), m, k, cap))
+
+    @staticmethod
+    def _hashes(key: Hashable) -> Tuple[int, int]:
+        d = hashlib.blake2b(repr(key).encode("utf-8"), digest_size=16).digest()
+        return int.from_bytes(d[:8], "little"), int.from_bytes(d[8:], "little") | 1
+
+    @staticmethod
+    def _set_bits(layer: tuple, h1: int, h2: int) -> None:
+        bits, m, k, _ = layer
+        for i in range(k):
+            j = (h1 + i * h2) % m
+            bits[j >> 3] |= 1 << (j & 7)
+
+    @staticmethod
+    def _test(layer: tuple, h1: int, h2: int) -> bool:
+        bits, m, k, _ = layer
+        for i in range(k):
+            j = (h1 + i * h2) % m
+            if not bits[j >> 3] & (1 << (j & 7)):
+                return False
+        return True
+
+
+class LeaseHeartbeat:
+    """Gọi renew() mỗi `interval` giây trong nền khi đang xử lý 1 shard.
+
+    renew() trả False (hoặc raise) nghĩa là lease đã mất (hết hạn và bị worker khác
+    nhận); `lost` được bật để caller biết kết quả shard có thể bị chạy trùng.
+    Ghi offer là upsert idempotent, nhưng sweep (mark-and-sweep theo thế hệ lần chạy)
+    thì không: hai lần chạy trùng đóng dấu `seen_run` khác nhau lên cùng merchant, nên
+    lần chạy đã mất lease phải bỏ sweep (xem `lease_held` của ingest datafeeds).
+
+        async with LeaseHeartbeat(lambda: crud.renew_lease(...), interval=60) as hb:
+            ...
+        hb.lost
+    """
+
+    def __init__(self, renew: Callable[[], bool], interval: float) -> None:
+        self.renew = renew
+        self.interval = max(0.01, float(interval))
+        self.lost = False
+        self.beats = 0
+        self._task: asyncio.Task | None = None
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                ok = self.renew()
+            except Exception as e:
+                logger.warning("lease heartbeat failed: %s", e)
+                ok = False
+            if not ok:
+                self.lost = True
+                return
+            self.beats += 1
+
+    async def __aenter__(self) -> "LeaseHeartbeat":
+        self._task = asyncio.create_task(self._loop())
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+class IngestRunContext:
+    def __init__(self, db: Any = None, name: str = "ingest") -> None:
+        self.db = db
+        self.name = name
+        # Thế hệ của lần chạy (epoch ms, tăng dần): đóng dấu offer được thấy (seen_run)
+        self.generation = time.time_ns() // 1_000_000
+        self._memo: Dict[Tuple[str, Hashable], Any] = {}
+        self._locks: Dict[Tuple[str, Hashable], asyncio.Lock] = {}
+        self._calls: Dict[str, int] = {}
+        self._hits: Dict[str, int] = {}
+        self._campaigns: CampaignDirectory | None = None
+
+    @property
+    def campaigns(self) -> CampaignDirectory:
+        """Campaign directory, nạp lười (1 query) ở lần truy cập đầu."""
+        if self._campaigns is None:
+            self._campaigns = CampaignDirectory.load(self.db)
+        return self._campaigns
+
+    def has(self, kind: str, key: Hashable) -> bool:
+        return (kind, key) in self._memo
+
+    def get(self, kind: str, key: Hashable, default: Any = None) -> Any:
+        return self._memo.get((kind, key), default)
+
+    def forget(self, kind: str, key: Hashable) -> None:
+        self._memo.pop((kind, key), None)
+
+    async def once(
+        self, kind: str, key: Hashable, factory: Callable[[], Awaitable[Any] | Any]
+    ) -> Any:
+        """Trả kết quả đã memo của (kind, key); lần đầu thì gọi factory().
+
+        Nếu factory raise thì không memo (lần sau sẽ thử lại).
+        """
+        k = (kind, key)
+        if k in self._memo:
+            self._hits[kind] = self._hits.get(kind, 0) + 1
+            return self._memo[k]
+        lock = self._locks.setdefault(k, asyncio.Lock())
+        async with lock:
+            if k in self._memo:
+                self._hits[kind] = self._hits.get(kind, 0) + 1
+                return self._memo[k]
+            self._calls[kind] = self._calls.get(kind, 0) + 1
+            res = factory()
+            if inspect.isawaitable(res):
+                res = await res
+            self._memo[k] = res
+            return res
+
+    def stats(self) -> dict:
+        kinds = sorted(set(self._calls) | set(self._hits))
+        return {
+            kind: {"calls": self._calls.get(kind, 0), "hits": self._hits.get(kind, 0)}
+            for kind in kinds
+        }
@@ -0,0 +1,211 @@
+"""
+Pipeline ingest nhiều stage nối bằng asyncio.Queue có giới hạn (backpressure).
+
+Mỗi stage là một hàm async nhận 1 item và:
+- trả về giá trị -> đẩy sang stage kế tiếp (None = bỏ qua item),
+- hoặc là async generator -> mỗi giá trị yield được đẩy sang stage kế tiếp
+  (dùng cho stage fetch: 1 merchant -> nhiều trang).
+
+Mỗi stage có `concurrency` worker riêng; queue giữa các stage có `queue_size`
+phần tử nên stage nhanh sẽ tự chờ stage chậm (fetch không chạy quá xa write).
+Lỗi của một item chỉ được đếm vào `errors` của stage, không dừng cả pipeline.
+
+Ví dụ:
+    pipe = Pipeline([
+        Stage("fetch", fetch_pages, concurrency=2),
+        Stage("map", map_page),
+        Stage("write", write_batch),
+    ])
+    await pipe.run(merchants)
+    pipe.report()  # thống kê throughput từng stage
+"""
+
+from __future__ import annotations
+
+import asyncio
+import inspect
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterable, Awaitable, Callable, Iterable, List
+
+import metrics
+
+logger = logging.getLogger("affiliate_api")
+
+_DONE = object()  # sentinel báo worker kết thúc
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable[[Any], Awaitable[Any] | AsyncIterable[Any] | Any]
+    concurrency: int = 1
+    # Hàm đếm số "đơn vị" trong 1 output (vd. số sản phẩm trong 1 trang) để báo throughput
+    count: Callable[[Any], int] | None = None
+
+
+@dataclass
+class StageStats:
+    name: str
+    concurrency: int
+    items_in: int = 0
+    items_out: int = 0
+    units_out: int = 0
+    errors: int = 0
+    busy_sec: float = 0.0
+    first_at: float | None = None
+    last_at: float | None = None
+    last_error: str | None = None
+
+    def as_dict(self) -> dict:
+        wall = (
+            (self.last_at - self.first_at)
+            if self.first_at is not None and self.last_at is not None
+            else 0.0
+        )
+        return {
+            "stage": self.name,
+            "concurrency": self.concurrency,
+            "in": self.items_in,
+            "out": self.items_out,
+            "units": self.units_out,
+            "errors": self.errors,
+            "busy_s": round(self.busy_sec, 4),
+            "wall_s": round(wall, 4),
+            # throughput tính trên thời gian stage thực sự hoạt động
+            "units_per_s": round(self.units_out / wall, 2) if wall > 0 else None,
+            "last_error": self.last_error,
+        }
+
+
+@dataclass
+class Pipeline:
+    stages: List[Stage]
+    queue_size: int = 8
+    name: str = "ingest"
+    stats: List[StageStats] = field(init=False)
+    elapsed_sec: float = field(init=False, default=0.0)
+
+    def __post_init__(self) -> None:
+        if not self.stages:
+            raise ValueError("Pipeline cần ít nhất 1 stage")
+        self.stats = [StageStats(s.name, max(1, s.concurrency)) for s in self.stages]
+        self._stopped = False
+
+    def stop(self) -> None:
+        """Ngừng nạp thêm item từ source (các item đang chạy vẫn được xử lý hết)."""
+        self._stopped = True
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped
+
+    async def run(self, source: Iterable[Any] | AsyncIterable[Any]) -> List[dict]:
+        t0 = time.perf_counter()
+        queues = [asyncio.Queue(maxsize=max(1, self.queue_size)) for _ in self.stages]
+        remaining = [max(1, s.concurrency) for s in self.stages]
+
+        async def _emit(idx: int, value: Any) -> None:
+            st = self.stats[idx]
+            st.items_out += 1
+            counter = self.stages[idx].count
+            try:
+                units = counter(value) if counter else 1
+            except Exception:
+                units = 1
+            st.units_out += units
+            metrics.INGEST_ITEMS.inc(units, pipeline=self.name, stage=st.name)
+            if idx + 1 < len(self.stages):
+                await queues[idx + 1].put(value)
+
+        async def _process(idx: int, item: Any) -> None:
+            stage, st = self.stages[idx], self.stats[idx]
+            started = time.perf_counter()
+            if st.first_at is None:
+                st.first_at = started
+            try:
+                res = stage.fn(item)
+                if inspect.isasyncgen(res):
+                    async for out in res:
+                        # không tính thời gian chờ queue downstream vào busy
+                        st.busy_sec += time.perf_counter() - started
+                        if out is not None:
+                            await _emit(idx, out)
+                        started = time.perf_counter()
+                else:
+                    if inspect.isawaitable(res):
+                        res = await res
+                    st.busy_sec += time.perf_counter() - started
+                    started = None
+                    if res is not None:
+                        await _emit(idx, res)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                st.errors += 1
+                st.last_error = f"{type(e).__name__}: {e}"
+                metrics.INGEST_STAGE_ERRORS.inc(pipeline=self.name, stage=st.name)
+                logger.debug("pipeline %s/%s error: %s", self.name, stage.name, e)
+            finally:
+                if started is not None:
+                    st.busy_sec += time.perf_counter() - started
+                st.last_at = time.perf_counter()
+
+        async def _worker(idx: int) -> None:
+            q = queues[idx]
+            while True:
+                item = await q.get()
+                if item is _DONE:
+                    break
+                self.stats[idx].items_in += 1
+                await _process(idx, item)
+            remaining[idx] -= 1
+            if remaining[idx] == 0 and idx + 1 < len(self.stages):
+                for _ in range(remaining[idx + 1]):
+                    await queues[idx + 1].put(_DONE)
+
+        async def _feed() -> None:
+            if hasattr(source, "__aiter__"):
+                async for item in source:  # type: ignore[union-attr]
+                    if self._stopped:
+                        break
+                    await queues[0].put(item)
+            else:
+                for item in source:  # type: ignore[union-attr]
+                    if self._stopped:
+                        break
+                    await queues[0].put(item)
+            for _ in range(remaining[0]):
+                await queues[0].put(_DONE)
+
+        tasks = [asyncio.create_task(_feed())]
+        for idx, stage in enumerate(self.stages):
+            for _ in range(max(1, stage.concurrency)):
+                tasks.append(asyncio.create_task(_worker(idx)))
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            self.elapsed_sec = time.perf_counter() - t0
+        return self.report()
+
+    def report(self) -> List[dict]:
+        return [s.as_dict() for s in self.stats]
+
+
+async def gather_limited(
+    fn: Callable[[Any], Awaitable[Any]], items: Iterable[Any], limit: int = 8
+) -> List[Any]:
+    """asyncio.gather với tối đa `limit` coroutine chạy đồng thời (giữ thứ tự kết quả)."""
+    sem = asyncio.Semaphore(max(1, limit))
+
+    async def _one(x: Any) -> Any:
+        async with sem:
+            return await fn(x)
+
+    return list(await asyncio.gather(*(_one(x) for x in items)))
@@ -0,0 +1,461 @@
+"""
+Job runner in-process cho tác vụ dài (ingest, dọn link chết, import Excel).
+
+- submit() ghi bản ghi vào bảng jobs (status=queued) và trả job_id ngay; HTTP request
+  không phải chờ tác vụ chạy xong (tránh timeout sau Cloudflare, không giữ worker).
+- Job chạy trên ThreadPoolExecutor riêng, mỗi job một event loop + DB session riêng,
+  nên code ingest (httpx async + SQLAlchemy sync) không chặn event loop của API.
+- Giới hạn đồng thời theo loại job (JOB_LIMITS, override bằng env JOB_LIMIT_<TYPE>);
+  job vượt giới hạn nằm trong hàng đợi của loại đó, không chiếm thread.
+- Trong job: report(**progress) ghi tiến độ, partial(key, value) ghi kết quả từng phần,
+  cancelled() kiểm tra cờ huỷ. Ngoài job các hàm này không làm gì.
+- cancel(job_id): job đang chờ bị huỷ ngay; job đang chạy bị cancel task asyncio tại
+  điểm await kế tiếp, kết quả từng phần vẫn được giữ lại.
+- Heartbeat (thread nền mỗi JOB_HEARTBEAT_SEC): gia hạn updated_at của job tiến trình này
+  giữ và đọc cờ cancel_requested, nên cancel gửi tới worker khác vẫn có hiệu lực. Job
+  queued/running không có heartbeat quá JOB_STALE_SEC bị đánh dấu interrupted.
+
+Giới hạn đồng thời áp dụng trong 1 tiến trình (mỗi worker uvicorn có runner riêng).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import inspect
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, UTC, timedelta
+from typing import Any, Awaitable, Callable, ContextManager, Deque, Dict
+
+import json_codec
+
+logger = logging.getLogger("affiliate_api")
+
+# Số job chạy đồng thời tối đa theo loại; loại không khai báo dùng DEFAULT_LIMIT
+JOB_LIMITS: Dict[str, int] = {
+    "ingest_refresh": 1,
+    "ingest": 2,
+    "offers_cleanup": 1,
+    "excel_import": 1,
+}
+DEFAULT_LIMIT = 1
+
+TERMINAL = ("succeeded", "failed", "cancelled")
+
+# Ghi progress xuống DB tối đa 1 lần / khoảng này (giây)
+_FLUSH_INTERVAL = 1.0
+
+# Chu kỳ heartbeat (giây) và tuổi heartbeat (giây) để coi job là mồ côi (worker đã chết,
+# kể cả container tạo lại với hostname mới nên không so được hostname:pid)
+JOB_HEARTBEAT_SEC = float(os.getenv("JOB_HEARTBEAT_SEC", "10") or 10)
+JOB_STALE_SEC = float(os.getenv("JOB_STALE_SEC", "300") or 300)
+
+_current: contextvars.ContextVar["_JobHandle | None"] = contextvars.ContextVar(
+    "current_job", default=None
+)
+
+
+def _worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _encode(obj: Any) -> str | None:
+    if obj is None:
+        return None
+    try:
+        return json_codec.dumps(obj)
+    except TypeError:
+        from fastapi.encoders import jsonable_encoder
+
+        return json_codec.dumps(jsonable_encoder(obj))
+
+
+def _error_text(e: BaseException) -> str:
+    detail = getattr(e, "detail", None)  # HTTPException
+    if detail is not None:
+        code = getattr(e, "status_code", None)
+        return _encode({"status_code": code, "detail": detail}) or str(e)
+    return f"{type(e).__name__}: {e}"
+
+
+class _JobHandle:
+    def __init__(self, runner: "JobRunner", job_id: str, job_type: str) -> None:
+        self.runner = runner
+        self.id = job_id
+        self.type = job_type
+        self.progress: Dict[str, Any] = {}
+        self.partial: Dict[str, Any] = {}
+        self.cancel_event = threading.Event()
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.task: asyncio.Task | None = None
+        self._last_flush = 0.0
+
+    def flush(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._last_flush < _FLUSH_INTERVAL:
+            return
+        self._last_flush = now
+        self.runner._update(
+            self.id,
+            progress=_encode(self.progress),
+            result=_encode(self.partial) if self.partial else None,
+        )
+
+
+def current_job_id() -> str | None:
+    h = _current.get()
+    return h.id if h else None
+
+
+def report(**progress: Any) -> None:
+    """Cập nhật tiến độ của job hiện tại (no-op nếu không chạy trong job)."""
+    h = _current.get()
+    if h is None:
+        return
+    h.progress.update(progress)
+    h.progress["updated_at"] = datetime.now(UTC).isoformat()
+    try:
+        h.flush()
+    except Exception as e:  # không để lỗi ghi progress làm hỏng job
+        logger.debug("job %s: flush progress failed: %s", h.id, e)
+
+
+def partial(key: str, value: Any) -> None:
+    """Ghi kết quả từng phần (vd. kết quả từng phase) cho job hiện tại."""
+    h = _current.get()
+    if h is None:
+        return
+    h.partial[key] = value
+    try:
+        h.flush(force=True)
+    except Exception as e:
+        logger.debug("job %s: flush partial failed: %s", h.id, e)
+
+
+def cancelled() -> bool:
+    """Job hiện tại đã được yêu cầu huỷ (kể cả từ worker khác, qua heartbeat)."""
+    h = _current.get()
+    return bool(h and h.cancel_event.is_set())
+
+
+class JobRunner:
+    def __init__(
+        self,
+        session_factory: Callable[[], ContextManager[Any]],
+        limits: Dict[str, int] | None = None,
+        max_workers: int | None = None,
+    ) -> None:
+        self._session = session_factory
+        self.limits = dict(JOB_LIMITS)
+        self.limits.update(limits or {})
+        for key, val in os.environ.items():
+            if key.startswith("JOB_LIMIT_"):
+                try:
+                    self.limits[key[len("JOB_LIMIT_") :].lower()] = max(1, int(val))
+                except ValueError:
+                    pass
+        workers = (
+            max_workers
+            or int(os.getenv("JOB_WORKERS", "0") or 0)
+            or sum(self.limits.values())
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, workers), thread_name_prefix="job"
+        )
+        self._lock = threading.Lock()
+        self._running: Dict[str, int] = {}
+        self._pending: Dict[str, Deque[tuple[_JobHandle, Callable]]] = {}
+        self._handles: Dict[str, _JobHandle] = {}
+        self.worker = _worker_id()
+        self._started = datetime.now(UTC)
+        self._stop = threading.Event()
+        self._heartbeat_thread: threading.Thread | None = None
+
+    # ---- DB helpers ----
+    def _update(self, job_id: str, **fields: Any) -> None:
+        import crud
+
+        with self._session() as db:
+            crud.update_job(db, job_id, **fields)
+
+    def limit_for(self, job_type: str) -> int:
+        return max(1, int(self.limits.get(job_type, DEFAULT_LIMIT)))
+
+    # ---- API ----
+    def submit(
+        self,
+        job_type: str,
+        fn: Callable[[Any], Awaitable[Any] | Any],
+        params: Any = None,
+    ) -> dict:
+        """Đăng ký job; fn(db) chạy nền với DB session riêng. Trả dict job (queued)."""
+        import crud
+
+        job_id = uuid.uuid4().hex
+        with self._session() as db:
+            crud.create_job(db, job_id, job_type, _encode(params), self.worker)
+        handle = _JobHandle(self, job_id, job_type)
+        self.start()
+        with self._lock:
+            self._handles[job_id] = handle
+            if self._running.get(job_type, 0) < self.limit_for(job_type):
+                self._running[job_type] = self._running.get(job_type, 0) + 1
+                self._executor.submit(self._run, handle, fn)
+            else:
+                self._pending.setdefault(job_type, deque()).append((handle, fn))
+        return self.get(job_id) or {"id": job_id, "type": job_type, "status": "queued"}
+
+    def get(self, job_id: str) -> dict | None:
+        import crud
+
+        with self._session() as db:
+            row = crud.get_job(db, job_id)
+            if not row:
+                return None
+            out = self.to_dict(row)
+        h = self._handles.get(job_id)
+        if h is not None and out["status"] == "running":
+            # tiến độ mới nhất trong bộ nhớ (DB chỉ được ghi theo chu kỳ)
+            out["progress"] = dict(h.progress)
+            if h.partial:
+                out["result"] = dict(h.partial)
+        return out
+
+    def list(
+        self, job_type: str | None = None, status: str | None = None, limit: int = 50
+    ) -> list[dict]:
+        import crud
+
+        with self._session() as db:
+            return [
+                self.to_dict(r, brief=True)
+                for r in crud.list_jobs(db, job_type, status, limit)
+            ]
+
+    def cancel(self, job_id: str) -> dict | None:
+        import crud
+
+        with self._session() as db:
+            row = crud.get_job(db, job_id)
+            if not row:
+                return None
+            if row.status in TERMINAL:
+                return self.to_dict(row)
+            crud.update_job(db, job_id, cancel_requested=True)
+        # Job của worker khác: worker đó đọc cờ ở heartbeat kế tiếp
+        h = self._handles.get(job_id)
+        if h is not None:
+            self._cancel_local(h)
+        return self.get(job_id)
+
+    def _cancel_local(self, h: _JobHandle) -> None:
+        h.cancel_event.set()
+        with self._lock:
+            q = self._pending.get(h.type)
+            queued = q is not None and any(x[0] is h for x in q)
+            if queued:
+                self._pending[h.type] = deque(x for x in q if x[0] is not h)
+        if queued:
+            self._finish(h, "cancelled")
+        elif h.loop is not None and h.task is not None:
+            h.loop.call_soon_threadsafe(h.task.cancel)
+
+    def heartbeat(self) -> None:
+        """Gia hạn updated_at các job tiến trình này đang giữ và áp cờ cancel_requested
+        (đặt bởi POST /jobs/{id}/cancel rơi vào worker khác)."""
+        import models
+
+        ids = list(self._handles)
+        if not ids:
+            return
+        with self._session() as db:
+            flagged = [
+                job_id
+                for job_id, flag in db.query(models.Job.id, models.Job.cancel_requested)
+                .filter(models.Job.id.in_(ids))
+                .all()
+                if flag
+            ]
+            db.query(models.Job).filter(
+                models.Job.id.in_(ids), models.Job.status.in_(["queued", "running"])
+            ).update({"updated_at": datetime.now(UTC)}, synchronize_session=False)
+            db.commit()
+        for job_id in flagged:
+            h = self._handles.get(job_id)
+            if h is not None and not h.cancel_event.is_set():
+                logger.info("job %s: cancel requested from another worker", job_id)
+                self._cancel_local(h)
+
+    def start(self) -> None:
+        """Chạy thread heartbeat (idempotent; submit() tự gọi)."""
+        with self._lock:
+            if self._heartbeat_thread is not None or self._stop.is_set():
+                return
+            self._heartbeat_thread = threading.Thread(
+                target=self._heartbeat_loop, name="job-heartbeat", daemon=True
+            )
+            self._heartbeat_thread.start()
+
+    def _heartbeat_loop(self) -> None:
+        while not self._stop.wait(JOB_HEARTBEAT_SEC):
+            try:
+                self.heartbeat()
+                self.mark_interrupted()
+            except Exception as e:  # DB tạm lỗi: thử lại chu kỳ sau
+                logger.warning("jobs: heartbeat failed: %s", e)
+
+    def mark_interrupted(self) -> int:
+        """Job queued/running mồ côi -> failed: của tiến trình đã chết trên cùng host, của
+        lần chạy trước của chính tiến trình này, hoặc không có heartbeat quá JOB_STALE_SEC
+        (worker ở host khác / container tạo lại với hostname mới)."""
+        import models
+
+        host = socket.gethostname()
+        now = datetime.now(UTC)
+        cutoff = now - timedelta(seconds=JOB_STALE_SEC)
+        n = 0
+        with self._session() as db:
+            rows = (
+                db.query(models.Job)
+                .filter(models.Job.status.in_(["queued", "running"]))
+                .all()
+            )
+            for r in rows:
+                if r.id in self._handles:
+                    continue
+                w_host, _, pid = (r.worker or "").rpartition(":")
+                created = _aware(r.created_at)
+                exited = (
+                    # cùng hostname:pid nhưng tạo trước runner này: lần chạy trước (restart)
+                    r.worker == self.worker
+                    and created is not None
+                    and created < self._started
+                ) or (
+                    r.worker != self.worker
+                    and w_host == host
+                    and pid.isdigit()
+                    and not _pid_alive(int(pid))
+                )
+                beat = _aware(r.updated_at) or created
+                if exited:
+                    r.error = "interrupted: worker process exited"
+                elif beat is None or beat < cutoff:
+                    r.error = "interrupted: no heartbeat"
+                else:
+                    continue
+                r.status = "failed"
+                r.finished_at = now
+                n += 1
+            db.commit()
+        return n
+
+    def shutdown(self, wait: bool = False) -> None:
+        self._stop.set()
+        for h in list(self._handles.values()):
+            if h.loop is not None and h.task is not None:
+                h.loop.call_soon_threadsafe(h.task.cancel)
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    @staticmethod
+    def to_dict(row: Any, brief: bool = False) -> dict:
+        def _ts(v):
+            return v.isoformat() if v else None
+
+        out = {
+            "id": row.id,
+            "type": row.type,
+            "status": row.status,
+            "cancel_requested": bool(row.cancel_requested),
+            "created_at": _ts(row.created_at),
+            "started_at": _ts(row.started_at),
+            "finished_at": _ts(row.finished_at),
+            "progress": json_codec.loads_dict(row.progress),
+            "error": row.error,
+        }
+        if not brief:
+            out["params"] = json_codec.loads_dict(row.params)
+            out["result"] = json_codec.loads_dict(row.result) or None
+        return out
+
+    # ---- worker ----
+    def _run(self, handle: _JobHandle, fn: Callable) -> None:
+        try:
+            if handle.cancel_event.is_set():
+                self._finish(handle, "cancelled")
+                return
+            self._update(handle.id, status="running", started_at=datetime.now(UTC))
+            try:
+                result = asyncio.run(self._main(handle, fn))
+            except asyncio.CancelledError:
+                self._finish(handle, "cancelled")
+            except BaseException as e:  # noqa: BLE001 - ghi lỗi vào job
+                logger.warning("job %s (%s) failed: %s", handle.id, handle.type, e)
+                self._finish(handle, "failed", error=_error_text(e))
+            else:
+                self._finish(handle, "succeeded", result=result)
+        except Exception as e:  # lỗi ghi DB trạng thái: chỉ log
+            logger.error("job %s: runner error: %s", handle.id, e)
+        finally:
+            self._release(handle.type)
+
+    async def _main(self, handle: _JobHandle, fn: Callable) -> Any:
+        handle.loop = asyncio.get_running_loop()
+        handle.task = asyncio.current_task()
+        _current.set(handle)
+        if handle.cancel_event.is_set():
+            raise asyncio.CancelledError()
+        with self._session() as db:
+            res = fn(db)
+            if inspect.isawaitable(res):
+                res = await res
+            return res
+
+    def _finish(
+        self,
+        handle: _JobHandle,
+        status: str,
+        result: Any = None,
+        error: str | None = None,
+    ) -> None:
+        if result is None and handle.partial:
+            result = handle.partial
+        self._update(
+            handle.id,
+            status=status,
+            progress=_encode(handle.progress) if handle.progress else None,
+            result=_encode(result),
+            error=error,
+            finished_at=datetime.now(UTC),
+        )
+        self._handles.pop(handle.id, None)
+
+    def _release(self, job_type: str) -> None:
+        with self._lock:
+            q = self._pending.get(job_type)
+            if q:
+                handle, fn = q.popleft()
+                self._executor.submit(self._run, handle, fn)
+            else:
+                self._running[job_type] = max(0, self._running.get(job_type, 1) - 1)
+
+
+def _aware(dt: datetime | None) -> datetime | None:
+    # SQLite trả datetime naive (đã lưu theo UTC)
+    return dt.replace(tzinfo=UTC) if dt is not None and dt.tzinfo is None else dt
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except Exception:
+        return True
+    return True
@@ -0,0 +1,96 @@
+"""
+JSON codec dùng chung cho backend.
+
+- Dùng orjson nếu có (nhanh hơn nhiều cho extra/log/response), fallback stdlib json.
+- Output hai backend giống nhau: UTF-8 không escape (tương đương ensure_ascii=False),
+  separators gọn (",", ":"), key không phải str được đổi sang str, datetime -> isoformat,
+  numpy scalar -> số Python.
+- Ép dùng stdlib: JSON_CODEC=stdlib (debug/so sánh).
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any
+
+from starlette.responses import JSONResponse
+
+try:  # optional dependency
+    import orjson as _orjson
+except Exception:  # pragma: no cover - môi trường không có orjson
+    _orjson = None
+
+if os.getenv("JSON_CODEC", "").strip().lower() in ("stdlib", "json"):
+    _orjson = None
+
+BACKEND = "orjson" if _orjson is not None else "json"
+
+# orjson.JSONDecodeError là subclass của json.JSONDecodeError (ValueError)
+JSONDecodeError = json.JSONDecodeError
+
+
+def _default(obj: Any) -> Any:
+    """Kiểu không chuẩn JSON thường gặp (pandas/numpy/datetime/Decimal)."""
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    item = getattr(obj, "item", None)  # numpy scalar
+    if callable(item):
+        return item()
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+_STDLIB_ENCODER = json.JSONEncoder(
+    ensure_ascii=False, separators=(",", ":"), default=_default
+)
+
+if _orjson is not None:
+    _OPTS = _orjson.OPT_NON_STR_KEYS | _orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps_bytes(obj: Any) -> bytes:
+        try:
+            return _orjson.dumps(obj, default=_default, option=_OPTS)
+        except (TypeError, _orjson.JSONEncodeError):
+            # int > 64-bit, subclass lạ... -> để stdlib quyết định (giữ hành vi cũ)
+            return _STDLIB_ENCODER.encode(obj).encode("utf-8")
+
+    def dumps(obj: Any) -> str:
+        return dumps_bytes(obj).decode("utf-8")
+
+    def loads(data: str | bytes | bytearray) -> Any:
+        return _orjson.loads(data)
+
+else:
+
+    def dumps(obj: Any) -> str:
+        return _STDLIB_ENCODER.encode(obj)
+
+    def dumps_bytes(obj: Any) -> bytes:
+        return _STDLIB_ENCODER.encode(obj).encode("utf-8")
+
+    def loads(data: str | bytes | bytearray) -> Any:
+        return json.loads(data)
+
+
+def loads_dict(data: str | bytes | None) -> dict:
+    """Decode cột Text chứa JSON object; rỗng/hỏng/không phải dict -> {}."""
+    if not data:
+        return {}
+    try:
+        val = loads(data)
+    except Exception:
+        return {}
+    return val if isinstance(val, dict) else {}
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse render qua codec chung (kiểu ORJSONResponse, có fallback stdlib)."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps_bytes(content)
@@ -4,7 +4,8 @@ import os
 import hmac
 import hashlib
 import base64
-import json
+import uuid
+import json_codec
 import time
 import asyncio
 import sys
@@ -14,7 +15,8 @@ _BACKEND_DIR = os.path.dirname(__file__)
 if _BACKEND_DIR not in sys.path:
     sys.path.append(_BACKEND_DIR)
 from urllib.parse import urlparse, quote_plus, parse_qsl, urlencode, urlunparse
-from typing import Optional, Dict, List, Any, Literal
+from typing import Optional, Dict, List, Any, Literal, Callable
+from contextlib import contextmanager
 
 from fastapi import (
     FastAPI,
@@ -26,29 +28,59 @@ from fastapi import (
     Body,
     Query,
     Header,
+    Response,
 )
 from fastapi.middleware.cors import CORSMiddleware
 from providers import ProviderRegistry, ProviderOps
 from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse
+from json_codec import FastJSONResponse
+import jobs
+import metrics
+import timeseries
+from ingest_context import (
+    CampaignDirectory,
+    IngestRunContext,
+    LeaseHeartbeat,
+    MerchantCursor,
+    MerchantResolver,
+    SeenKeys,
+    merchant_alias,
+    normalize_user_status,
+    shard_of,
+)
 import io
 from fastapi.exceptions import RequestValidationError
 
 from sqlalchemy.orm import Session
-from sqlalchemy import text, or_, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text
 
 from ai_service import suggest_products_with_config
 import models
 import schemas
 import crud
-from database import Base, engine, SessionLocal, apply_simple_migrations
+from database import (
+    Base,
+    engine,
+    SessionLocal,
+    async_session_factory,
+    worker_session_factory,
+    DB_PROFILE,
+    db_profile,
+    pool_status,
+)
+from migrations import run_migrations, migration_status
+from pagination import decode_cursor, keyset_page, next_cursor
 from pydantic import BaseModel, HttpUrl, Field
 from datetime import datetime, UTC, timedelta
 # Only import names used at module level
 from accesstrade_service import (
     fetch_promotions,
     fetch_campaign_detail,
+    fetch_campaign_details,
     fetch_commission_policies,  # NEW
+    pin_active_campaigns,
     _check_url_alive,
 )
 
@@ -116,6 +148,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Cursor trang kế (/offers, /campaigns) để trình duyệt đọc được
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Logger
@@ -125,13 +159,13 @@ if not logger.handlers:
 
 # --- DB init: create tables and apply lightweight migrations (no Alembic here) ---
 Base.metadata.create_all(bind=engine)
-# Ensure older Postgres DBs get new columns added idempotently
+# Migration có phiên bản (schema_version): chỉ chạy bước chưa áp dụng, lần sau là no-op
 try:
-    apply_simple_migrations(engine)
+    run_migrations(engine)
 except Exception:
     # Non-fatal: continue startup even if migration helper fails
     logger = logging.getLogger("affiliate_api")
-    logger.warning("apply_simple_migrations failed during startup", exc_info=True)
+    logger.warning("run_migrations failed during startup", exc_info=True)
 
 
 # Thiết lập mặc định cho policy link-check nếu chưa có trong DB
@@ -163,6 +197,77 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    """AsyncSession (asyncpg/aiosqlite) cho endpoint `async def`: query không chặn event loop."""
+    async with async_session_factory()() as db:
+        yield db
+
+
+@contextmanager
+def _job_db():
+    """DB session riêng cho job nền / _run_off_loop: engine profile worker (không bị
+    statement_timeout của profile web); tôn trọng dependency override khi test."""
+    override = app.dependency_overrides.get(get_db)
+    if override is None:
+        db = worker_session_factory()()
+        try:
+            yield db
+        finally:
+            db.close()
+        return
+    gen = override()
+    db = next(gen)
+    try:
+        yield db
+    finally:
+        gen.close()
+
+
+# Job runner nền cho tác vụ dài (ingest, cleanup, import Excel) — xem jobs.py
+job_runner = jobs.JobRunner(_job_db)
+try:
+    job_runner.mark_interrupted()
+except Exception:
+    logger.warning("jobs: mark_interrupted failed during startup", exc_info=True)
+# Heartbeat ngay từ đầu: job mồ côi của worker/container khác được đánh dấu cả khi
+# tiến trình này chưa nhận job nào
+job_runner.start()
+
+
+async def _run_off_loop(fn):
+    """
+    Chạy `fn(db)` (impl async dùng session sync: ingest, cleanup, import Excel) trên thread
+    riêng với event loop + DB session riêng như job nền, nhưng chờ kết quả trong request.
+    Query sync của impl không còn chặn event loop của web (redirect, request khác).
+    """
+
+    def _runner():
+        with _job_db() as jdb:
+            return asyncio.run(fn(jdb))
+
+    return await asyncio.to_thread(_runner)
+
+
+def _submit_job(job_type: str, params: Any, fn) -> JSONResponse:
+    """Đăng ký job nền, trả 202 + job_id ngay (theo dõi qua GET /jobs/{id})."""
+    job = job_runner.submit(job_type, fn, params)
+    return JSONResponse(
+        status_code=202,
+        content={
+            "ok": True,
+            "job_id": job["id"],
+            "type": job_type,
+            "status": job["status"],
+            "status_url": f"/jobs/{job['id']}",
+        },
+    )
+
+
+_BACKGROUND_QUERY_DESC = (
+    "Chạy nền: trả job_id ngay (HTTP 202), theo dõi tiến độ/huỷ qua /jobs/{id}"
+)
+
+
 # ---------------- Error handlers ----------------
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -205,13 +310,66 @@ def health(db: Session = Depends(get_db)):
         return {"ok": False, "error": str(e)}
 
 
+@app.get(
+    "/health/db",
+    tags=["System 🛠️"],
+    summary="Tình trạng DB: pool connection + cấu hình engine",
+    description=(
+        "Ping DB và trả số liệu pool: connection đang mượn (checked_out), overflow, thời gian chờ lấy "
+        "connection (avg/max, số lần timeout), profile engine (DB_PROFILE) đang dùng.\n"
+        "SQLite: kèm journal_mode/synchronous/busy_timeout hiệu lực (mong đợi wal / 1 / SQLITE_BUSY_TIMEOUT_MS)."
+    ),
+)
+def health_db(db: Session = Depends(get_db)):
+    bind = db.get_bind()
+    info: dict = {
+        "ok": True,
+        "dialect": bind.dialect.name,
+        "profile": DB_PROFILE,
+        "settings": db_profile(),
+    }
+    t0 = time.perf_counter()
+    try:
+        db.execute(text("SELECT 1"))
+        info["ping_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+        if bind.dialect.name == "sqlite":
+            info["sqlite"] = {
+                name: db.execute(text(f"PRAGMA {name}")).scalar()
+                for name in ("journal_mode", "synchronous", "busy_timeout")
+            }
+    except Exception as e:
+        logger.exception("DB health check failed")
+        info.update(ok=False, error=str(e))
+    info["pool"] = pool_status(bind)
+    return info
+
+
+@app.get(
+    "/metrics",
+    tags=["System 🛠️"],
+    summary="Metrics Prometheus (ingest, upstream, DB, link-check)",
+    description=(
+        "Counter/histogram dạng text exposition của Prometheus: latency Accesstrade theo endpoint/status, "
+        "số item fetch/map/write theo pipeline, item bị bỏ qua theo lý do, latency ghi DB, thời gian chờ khoá "
+        "và kết quả link-check.\n"
+        "Chạy nhiều worker: đặt METRICS_MULTIPROC_DIR để số liệu được cộng dồn từ mọi worker."
+    ),
+    response_class=PlainTextResponse,
+)
+def metrics_endpoint():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.get(
     "/health/migrations",
     tags=["System 🛠️"],
     summary="Tình trạng migration nhẹ",
     description=(
-        "Báo cáo nhanh các cột/constraint legacy đã xử lý. \n"
-        "Không dùng Alembic: logic nằm trong apply_simple_migrations()."
+        "Báo cáo nhanh các cột/constraint legacy đã xử lý và phiên bản schema "
+        "(bảng schema_version: current/latest/pending). \n"
+        "Không dùng Alembic: các bước nằm trong backend/migrations.py."
     ),
 )
 def health_migrations(db: Session = Depends(get_db)):
@@ -224,6 +382,10 @@ def health_migrations(db: Session = Depends(get_db)):
     except Exception:
         engine_name = None
     info: dict = {"ok": True, "engine": engine_name}
+    try:
+        info["schema_version"] = migration_status(db.get_bind())
+    except Exception as e:
+        info.update({"ok": False, "schema_version_error": str(e)})
     try:
         # Kiểm tra tồn tại cột platform trong affiliate_templates
         has_platform = False
@@ -499,7 +661,9 @@ def _append_missing_query_params(
 
 def _make_token(affiliate_url: str, ts: Optional[int] = None) -> str:
     payload = {"u": affiliate_url, "ts": ts or int(time.time())}
-    b64 = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+    b64 = (
+        base64.urlsafe_b64encode(json_codec.dumps_bytes(payload)).decode().rstrip("=")
+    )
     sig = hmac.new(AFF_SECRET.encode(), b64.encode(), hashlib.sha256).hexdigest()
     return f"{b64}.{sig}"
 
@@ -511,7 +675,7 @@ def _parse_token(token: str) -> str:
         if not hmac.compare_digest(expect, sig):
             raise ValueError("invalid signature")
         pad = "=" * (-len(b64) % 4)
-        payload = json.loads(base64.urlsafe_b64decode(b64 + pad).decode())
+        payload = json_codec.loads(base64.urlsafe_b64decode(b64 + pad))
         # TTL kiểm tra
         if AFF_TOKEN_TTL_SEC and AFF_TOKEN_TTL_SEC > 0:
             ts = int(payload.get("ts") or 0)
@@ -531,6 +695,7 @@ def _parse_token(token: str) -> str:
     summary="Danh sách link",
     description="Lấy danh sách link tiếp thị từ DB. Hỗ trợ phân trang qua `skip`, `limit`.",
     response_model=list[schemas.AffiliateLinkOut],
+    response_class=FastJSONResponse,
 )
 def read_links(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
     return crud.get_links(db, skip=skip, limit=limit)
@@ -644,6 +809,7 @@ def delete_link(link_id: int, db: Session = Depends(get_db)):
     summary="Danh sách cấu hình API",
     description="Liệt kê toàn bộ cấu hình nhà cung cấp AI/API.",
     response_model=list[schemas.APIConfigOut],
+    response_class=FastJSONResponse,
 )
 def read_api_configs(db: Session = Depends(get_db)):
     return crud.list_api_configs(db)
@@ -752,18 +918,12 @@ async def ai_suggest(query: str, provider: str = "groq", db: Session = Depends(g
     # Giữ nguyên logic gốc
     products = []
     for o in crud.list_offers(db, limit=50):
-        desc = None
-        if o.extra:
-            try:
-                desc = json.loads(o.extra).get("desc")
-            except Exception:
-                pass
         products.append(
             {
                 "name": o.title,
                 "url": o.url,
                 "affiliate_url": o.affiliate_url or o.url,
-                "desc": desc,
+                "desc": o.desc,
             }
         )
     if not products:
@@ -786,18 +946,12 @@ async def ai_test(
     # Giữ nguyên logic gốc
     products = []
     for o in crud.list_offers(db, limit=50):
-        desc = None
-        if o.extra:
-            try:
-                desc = json.loads(o.extra).get("desc")
-            except Exception:
-                pass
         products.append(
             {
                 "name": o.title,
                 "url": o.url,
                 "affiliate_url": o.affiliate_url or o.url,
-                "desc": desc,
+                "desc": o.desc,
             }
         )
     if not products:
@@ -822,6 +976,7 @@ async def ai_test(
         "Khuyến nghị: cấu hình một mẫu cho mỗi cặp (network, platform)."
     ),
     response_model=list[schemas.AffiliateTemplateOut],
+    response_class=FastJSONResponse,
 )
 def list_templates(db: Session = Depends(get_db)):
     return crud.list_affiliate_templates(db)
@@ -877,13 +1032,11 @@ def auto_generate_templates(
     db: Session = Depends(get_db),
 ):
     # 1) Lấy merchants/platform đã APPROVED + running
-    from sqlalchemy import func as _f
-
     campaigns = (
         db.query(models.Campaign)
         .filter(
             models.Campaign.status == "running",
-            _f.upper(_f.trim(models.Campaign.user_registration_status)) == "APPROVED",
+            models.Campaign.user_registration_status == "APPROVED",
         )
         .all()
     )
@@ -1115,6 +1268,7 @@ def redirect_short_link(token: str, db: Session = Depends(get_db)):
     tags=["Affiliate 🎯"],
     summary="Danh sách shortlinks",
     response_model=list[schemas.ShortlinkOut],
+    response_class=FastJSONResponse,
     description="Liệt kê các shortlink đã phát sinh qua /aff/convert (có click_count).",
 )
 def list_shortlinks(
@@ -1210,7 +1364,7 @@ def ingest_web_vitals(batch: WebVitalsBatch, db: Session = Depends(get_db)):
                 url=(m.url[:2048] if m.url else None),
                 referrer=(m.referrer[:2048] if m.referrer else None),
                 session_id=(m.session_id[:64] if m.session_id else None),
-                extra=json.dumps(m.extra) if m.extra else None,
+                extra=json_codec.dumps(m.extra) if m.extra else None,
             )
             # map ts (ms) -> timestamp nếu có
             # (Optional) map ts provided by client -> ignore to avoid Column assignment confusion
@@ -1229,6 +1383,7 @@ def ingest_web_vitals(batch: WebVitalsBatch, db: Session = Depends(get_db)):
     "/metrics/web-vitals",
     tags=["Metrics 📈"],
     response_model=list[schemas.WebVitalOut],
+    response_class=FastJSONResponse,
     summary="Liệt kê Web Vitals",
     description="Truy vấn nhanh các metric đã thu thập (giới hạn 500 bản ghi gần nhất).",
 )
@@ -1259,7 +1414,7 @@ def list_web_vitals(
         extra = None
         if r.extra:
             try:
-                extra = json.loads(r.extra)
+                extra = json_codec.loads(r.extra)
             except Exception:
                 pass
         out.append(
@@ -1330,8 +1485,8 @@ def summary_web_vitals(
         return sorted_vals[f] + (sorted_vals[c] - sorted_vals[f]) * d
 
     summary: dict[str, dict] = {}
-    for name, metrics in bucket.items():
-        values = [m.value for m in metrics if m.value is not None]
+    for name, samples in bucket.items():
+        values = [m.value for m in samples if m.value is not None]
         values.sort()
         count = len(values)
         if count == 0:
@@ -1341,7 +1496,7 @@ def summary_web_vitals(
         p75 = _percentile(values, 0.75)
         p95 = _percentile(values, 0.95)
         ratings = {"good": 0, "needs-improvement": 0, "poor": 0}
-        for m in metrics:
+        for m in samples:
             if m.rating in ratings:
                 ratings[m.rating] += 1
         total_r = sum(ratings.values()) or 1
@@ -1563,6 +1718,15 @@ class IngestAllDatafeedsReq(BaseModel):
     - max_pages: chặn vòng lặp vô hạn nếu API trả bất thường (mặc định 2000 trang)
     - throttle_ms: nghỉ giữa các lần gọi để tôn trọng rate-limit (mặc định 50ms)
     - check_urls: nếu True mới kiểm tra link sống (mặc định False).
+    - fetch_concurrency: số merchant được fetch song song trong pipeline (mặc định 2).
+    - queue_size: số trang tối đa chờ giữa các stage fetch → enrich → map → write (backpressure).
+    - sweep_missing: merchant được quét hết feed (từ trang 1 tới trang cuối, không lỗi) thì
+      retire (soft delete) các offer datafeeds của campaign đó không xuất hiện trong lần chạy.
+    - shards: > 1 thì chia merchants thành N shard (crc32) và quét theo lease trong bảng
+      ingest_leases; gọi song song nhiều lần (nhiều worker/node) để chia tải, shard của
+      worker chết được worker khác nhận lại khi lease hết hạn.
+    - dedup: bỏ item trùng (merchant, source_id) đã gặp ở trang trước trong lần chạy (trang
+      chồng lấn khi dữ liệu dịch chuyển lúc phân trang) trước bước enrich/map/ghi.
     """
 
     params: Dict[str, str] | None = None
@@ -1571,6 +1735,11 @@ class IngestAllDatafeedsReq(BaseModel):
     throttle_ms: int = 50
     check_urls: bool = False
     verbose: bool = False
+    fetch_concurrency: int = Field(2, ge=1, le=16)
+    queue_size: int = Field(4, ge=1, le=64)
+    sweep_missing: bool = True
+    shards: int = Field(1, ge=1, le=256)
+    dedup: bool = True
     model_config = {
         "json_schema_extra": {
             "examples": [
@@ -1595,6 +1764,7 @@ class CampaignsSyncReq(BaseModel):
     - enrich_user_status: lấy user_status thật từ campaign detail (chậm). Mặc định False để nhanh.
     - limit_per_page, page_concurrency, window_pages, throttle_ms: tinh chỉnh tốc độ vs độ ổn định.
     - merchant: nếu truyền sẽ lọc theo merchant sau khi fetch.
+    - detail_concurrency: số campaign detail gọi song song khi enrich user_status.
     """
 
     statuses: List[str] = Field(default_factory=lambda: ["running", "paused"])
@@ -1605,6 +1775,8 @@ class CampaignsSyncReq(BaseModel):
     window_pages: int = 10
     throttle_ms: int = 50
     merchant: str | None = None
+    # Số campaign detail gọi song song khi enrich (vẫn chịu ngân sách AT_MAX_CONCURRENCY)
+    detail_concurrency: int = Field(8, ge=1, le=32)
     model_config = {
         "json_schema_extra": {
             "examples": [
@@ -1647,6 +1819,7 @@ class IngestV2TopProductsReq(BaseModel):
     - max_pages: số trang tối đa sẽ quét
     - throttle_ms: nghỉ giữa các lần gọi
     - check_urls: nếu True mới kiểm tra link sống (mặc định False).
+    - fetch_concurrency / queue_size: tinh chỉnh pipeline như /ingest/datafeeds/all.
     """
 
     merchant: str | None = None
@@ -1657,6 +1830,8 @@ class IngestV2TopProductsReq(BaseModel):
     limit_per_page: int = 100
     max_pages: int = 200
     throttle_ms: int = 50
+    fetch_concurrency: int = Field(2, ge=1, le=16)
+    queue_size: int = Field(4, ge=1, le=64)
     model_config = {
         "json_schema_extra": {
             "examples": [
@@ -1726,15 +1901,6 @@ def campaigns_summary(db: Session = Depends(get_db)):
 
     total = len(rows)
 
-    def _norm_user(us: str | None) -> str | None:
-        if not us:
-            return None
-        u = str(us).strip().upper()
-        # chấp nhận SUCCESSFUL như APPROVED để tương thích nguồn dữ liệu
-        if u == "SUCCESSFUL":
-            return "APPROVED"
-        return u
-
     by_status: dict[str, int] = {}
     by_user_status: dict[str, int] = {}
     running_approved_count = 0
@@ -1744,7 +1910,8 @@ def campaigns_summary(db: Session = Depends(get_db)):
         st_key = status or "NULL"
         by_status[st_key] = by_status.get(st_key, 0) + 1
 
-        eff_user = _norm_user(us)
+        # user_registration_status đã chuẩn hoá khi ghi (crud) và backfill (migration v3)
+        eff_user = us or None
         us_key = eff_user or "NULL"
         by_user_status[us_key] = by_user_status.get(us_key, 0) + 1
 
@@ -1764,6 +1931,47 @@ def campaigns_summary(db: Session = Depends(get_db)):
     }
 
 
+def _detail_user_status(det: dict | None) -> str | None:
+    """user_status của mình từ campaign detail (đã chuẩn hoá), None nếu detail không có."""
+    if not det:
+        return None
+    raw = (
+        det.get("user_registration_status")
+        or det.get("publisher_status")
+        or det.get("user_status")
+    )
+    # Fallback: đôi khi detail chỉ trả 'approval' = successful/pending/unregistered
+    if not raw:
+        appr = det.get("approval")
+        if isinstance(appr, str) and appr.lower() in (
+            "successful",
+            "pending",
+            "unregistered",
+        ):
+            raw = appr
+    if raw in (None, "", []):
+        return None
+    return normalize_user_status(raw) or None
+
+
+def _write_campaigns(db: Session, payloads: list[schemas.CampaignCreate]) -> int:
+    """Ghi cả lô campaign bằng 1 bulk upsert; lỗi thì fallback từng campaign (bỏ qua bản lỗi)."""
+    try:
+        return crud.bulk_upsert_campaigns(db, payloads)
+    except Exception as e:
+        db.rollback()
+        logger.debug("Campaign bulk upsert failed, fallback per row: %s", e)
+    n = 0
+    for p in payloads:
+        try:
+            crud.upsert_campaign(db, p)
+            n += 1
+        except Exception as e:
+            db.rollback()
+            logger.debug("Skip campaign upsert: %s", e)
+    return n
+
+
 @app.post(
     "/campaigns/backfill-user-status",
     tags=["Campaigns 📢"],
@@ -1774,18 +1982,16 @@ def campaigns_summary(db: Session = Depends(get_db)):
         "Lưu ý: Dùng AT_MOCK=1 để chạy ở chế độ mock nếu chưa cấu hình Accesstrade."
     ),
 )
-async def backfill_user_status(limit: int = 200, db: Session = Depends(get_db)):
-    # Helper: normalize user status
-    def _norm(us: str | None) -> str | None:
-        if not us:
-            return None
-        s = str(us).strip().upper()
-        if not s:
-            return None
-        if s == "SUCCESSFUL":
-            return "APPROVED"
-        return s
-
+async def backfill_user_status(
+    limit: int = 200,
+    concurrency: int = Query(
+        8,
+        ge=1,
+        le=32,
+        description="Số campaign detail gọi song song (≤ AT_MAX_CONCURRENCY)",
+    ),
+    db: Session = Depends(get_db),
+):
     def _summary() -> dict:
         rows = db.query(
             models.Campaign.status, models.Campaign.user_registration_status
@@ -1796,7 +2002,7 @@ async def backfill_user_status(limit: int = 200, db: Session = Depends(get_db)):
         for st, us in rows:
             st_key = st or "NULL"
             by_status[st_key] = by_status.get(st_key, 0) + 1
-            eff = _norm(us) or "NULL"
+            eff = us or "NULL"
             by_user[eff] = by_user.get(eff, 0) + 1
         return {"total": total, "by_status": by_status, "by_user_status": by_user}
 
@@ -1804,49 +2010,20 @@ async def backfill_user_status(limit: int = 200, db: Session = Depends(get_db)):
 
     targets = (
         db.query(models.Campaign)
-        .filter(
-            or_(
-                models.Campaign.user_registration_status.is_(None),
-                func.trim(models.Campaign.user_registration_status) == "",
-            )
-        )
+        # status đã chuẩn hoá khi ghi (rỗng -> NULL): lọc thẳng cột để dùng index
+        .filter(models.Campaign.user_registration_status.is_(None))
         .limit(limit)
         .all()
     )
-    fixed = 0
-    for c in targets:
-        try:
-            det = await fetch_campaign_detail(db, c.campaign_id)
-            if not det:
-                continue
-            user_raw = (
-                det.get("user_registration_status")
-                or det.get("publisher_status")
-                or det.get("user_status")
-            )
-            if not user_raw:
-                appr = det.get("approval")
-                if isinstance(appr, str) and appr.lower() in (
-                    "successful",
-                    "pending",
-                    "unregistered",
-                ):
-                    user_raw = (
-                        "APPROVED" if appr.lower() == "successful" else appr.upper()
-                    )
-            eff = _norm(user_raw)
-            if not eff:
-                continue
-            crud.upsert_campaign(
-                db,
-                schemas.CampaignCreate(
-                    campaign_id=str(c.campaign_id),
-                    user_registration_status=eff,
-                ),
-            )
-            fixed += 1
-        except Exception:
-            continue
+    details = await fetch_campaign_details(
+        db, [c.campaign_id for c in targets], concurrency=concurrency
+    )
+    payloads = [
+        schemas.CampaignCreate(campaign_id=cid, user_registration_status=eff)
+        for cid, det in details.items()
+        if (eff := _detail_user_status(det))
+    ]
+    fixed = _write_campaigns(db, payloads)
 
     after = _summary()
     return {"fixed": fixed, "before": before, "after": after}
@@ -1855,14 +2032,48 @@ async def backfill_user_status(limit: int = 200, db: Session = Depends(get_db)):
 # Legacy maintenance endpoints removed; project uses the new standard exclusively.
 
 
-@app.get("/campaigns", response_model=list[schemas.CampaignOut], tags=["Campaigns 📢"])
+def _decode_cursor_or_400(cursor: str | None, sort: str):
+    if not cursor:
+        return None
+    try:
+        return decode_cursor(cursor, sort)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _set_next_cursor(response: Response, rows, sort: str, limit: int | None) -> None:
+    token = next_cursor(rows, sort, limit)
+    if token:
+        response.headers["X-Next-Cursor"] = token
+
+
+@app.get(
+    "/campaigns",
+    response_model=list[schemas.CampaignOut],
+    response_class=FastJSONResponse,
+    tags=["Campaigns 📢"],
+)
 def list_campaigns_api(
+    response: Response,
     status: str | None = None,
     approval: str | None = None,
     user_status: str | None = None,
     merchant: str | None = None,
+    limit: int | None = Query(
+        None, ge=1, le=1000, description="Số campaign mỗi trang (mặc định: tất cả)"
+    ),
+    cursor: str | None = Query(
+        None, description="Cursor từ header X-Next-Cursor của trang trước"
+    ),
+    sort: Literal["-updated_at", "updated_at", "id", "-id"] = "-updated_at",
     db: Session = Depends(get_db),
 ):
+    """
+    Danh sách campaign theo thứ tự ổn định `(sort, id)`.
+    Có `limit`: trang đầy thì header `X-Next-Cursor` chứa cursor cho trang kế (keyset, chi phí
+    mỗi trang không đổi). Không truyền `limit`: trả toàn bộ như trước.
+    """
+    after = _decode_cursor_or_400(cursor, sort)
     q = db.query(models.Campaign)
     if status:
         q = q.filter(models.Campaign.status == status)
@@ -1871,29 +2082,28 @@ def list_campaigns_api(
         q = q.filter(models.Campaign.approval == approval)
     # Filter user_status theo chuẩn mới trực tiếp
     if user_status:
-        us = user_status.strip().upper()
-        if us == "SUCCESSFUL":
-            us = "APPROVED"
         q = q.filter(
-            func.upper(func.trim(models.Campaign.user_registration_status)) == us
+            models.Campaign.user_registration_status
+            == normalize_user_status(user_status)
         )
     if merchant:
         q = q.filter(models.Campaign.merchant == merchant)
-    return q.order_by(models.Campaign.updated_at.desc()).all()
+    rows = keyset_page(q, models.Campaign, sort, after=after, limit=limit)
+    _set_next_cursor(response, rows, sort, limit)
+    return rows
 
 
 @app.get(
-    "/campaigns/approved-merchants", response_model=list[str], tags=["Campaigns 📢"]
+    "/campaigns/approved-merchants",
+    response_model=list[str],
+    response_class=FastJSONResponse,
+    tags=["Campaigns 📢"],
 )
 def list_approved_merchants_api(db: Session = Depends(get_db)):
     rows = (
         db.query(models.Campaign.merchant)
         .filter(models.Campaign.status == "running")
-        .filter(
-            func.upper(func.trim(models.Campaign.user_registration_status)).in_(
-                ["APPROVED", "SUCCESSFUL"]
-            )
-        )
+        .filter(models.Campaign.user_registration_status == "APPROVED")
         .distinct()
         .all()
     )
@@ -1901,14 +2111,30 @@ def list_approved_merchants_api(db: Session = Depends(get_db)):
     return merchants
 
 
-@app.get("/offers", response_model=list[schemas.ProductOfferOut], tags=["Offers 🛒"])
+@app.get(
+    "/offers",
+    response_model=list[schemas.ProductOfferOut],
+    response_class=FastJSONResponse,
+    tags=["Offers 🛒"],
+)
 def list_offers_api(
+    response: Response,
     merchant: str | None = None,
     skip: int = 0,
     limit: int = 50,
     category: Literal["offers", "top-products"] = Query(
         "offers", description="Nhóm dữ liệu: offers | top-products"
     ),
+    cate: str | None = Query(
+        None, description="Lọc theo danh mục sản phẩm (khớp chính xác)"
+    ),
+    shop_name: str | None = Query(
+        None, description="Lọc theo tên cửa hàng (khớp chính xác)"
+    ),
+    cursor: str | None = Query(
+        None, description="Cursor từ header X-Next-Cursor của trang trước (bỏ qua skip)"
+    ),
+    sort: Literal["id", "-id", "updated_at", "-updated_at", "price", "-price"] = "id",
     db: Session = Depends(get_db),
 ):
     """
@@ -1917,7 +2143,12 @@ def list_offers_api(
     - `skip`: số bản ghi bỏ qua (offset)
     - `limit`: số bản ghi tối đa trả về
     - `category`: 'offers' (mặc định) hoặc 'top-products'.
+    - `cate` / `shop_name`: lọc theo danh mục / cửa hàng của sản phẩm (cột có index).
+    - `sort`: id | updated_at | price (tiền tố `-` = giảm dần), thứ tự ổn định theo `(sort, id)`.
+    - `cursor`: phân trang keyset. Trang đầy thì header `X-Next-Cursor` chứa cursor trang kế;
+      gửi lại cùng `sort` để đọc tiếp với chi phí không đổi (thay cho `skip` ở trang sâu).
     """
+    after = _decode_cursor_or_400(cursor, sort)
     cat = (category or "offers").strip().lower()
     if cat not in ("offers", "top-products"):
         raise HTTPException(
@@ -1927,7 +2158,15 @@ def list_offers_api(
 
     if cat == "top-products":
         rows = crud.list_offers(
-            db, merchant=merchant, skip=skip, limit=limit, source_type="top_products"
+            db,
+            merchant=merchant,
+            skip=skip,
+            limit=limit,
+            source_type="top_products",
+            cate=cate,
+            shop_name=shop_name,
+            sort=sort,
+            after=after,
         )
     else:
         # 'offers' mặc định: loại trừ các nhóm không phải catalog chính
@@ -1937,7 +2176,12 @@ def list_offers_api(
             skip=skip,
             limit=limit,
             exclude_source_types=["top_products", "promotions"],
+            cate=cate,
+            shop_name=shop_name,
+            sort=sort,
+            after=after,
         )
+    _set_next_cursor(response, rows, sort, limit)
 
     out: list[dict] = []
     for o in rows:
@@ -1960,20 +2204,11 @@ def list_offers_api(
             "product_id": o.product_id,
             "extra": o.extra,
             "updated_at": o.updated_at,
-            "desc": None,
-            "cate": None,
-            "shop_name": None,
-            "update_time_raw": None,
+            "desc": o.desc,
+            "cate": o.cate,
+            "shop_name": o.shop_name,
+            "update_time_raw": o.update_time_raw,
         }
-
-        try:
-            ex = json.loads(o.extra) if o.extra else {}
-            item["desc"] = ex.get("desc")
-            item["cate"] = ex.get("cate")
-            item["shop_name"] = ex.get("shop_name")
-            item["update_time_raw"] = ex.get("update_time_raw") or ex.get("update_time")
-        except Exception:
-            pass
         out.append(item)
 
     return out
@@ -2012,19 +2247,11 @@ def get_offer_extras(offer_id: int, db: Session = Depends(get_db)):
         "product_id": o.product_id,
         "extra": o.extra,
         "updated_at": o.updated_at,
-        "desc": None,
-        "cate": None,
-        "shop_name": None,
-        "update_time_raw": None,
+        "desc": o.desc,
+        "cate": o.cate,
+        "shop_name": o.shop_name,
+        "update_time_raw": o.update_time_raw,
     }
-    try:
-        ex = json.loads(o.extra) if o.extra else {}
-        item["desc"] = ex.get("desc")
-        item["cate"] = ex.get("cate")
-        item["shop_name"] = ex.get("shop_name")
-        item["update_time_raw"] = ex.get("update_time_raw") or ex.get("update_time")
-    except Exception:
-        pass
 
     campaign = None
     promotions: list[dict] = []
@@ -2076,6 +2303,41 @@ def get_offer_extras(offer_id: int, db: Session = Depends(get_db)):
     return data
 
 
+@app.get(
+    "/offers/{offer_id}/price-history",
+    tags=["Offers 🛒"],
+    summary="Lịch sử giá của offer (đã downsample)",
+    description=(
+        "Chuỗi giá theo thời gian của 1 offer. price_history chỉ có dòng mới khi giá đổi.\n"
+        "Lịch sử dài được downsample phía server (LTTB) còn tối đa `points` điểm, "
+        "giữ điểm đầu/cuối và các đỉnh/đáy.\n"
+        "Structure: {offer_id, currency, current_price, total, downsampled, min, max, points: [{t, price}]}."
+    ),
+)
+def get_offer_price_history(
+    offer_id: int,
+    points: int = Query(200, ge=3, le=5000, description="Số điểm tối đa trả về"),
+    since: datetime | None = Query(None, description="Chỉ lấy từ thời điểm này"),
+    db: Session = Depends(get_db),
+):
+    o = crud.get_offer_by_id(db, offer_id)
+    if not o:
+        raise HTTPException(status_code=404, detail="Offer not found")
+    rows = crud.get_price_history(db, offer_id, since=since)
+    prices = [float(p) for _, p in rows]
+    idx = timeseries.lttb_indices([ts.timestamp() for ts, _ in rows], prices, points)
+    return {
+        "offer_id": offer_id,
+        "currency": o.currency,
+        "current_price": o.price,
+        "total": len(rows),
+        "downsampled": len(idx) < len(rows),
+        "min": min(prices) if prices else None,
+        "max": max(prices) if prices else None,
+        "points": [{"t": rows[i][0].isoformat(), "price": prices[i]} for i in idx],
+    }
+
+
 @app.post(
     "/ingest/policy",
     tags=["Settings ⚙️"],
@@ -2145,6 +2407,7 @@ async def ingest_products(
             }
         },
     ),
+    background: bool = Query(False, description=_BACKGROUND_QUERY_DESC),
     db: Session = Depends(get_db),
 ):
     provider = (req.provider or "accesstrade").lower()
@@ -2153,242 +2416,408 @@ async def ingest_products(
         raise HTTPException(
             status_code=400, detail=f"Provider '{provider}' hiện chưa được hỗ trợ"
         )
-    return await ops.products(req, db)
+    if background:
+        return _submit_job(
+            "ingest",
+            {"endpoint": "/ingest/products", **req.model_dump()},
+            lambda jdb: ops.products(req, jdb),
+        )
+    return await _run_off_loop(lambda jdb: ops.products(req, jdb))
 
 
-# Internal helper: Accesstrade implementation for products ingest
-async def _ingest_products_accesstrade_impl(req: IngestReq, db: Session):
-    from accesstrade_service import (
-        fetch_active_campaigns,
-        fetch_campaign_detail,
-        fetch_products,
-        fetch_promotions,
-        fetch_commission_policies,
-        map_at_product_to_offer,
-        _check_url_alive,
-    )
+# ---- Helpers dùng chung cho các pipeline ingest (fetch → enrich → map → write) ----
+def _map_campaign_status(v):
+    # map status "1/0" -> "running/paused" nếu API trả dạng số
+    s = str(v).strip() if v is not None else None
+    if s == "1":
+        return "running"
+    if s == "0":
+        return "paused"
+    return s
 
-    active_campaigns = await fetch_active_campaigns(db)
-    logger.info("Fetched %d active campaigns", len(active_campaigns))
-    merchant_campaign_map = {v: k for k, v in active_campaigns.items()}
 
-    items = await fetch_products(db, req.path, req.params or {})
-    if not items:
-        return {"ok": True, "imported": 0}
+def _campaign_user_status(row) -> str:
+    return (row.user_registration_status or "") if row else ""
 
-    imported = 0
 
-    def _vlog(reason: str, extra: dict | None = None):
-        try:
-            from accesstrade_service import _log_jsonl as _rawlog
+def _offer_status_fields(row) -> dict:
+    """approval_status & eligible_commission của offer theo campaign row (nếu có)."""
+    if not row:
+        return {}
+    us = _campaign_user_status(row)
+    return {
+        "approval_status": (
+            "successful"
+            if us == "APPROVED"
+            else (
+                "pending"
+                if us == "PENDING"
+                else "unregistered"
+                if us == "NOT_REGISTERED"
+                else None
+            )
+        ),
+        "eligible_commission": (row.status == "running") and (us == "APPROVED"),
+    }
 
-            payload = {"endpoint": "manual_ingest", "reason": reason}
-            if extra:
-                payload.update(extra)
-            _rawlog("ingest_skips.jsonl", payload)
-        except Exception:
-            pass
 
-    for it in items:
-        policies = []  # ensure defined for each iteration
-        camp_id = str(it.get("campaign_id") or it.get("campaign_id_str") or "").strip()
-        merchant = str(it.get("merchant") or it.get("campaign") or "").lower().strip()
-        _alias = {"lazadacps": "lazada", "tikivn": "tiki"}
-        merchant_norm = _alias.get(
-            merchant, merchant.split(".")[0] if "." in merchant else merchant
-        )
+def _upsert_campaign_from_detail(
+    db: Session, camp: dict, camp_id: str, merchant_norm: str | None
+):
+    approval_val = camp.get("approval")
+    _user_raw = (
+        camp.get("user_registration_status")
+        or camp.get("publisher_status")
+        or camp.get("user_status")
+    )
+    return crud.upsert_campaign(
+        db,
+        schemas.CampaignCreate(
+            campaign_id=str(camp.get("campaign_id") or camp_id),
+            merchant=str(camp.get("merchant") or merchant_norm or "").lower() or None,
+            name=camp.get("name"),
+            status=_map_campaign_status(camp.get("status")),
+            approval=(str(approval_val) if approval_val is not None else None),
+            start_time=camp.get("start_time"),
+            end_time=camp.get("end_time"),
+            user_registration_status=(
+                _user_raw if _user_raw not in (None, "", []) else None
+            ),
+        ),
+    )
 
-        def _resolve_campaign_id_by_suffix(m_name: str) -> tuple[str | None, str]:
-            if m_name in merchant_campaign_map:
-                return merchant_campaign_map[m_name], "exact"
-            for m_key, cid in merchant_campaign_map.items():
-                if m_key.endswith(m_name) or f"_{m_name}" in m_key:
-                    return cid, f"suffix({m_key})"
-            for m_key, cid in merchant_campaign_map.items():
-                if m_name in m_key:
-                    return cid, f"contains({m_key})"
-            return None, ""
-
-        if not camp_id:
-            camp_id, how = _resolve_campaign_id_by_suffix(merchant_norm)
-            if camp_id:
-                logger.debug(
-                    "Fallback campaign_id=%s via %s cho merchant=%s (norm=%s) [manual ingest]",
-                    camp_id,
-                    how,
-                    merchant,
-                    merchant_norm,
-                )
-            else:
-                _vlog(
-                    "no_campaign_match",
-                    {"merchant": merchant, "merchant_norm": merchant_norm},
-                )
 
-        if not camp_id or camp_id not in active_campaigns:
-            logger.info(
-                "Skip product vì campaign_id=%s không active [manual ingest] (merchant=%s)",
-                camp_id,
-                merchant_norm,
-            )
-            _vlog(
-                "campaign_not_active",
-                {"campaign_id": camp_id, "merchant": merchant_norm},
+def _upsert_promotions_for_campaign(db: Session, camp_id: str, promos: list) -> None:
+    for prom in promos or []:
+        try:
+            crud.upsert_promotion(
+                db,
+                schemas.PromotionCreate(
+                    campaign_id=camp_id,
+                    name=prom.get("name"),
+                    content=prom.get("content") or prom.get("description"),
+                    start_time=prom.get("start_time"),
+                    end_time=prom.get("end_time"),
+                    coupon=prom.get("coupon"),
+                    link=prom.get("link"),
+                ),
             )
-            continue
+        except Exception as e:
+            logger.debug("Skip promotion upsert: %s", e)
+
+
+def _commission_payloads(
+    camp_id: str, policies: list
+) -> list[schemas.CommissionPolicyCreate]:
+    return [
+        schemas.CommissionPolicyCreate(
+            campaign_id=str(camp_id),
+            reward_type=rec.get("reward_type") or rec.get("type"),
+            sales_ratio=rec.get("sales_ratio") or rec.get("ratio"),
+            sales_price=rec.get("sales_price"),
+            target_month=rec.get("target_month"),
+        )
+        for rec in policies or []
+    ]
 
-        try:
-            _row = crud.get_campaign_by_cid(db, camp_id)
-            _us = (_row.user_registration_status or "").upper() if _row else ""
-            if _us == "SUCCESSFUL":
-                _us = "APPROVED"
-            if not _row or _us != "APPROVED":
-                logger.info(
-                    "Skip product vì campaign_id=%s chưa APPROVED [manual ingest]",
-                    camp_id,
-                )
-                _vlog("campaign_not_approved", {"campaign_id": camp_id})
-                continue
-        except Exception:
-            continue
 
-        promotions_data = (
-            await fetch_promotions(db, merchant_norm) if merchant_norm else []
-        )
-        if promotions_data:
-            for prom in promotions_data:
-                try:
-                    crud.upsert_promotion(
-                        db,
-                        schemas.PromotionCreate(
-                            campaign_id=camp_id,
-                            name=prom.get("name"),
-                            content=prom.get("content") or prom.get("description"),
-                            start_time=prom.get("start_time"),
-                            end_time=prom.get("end_time"),
-                            coupon=prom.get("coupon"),
-                            link=prom.get("link"),
-                        ),
-                    )
-                except Exception as e:
-                    logger.debug("Skip promotion upsert: %s", e)
+def _upsert_commissions_for_campaign(db: Session, camp_id: str, policies: list) -> None:
+    crud.bulk_upsert_commission_policies(db, _commission_payloads(camp_id, policies))
 
-        try:
-            camp = await fetch_campaign_detail(db, camp_id)
-            if camp:
-                status_val = camp.get("status")
-                approval_val = camp.get("approval")
-                _user_raw = (
-                    camp.get("user_registration_status")
-                    or camp.get("publisher_status")
-                    or camp.get("user_status")
-                )
 
-                def _map_status(v):
-                    s = str(v).strip() if v is not None else None
-                    if s == "1":
-                        return "running"
-                    if s == "0":
-                        return "paused"
-                    return s
+# ---- Enrich theo campaign: memo trong 1 lần chạy (IngestRunContext) ----
+async def _enrich_campaign_detail(
+    ctx: IngestRunContext, camp_id: str, merchant_norm: str | None
+) -> dict | None:
+    """fetch_campaign_detail + upsert campaign: 1 lần/campaign_id mỗi lần chạy."""
+    from accesstrade_service import fetch_campaign_detail
 
-                crud.upsert_campaign(
-                    db,
-                    schemas.CampaignCreate(
-                        campaign_id=str(camp.get("campaign_id") or camp_id),
-                        merchant=str(
-                            camp.get("merchant") or merchant_norm or ""
-                        ).lower()
-                        or None,
-                        name=camp.get("name"),
-                        status=_map_status(status_val),
-                        approval=(
-                            str(approval_val) if approval_val is not None else None
-                        ),
-                        start_time=camp.get("start_time"),
-                        end_time=camp.get("end_time"),
-                        user_registration_status=(
-                            _user_raw if _user_raw not in (None, "", []) else None
-                        ),
-                    ),
-                )
+    async def _load():
+        try:
+            camp = await fetch_campaign_detail(ctx.db, camp_id)
+            if camp:
+                row = _upsert_campaign_from_detail(ctx.db, camp, camp_id, merchant_norm)
+                ctx.campaigns.refresh(row)  # giữ directory đồng bộ với DB
+            return camp
         except Exception as e:
             logger.debug("Skip campaign upsert: %s", e)
+            return None
 
-        try:
-            policies = await fetch_commission_policies(db, camp_id)
-            for rec in policies or []:
-                crud.upsert_commission_policy(
-                    db,
-                    schemas.CommissionPolicyCreate(
-                        campaign_id=camp_id,
-                        reward_type=rec.get("reward_type") or rec.get("type"),
-                        sales_ratio=rec.get("sales_ratio") or rec.get("ratio"),
-                        sales_price=rec.get("sales_price"),
-                        target_month=rec.get("target_month"),
-                    ),
-                )
-        except Exception as e:
-            logger.debug("Skip commission upsert: %s", e)
+    return await ctx.once("campaign_detail", camp_id, _load)
 
-        data = map_at_product_to_offer(
-            it, commission=policies, promotion=promotions_data
-        )
-        if not data.get("url") or not data.get("source_id"):
-            continue
 
-        data["campaign_id"] = camp_id
-        data["source_type"] = "manual"
-        _camp_row = crud.get_campaign_by_cid(db, camp_id)
-        if _camp_row:
-            us = (_camp_row.user_registration_status or "").upper()
-            if us == "SUCCESSFUL":
-                us = "APPROVED"
-            data["approval_status"] = (
-                "successful"
-                if us == "APPROVED"
-                else (
-                    "pending"
-                    if us == "PENDING"
-                    else "unregistered" if us == "NOT_REGISTERED" else None
-                )
-            )
-            data["eligible_commission"] = (_camp_row.status == "running") and (
-                us == "APPROVED"
-            )
+async def _enrich_promotions(
+    ctx: IngestRunContext, camp_id: str, merchant_norm: str | None
+) -> list:
+    """Promotions: fetch 1 lần/merchant, upsert 1 lần/campaign_id mỗi lần chạy."""
+    from accesstrade_service import fetch_promotions
 
-        if not await _check_url_alive(str(data.get("url") or "")):
-            logger.info(
-                "Skip dead product [manual ingest]: title='%s'", data.get("title")
-            )
-            _vlog("dead_url", {"url": data.get("url")})
-            continue
+    if not merchant_norm:
+        return []
 
+    async def _load():
+        # Lỗi promotions không được làm hỏng cả batch offer (stage error tắt sweep cả lần chạy)
         try:
-            crud.upsert_offer_for_excel(db, schemas.ProductOfferCreate(**data))
-        except Exception:
-            crud.upsert_offer_by_source(db, schemas.ProductOfferCreate(**data))
-        imported += 1
+            return await fetch_promotions(ctx.db, merchant_norm) or []
+        except Exception as e:
+            logger.warning("Promotions fetch failed for %s: %s", merchant_norm, e)
+            return []
+
+    promos = await ctx.once("promotions", merchant_norm, _load)
+    await ctx.once(
+        "promotions_upsert",
+        camp_id,
+        lambda: _upsert_promotions_for_campaign(ctx.db, camp_id, promos),
+    )
+    return promos
 
-    return {"ok": True, "imported": imported}
 
+async def _enrich_commissions(ctx: IngestRunContext, camp_id: str) -> list:
+    """Commission policies: fetch + upsert 1 lần/campaign_id mỗi lần chạy."""
+    from accesstrade_service import fetch_commission_policies
 
-async def ingest_accesstrade_datafeeds_all(
-    req: IngestAllDatafeedsReq,
-    db: Session = Depends(get_db),
-):
+    async def _load():
+        policies: list = []
+        try:
+            policies = await fetch_commission_policies(ctx.db, camp_id) or []
+            _upsert_commissions_for_campaign(ctx.db, camp_id, policies)
+        except Exception as e:
+            logger.debug("Skip commission upsert: %s", e)
+        return policies
 
-    # Dùng luôn session `db` từ Depends; không mở/đóng session mới tại đây
-    from accesstrade_service import fetch_campaigns_full_all, fetch_campaign_detail
+    return await ctx.once("commissions", camp_id, _load)
 
-    items = await fetch_campaigns_full_all(
-        db,
-        status="running",
-        limit_per_page=req.limit_per_page or 100,
-        max_pages=req.max_pages or 200,
-        throttle_ms=req.throttle_ms or 0,
-    )
-    imported = 0
+
+def _write_offers(db: Session, offers: list[dict], run_gen: int | None = None) -> dict:
+    """Stage write: upsert cả batch bằng 1 câu INSERT ... ON CONFLICT.
+
+    Trả về {"inserted", "updated", "unchanged", "errors"}; offer không hợp lệ bị bỏ qua.
+    Batch lỗi (1 dòng hỏng, deadlock, timeout) được ghi lại từng dòng: chỉ dòng vẫn lỗi
+    bị bỏ và đếm vào "errors", không mất cả batch.
+    """
+    res = {"inserted": 0, "updated": 0, "unchanged": 0, "errors": 0}
+    payloads = []
+    for data in offers:
+        try:
+            payloads.append(schemas.ProductOfferCreate(**data))
+        except Exception as e:
+            logger.debug("Skip invalid offer %s: %s", data.get("source_id"), e)
+    if not payloads:
+        return res
+    t0 = time.perf_counter()
+    # match_any_source: cập nhật record cùng source_id dù source khác (như Excel)
+    try:
+        res.update(
+            crud.bulk_upsert_offers(
+                db, payloads, match_any_source=True, run_gen=run_gen
+            )
+        )
+        outcome = "ok"
+    except Exception as e:
+        db.rollback()
+        outcome = "error"
+        logger.warning(
+            "Offer batch upsert failed (%d items), retrying row by row: %s",
+            len(payloads),
+            e,
+        )
+        for p in payloads:
+            try:
+                one = crud.bulk_upsert_offers(
+                    db, [p], match_any_source=True, run_gen=run_gen
+                )
+            except Exception as e:
+                db.rollback()
+                res["errors"] += 1
+                logger.warning("Skip offer %s: %s", p.source_id, e)
+                continue
+            for k, v in one.items():
+                res[k] += v
+    metrics.DB_WRITE_SECONDS.observe(
+        time.perf_counter() - t0, op="bulk_upsert_offers", outcome=outcome
+    )
+    for k in ("inserted", "updated", "unchanged"):
+        if res[k]:
+            metrics.OFFERS_WRITTEN.inc(res[k], result=k)
+    return res
+
+
+def _ingest_vlog(endpoint: str, reason: str, extra: dict | None = None) -> None:
+    metrics.INGEST_SKIPPED.inc(endpoint=endpoint, reason=reason)
+    try:
+        from accesstrade_service import _log_jsonl as _rawlog
+
+        payload = {"endpoint": endpoint, "reason": reason}
+        if extra:
+            payload.update(extra)
+        _rawlog("ingest_skips.jsonl", payload)
+    except Exception:
+        pass
+
+
+# Internal helper: Accesstrade implementation for products ingest
+async def _ingest_products_accesstrade_impl(req: IngestReq, db: Session):
+    from accesstrade_service import (
+        fetch_active_campaigns,
+        fetch_products,
+        map_at_products_to_offers,
+        _check_url_alive,
+    )
+    from ingest_pipeline import Pipeline, Stage, gather_limited
+
+    active_campaigns = await fetch_active_campaigns(db)
+    logger.info("Fetched %d active campaigns", len(active_campaigns))
+    resolver = MerchantResolver(active_campaigns)
+
+    def _vlog(reason: str, extra: dict | None = None):
+        _ingest_vlog("manual_ingest", reason, extra)
+
+    imported = 0
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0, "errors": 0}
+    fetched = 0
+    ctx = IngestRunContext(db, name="manual_ingest")
+
+    # fetch: 1 request, nhóm item theo (campaign_id, merchant) để enrich 1 lần/nhóm
+    async def _fetch(_req: IngestReq):
+        nonlocal fetched
+        items = await fetch_products(db, _req.path, _req.params or {})
+        fetched = len(items or [])
+        groups: dict[tuple[str, str], list[dict]] = {}
+        for it in items or []:
+            camp_id = str(
+                it.get("campaign_id") or it.get("campaign_id_str") or ""
+            ).strip()
+            merchant = (
+                str(it.get("merchant") or it.get("campaign") or "").lower().strip()
+            )
+            merchant_norm = merchant_alias(merchant.split(".")[0])
+            if not camp_id:
+                camp_id, how = resolver.resolve(merchant_norm)
+                if camp_id:
+                    logger.debug(
+                        "Fallback campaign_id=%s via %s cho merchant=%s (norm=%s) [manual ingest]",
+                        camp_id,
+                        how,
+                        merchant,
+                        merchant_norm,
+                    )
+                else:
+                    _vlog(
+                        "no_campaign_match",
+                        {"merchant": merchant, "merchant_norm": merchant_norm},
+                    )
+            if not camp_id or camp_id not in active_campaigns:
+                logger.info(
+                    "Skip product vì campaign_id=%s không active [manual ingest] (merchant=%s)",
+                    camp_id,
+                    merchant_norm,
+                )
+                _vlog(
+                    "campaign_not_active",
+                    {"campaign_id": camp_id, "merchant": merchant_norm},
+                )
+                continue
+            groups.setdefault((camp_id, merchant_norm), []).append(it)
+        for (camp_id, merchant_norm), group in groups.items():
+            yield {"campaign_id": camp_id, "merchant": merchant_norm, "items": group}
+
+    # enrich: kiểm tra APPROVED + promotions/campaign detail/commission cho cả nhóm
+    async def _enrich(batch: dict):
+        camp_id, merchant_norm = batch["campaign_id"], batch["merchant"]
+        if not ctx.campaigns.is_approved(camp_id):
+            logger.info(
+                "Skip product vì campaign_id=%s chưa APPROVED [manual ingest]", camp_id
+            )
+            _vlog(
+                "campaign_not_approved",
+                {"campaign_id": camp_id, "items": len(batch["items"])},
+            )
+            return None
+
+        # memo theo campaign_id/merchant: mỗi campaign chỉ enrich 1 lần/lần chạy
+        batch["promotions"] = await _enrich_promotions(ctx, camp_id, merchant_norm)
+        await _enrich_campaign_detail(ctx, camp_id, merchant_norm)
+        batch["policies"] = await _enrich_commissions(ctx, camp_id)
+        return batch
+
+    # map: chuẩn hoá cả nhóm 1 lần + kiểm tra link sống
+    async def _map(batch: dict):
+        camp_id = batch["campaign_id"]
+        status_fields = _offer_status_fields(ctx.campaigns.get(camp_id))
+        offers = []
+        for data in map_at_products_to_offers(
+            batch["items"], commission=batch["policies"], promotion=batch["promotions"]
+        ):
+            if not data.get("url") or not data.get("source_id"):
+                continue
+            data["campaign_id"] = camp_id
+            data["source_type"] = "manual"
+            data.update(status_fields)
+            offers.append(data)
+
+        alive = await gather_limited(
+            lambda d: _check_url_alive(str(d.get("url") or "")), offers
+        )
+        kept = []
+        for data, ok in zip(offers, alive):
+            if not ok:
+                logger.info(
+                    "Skip dead product [manual ingest]: title='%s'", data.get("title")
+                )
+                _vlog("dead_url", {"url": data.get("url")})
+                continue
+            kept.append(data)
+        return kept or None
+
+    async def _write(offers: list[dict]):
+        nonlocal imported
+        res = _write_offers(db, offers)
+        for k in counts:
+            counts[k] += res[k]
+        # cả offer không đổi: đã có và đúng trong DB
+        n = res["inserted"] + res["updated"] + res["unchanged"]
+        imported += n
+        jobs.report(imported=imported, **counts)
+        return n
+
+    pipe = Pipeline(
+        [
+            Stage("fetch", _fetch, count=lambda b: len(b["items"])),
+            Stage("enrich", _enrich, count=lambda b: len(b["items"])),
+            Stage("map", _map, count=len),
+            Stage("write", _write, count=lambda n: n),
+        ],
+        name="manual_ingest",
+    )
+    stages = await pipe.run([req])
+    return {
+        "ok": True,
+        "imported": imported,
+        **counts,
+        "fetched": fetched,
+        "stages": stages,
+        "memo": ctx.stats(),
+    }
+
+
+async def _sync_running_campaigns(
+    db: Session, req: IngestAllDatafeedsReq, ctx: IngestRunContext
+) -> int:
+    """Đồng bộ campaigns đang chạy (APPROVED/PENDING) trước khi quét datafeeds."""
+    from accesstrade_service import fetch_campaigns_full_all, refresh_active_campaigns
+
+    limit, max_pages = req.limit_per_page or 100, req.max_pages or 200
+    items = await fetch_campaigns_full_all(
+        db,
+        status="running",
+        limit_per_page=limit,
+        max_pages=max_pages,
+        throttle_ms=req.throttle_ms or 0,
+    )
+    if items and len(items) < limit * max_pages:
+        # Đã quét đủ campaign đang chạy: dùng luôn làm snapshot, khỏi gọi lại API
+        await refresh_active_campaigns(db, items)
+    imported = 0
     for camp in items or []:
         try:
             camp_id = str(camp.get("campaign_id") or camp.get("id") or "").strip()
@@ -2398,15 +2827,6 @@ async def ingest_accesstrade_datafeeds_all(
             status_val = camp.get("status")
             approval_val = camp.get("approval")
 
-            # map status "1/0" -> "running/paused" nếu API trả dạng số
-            def _map_status(v):
-                s = str(v).strip() if v is not None else None
-                if s == "1":
-                    return "running"
-                if s == "0":
-                    return "paused"
-                return s
-
             # Tách approval (kiểu duyệt campaign) ↔ user_status (trạng thái đăng ký của riêng mình)
             def _split_approval_or_user(v):
                 if v is None:
@@ -2421,7 +2841,7 @@ async def ingest_accesstrade_datafeeds_all(
             approval_for_campaign, user_status = _split_approval_or_user(approval_val)
 
             # NEW: nếu API không cung cấp user_status, dùng giá trị cũ trong DB để tránh mất record
-            existing = crud.get_campaign_by_cid(db, camp_id)
+            existing = ctx.campaigns.get(camp_id)
             eff_user = user_status or (
                 existing.user_registration_status if existing else None
             )
@@ -2435,7 +2855,7 @@ async def ingest_accesstrade_datafeeds_all(
                 campaign_id=camp_id,
                 merchant=merchant or None,
                 name=camp.get("name"),
-                status=_map_status(status_val),
+                status=_map_campaign_status(status_val),
                 approval=approval_for_campaign,  # KHÔNG còn ghi 'successful/pending/unregistered' ở đây
                 start_time=camp.get("start_time"),
                 end_time=camp.get("end_time"),
@@ -2443,21 +2863,39 @@ async def ingest_accesstrade_datafeeds_all(
                 user_registration_status=eff_user,  # NOT_REGISTERED/PENDING/APPROVED hoặc None
             )
 
-            crud.upsert_campaign(db, payload)
+            ctx.campaigns.refresh(crud.upsert_campaign(db, payload))
             imported += 1
         except Exception as e:
             logger.debug("Skip campaign upsert: %s", e)
 
     logger.info("Scheduled campaigns sync done: %s", imported)
+    return imported
+
+
+async def ingest_accesstrade_datafeeds_all(
+    req: IngestAllDatafeedsReq,
+    db: Session = Depends(get_db),
+    *,
+    cursor: MerchantCursor | None = None,
+    shard: tuple[int, int] | None = None,
+    sync_campaigns: bool = True,
+    lease_held: Callable[[], bool] | None = None,
+):
+
+    # Dùng luôn session `db` từ Depends; không mở/đóng session mới tại đây
+    # Ngữ cảnh lần chạy: campaign directory (1 query) + memo enrich theo campaign_id
+    ctx = IngestRunContext(db, name="datafeeds_all")
+
+    if sync_campaigns:
+        await _sync_running_campaigns(db, req, ctx)
 
     from accesstrade_service import (
         fetch_products,
         fetch_active_campaigns,
-        fetch_promotions,
-        fetch_commission_policies,
-        map_at_product_to_offer,
+        map_at_products_to_offers,
         _check_url_alive,
     )
+    from ingest_pipeline import Pipeline, Stage, gather_limited
 
     # 0) Lấy danh sách campaign đang chạy để lọc
     active_campaigns = await fetch_active_campaigns(db)  # dict {campaign_id: merchant}
@@ -2467,36 +2905,23 @@ async def ingest_accesstrade_datafeeds_all(
             c.campaign_id: c.merchant
             for c in db.query(models.Campaign)
             .filter(models.Campaign.status == "running")
-            .filter(
-                models.Campaign.user_registration_status.in_(["APPROVED", "SUCCESSFUL"])
-            )
+            .filter(models.Campaign.user_registration_status == "APPROVED")
             .all()
             if c.campaign_id and c.merchant
         }
-    # Note: the direct map isn't used later; only approved map below is used.
 
     # Map merchant -> approved campaign_id (running + user APPROVED) for fallback rebinding
     approved_cid_by_merchant: dict[str, str] = {}
     try:
         for cid, m in active_campaigns.items():
-            _row = crud.get_campaign_by_cid(db, cid)
-            if _row:
-                _us = (_row.user_registration_status or "").upper()
-                if _us == "SUCCESSFUL":
-                    _us = "APPROVED"
-                if _us == "APPROVED":
-                    approved_cid_by_merchant[(m or "").lower()] = cid
+            if ctx.campaigns.is_approved(cid):
+                approved_cid_by_merchant[(m or "").lower()] = cid
     except Exception:
         pass
 
-    # chính sách ingest (API bỏ qua policy; policy chỉ áp dụng cho import Excel)
-    only_with_commission = False
-
-    # 2) Cache promotions theo merchant để tránh gọi trùng
-    promotion_cache: dict[str, list[dict]] = {}
+    # chính sách ingest: API bỏ qua policy only_with_commission (chỉ áp dụng cho import Excel)
 
-    # NEW: Cache commission theo campaign_id để tránh spam API (fix NameError)
-    cache_commissions: dict[str, list[dict]] = {}
+    # 2) Promotions/commission/campaign detail: memo theo merchant/campaign_id qua ctx
 
     # 3) Tham số gọi API datafeeds + bộ lọc phía server
     base_params = dict(req.params or {})
@@ -2516,30 +2941,31 @@ async def ingest_accesstrade_datafeeds_all(
         filter_cid = filter_cid.strip()
 
     imported = 0
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0, "errors": 0}
     total_pages = 0
 
+    # Mark-and-sweep: merchant quét hết feed trong lần chạy (exhausted) và không bị bỏ trang
+    # nào (incomplete) thì offer không được đóng dấu ctx.generation sẽ bị retire.
+    # Chỉ khi không có bộ lọc nào ngoài merchant/campaign (feed đầy đủ).
+    full_feed = not (
+        set(base_params)
+        - {"merchant", "campaign", "merchant_slug", "campaign_id", "camp_id"}
+    )
+    exhausted: set[str] = set()
+    incomplete: set[str] = set()
+    cids_by_merchant: dict[str, set[str]] = {}
+    # Khử trùng (merchant, source_id) giữa các trang trong lần chạy
+    seen = SeenKeys(exact_max=INGEST_DEDUP_EXACT_MAX) if req.dedup else None
+
     # Xây danh sách merchants cần chạy: ưu tiên từ active_campaigns (đang chạy) ∩ DB (APPROVED)
-    approved_merchants: set[str] = set()
-    try:
-        for cid, m in active_campaigns.items():
-            _row = crud.get_campaign_by_cid(db, cid)
-            if _row:
-                _us = (_row.user_registration_status or "").upper()
-                if _us == "SUCCESSFUL":
-                    _us = "APPROVED"
-                if _us == "APPROVED":
-                    approved_merchants.add((m or "").lower())
-    except Exception:
-        pass
+    approved_merchants: set[str] = set(approved_cid_by_merchant.keys())
     if not approved_merchants:
         # Fallback: lấy từ DB
         approved_merchants = {
             (c.merchant or "").lower()
             for c in db.query(models.Campaign)
             .filter(models.Campaign.status == "running")
-            .filter(
-                models.Campaign.user_registration_status.in_(["APPROVED", "SUCCESSFUL"])
-            )
+            .filter(models.Campaign.user_registration_status == "APPROVED")
             .all()
             if c.merchant
         }
@@ -2559,65 +2985,77 @@ async def ingest_accesstrade_datafeeds_all(
             approved_merchants = set()
 
     if filter_merchant:
-        m_norm = filter_merchant
         # alias nội bộ
-        _alias = {"lazadacps": "lazada", "tikivn": "tiki"}
-        m_norm = _alias.get(m_norm, m_norm)
-        if approved_merchants:
-            approved_merchants = {
-                m
-                for m in approved_merchants
-                if (m == m_norm or m.endswith(m_norm) or (m_norm in m))
-            }
-        else:
-            # nếu trước đó rỗng (ví dụ đã lọc theo campaign_id không khớp) thì giữ rỗng
-            pass
+        m_norm = merchant_alias(filter_merchant)
+        # nếu trước đó rỗng (ví dụ đã lọc theo campaign_id không khớp) thì giữ rỗng
+        approved_merchants = {
+            m
+            for m in approved_merchants
+            if (m == m_norm or m.endswith(m_norm) or (m_norm in m))
+        }
+
+    # Chạy theo shard lease: chỉ các merchant thuộc shard được giao
+    if shard is not None:
+        approved_merchants = {
+            m for m in approved_merchants if shard_of(m, shard[1]) == shard[0]
+        }
 
     # verbose helper
     def _vlog(reason: str, extra: dict | None = None):
-        try:
-            from accesstrade_service import _log_jsonl as _rawlog
-
-            payload = {"endpoint": "datafeeds_all", "reason": reason}
-            if extra:
-                payload.update(extra)
-            _rawlog("ingest_skips.jsonl", payload)
-        except Exception:
-            pass
-
-    # Lặp từng merchant đã APPROVED và gọi /v1/datafeeds với bộ lọc merchant
-    for m in sorted(approved_merchants):
-        _alias = {"lazadacps": "lazada", "tikivn": "tiki"}
-        merchant_fetch = _alias.get(m, m)
-
-        # Xác định campaign_id tương ứng merchant đang fetch (ưu tiên exact, sau đó suffix/contains)
-        cid_for_fetch = None
-        # Ưu tiên forced campaign id nếu đã xác định
-        if m in forced_cid_by_merchant:
-            cid_for_fetch = forced_cid_by_merchant[m]
-        for cid, mm in active_campaigns.items():
-            if (mm or "").lower() == merchant_fetch or (mm or "").lower() == m:
-                cid_for_fetch = cid
-                break
-        if not cid_for_fetch:
-            for cid, mm in active_campaigns.items():
-                mm_l = (mm or "").lower()
-                if (
-                    mm_l.endswith(merchant_fetch)
-                    or f"_{merchant_fetch}" in mm_l
-                    or (merchant_fetch in mm_l)
-                ):
-                    cid_for_fetch = cid
-                    break
-        if not cid_for_fetch and merchant_fetch != m:
-            for cid, mm in active_campaigns.items():
-                mm_l = (mm or "").lower()
-                if mm_l.endswith(m) or f"_{m}" in mm_l or (m in mm_l):
-                    cid_for_fetch = cid
-                    break
-
-        page = 1
-        while page <= max(1, req.max_pages):
+        if req.verbose:
+            _ingest_vlog("datafeeds_all", reason, extra)
+
+    # campaign_id tương ứng merchant đang fetch: campaign_id được lọc tường minh trước,
+    # sau đó exact/hậu tố/chứa qua resolver dùng chung
+    resolver = MerchantResolver(active_campaigns)
+
+    def _cid_for_merchant(m: str) -> str | None:
+        return forced_cid_by_merchant.get(m) or resolver.campaign_for(m)
+
+    def _dedup_items(m: str, items: list) -> list:
+        if seen is None:
+            return items
+        fresh = []
+        for it in items:
+            sid = str(it.get("id") or it.get("product_id") or it.get("sku") or "")
+            if not sid or seen.add((m, sid)):
+                fresh.append(it)
+        dropped = len(items) - len(fresh)
+        if dropped:
+            metrics.INGEST_SKIPPED.inc(
+                dropped, endpoint="datafeeds_all", reason="duplicate"
+            )
+            if not seen.exact:
+                # Bloom có thể báo trùng nhầm: item bị bỏ không được đóng dấu -> không sweep
+                incomplete.add(m)
+        return fresh
+
+    # fetch: mỗi merchant APPROVED -> phân trang /v1/datafeeds, yield từng trang
+    async def _fetch(m: str):
+        nonlocal total_pages
+        merchant_fetch = merchant_alias(m)
+        cid_for_fetch = _cid_for_merchant(m)
+        if cid_for_fetch:
+            # Ghi nhận cả khi feed rỗng hẳn (không batch nào ghi): merchant quét hết mà
+            # không còn sản phẩm thì offer cũ của campaign vẫn được sweep
+            cids_by_merchant.setdefault(m, set()).add(cid_for_fetch)
+        # resume: merchant bị dừng ở lần trước chạy tiếp từ trang đã lưu
+        page = cursor.start_page(m) if cursor else 1
+        from_first_page = page == 1
+        last_page = page + max(1, req.max_pages) - 1
+        while page <= last_page:
+            if jobs.cancelled():
+                # Job bị huỷ (có thể từ worker khác): dừng giữa các trang, không sweep
+                incomplete.add(m)
+                if cursor:
+                    cursor.stopped(m, page)
+                pipe.stop()
+                return
+            if cursor and cursor.expired():
+                # Hết thời gian: lưu trang kế tiếp, ngừng nạp merchant mới
+                cursor.stopped(m, page)
+                pipe.stop()
+                return
             params = dict(base_params)
             params["page"] = str(page)
             params["limit"] = str(req.limit_per_page)
@@ -2625,235 +3063,26 @@ async def ingest_accesstrade_datafeeds_all(
 
             items = await fetch_products(db, "/v1/datafeeds", params)
             if not items:
-                # Không có dữ liệu cho merchant/page này → dừng merchant
+                # Trang đầu rỗng: merchant không có sản phẩm. Trang sau rỗng (trang trước
+                # đầy) không chứng minh đã hết feed -> không sweep merchant này
+                if from_first_page and page == 1:
+                    exhausted.add(m)
+                else:
+                    incomplete.add(m)
                 break
-
-            # Xử lý từng item
-            for it in items:
-                # Gắn merchant theo vòng lặp ngoài và force-bind campaign_id theo merchant đang fetch
-                merchant_norm = m
-                camp_id = cid_for_fetch
-
-                # Bỏ qua nếu campaign không active
-                if not camp_id or camp_id not in active_campaigns:
-                    if req.verbose:
-                        _vlog(
-                            "campaign_not_active",
-                            {
-                                "campaign_id": camp_id,
-                                "merchant": merchant_norm,
-                                "page": page,
-                            },
-                        )
-                    continue
-
-                # YÊU CẦU: user APPROVED
-                try:
-                    _row = crud.get_campaign_by_cid(db, camp_id)
-                    us = (_row.user_registration_status or "").upper() if _row else ""
-                    if us == "SUCCESSFUL":
-                        us = "APPROVED"
-                    if (not _row) or (us != "APPROVED"):
-                        # Fallback: nếu merchant có campaign khác đã APPROVED, dùng campaign đó
-                        alt_cid = approved_cid_by_merchant.get(merchant_norm)
-                        if alt_cid:
-                            if req.verbose:
-                                _vlog(
-                                    "rebind_campaign_id",
-                                    {
-                                        "from": camp_id,
-                                        "to": alt_cid,
-                                        "merchant": merchant_norm,
-                                        "page": page,
-                                    },
-                                )
-                            camp_id = alt_cid
-                        else:
-                            if req.verbose:
-                                _vlog(
-                                    "campaign_not_approved",
-                                    {
-                                        "campaign_id": camp_id,
-                                        "merchant": merchant_norm,
-                                        "page": page,
-                                    },
-                                )
-                            continue
-                except Exception:
-                    continue
-
-                # Lấy commission theo camp_id (cache)
-                policies = cache_commissions.get(camp_id)
-                if policies is None:
-                    try:
-                        policies = await fetch_commission_policies(db, camp_id)
-                        cache_commissions[camp_id] = policies or []
-                        for p in policies or []:
-                            crud.upsert_commission_policy(
-                                db,
-                                schemas.CommissionPolicyCreate(
-                                    campaign_id=str(camp_id),
-                                    reward_type=p.get("reward_type") or p.get("type"),
-                                    sales_ratio=p.get("sales_ratio") or p.get("ratio"),
-                                    sales_price=p.get("sales_price"),
-                                    target_month=p.get("target_month"),
-                                ),
-                            )
-                    except Exception:
-                        policies = []
-                        logger.debug("Skip commission upsert")
-
-                if only_with_commission:
-                    eligible_by_status = False
-                    try:
-                        _camp_row = crud.get_campaign_by_cid(db, camp_id)
-                        if _camp_row:
-                            _us = (_camp_row.user_registration_status or "").upper()
-                            if _us == "SUCCESSFUL":
-                                _us = "APPROVED"
-                            eligible_by_status = (_camp_row.status == "running") and (
-                                _us == "APPROVED"
-                            )
-                    except Exception:
-                        eligible_by_status = False
-
-                    has_commission = bool(policies) or eligible_by_status
-                    if not has_commission:
-                        if req.verbose:
-                            _vlog(
-                                "no_commission",
-                                {
-                                    "campaign_id": camp_id,
-                                    "merchant": merchant_norm,
-                                    "page": page,
-                                },
-                            )
-                        continue
-
-                # Promotions: lấy theo merchant, có cache + upsert DB
-                if merchant_norm not in promotion_cache:
-                    promotion_cache[merchant_norm] = (
-                        await fetch_promotions(db, merchant_norm) or []
-                    )
-                pr_list = promotion_cache.get(merchant_norm, [])
-                if pr_list:
-                    for prom in pr_list:
-                        try:
-                            crud.upsert_promotion(
-                                db,
-                                schemas.PromotionCreate(
-                                    campaign_id=camp_id,
-                                    name=prom.get("name"),
-                                    content=prom.get("content")
-                                    or prom.get("description"),
-                                    start_time=prom.get("start_time"),
-                                    end_time=prom.get("end_time"),
-                                    coupon=prom.get("coupon"),
-                                    link=prom.get("link"),
-                                ),
-                            )
-                        except Exception as e:
-                            logger.debug("Skip promotion upsert: %s", e)
-
-                # Campaign detail: đồng nhất upsert
-                try:
-                    camp = await fetch_campaign_detail(db, camp_id)
-                    if camp:
-                        status_val = camp.get("status")
-                        approval_val = camp.get("approval")
-
-                        def _map_status(v):
-                            s = str(v).strip() if v is not None else None
-                            if s == "1":
-                                return "running"
-                            if s == "0":
-                                return "paused"
-                            return s
-
-                        _user_raw = (
-                            camp.get("user_registration_status")
-                            or camp.get("publisher_status")
-                            or camp.get("user_status")
-                        )
-                        crud.upsert_campaign(
-                            db,
-                            schemas.CampaignCreate(
-                                campaign_id=str(camp.get("campaign_id") or camp_id),
-                                merchant=str(
-                                    camp.get("merchant") or merchant_norm or ""
-                                ).lower()
-                                or None,
-                                name=camp.get("name"),
-                                status=_map_status(status_val),
-                                approval=(
-                                    str(approval_val)
-                                    if approval_val is not None
-                                    else None
-                                ),
-                                start_time=camp.get("start_time"),
-                                end_time=camp.get("end_time"),
-                                user_registration_status=(
-                                    _user_raw
-                                    if _user_raw not in (None, "", [])
-                                    else None
-                                ),
-                            ),
-                        )
-                except Exception as e:
-                    logger.debug("Skip campaign upsert: %s", e)
-
-                # Chuẩn hoá record → ProductOfferCreate
-                data = map_at_product_to_offer(
-                    it, commission=policies, promotion=pr_list
-                )
-                if not data or not data.get("url"):
-                    continue
-                data["campaign_id"] = camp_id
-
-                # NEW: gắn loại nguồn + trạng thái phê duyệt & eligibility
-                data["source_type"] = "datafeeds"
-                _camp_row = crud.get_campaign_by_cid(db, camp_id)
-                if _camp_row:
-                    us = (_camp_row.user_registration_status or "").upper()
-                    if us == "SUCCESSFUL":
-                        us = "APPROVED"
-                    data["approval_status"] = (
-                        "successful"
-                        if us == "APPROVED"
-                        else (
-                            "pending"
-                            if us == "PENDING"
-                            else "unregistered" if us == "NOT_REGISTERED" else None
-                        )
-                    )
-                    data["eligible_commission"] = (_camp_row.status == "running") and (
-                        us == "APPROVED"
-                    )
-
-                # Link gốc: chỉ kiểm tra khi bật cờ (để tránh bỏ sót do chặn bot/timeout trong môi trường container)
-                if req.check_urls:
-                    if not await _check_url_alive(data["url"]):
-                        if req.verbose:
-                            _vlog(
-                                "dead_url",
-                                {
-                                    "url": data.get("url"),
-                                    "merchant": merchant_norm,
-                                    "page": page,
-                                },
-                            )
-                        continue
-
-                try:
-                    crud.upsert_offer_for_excel(db, schemas.ProductOfferCreate(**data))
-                except Exception:
-                    crud.upsert_offer_by_source(db, schemas.ProductOfferCreate(**data))
-                imported += 1
-
-            # Sau khi xử lý xong 1 trang cho merchant hiện tại
             total_pages += 1
+            fresh = _dedup_items(m, items)
+            if fresh:
+                yield {
+                    "merchant": m,
+                    "campaign_id": cid_for_fetch,
+                    "page": page,
+                    "items": fresh,
+                }
             # Dừng nếu trang hiện tại ít hơn limit → coi như trang cuối
             if len(items) < (req.limit_per_page or 100):
+                if from_first_page:
+                    exhausted.add(m)
                 break
 
             # Trang tiếp theo
@@ -2861,15 +3090,270 @@ async def ingest_accesstrade_datafeeds_all(
             sleep_ms = getattr(req, "throttle_ms", 0) or 0
             if sleep_ms:
                 await asyncio.sleep(sleep_ms / 1000.0)
+        if cursor:
+            cursor.done(m)
+
+    # enrich: kiểm tra campaign active/APPROVED, commission/promotions/campaign detail cho cả trang
+    async def _enrich(batch: dict):
+        merchant_norm, camp_id, page = (
+            batch["merchant"],
+            batch["campaign_id"],
+            batch["page"],
+        )
+        n_items = len(batch["items"])
 
-    return {"ok": True, "imported": imported, "pages": total_pages}
+        # Bỏ qua nếu campaign không active
+        if not camp_id or camp_id not in active_campaigns:
+            incomplete.add(merchant_norm)
+            _vlog(
+                "campaign_not_active",
+                {
+                    "campaign_id": camp_id,
+                    "merchant": merchant_norm,
+                    "page": page,
+                    "items": n_items,
+                },
+            )
+            return None
+
+        # YÊU CẦU: user APPROVED
+        if not ctx.campaigns.is_approved(camp_id):
+            # Fallback: nếu merchant có campaign khác đã APPROVED, dùng campaign đó
+            alt_cid = approved_cid_by_merchant.get(merchant_norm)
+            if not alt_cid:
+                incomplete.add(merchant_norm)
+                _vlog(
+                    "campaign_not_approved",
+                    {
+                        "campaign_id": camp_id,
+                        "merchant": merchant_norm,
+                        "page": page,
+                        "items": n_items,
+                    },
+                )
+                return None
+            _vlog(
+                "rebind_campaign_id",
+                {
+                    "from": camp_id,
+                    "to": alt_cid,
+                    "merchant": merchant_norm,
+                    "page": page,
+                },
+            )
+            camp_id = alt_cid
+
+        # Commission / promotions / campaign detail: memo theo campaign_id trong lần chạy
+        policies = await _enrich_commissions(ctx, camp_id)
+        pr_list = await _enrich_promotions(ctx, camp_id, merchant_norm)
+        await _enrich_campaign_detail(ctx, camp_id, merchant_norm)
+
+        batch.update(campaign_id=camp_id, policies=policies, promotions=pr_list)
+        return batch
+
+    # map: chuẩn hoá cả trang → payload ProductOfferCreate
+    async def _map(batch: dict):
+        camp_id, merchant_norm, page = (
+            batch["campaign_id"],
+            batch["merchant"],
+            batch["page"],
+        )
+        # NEW: gắn loại nguồn + trạng thái phê duyệt & eligibility
+        status_fields = _offer_status_fields(ctx.campaigns.get(camp_id))
+        offers = []
+        for data in map_at_products_to_offers(
+            batch["items"], commission=batch["policies"], promotion=batch["promotions"]
+        ):
+            if not data or not data.get("url"):
+                continue
+            data["campaign_id"] = camp_id
+            data["source_type"] = "datafeeds"
+            data.update(status_fields)
+            offers.append(data)
+
+        # Link gốc: chỉ kiểm tra khi bật cờ (để tránh bỏ sót do chặn bot/timeout trong môi trường container)
+        if req.check_urls and offers:
+            alive = await gather_limited(lambda d: _check_url_alive(d["url"]), offers)
+            kept = []
+            for data, ok in zip(offers, alive):
+                if not ok:
+                    _vlog(
+                        "dead_url",
+                        {
+                            "url": data.get("url"),
+                            "merchant": merchant_norm,
+                            "page": page,
+                        },
+                    )
+                    continue
+                kept.append(data)
+            offers = kept
+        if not offers:
+            incomplete.add(merchant_norm)
+            return None
+        return {"merchant": merchant_norm, "campaign_id": camp_id, "offers": offers}
+
+    async def _write(batch: dict):
+        nonlocal imported
+        offers = batch["offers"]
+        res = _write_offers(db, offers, run_gen=ctx.generation)
+        for k in counts:
+            counts[k] += res[k]
+        # cả offer không đổi: đã có và đúng trong DB
+        n = res["inserted"] + res["updated"] + res["unchanged"]
+        if n < len(offers):
+            incomplete.add(batch["merchant"])  # offer lỗi/không hợp lệ: không đóng dấu
+        cids_by_merchant.setdefault(batch["merchant"], set()).add(batch["campaign_id"])
+        imported += n
+        jobs.report(imported=imported, **counts)
+        return n
+
+    pipe = Pipeline(
+        [
+            Stage(
+                "fetch",
+                _fetch,
+                concurrency=req.fetch_concurrency,
+                count=lambda b: len(b["items"]),
+            ),
+            Stage("enrich", _enrich, count=lambda b: len(b["items"])),
+            Stage("map", _map, count=lambda b: len(b["offers"])),
+            Stage("write", _write, count=lambda n: n),
+        ],
+        queue_size=req.queue_size,
+        name="datafeeds_all",
+    )
+    # Lặp từng merchant đã APPROVED và gọi /v1/datafeeds với bộ lọc merchant
+    # (có cursor: xoay vòng bắt đầu từ merchant dừng ở lần chạy trước)
+    merchants_order = (
+        cursor.order(approved_merchants) if cursor else sorted(approved_merchants)
+    )
+    stages = await pipe.run(merchants_order)
+
+    # Sweep: lỗi stage không gán được cho merchant nào -> bỏ qua sweep cả lần chạy.
+    # Campaign cũng được ghi bởi merchant chưa quét hết thì không sweep.
+    retired = 0
+    sweep = req.sweep_missing and full_feed and not any(st["errors"] for st in stages)
+    if sweep and lease_held is not None and not lease_held():
+        # Shard đã bị worker khác nhận: lần chạy đó đóng dấu thế hệ khác lên cùng
+        # merchant, sweep ở đây sẽ retire offer nó vừa ghi
+        logger.warning("Skip sweep for shard %s: lease lost", shard)
+        sweep = False
+    if sweep:
+        swept = exhausted - incomplete
+        keep = {
+            cid for m, cs in cids_by_merchant.items() if m not in swept for cid in cs
+        }
+        cids = {
+            cid for m in swept for cid in cids_by_merchant.get(m, ()) if cid not in keep
+        }
+        try:
+            retired = crud.retire_unseen_offers(db, ctx.generation, cids)
+        except Exception as e:
+            db.rollback()
+            logger.warning("Skip retire unseen offers: %s", e)
+
+    out = {
+        "ok": True,
+        "imported": imported,
+        **counts,
+        "retired": retired,
+        "pages": total_pages,
+        "duplicates": seen.duplicates if seen else 0,
+        "stages": stages,
+        "memo": ctx.stats(),
+    }
+    if cursor:
+        out["checkpoint"] = cursor.state()
+    return out
+
+
+# TTL lease shard (giây); heartbeat gia hạn mỗi TTL/3
+INGEST_LEASE_TTL_SEC = int(os.getenv("INGEST_LEASE_TTL_SEC", "300") or 300)
+# Số key (merchant, source_id) giữ chính xác trong 1 lần chạy trước khi chuyển sang Bloom filter
+INGEST_DEDUP_EXACT_MAX = int(os.getenv("INGEST_DEDUP_EXACT_MAX", "200000") or 200000)
+
+
+async def ingest_datafeeds_sharded(
+    req: IngestAllDatafeedsReq, db: Session, *, deadline: float | None = None
+) -> dict:
+    """Quét datafeeds theo shard lease (bảng ingest_leases).
+
+    Mỗi lời gọi (trên bất kỳ worker/node nào) lần lượt claim shard còn trống hoặc shard
+    có lease hết hạn (worker chết) cho tới khi hết shard của vòng hiện tại hoặc quá
+    deadline. Gọi song song N lần (vd. N job background) để N worker cùng quét.
+    """
+    name = "datafeeds_all"
+    ttl = max(5, INGEST_LEASE_TTL_SEC)
+    owner = f"{job_runner.worker}:{uuid.uuid4().hex[:6]}"
+    round_no, shards = crud.begin_lease_round(db, name, req.shards)
+    totals = {
+        "imported": 0,
+        "inserted": 0,
+        "updated": 0,
+        "unchanged": 0,
+        "errors": 0,
+        "retired": 0,
+        "duplicates": 0,
+    }
+    done: list[dict] = []
+    # job bị huỷ: không claim thêm shard
+    while (deadline is None or time.time() < deadline) and not jobs.cancelled():
+        lease = crud.claim_lease(db, name, owner, ttl, round_no)
+        if lease is None:
+            break
+        k = lease.shard
+
+        def _renew(k=k) -> bool:
+            with _job_db() as hdb:
+                return crud.renew_lease(hdb, name, k, owner, ttl)
+
+        jobs.report(shard=k, shards=shards, round=round_no, **totals)
+        try:
+            async with LeaseHeartbeat(_renew, interval=ttl / 3) as hb:
+                res = await ingest_accesstrade_datafeeds_all(
+                    req,
+                    db,
+                    shard=(k, shards),
+                    sync_campaigns=not done,
+                    # trước khi sweep: lease còn của mình (gia hạn luôn) thì mới sweep
+                    lease_held=lambda hb=hb: not hb.lost and _renew(),
+                )
+        except BaseException:
+            db.rollback()
+            crud.release_lease(db, name, k, owner)
+            raise
+        summary = {key: res.get(key, 0) for key in totals}
+        kept = crud.complete_lease(db, name, k, owner, summary)
+        for key in totals:
+            totals[key] += summary[key]
+        done.append(
+            {
+                "shard": k,
+                "stolen": lease.attempts > 1,
+                "lease_lost": hb.lost or not kept,
+                **summary,
+            }
+        )
+    return {
+        "ok": True,
+        **totals,
+        "round": round_no,
+        "shards": shards,
+        "owner": owner,
+        "processed": done,
+    }
 
 
 async def ingest_v2_campaigns_sync(
     req: CampaignsSyncReq,
     db: Session = Depends(get_db),
 ):
-    from accesstrade_service import fetch_campaigns_full_all, fetch_campaign_detail
+    from accesstrade_service import (
+        fetch_campaigns_full_all,
+        invalidate_active_campaigns,
+        refresh_active_campaigns,
+    )
 
     # --- gom dữ liệu theo nhiều trạng thái (running/paused/...) nếu được truyền ---
     statuses = req.statuses or [
@@ -2877,6 +3361,7 @@ async def ingest_v2_campaigns_sync(
         "paused",
     ]  # mặc định: chạy cả running và paused
     unique = {}
+    running: list[dict] | None = None
     for st in statuses:
         try:
             items = await fetch_campaigns_full_all(
@@ -2892,18 +3377,13 @@ async def ingest_v2_campaigns_sync(
                 cid = str(it.get("campaign_id") or it.get("id") or "").strip()
                 if cid:
                     unique[cid] = it
+            if str(st).strip().lower() == "running":
+                running = list(items or [])
         except Exception as e:
             logger.error("ingest_v2_campaigns_sync: fetch failed (%s): %s", st, e)
 
-    imported = 0
-
-    def _map_status(v):
-        s = str(v).strip() if v is not None else None
-        if s == "1":
-            return "running"
-        if s == "0":
-            return "paused"
-        return s
+    # user_status hiện có trong DB: 1 query cho cả lần sync thay vì 1 query/campaign
+    directory = CampaignDirectory.load(db) if req.only_my else None
 
     def _split_approval_or_user(v):
         """
@@ -2920,86 +3400,80 @@ async def ingest_v2_campaigns_sync(
         # còn lại để nguyên cho kiểu duyệt (auto/manual/…)
         return (str(v), None)
 
+    rows: list[tuple[str, str, dict, str | None, str | None, str | None]] = []
     for camp in unique.values():
-        try:
-            camp_id = str(camp.get("campaign_id") or camp.get("id") or "").strip()
-            merchant = (
-                str(camp.get("merchant") or camp.get("name") or "").lower().strip()
-            )
-            if req.merchant and merchant != req.merchant.strip().lower():
-                continue
+        camp_id = str(camp.get("campaign_id") or camp.get("id") or "").strip()
+        merchant = str(camp.get("merchant") or camp.get("name") or "").lower().strip()
+        if req.merchant and merchant != req.merchant.strip().lower():
+            continue
+        status_val = _map_campaign_status(camp.get("status"))
+        approval_val, user_status = _split_approval_or_user(camp.get("approval"))
+        rows.append((camp_id, merchant, camp, status_val, approval_val, user_status))
 
-            status_val = _map_status(camp.get("status"))
-            approval_val, user_status = _split_approval_or_user(camp.get("approval"))
+    # enrich user_status từ detail nếu bật cờ (chính xác hơn): gọi song song có giới hạn
+    need_detail = [
+        r[0] for r in rows if req.enrich_user_status or (req.only_my and not r[5])
+    ]
+    details = (
+        await fetch_campaign_details(
+            db, need_detail, concurrency=req.detail_concurrency
+        )
+        if need_detail
+        else {}
+    )
 
-            # enrich user_status từ detail nếu bật cờ (chính xác hơn)
-            if req.enrich_user_status or (req.only_my and not user_status):
-                try:
-                    det = await fetch_campaign_detail(db, camp_id)
-                    if det:
-                        _user_raw = (
-                            det.get("user_registration_status")
-                            or det.get("publisher_status")
-                            or det.get("user_status")
-                        )
-                        # Fallback: đôi khi detail chỉ trả 'approval' = successful/pending/unregistered
-                        if not _user_raw:
-                            appr_det = det.get("approval")
-                            if isinstance(appr_det, str) and appr_det.lower() in (
-                                "successful",
-                                "pending",
-                                "unregistered",
-                            ):
-                                _user_raw = (
-                                    "APPROVED"
-                                    if appr_det.lower() == "successful"
-                                    else appr_det.upper()
-                                )
-                        if _user_raw not in (None, "", []):
-                            user_status = str(_user_raw).strip().upper()
-                except Exception:
-                    pass
+    payloads: list[schemas.CampaignCreate] = []
+    for camp_id, merchant, camp, status_val, approval_val, user_status in rows:
+        user_status = _detail_user_status(details.get(camp_id)) or user_status
 
-            # Lọc only_my: chỉ giữ APPROVED/PENDING.
-            # Nếu đã bật enrich_user_status nhưng vẫn KHÔNG lấy được user_status (API không trả),
-            # cho phép import để lưu lại trước (tránh imported=0 ở lần đầu).
-            if req.only_my:
-                existing = crud.get_campaign_by_cid(db, camp_id)
-                eff_user = user_status or (
-                    existing.user_registration_status if existing else None
+        # Lọc only_my: chỉ giữ APPROVED/PENDING.
+        # Nếu đã bật enrich_user_status nhưng vẫn KHÔNG lấy được user_status (API không trả),
+        # cho phép import để lưu lại trước (tránh imported=0 ở lần đầu).
+        eff_user = user_status
+        if req.only_my:
+            existing = directory.get(camp_id)
+            eff_user = user_status or (
+                existing.user_registration_status if existing else None
+            )
+            if eff_user not in ("APPROVED", "PENDING"):
+                if req.enrich_user_status and eff_user is None:
+                    logger.debug(
+                        "only_my=true: allow %s (%s) dù user_status chưa rõ (first-run).",
+                        camp_id,
+                        merchant,
+                    )
+                else:
+                    logger.debug(
+                        "only_my=true: skip %s (%s) vì user_status=%s",
+                        camp_id,
+                        merchant,
+                        eff_user,
+                    )
+                    continue
+        try:
+            payloads.append(
+                schemas.CampaignCreate(
+                    campaign_id=camp_id,
+                    merchant=merchant or None,
+                    name=camp.get("name"),
+                    status=status_val,
+                    approval=approval_val,  # KHÔNG còn ghi 'successful' ở đây nữa
+                    start_time=camp.get("start_time"),
+                    end_time=camp.get("end_time"),
+                    # Ghi user_status hiệu dụng (ưu tiên giá trị mới; nếu None dùng giá trị cũ để tránh NULL)
+                    user_registration_status=eff_user,  # NOT_REGISTERED / PENDING / APPROVED / None
                 )
-                if eff_user not in ("APPROVED", "PENDING"):
-                    if req.enrich_user_status and eff_user is None:
-                        logger.debug(
-                            "only_my=true: allow %s (%s) dù user_status chưa rõ (first-run).",
-                            camp_id,
-                            merchant,
-                        )
-                    else:
-                        logger.debug(
-                            "only_my=true: skip %s (%s) vì user_status=%s",
-                            camp_id,
-                            merchant,
-                            eff_user,
-                        )
-                        continue
-
-            payload = schemas.CampaignCreate(
-                campaign_id=camp_id,
-                merchant=merchant or None,
-                name=camp.get("name"),
-                status=status_val,
-                approval=approval_val,  # KHÔNG còn ghi 'successful' ở đây nữa
-                start_time=camp.get("start_time"),
-                end_time=camp.get("end_time"),
-                # Ghi user_status hiệu dụng (ưu tiên giá trị mới; nếu None dùng giá trị cũ để tránh NULL)
-                user_registration_status=eff_user,  # NOT_REGISTERED / PENDING / APPROVED / None
             )
-            crud.upsert_campaign(db, payload)
-            imported += 1
         except Exception as e:
             logger.debug("Skip campaign upsert: %s", e)
 
+    imported = _write_campaigns(db, payloads)
+
+    # Snapshot campaign đang chạy (dùng cho các pha ingest sau) theo kết quả sync vừa rồi
+    if running:
+        await refresh_active_campaigns(db, running)
+    else:
+        invalidate_active_campaigns()
     return {"ok": True, "imported": imported}
 
 
@@ -3009,6 +3483,8 @@ async def ingest_v2_campaigns_sync(
 async def ingest_v2_promotions(
     req: IngestV2PromotionsReq,
     db: Session = Depends(get_db),
+    *,
+    cursor: MerchantCursor | None = None,
 ):
     from accesstrade_service import fetch_promotions, fetch_active_campaigns, _log_jsonl
 
@@ -3024,12 +3500,12 @@ async def ingest_v2_promotions(
         # key không tồn tại → không có dữ liệu mới
         return None
 
-    # 0) Tập merchant cần chạy = theo yêu cầu hoặc theo DB các campaign đã APPROVED/SUCCESSFUL
+    # 0) Tập merchant cần chạy = theo yêu cầu hoặc theo DB các campaign đã APPROVED
     #    KHÔNG bắt buộc campaign đang running đối với việc lưu promotions
     #    Lưu ý: KHÔNG filter theo req.merchant ở đây để tránh miss do alias (vd tikivn ↔ tiki)
     approved_rows = (
         db.query(models.Campaign)
-        .filter(func.upper(func.trim(models.Campaign.user_registration_status)).in_(["APPROVED", "SUCCESSFUL"]))  # type: ignore
+        .filter(models.Campaign.user_registration_status == "APPROVED")
         .all()
     )
 
@@ -3049,10 +3525,13 @@ async def ingest_v2_promotions(
     if req.merchant:
         merchants = {req.merchant.strip().lower()}
 
-    # 1) Vòng lặp từng merchant
-    for m in sorted(merchants):
-        _alias = {"lazadacps": "lazada", "tikivn": "tiki"}
-        m_fetch = _alias.get(m, m)
+    # 1) Vòng lặp từng merchant (có cursor: xoay vòng từ merchant dừng ở lần trước)
+    for m in cursor.order(merchants) if cursor else sorted(merchants):
+        if cursor:
+            if cursor.expired():
+                break
+            cursor.done(m)
+        m_fetch = merchant_alias(m)
         promos = await fetch_promotions(db, m_fetch) or []
 
         # Chọn campaign_id đã APPROVED & RUNNING cho merchant này
@@ -3127,6 +3606,12 @@ async def ingest_v2_promotions(
         if sleep_ms:
             await asyncio.sleep(sleep_ms / 1000.0)
 
+    if cursor:
+        return {
+            "ok": True,
+            "promotions": imported_promos,
+            "checkpoint": cursor.state(),
+        }
     return {"ok": True, "promotions": imported_promos}
 
 
@@ -3136,12 +3621,15 @@ async def ingest_v2_promotions(
 async def ingest_v2_top_products(
     req: IngestV2TopProductsReq,
     db: Session = Depends(get_db),
+    *,
+    cursor: MerchantCursor | None = None,
 ):
     from accesstrade_service import (
         fetch_top_products,
         fetch_active_campaigns,
         _check_url_alive,
     )
+    from ingest_pipeline import Pipeline, Stage, gather_limited
 
     # 0) Lấy map campaign đang chạy {campaign_id: merchant}
     active = await fetch_active_campaigns(db)  # {campaign_id: merchant}
@@ -3150,24 +3638,18 @@ async def ingest_v2_top_products(
             c.campaign_id: c.merchant
             for c in db.query(models.Campaign)
             .filter(models.Campaign.status == "running")
-            .filter(
-                models.Campaign.user_registration_status.in_(["APPROVED", "SUCCESSFUL"])
-            )
+            .filter(models.Campaign.user_registration_status == "APPROVED")
             .all()
             if c.campaign_id and c.merchant
         }
 
+    # Campaign directory: 1 query cho toàn bộ quyết định APPROVED/running của lần chạy
+    campaigns = CampaignDirectory.load(db)
+
     # Xây danh sách merchants đã APPROVED & running
-    approved_running_merchants: set[str] = set()
-    for cid, m in active.items():
-        row = crud.get_campaign_by_cid(db, cid)
-        if not row:
-            continue
-        us = (row.user_registration_status or "").upper()
-        if us == "SUCCESSFUL":
-            us = "APPROVED"
-        if us == "APPROVED" and (row.status or "").lower() == "running":
-            approved_running_merchants.add((m or "").lower())
+    approved_running_merchants: set[str] = {
+        (m or "").lower() for cid, m in active.items() if campaigns.eligible(cid)
+    }
 
     # Toàn bộ merchants đang active (chỉ xét running theo API)
     all_active_merchants: set[str] = {(m or "").lower() for m in active.values() if m}
@@ -3190,43 +3672,31 @@ async def ingest_v2_top_products(
         date_from_use = req.date_from
         date_to_use = req.date_to
 
-    imported_total = 0
     result_by_merchant: dict[str, int] = {}
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0, "errors": 0}
     skipped_merchants: set[str] = set()
 
-    _alias = {"lazadacps": "lazada", "tikivn": "tiki"}
-
-    for m_req in sorted(merchants):
-        m_fetch = _alias.get(m_req, m_req)
-
-        # map merchant -> campaign_id đang chạy
-        campaign_id = None
-        for cid, mm in active.items():
-            mm_l = (mm or "").lower()
-            if mm_l == m_req or mm_l == m_fetch:
-                campaign_id = cid
-                break
-        if not campaign_id:
-            for cid, mm in active.items():
-                mm_l = (mm or "").lower()
-                if mm_l.endswith(m_req) or f"_{m_req}" in mm_l or (m_req in mm_l):
-                    campaign_id = cid
-                    break
-        if not campaign_id and m_fetch != m_req:
-            for cid, mm in active.items():
-                mm_l = (mm or "").lower()
-                if mm_l.endswith(m_fetch) or f"_{m_fetch}" in mm_l or (m_fetch in mm_l):
-                    campaign_id = cid
-                    break
+    resolver = MerchantResolver(active)
 
+    # fetch: mỗi merchant -> phân trang top_products
+    async def _fetch(m_req: str):
+        m_fetch = merchant_alias(m_req)
+        campaign_id = resolver.campaign_for(m_req)
         if not campaign_id:
             # Không tìm thấy campaign đang chạy cho merchant này
             skipped_merchants.add(m_req)
-            continue
-
-        page = 1
-        imported = 0
-        while page <= max(1, req.max_pages):
+            if cursor:
+                cursor.done(m_req)
+            return
+        result_by_merchant.setdefault(m_req, 0)
+
+        page = cursor.start_page(m_req) if cursor else 1
+        last_page = page + max(1, req.max_pages) - 1
+        while page <= last_page:
+            if cursor and cursor.expired():
+                cursor.stopped(m_req, page)
+                pipe.stop()
+                return
             items = await fetch_top_products(
                 db,
                 merchant=m_fetch,
@@ -3237,93 +3707,110 @@ async def ingest_v2_top_products(
             )
             if not items:
                 break
-
-            for it in items:
-                try:
-                    title = it.get("name") or "Sản phẩm"
-                    link = it.get("link") or it.get("url")
-                    aff = it.get("aff_link")
-                    img = it.get("image") or it.get("thumb")
-                    price = it.get("price")
-                    product_id = it.get("product_id") or it.get("id")
-
-                    if not link and not aff:
-                        logger.debug("[TOP] skip: no link/aff for %s", title)
-                        continue
-                    url_to_check = link or aff
-
-                    alive = (
-                        True
-                        if not req.check_urls
-                        else await _check_url_alive(str(url_to_check or ""))
-                    )
-                    if not alive:
-                        logger.debug("[TOP] skip: dead url %s", url_to_check)
-                        continue
-
-                    base_key = str(product_id or url_to_check)
-                    sid = hashlib.md5(base_key.encode("utf-8")).hexdigest()
-
-                    extra = {
-                        "source_type": "top_products",
-                        "raw": it,
-                    }
-                    try:
-                        _row = (
-                            crud.get_campaign_by_cid(db, campaign_id)
-                            if campaign_id
-                            else None
-                        )
-                        _user = (
-                            (_row.user_registration_status or "").upper()
-                            if _row
-                            else ""
-                        )
-                        if not _row or _user not in ("APPROVED", "SUCCESSFUL"):
-                            continue
-                    except Exception:
-                        continue
-
-                    payload = schemas.ProductOfferCreate(
-                        source="accesstrade",
-                        source_id=f"top:{m_req}:{sid}",
-                        merchant=m_req,
-                        title=title,
-                        url=link or aff,
-                        affiliate_url=aff,
-                        image_url=img,
-                        price=price,
-                        currency="VND",
-                        campaign_id=campaign_id,
-                        source_type="top_products",
-                        eligible_commission=bool(
-                            _row
-                            and _row.status == "running"
-                            and (_row.user_registration_status or "").upper()
-                            in ("APPROVED", "SUCCESSFUL")
-                        ),
-                        affiliate_link_available=bool(aff),
-                        product_id=str(product_id) if product_id is not None else None,
-                        extra=json.dumps(extra, ensure_ascii=False),
-                    )
-
-                    try:
-                        crud.upsert_offer_for_excel(db, payload)
-                    except Exception:
-                        crud.upsert_offer_by_source(db, payload)
-                    imported += 1
-                except Exception as e:
-                    logger.debug("Skip top_product upsert: %s", e)
+            yield {"merchant": m_req, "campaign_id": campaign_id, "items": items}
 
             page += 1
             sleep_ms = getattr(req, "throttle_ms", 0) or 0
             if sleep_ms:
                 await asyncio.sleep(sleep_ms / 1000.0)
+        if cursor:
+            cursor.done(m_req)
+
+    # enrich: campaign phải APPROVED; eligibility tính 1 lần cho cả trang
+    async def _enrich(batch: dict):
+        if not campaigns.is_approved(batch["campaign_id"]):
+            return None
+        batch["eligible"] = campaigns.is_running(batch["campaign_id"])
+        return batch
+
+    # map: item top_products → payload ProductOfferCreate (+ kiểm tra link nếu bật)
+    async def _map(batch: dict):
+        m_req, campaign_id = batch["merchant"], batch["campaign_id"]
+        offers = []
+        for it in batch["items"]:
+            title = it.get("name") or "Sản phẩm"
+            link = it.get("link") or it.get("url")
+            aff = it.get("aff_link")
+            product_id = it.get("product_id") or it.get("id")
+
+            if not link and not aff:
+                logger.debug("[TOP] skip: no link/aff for %s", title)
+                continue
+            url_to_check = link or aff
+            base_key = str(product_id or url_to_check)
+            sid = hashlib.md5(base_key.encode("utf-8")).hexdigest()
+            offers.append(
+                {
+                    "source": "accesstrade",
+                    "source_id": f"top:{m_req}:{sid}",
+                    "merchant": m_req,
+                    "title": title,
+                    "url": url_to_check,
+                    "affiliate_url": aff,
+                    "image_url": it.get("image") or it.get("thumb"),
+                    "price": it.get("price"),
+                    "currency": "VND",
+                    "campaign_id": campaign_id,
+                    "source_type": "top_products",
+                    "eligible_commission": batch["eligible"],
+                    "affiliate_link_available": bool(aff),
+                    "product_id": str(product_id) if product_id is not None else None,
+                    "extra": {"source_type": "top_products", "raw": it},
+                }
+            )
 
-        imported_total += imported
-        result_by_merchant[m_req] = imported
+        if req.check_urls and offers:
+            alive = await gather_limited(
+                lambda d: _check_url_alive(str(d["url"] or "")), offers
+            )
+            for data, ok in zip(offers, alive):
+                if not ok:
+                    logger.debug("[TOP] skip: dead url %s", data["url"])
+            offers = [d for d, ok in zip(offers, alive) if ok]
+
+        for data in offers:
+            data["extra"] = json_codec.dumps(data["extra"])
+        return {"merchant": m_req, "offers": offers} if offers else None
+
+    async def _write(batch: dict):
+        res = _write_offers(db, batch["offers"])
+        for k in counts:
+            counts[k] += res[k]
+        # cả offer không đổi: đã có và đúng trong DB
+        n = res["inserted"] + res["updated"] + res["unchanged"]
+        jobs.report(merchant=batch["merchant"], **counts)
+        result_by_merchant[batch["merchant"]] = (
+            result_by_merchant.get(batch["merchant"], 0) + n
+        )
+        return n
+
+    pipe = Pipeline(
+        [
+            Stage(
+                "fetch",
+                _fetch,
+                concurrency=req.fetch_concurrency,
+                count=lambda b: len(b["items"]),
+            ),
+            Stage("enrich", _enrich, count=lambda b: len(b["items"])),
+            Stage("map", _map, count=lambda b: len(b["offers"])),
+            Stage("write", _write, count=lambda n: n),
+        ],
+        queue_size=req.queue_size,
+        name="top_products",
+    )
+    stages = await pipe.run(cursor.order(merchants) if cursor else sorted(merchants))
 
-    resp = {"ok": True, "imported": imported_total, "by_merchant": result_by_merchant}
+    imported_total = sum(result_by_merchant.values())
+    resp = {
+        "ok": True,
+        "imported": imported_total,
+        **counts,
+        "by_merchant": result_by_merchant,
+        "stages": stages,
+    }
+    if cursor:
+        resp["checkpoint"] = cursor.state()
     if req.verbose:
         # Nếu không truyền merchant: coi các merchant active nhưng không approved là bị bỏ qua
         # Nếu có truyền merchant cụ thể: thêm vào skipped nếu merchant đó không thuộc approved_running
@@ -3370,12 +3857,15 @@ class IngestCommissionsReq(ProviderReq, BaseModel):
     - merchant: lọc theo merchant (nếu không truyền campaign_ids).
     - max_campaigns: giới hạn số campaign tối đa sẽ quét (để an toàn). Mặc định 100.
     - verbose: ghi log chi tiết vào JSONL.
+    - concurrency: số campaign lấy commission song song.
     """
 
     campaign_ids: list[str] | None = None
     merchant: str | None = None
     max_campaigns: int = 100
     verbose: bool = False
+    # Số campaign lấy commission song song (vẫn chịu ngân sách AT_MAX_CONCURRENCY)
+    concurrency: int = Field(8, ge=1, le=32)
 
     model_config = {
         "json_schema_extra": {
@@ -3429,12 +3919,19 @@ async def ingest_campaigns_sync_unified(
             }
         },
     ),
+    background: bool = Query(False, description=_BACKGROUND_QUERY_DESC),
     db: Session = Depends(get_db),
 ):
     prov = (req.provider or "accesstrade").lower()
     if prov == "accesstrade":
         inner = CampaignsSyncReq(**req.model_dump(exclude={"provider"}))
-        return await ingest_v2_campaigns_sync(inner, db)
+        if background:
+            return _submit_job(
+                "ingest",
+                {"endpoint": "/ingest/campaigns/sync", **req.model_dump()},
+                lambda jdb: ingest_v2_campaigns_sync(inner, jdb),
+            )
+        return await _run_off_loop(lambda jdb: ingest_v2_campaigns_sync(inner, jdb))
     raise HTTPException(
         status_code=400, detail=f"Provider '{prov}' hiện chưa được hỗ trợ"
     )
@@ -3467,12 +3964,19 @@ async def ingest_promotions_unified(
             }
         },
     ),
+    background: bool = Query(False, description=_BACKGROUND_QUERY_DESC),
     db: Session = Depends(get_db),
 ):
     prov = (req.provider or "accesstrade").lower()
     if prov == "accesstrade":
         inner = IngestV2PromotionsReq(**req.model_dump(exclude={"provider"}))
-        return await ingest_v2_promotions(inner, db)
+        if background:
+            return _submit_job(
+                "ingest",
+                {"endpoint": "/ingest/promotions", **req.model_dump()},
+                lambda jdb: ingest_v2_promotions(inner, jdb),
+            )
+        return await _run_off_loop(lambda jdb: ingest_v2_promotions(inner, jdb))
     raise HTTPException(
         status_code=400, detail=f"Provider '{prov}' hiện chưa được hỗ trợ"
     )
@@ -3509,12 +4013,19 @@ async def ingest_top_products_unified(
             }
         },
     ),
+    background: bool = Query(False, description=_BACKGROUND_QUERY_DESC),
     db: Session = Depends(get_db),
 ):
     prov = (req.provider or "accesstrade").lower()
     if prov == "accesstrade":
         inner = IngestV2TopProductsReq(**req.model_dump(exclude={"provider"}))
-        return await ingest_v2_top_products(inner, db)
+        if background:
+            return _submit_job(
+                "ingest",
+                {"endpoint": "/ingest/top-products", **req.model_dump()},
+                lambda jdb: ingest_v2_top_products(inner, jdb),
+            )
+        return await _run_off_loop(lambda jdb: ingest_v2_top_products(inner, jdb))
     raise HTTPException(
         status_code=400, detail=f"Provider '{prov}' hiện chưa được hỗ trợ"
     )
@@ -3550,12 +4061,24 @@ async def ingest_datafeeds_all_unified(
             }
         },
     ),
+    background: bool = Query(False, description=_BACKGROUND_QUERY_DESC),
     db: Session = Depends(get_db),
 ):
     prov = (req.provider or "accesstrade").lower()
     if prov == "accesstrade":
         inner = IngestAllDatafeedsReq(**req.model_dump(exclude={"provider"}))
-        return await ingest_accesstrade_datafeeds_all(inner, db)
+        run = (
+            ingest_datafeeds_sharded
+            if inner.shards > 1
+            else ingest_accesstrade_datafeeds_all
+        )
+        if background:
+            return _submit_job(
+                "ingest",
+                {"endpoint": "/ingest/datafeeds/all", **req.model_dump()},
+                lambda jdb: run(inner, jdb),
+            )
+        return await _run_off_loop(lambda jdb: run(inner, jdb))
     raise HTTPException(
         status_code=400, detail=f"Provider '{prov}' hiện chưa được hỗ trợ"
     )
@@ -3594,31 +4117,39 @@ async def ingest_commissions_unified(
             },
         },
     ),
+    background: bool = Query(False, description=_BACKGROUND_QUERY_DESC),
     db: Session = Depends(get_db),
 ):
-    from accesstrade_service import fetch_active_campaigns, fetch_commission_policies
-
     prov = (req.provider or "accesstrade").lower()
     if prov != "accesstrade":
         raise HTTPException(
             status_code=400, detail=f"Provider '{prov}' hiện chưa được hỗ trợ"
         )
+    if background:
+        return _submit_job(
+            "ingest",
+            {"endpoint": "/ingest/commissions", **req.model_dump()},
+            lambda jdb: _ingest_commissions_impl(req, jdb),
+        )
+    return await _run_off_loop(lambda jdb: _ingest_commissions_impl(req, jdb))
+
+
+async def _ingest_commissions_impl(req: IngestCommissionsReq, db: Session):
+    from accesstrade_service import fetch_active_campaigns, fetch_commission_policies
+    from ingest_pipeline import gather_limited
 
     # Xác định danh sách campaign_id cần lấy
     campaign_ids: list[str] = []
     if req.campaign_ids:
-        campaign_ids = [str(c).strip() for c in req.campaign_ids if str(c).strip()]
+        campaign_ids = list(
+            dict.fromkeys(str(c).strip() for c in req.campaign_ids if str(c).strip())
+        )
     else:
         # tất cả campaign đang chạy đã APPROVED (hoặc lọc theo merchant)
         active = await fetch_active_campaigns(db)  # {cid: merchant}
+        campaigns = CampaignDirectory.load(db)
         for cid, m in active.items():
-            row = crud.get_campaign_by_cid(db, cid)
-            if not row:
-                continue
-            us = (row.user_registration_status or "").upper()
-            if us == "SUCCESSFUL":
-                us = "APPROVED"
-            if us != "APPROVED":
+            if not campaigns.is_approved(cid):
                 continue
             if req.merchant and (m or "").lower() != req.merchant.strip().lower():
                 continue
@@ -3626,26 +4157,23 @@ async def ingest_commissions_unified(
         if req.max_campaigns and len(campaign_ids) > req.max_campaigns:
             campaign_ids = campaign_ids[: max(1, int(req.max_campaigns))]
 
-    imported = 0
-    for cid in campaign_ids:
+    # Fetch song song (mỗi campaign tối đa vài request, cùng chịu ngân sách AT_MAX_CONCURRENCY)
+    async def _fetch(cid: str) -> list:
         try:
-            items = await fetch_commission_policies(db, cid)
-            for rec in items or []:
-                crud.upsert_commission_policy(
-                    db,
-                    schemas.CommissionPolicyCreate(
-                        campaign_id=str(cid),
-                        reward_type=rec.get("reward_type") or rec.get("type"),
-                        sales_ratio=rec.get("sales_ratio") or rec.get("ratio"),
-                        sales_price=rec.get("sales_price"),
-                        target_month=rec.get("target_month"),
-                    ),
-                )
-                imported += 1
+            return await fetch_commission_policies(db, cid) or []
         except Exception as e:
             if req.verbose:
                 logger.debug("Ingest commission failed for %s: %s", cid, e)
-            continue
+            return []
+
+    fetched = await gather_limited(_fetch, campaign_ids, limit=req.concurrency)
+    payloads = [
+        p
+        for cid, items in zip(campaign_ids, fetched)
+        for p in _commission_payloads(cid, items)
+    ]
+    # Ghi cả lượt bằng 1 upsert theo lô (khoá campaign_id, reward_type, target_month)
+    imported = crud.bulk_upsert_commission_policies(db, payloads)
 
     return {"ok": True, "campaigns": len(campaign_ids), "policies_imported": imported}
 
@@ -3733,7 +4261,16 @@ def delete_offer_api(
         "Tác vụ quét toàn bộ sản phẩm trong DB, kiểm tra link sống/chết và **xoá tất cả** link chết."
     ),
 )
-async def cleanup_dead_offers(db: Session = Depends(get_db)):
+async def cleanup_dead_offers(
+    background: bool = Query(False, description=_BACKGROUND_QUERY_DESC),
+    db: Session = Depends(get_db),
+):
+    if background:
+        return _submit_job("offers_cleanup", {}, _cleanup_dead_offers_impl)
+    return await _run_off_loop(_cleanup_dead_offers_impl)
+
+
+async def _cleanup_dead_offers_impl(db: Session):
     offers = crud.list_offers(db, limit=1000)
     removed = 0
     alive_count = 0
@@ -3741,11 +4278,15 @@ async def cleanup_dead_offers(db: Session = Depends(get_db)):
     for idx, o in enumerate(offers, start=1):
         if idx % 50 == 0 or idx == total:
             logger.info("Cleanup progress: %d/%d", idx, total)
+            # commit theo lô: job bị huỷ giữa chừng vẫn giữ phần đã xoá
+            db.commit()
+            jobs.report(scanned=idx, total=total, dead=removed, alive=alive_count)
         alive = await _check_url_alive(o.url)  # chỉ dùng link gốc để tránh click ảo
         if not alive:
             logger.info(
                 "Removing dead product via API: id=%s, title='%s'", o.id, o.title
             )
+            crud.delete_price_history(db, [o.id])
             db.delete(o)
             removed += 1
         else:
@@ -3788,6 +4329,7 @@ async def scheduler_linkcheck_rotate(
     # lọc theo modulo tuỳ biến
     slice_q = (
         db.query(ProductOffer)
+        .filter(ProductOffer.retired_at.is_(None))
         .filter(text("id % :mod = :cur"))
         .params(mod=mod, cur=cursor)
     )
@@ -3806,6 +4348,7 @@ async def scheduler_linkcheck_rotate(
             alive_count += 1
         else:
             if delete_dead:
+                crud.delete_price_history(db, [o.id])
                 db.delete(o)
                 removed += 1
     db.commit()
@@ -3908,19 +4451,81 @@ class IngestRefreshReq(BaseModel):
     verbose: bool = False
 
 
+@app.get(
+    "/ingest/leases",
+    tags=["System 🛠️"],
+    summary="Trạng thái shard lease của ingest",
+    description=(
+        "Các shard của vòng quét hiện tại (ingest_leases): status pending/running/done, "
+        "owner (worker:pid), heartbeat/expires (epoch giây), số lần claim và kết quả shard."
+    ),
+)
+def list_ingest_leases_api(
+    name: str = Query("datafeeds_all"), db: Session = Depends(get_db)
+):
+    return {"name": name, "leases": crud.list_leases(db, name)}
+
+
+# ---------------- Jobs (tác vụ nền) ----------------
+@app.get(
+    "/jobs",
+    tags=["System 🛠️"],
+    summary="Danh sách job nền gần đây",
+    response_class=FastJSONResponse,
+)
+def list_jobs_api(
+    type: str | None = Query(None, description="Lọc theo loại job"),
+    status: str | None = Query(
+        None, description="queued/running/succeeded/failed/cancelled"
+    ),
+    limit: int = Query(50, ge=1, le=500),
+):
+    return job_runner.list(job_type=type, status=status, limit=limit)
+
+
+@app.get(
+    "/jobs/{job_id}",
+    tags=["System 🛠️"],
+    summary="Trạng thái job nền",
+    description="Tiến độ (progress), kết quả từng phần/cuối (result) và lỗi của job.",
+    response_class=FastJSONResponse,
+)
+def get_job_api(job_id: str):
+    job = job_runner.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job")
+    return job
+
+
+@app.post(
+    "/jobs/{job_id}/cancel",
+    tags=["System 🛠️"],
+    summary="Huỷ job nền",
+    description="Job đang chờ bị huỷ ngay; job đang chạy dừng ở điểm chờ I/O kế tiếp (giữ kết quả từng phần).",
+)
+def cancel_job_api(job_id: str, _auth: bool | None = Depends(require_admin_key)):
+    job = job_runner.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job")
+    return job
+
+
 @app.get(
     "/scheduler/ingest/lock/status",
     tags=["Settings ⚙️"],
     summary="Trạng thái khoá ingest-refresh",
 )
 def ingest_lock_status(db: Session = Depends(get_db)):
-    return crud.get_ingest_lock_status(db, name="ingest_refresh")
+    st = crud.get_ingest_lock_status(db, name="ingest_refresh")
+    # Con trỏ resume theo phase (merchant/trang lần chạy sau sẽ bắt đầu)
+    st["checkpoints"] = crud.list_ingest_checkpoints(db, name="ingest_refresh")
+    return st
 
 
 @app.post(
     "/scheduler/ingest/lock/release",
     tags=["Settings ⚙️"],
-    summary="Tháo khoá ingest-refresh (best-effort)",
+    summary="Tháo khoá ingest-refresh",
     description=(
         "Tháo khoá nếu owner trùng hoặc khoá đã hết hạn. Dùng force=true (yêu cầu X-Admin-Key) để buộc giải phóng."
     ),
@@ -3964,30 +4569,92 @@ async def scheduler_ingest_refresh(
         },
     ),
     request: Request = None,  # type: ignore
+    background: bool = Query(False, description=_BACKGROUND_QUERY_DESC),
     db: Session = Depends(get_db),
 ):
-    import time as _time
-
     prov = (body.provider or "accesstrade").lower()
     if prov != "accesstrade":
         raise HTTPException(status_code=400, detail=f"Provider '{prov}' chưa hỗ trợ")
 
-    # Xác định owner từ header hoặc hostname
+    # Xác định owner từ header hoặc hostname:pid (mỗi tiến trình uvicorn 1 owner riêng)
     owner = request.headers.get("X-Worker-Id") if request else None  # type: ignore
     if not owner:
-        try:
-            owner = os.getenv("HOSTNAME") or os.uname().nodename  # type: ignore
-        except Exception:
-            owner = "api-node"
+        owner = job_runner.worker
 
     ttl = int(body.lock_ttl_sec or (body.max_minutes * 60 + 60))
     if not crud.acquire_ingest_lock(db, owner=owner, ttl_sec=ttl, name="ingest_refresh"):
         st = crud.get_ingest_lock_status(db, name="ingest_refresh")
         raise HTTPException(status_code=423, detail={"message": "Khoá đang bận", "lock": st})
+    if background:
+        # Khoá đã chiếm ở đây (trả 423 ngay nếu bận); job giữ khoá tới khi xong
+        return _submit_job(
+            "ingest_refresh",
+            {"owner": owner, **body.model_dump()},
+            lambda jdb: _scheduler_ingest_refresh_impl(body, owner, ttl, jdb),
+        )
+    return await _run_off_loop(
+        lambda jdb: _scheduler_ingest_refresh_impl(body, owner, ttl, jdb)
+    )
+
+
+async def _scheduler_ingest_refresh_impl(
+    body: IngestRefreshReq, owner: str, ttl: int, db: Session
+):
+    # Job nền có thể chờ trong hàng: gia hạn ngay khi bắt đầu, mất khoá thì không chạy
+    if not crud.renew_ingest_lock(db, owner, ttl, name="ingest_refresh"):
+        st = crud.get_ingest_lock_status(db, name="ingest_refresh")
+        raise HTTPException(
+            status_code=423, detail={"message": "Mất khoá trước khi chạy", "lock": st}
+        )
+
+    def _renew() -> bool:
+        with _job_db() as hdb:
+            return crud.renew_ingest_lock(hdb, owner, ttl, name="ingest_refresh")
+
+    # Heartbeat gia hạn khoá mỗi ttl/3 trong lúc chạy; tiến trình chết thì khoá hết hạn sau ttl
+    # Mọi pha trong lần chạy dùng chung 1 snapshot campaign đang chạy (sync nạp lại ở pha 1)
+    async with LeaseHeartbeat(_renew, interval=ttl / 3) as hb:
+        with pin_active_campaigns(ttl):
+            out = await _scheduler_ingest_refresh_run(body, owner, db)
+    if hb.lost:
+        out.setdefault("_meta", {})["lock_lost"] = True
+    return out
+
+
+async def _scheduler_ingest_refresh_run(
+    body: IngestRefreshReq, owner: str, db: Session
+):
+    import time as _time
 
     started = int(_time.time())
     deadline = started + int(body.max_minutes * 60)
     results: dict[str, dict | int] = {"_meta": {"owner": owner, "started": started, "deadline": deadline}}
+
+    # Checkpoint theo phase: lần sau chạy tiếp từ merchant/trang bị dừng (xoay vòng công bằng)
+    def _cursor(phase: str) -> MerchantCursor:
+        try:
+            cp = crud.get_ingest_checkpoint(db, "ingest_refresh", phase)
+        except Exception:
+            cp = None
+        return MerchantCursor.from_checkpoint(cp, deadline=deadline)
+
+    def _save_checkpoint(phase: str, cur: MerchantCursor) -> None:
+        st = cur.state()
+        try:
+            if st:
+                crud.save_ingest_checkpoint(
+                    db,
+                    "ingest_refresh",
+                    phase,
+                    st["merchant"],
+                    st["page"],
+                    {"pages": st["pages"], "pending": st["pending"]},
+                )
+            else:
+                crud.clear_ingest_checkpoint(db, "ingest_refresh", phase)
+        except Exception as e:
+            logger.debug("Skip checkpoint save (%s): %s", phase, e)
+
     try:
         # Log start
         try:
@@ -4019,8 +4686,10 @@ async def scheduler_ingest_refresh(
             window_pages=10,
             throttle_ms=max(0, body.throttle_ms or 0),
         )
+        jobs.report(phase="campaigns_sync")
         res1 = await ingest_v2_campaigns_sync(req1, db)
         results["campaigns_sync"] = res1  # type: ignore
+        jobs.partial("campaigns_sync", res1)
         if _time.time() >= deadline:
             results["_stopped"] = {"reason": "deadline", "at": int(_time.time())}
             return {"ok": True, **results}
@@ -4029,8 +4698,12 @@ async def scheduler_ingest_refresh(
 
         # 2) Promotions
         req2 = IngestV2PromotionsReq(merchant=None, verbose=False, throttle_ms=max(0, body.throttle_ms or 0))
-        res2 = await ingest_v2_promotions(req2, db)
+        jobs.report(phase="promotions")
+        cur2 = _cursor("promotions")
+        res2 = await ingest_v2_promotions(req2, db, cursor=cur2)
+        _save_checkpoint("promotions", cur2)
         results["promotions"] = res2  # type: ignore
+        jobs.partial("promotions", res2)
         if _time.time() >= deadline:
             results["_stopped"] = {"reason": "deadline", "at": int(_time.time())}
             return {"ok": True, **results}
@@ -4044,9 +4717,18 @@ async def scheduler_ingest_refresh(
             throttle_ms=max(0, body.throttle_ms or 0),
             check_urls=False,
             verbose=False,
+            shards=max(1, int(os.getenv("INGEST_SHARDS", "1") or 1)),
         )
-        res3 = await ingest_accesstrade_datafeeds_all(req3, db)
+        jobs.report(phase="datafeeds_all")
+        if req3.shards > 1:
+            # Shard lease thay cho checkpoint: shard dở dang được chạy lại ở lần sau
+            res3 = await ingest_datafeeds_sharded(req3, db, deadline=deadline)
+        else:
+            cur3 = _cursor("datafeeds_all")
+            res3 = await ingest_accesstrade_datafeeds_all(req3, db, cursor=cur3)
+            _save_checkpoint("datafeeds_all", cur3)
         results["datafeeds_all"] = res3  # type: ignore
+        jobs.partial("datafeeds_all", res3)
         if _time.time() >= deadline:
             results["_stopped"] = {"reason": "deadline", "at": int(_time.time())}
             return {"ok": True, **results}
@@ -4061,8 +4743,20 @@ async def scheduler_ingest_refresh(
                 max_pages=1,
                 throttle_ms=max(0, body.throttle_ms or 0),
             )
-            res4 = await ingest_v2_top_products(req4, db)
+            jobs.report(phase="top_products")
+            cur4 = _cursor("top_products")
+            res4 = await ingest_v2_top_products(req4, db, cursor=cur4)
+            _save_checkpoint("top_products", cur4)
             results["top_products"] = res4  # type: ignore
+            jobs.partial("top_products", res4)
+
+        # 5) Xoá hẳn offer đã retired quá hạn giữ (theo chunk, không gọi HTTP)
+        jobs.report(phase="purge_retired")
+        keep_days = int(os.getenv("OFFER_RETIRED_RETENTION_DAYS", "7") or 7)
+        purged = crud.purge_retired_offers(
+            db, datetime.now(UTC) - timedelta(days=max(0, keep_days))
+        )
+        results["purge_retired"] = {"deleted": purged, "retention_days": keep_days}
 
         # Done
         finished = int(_time.time())
@@ -4108,10 +4802,8 @@ async def scheduler_ingest_refresh(
         "Kiểm tra nhanh trạng thái link của một sản phẩm trong DB theo ID."
     ),
 )
-async def check_offer_status(offer_id: int, db: Session = Depends(get_db)):
-    offer = (
-        db.query(models.ProductOffer).filter(models.ProductOffer.id == offer_id).first()
-    )
+async def check_offer_status(offer_id: int, db: AsyncSession = Depends(get_async_db)):
+    offer = await crud.aget_offer_by_id(db, offer_id)
     if not offer:
         raise HTTPException(status_code=404, detail="Offer not found")
     alive = await _check_url_alive(offer.url)  # chỉ check link gốc để tránh click ảo
@@ -4191,6 +4883,7 @@ def delete_all_offers_api(
     "/catalog/promotions",
     tags=["Offers 🛒"],
     response_model=list[schemas.PromotionOut],
+    response_class=FastJSONResponse,
     summary="Liệt kê promotions",
     description="Danh sách promotions trong DB (phân trang).",
 )
@@ -4209,6 +4902,7 @@ def list_catalog_promotions(
     "/catalog/commissions",
     tags=["Offers 🛒"],
     response_model=list[schemas.CommissionPolicyOut],
+    response_class=FastJSONResponse,
     summary="Liệt kê commission policies",
     description="Danh sách chính sách hoa hồng theo chiến dịch (phân trang).",
 )
@@ -4239,7 +4933,9 @@ except Exception:
     description="Upload file Excel (.xlsx) chứa danh sách sản phẩm để import vào DB.",
 )
 async def import_offers_excel(
-    file: UploadFile = File(...), db: Session = Depends(get_db)
+    file: UploadFile = File(...),
+    background: bool = Query(False, description=_BACKGROUND_QUERY_DESC),
+    db: Session = Depends(get_db),
 ):
     if not file.filename.endswith(".xlsx"):
         raise HTTPException(status_code=400, detail="Chỉ hỗ trợ file .xlsx")
@@ -4250,6 +4946,17 @@ async def import_offers_excel(
         xls = pd.ExcelFile(io.BytesIO(content))
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Lỗi đọc file Excel: {e}")
+    if background:
+        # nội dung đã nằm trong bộ nhớ → job không phụ thuộc UploadFile (đóng sau request)
+        return _submit_job(
+            "excel_import",
+            {"filename": file.filename, "size": len(content)},
+            lambda jdb: _import_offers_excel_impl(xls, jdb),
+        )
+    return await _run_off_loop(lambda jdb: _import_offers_excel_impl(xls, jdb))
+
+
+async def _import_offers_excel_impl(xls, db: Session):
 
     # BẮT BUỘC: File Excel phải có 2 hàng tiêu đề
     # - Hàng 1: tiêu đề kỹ thuật (tên cột gốc) → được pandas dùng làm df.columns
@@ -4356,6 +5063,7 @@ async def import_offers_excel(
     from accesstrade_service import _check_url_alive
 
     imported = 0
+    pending_offers: list[schemas.ProductOfferCreate] = []
     skipped_required = 0
     required_errors: list[dict] = []
 
@@ -4378,7 +5086,9 @@ async def import_offers_excel(
         s = s.strip()
         return s if s != "" else None
 
-    for _, row in df.iterrows():
+    for row_no, (_, row) in enumerate(df.iterrows(), start=1):
+        if row_no % 200 == 0:
+            jobs.report(sheet="Products", rows=row_no, total=len(df), imported=imported)
         # Map columns expected in Products sheet coming from API datafeeds
         # Coerce and sanitize typical Excel NaN/empty values
         _price_val = row.get("price")
@@ -4495,7 +5205,7 @@ async def import_offers_excel(
         # Thêm các trường mở rộng
         for k, v in extra_fields.items():
             extra[k] = v
-        base["extra"] = json.dumps(extra, ensure_ascii=False)
+        base["extra"] = json_codec.dumps(extra)
 
         if only_with_commission:
             # Xác định đủ điều kiện: có cột eligible_commission=True hoặc có ít nhất một trường commission hợp lệ
@@ -4556,14 +5266,12 @@ async def import_offers_excel(
             except Exception:
                 continue
 
-        # Dùng upsert đặc thù cho Excel: ưu tiên cập nhật theo source_id (bất kể source hiện có)
-        try:
-            crud.upsert_offer_for_excel(db, data)
-        except Exception:
-            # fallback an toàn nếu hàm mới không khả dụng
-            crud.upsert_offer_by_source(db, data)
+        # Gom lại để upsert theo lô (ưu tiên cập nhật theo source_id bất kể source hiện có)
+        pending_offers.append(data)
         imported += 1
 
+    offer_counts = crud.bulk_upsert_offers(db, pending_offers, match_any_source=True)
+
     # =========================
     # IMPORT: Campaigns sheet
     # =========================
@@ -4797,6 +5505,9 @@ async def import_offers_excel(
     result = {
         "ok": True,
         "imported": imported,  # backward-compatible: số sản phẩm Products
+        "offers_inserted": offer_counts["inserted"],
+        "offers_updated": offer_counts["updated"],
+        "offers_unchanged": offer_counts["unchanged"],
         "campaigns": imported_campaigns,
         "commissions": imported_commissions,
         "promotions": imported_promotions,
@@ -4829,7 +5540,6 @@ def export_offers_excel(
     db: Session = Depends(get_db),
 ):
     import os
-    import json
 
     try:
         import pandas as pd  # type: ignore
@@ -4840,7 +5550,8 @@ def export_offers_excel(
     q_offers = db.query(models.ProductOffer).filter(
         models.ProductOffer.source_type.in_(
             ["datafeeds", "top_products", "manual", "excel"]
-        )  # loại bỏ "promotions"
+        ),  # loại bỏ "promotions"
+        models.ProductOffer.retired_at.is_(None),
     )
     if merchant:
         q_offers = q_offers.filter(models.ProductOffer.merchant == merchant.lower())
@@ -4854,11 +5565,10 @@ def export_offers_excel(
         q_offers = q_offers.limit(limit)
     offers = q_offers.all()
 
-    # 2) Campaigns: độc lập, chỉ APPROVED/SUCCESSFUL (chuẩn hoá theo uppercase/trim)
-    norm_user = func.upper(func.trim(models.Campaign.user_registration_status))
+    # 2) Campaigns: độc lập, chỉ APPROVED (cột đã chuẩn hoá khi ghi)
     campaigns_all = (
         db.query(models.Campaign)
-        .filter(norm_user.in_(["APPROVED", "SUCCESSFUL"]))
+        .filter(models.Campaign.user_registration_status == "APPROVED")
         .order_by(models.Campaign.campaign_id.asc())
         .all()
     )
@@ -4882,7 +5592,7 @@ def export_offers_excel(
         # Convert dict/list to JSON string
         if isinstance(v, (dict, list)):
             try:
-                v = json.dumps(v, ensure_ascii=False)
+                v = json_codec.dumps(v)
             except Exception:
                 v = str(v)
         # Convert datetime to ISO
@@ -4937,7 +5647,7 @@ def export_offers_excel(
             with open(path, "r", encoding="utf-8") as f:
                 for line in f:
                     try:
-                        yield json.loads(line)
+                        yield json_codec.loads(line)
                     except Exception:
                         pass
         except FileNotFoundError:
@@ -4993,7 +5703,7 @@ def export_offers_excel(
         extra = {}
         if o.extra:
             try:
-                extra = json.loads(o.extra)
+                extra = json_codec.loads(o.extra)
             except Exception:
                 extra = {}
         df_products_rows.append(
@@ -5023,12 +5733,10 @@ def export_offers_excel(
                 "updated_at": _sanitize_val(
                     o.updated_at.isoformat() if o.updated_at else None
                 ),
-                "desc": _sanitize_val(extra.get("desc")),
-                "cate": _sanitize_val(extra.get("cate")),
-                "shop_name": _sanitize_val(extra.get("shop_name")),
-                "update_time_raw": _sanitize_val(
-                    extra.get("update_time_raw") or extra.get("update_time")
-                ),
+                "desc": _sanitize_val(o.desc),
+                "cate": _sanitize_val(o.cate),
+                "shop_name": _sanitize_val(o.shop_name),
+                "update_time_raw": _sanitize_val(o.update_time_raw),
             }
         )
 
@@ -5479,7 +6187,7 @@ def campaign_description_page(campaign_id: str, db: Session = Depends(get_db)):
         with open(path, "r", encoding="utf-8") as f:
             for line in f:
                 try:
-                    rec = json.loads(line)
+                    rec = json_codec.loads(line)
                     if str(rec.get("campaign_id")) == str(campaign_id):
                         data = rec.get("raw", {}).get("data")
                         if isinstance(data, list) and data:
@@ -5532,14 +6240,17 @@ def campaign_description_page(campaign_id: str, db: Session = Depends(get_db)):
         " và commission policies (thử nhiều biến thể tham số). Cho frontend hiển thị nhanh trong 1 request."
     ),
 )
-async def campaign_extras(campaign_id: str, db: Session = Depends(get_db)):
+async def campaign_extras(campaign_id: str, db: AsyncSession = Depends(get_async_db)):
     detail: dict | None = None
     promotions: list[dict] = []
     policies: list[dict] = []
     merchant: str | None = None
+    # Config nạp 1 lần qua AsyncSession, truyền cho các hàm fetch thay cho Session sync
+    # (chưa có config: APIConfig rỗng -> các hàm fetch báo "Chưa cấu hình" như trước)
+    cfg = await crud.aget_api_config(db, "accesstrade") or models.APIConfig()
     # Lấy detail (có thể None nếu API không trả)
     try:
-        detail = await fetch_campaign_detail(db, campaign_id)
+        detail = await fetch_campaign_detail(cfg, campaign_id)
         if isinstance(detail, dict):
             merchant = (
                 detail.get("merchant") or detail.get("campaign") or ""
@@ -5550,13 +6261,13 @@ async def campaign_extras(campaign_id: str, db: Session = Depends(get_db)):
     # Lấy promotions dựa vào merchant
     if merchant:
         try:
-            promotions = await fetch_promotions(db, merchant) or []
+            promotions = await fetch_promotions(cfg, merchant) or []
         except Exception as e:
             promotions = [{"error": str(e)}]
 
     # Lấy commission policies
     try:
-        policies = await fetch_commission_policies(db, campaign_id) or []
+        policies = await fetch_commission_policies(cfg, campaign_id) or []
     except Exception as e:
         policies = [{"error": str(e)}]
 
@@ -5631,7 +6342,7 @@ def tail_log(request: Request, filename: str, n: int = Query(200, ge=1, le=2000)
             if not line:
                 continue
             try:
-                out.append(json.loads(line))
+                out.append(json_codec.loads(line))
             except Exception:
                 out.append({"_raw": line})
         return {"ok": True, "filename": safe_name, "lines": out, "count": len(out)}
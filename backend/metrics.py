@@ -0,0 +1,279 @@
+"""
+Metrics dạng Prometheus (text exposition 0.0.4) cho ingest và các lời gọi upstream.
+
+Counter/histogram giữ trong dict của process (1 lock, không I/O trên đường nóng).
+Khi chạy nhiều worker uvicorn, đặt `METRICS_MULTIPROC_DIR` (thư mục dùng chung, xoá
+sạch trước khi khởi động): mỗi process định kỳ ghi snapshot `<pid>-<id>.json` vào đó
+và `/metrics` cộng dồn snapshot của mọi process — bất kể request scrape rơi vào worker nào.
+Không đặt biến này thì `/metrics` chỉ trả số liệu của process hiện tại.
+
+Ví dụ:
+    UPSTREAM_SECONDS.observe(0.12, endpoint="datafeeds", status="200")
+    with DB_WRITE_SECONDS.time(op="bulk_upsert_offers"):
+        ...
+    INGEST_SKIPPED.inc(endpoint="datafeeds_all", reason="no_campaign")
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+logger = logging.getLogger("affiliate_api")
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Registry:
+    def __init__(self, directory: str | None = None, flush_sec: float = 5.0) -> None:
+        self._lock = threading.Lock()
+        self._meta: Dict[str, tuple] = {}  # name -> (type, help, buckets)
+        self._counters: Dict[Tuple[str, LabelKey], float] = {}
+        # name+labels -> [count từng bucket (không cộng dồn)..., +Inf, sum]
+        self._hists: Dict[Tuple[str, LabelKey], List[float]] = {}
+        self.directory = directory
+        self.flush_sec = max(0.5, float(flush_sec))
+        self._dirty = False
+        self._flusher: threading.Thread | None = None
+        self._file = f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json"
+
+    # --- khai báo ---
+    def counter(self, name: str, help: str) -> "Counter":
+        self._meta[name] = ("counter", help, ())
+        return Counter(self, name)
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS) -> "Histogram":
+        self._meta[name] = ("histogram", help, tuple(sorted(buckets)))
+        return Histogram(self, name)
+
+    # --- ghi ---
+    def _inc(self, name: str, value: float, labels: Dict[str, object]) -> None:
+        k = (name, _key(labels))
+        with self._lock:
+            self._counters[k] = self._counters.get(k, 0.0) + value
+            self._touch()
+
+    def _observe(self, name: str, value: float, labels: Dict[str, object]) -> None:
+        buckets = self._meta[name][2]
+        k = (name, _key(labels))
+        i = 0
+        while i < len(buckets) and value > buckets[i]:
+            i += 1
+        with self._lock:
+            h = self._hists.get(k)
+            if h is None:
+                h = self._hists[k] = [0.0] * (len(buckets) + 2)
+            h[i] += 1
+            h[-1] += value
+            self._touch()
+
+    def _touch(self) -> None:
+        self._dirty = True
+        if self.directory and self._flusher is None:
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name="metrics-flush", daemon=True
+            )
+            self._flusher.start()
+
+    # --- snapshot / gộp nhiều process ---
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": [[n, list(lb), v] for (n, lb), v in self._counters.items()],
+                "hists": [[n, list(lb), list(h)] for (n, lb), h in self._hists.items()],
+            }
+
+    def flush(self) -> None:
+        if not self.directory or not self._dirty:
+            return
+        self._dirty = False
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, self._file)
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, path)
+        except Exception as e:
+            self._dirty = True
+            logger.debug("metrics flush error: %s", e)
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.flush_sec)
+            self.flush()
+
+    def _snapshots(self) -> List[dict]:
+        if not self.directory:
+            return [self.snapshot()]
+        self._dirty = True
+        self.flush()
+        out = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        for fn in names:
+            if not fn.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, fn)) as f:
+                    out.append(json.load(f))
+            except Exception as e:
+                logger.debug("metrics snapshot %s unreadable: %s", fn, e)
+        return out
+
+    def collect(self) -> Tuple[dict, dict]:
+        """Cộng dồn snapshot mọi process: (counters, hists) theo (name, labels)."""
+        counters: Dict[Tuple[str, LabelKey], float] = {}
+        hists: Dict[Tuple[str, LabelKey], List[float]] = {}
+        for snap in self._snapshots():
+            for n, lb, v in snap.get("counters", []):
+                k = (n, tuple(tuple(p) for p in lb))
+                counters[k] = counters.get(k, 0.0) + v
+            for n, lb, h in snap.get("hists", []):
+                k = (n, tuple(tuple(p) for p in lb))
+                cur = hists.get(k)
+                if cur is None or len(cur) != len(h):
+                    hists[k] = list(h)
+                else:
+                    hists[k] = [a + b for a, b in zip(cur, h)]
+        return counters, hists
+
+    def render(self) -> str:
+        counters, hists = self.collect()
+        lines: List[str] = []
+        for name, (kind, help, buckets) in sorted(self._meta.items()):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (n, lb), v in sorted(counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{_fmt_labels(lb)} {_fmt(v)}")
+                continue
+            for (n, lb), h in sorted(hists.items()):
+                if n != name or len(h) != len(buckets) + 2:
+                    continue
+                acc = 0.0
+                for le, c in zip(buckets, h):
+                    acc += c
+                    lines.append(
+                        f"{name}_bucket{_fmt_labels(lb, le=_fmt(le))} {_fmt(acc)}"
+                    )
+                acc += h[len(buckets)]
+                lines.append(f"{name}_bucket{_fmt_labels(lb, le='+Inf')} {_fmt(acc)}")
+                lines.append(f"{name}_sum{_fmt_labels(lb)} {_fmt(h[-1])}")
+                lines.append(f"{name}_count{_fmt_labels(lb)} {_fmt(acc)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter:
+    def __init__(self, registry: Registry, name: str) -> None:
+        self._r, self.name = registry, name
+
+    def inc(self, value: float = 1, **labels: object) -> None:
+        self._r._inc(self.name, value, labels)
+
+
+class Histogram:
+    def __init__(self, registry: Registry, name: str) -> None:
+        self._r, self.name = registry, name
+
+    def observe(self, value: float, **labels: object) -> None:
+        self._r._observe(self.name, value, labels)
+
+    @contextmanager
+    def time(self, **labels: object) -> Iterator[dict]:
+        """Đo thời gian khối lệnh; caller có thể đặt thêm label vào dict trả về (vd. outcome)."""
+        t0 = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(lb: LabelKey, **extra: str) -> str:
+    pairs = list(lb) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in pairs) + "}"
+
+
+def _fmt(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+REGISTRY = Registry(
+    os.getenv("METRICS_MULTIPROC_DIR") or None,
+    flush_sec=float(os.getenv("METRICS_FLUSH_SEC", "5") or 5),
+)
+atexit.register(REGISTRY.flush)
+
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    "at_upstream_request_seconds",
+    "Latency of Accesstrade API calls by endpoint and HTTP status (status=error: no response).",
+)
+INGEST_ITEMS = REGISTRY.counter(
+    "ingest_items_total",
+    "Items produced by each ingest pipeline stage (fetch/enrich/map/write) per pipeline.",
+)
+INGEST_STAGE_ERRORS = REGISTRY.counter(
+    "ingest_stage_errors_total", "Items that raised in an ingest pipeline stage."
+)
+INGEST_SKIPPED = REGISTRY.counter(
+    "ingest_skipped_total", "Items skipped during ingest by endpoint and reason."
+)
+OFFERS_WRITTEN = REGISTRY.counter(
+    "offers_written_total",
+    "Offer rows handled by bulk upsert (inserted/updated/unchanged).",
+)
+DB_WRITE_SECONDS = REGISTRY.histogram(
+    "db_write_seconds", "Latency of DB batch writes by operation and outcome."
+)
+DB_POOL_WAIT_SECONDS = REGISTRY.histogram(
+    "db_pool_wait_seconds",
+    "Time spent waiting for a pooled DB connection by outcome (ok/timeout/error).",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 10.0, 30.0),
+)
+LOCK_WAIT_SECONDS = REGISTRY.histogram(
+    "ingest_lock_wait_seconds",
+    "Time spent acquiring ingest locks/leases by name and outcome.",
+)
+LINKCHECK = REGISTRY.counter(
+    "linkcheck_total", "Link liveness checks by outcome (alive/dead/error/skipped)."
+)
+
+
+def render() -> str:
+    return REGISTRY.render()
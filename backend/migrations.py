@@ -0,0 +1,401 @@
+"""
+Migration có phiên bản (không dùng Alembic).
+
+Mỗi bước là `Migration(version, name, fn)`; `fn(engine)` phải idempotent. Bảng
+`schema_version` ghi bước đã chạy nên lần khởi động sau chỉ cần 1 query đọc phiên bản:
+không còn introspect schema ở mọi worker. Nhiều worker khởi động cùng lúc trên Postgres
+tuần tự hoá bằng advisory lock; bước nào lỗi thì dừng (không ghi phiên bản) và chạy lại
+ở lần khởi động sau.
+
+Index trên bảng lớn tạo bằng `CREATE INDEX CONCURRENTLY` (Postgres, ngoài transaction)
+để không khoá ghi; định nghĩa index lấy từ models.py (create_all tạo sẵn cho DB mới).
+
+Thêm thay đổi schema: thêm 1 `Migration` mới cuối `MIGRATIONS` (version tăng dần),
+không sửa bước đã phát hành.
+
+Ví dụ:
+    applied = run_migrations(engine)  # [{"version": 2, "name": "composite_indexes", ...}]
+    migration_status(engine)          # {"current": 2, "latest": 2, "pending": []}
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator, List
+
+from sqlalchemy import bindparam, inspect, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateIndex
+
+import models
+from database import Base, apply_simple_migrations
+
+logger = logging.getLogger("affiliate_api")
+
+# Khoá advisory (Postgres) cho runner; số bất kỳ, cố định giữa các tiến trình
+_ADVISORY_KEY = 0x5C4E_0A11
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    fn: Callable[[Engine], None]
+
+
+def create_index(engine: Engine, name: str) -> bool:
+    """
+    Tạo index `name` (khai báo trong models.py) nếu chưa có; False nếu bảng chưa tồn tại.
+    Postgres: CONCURRENTLY trên connection autocommit; index INVALID còn sót từ lần tạo
+    bị ngắt giữa chừng được drop rồi tạo lại.
+    """
+    idx = next(
+        (
+            ix
+            for tbl in Base.metadata.tables.values()
+            for ix in tbl.indexes
+            if ix.name == name
+        ),
+        None,
+    )
+    if idx is None:
+        raise KeyError(f"Index {name!r} không có trong models")
+    if not inspect(engine).has_table(idx.table.name):
+        return False
+    ddl = str(CreateIndex(idx, if_not_exists=True).compile(dialect=engine.dialect))
+    if engine.dialect.name != "postgresql":
+        with engine.begin() as conn:
+            conn.execute(text(ddl))
+        return True
+
+    ddl = ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1).replace(
+        "CREATE UNIQUE INDEX", "CREATE UNIQUE INDEX CONCURRENTLY", 1
+    )
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        # Build index có thể lâu hơn statement_timeout của profile web
+        conn.execute(text("SET statement_timeout = 0"))
+        try:
+            invalid = conn.execute(
+                text(
+                    "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                    "WHERE c.relname = :n AND NOT i.indisvalid"
+                ),
+                {"n": name},
+            ).first()
+            if invalid:
+                conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+            conn.execute(text(ddl))
+        finally:
+            conn.execute(text("RESET statement_timeout"))
+    return True
+
+
+def merge_duplicates(
+    engine: Engine,
+    table: str,
+    key: list[str],
+    fill: tuple[str, ...],
+    *,
+    where: str = "1=1",
+    repoint: tuple[tuple[str, str], ...] = (),
+) -> int:
+    """
+    Gộp bản ghi trùng khoá `key` (biểu thức SQL) về bản ghi id lớn nhất của mỗi nhóm:
+    cột `fill` đang NULL ở bản giữ lại được lấp từ bản trùng mới nhất có giá trị; bảng con
+    `repoint` ((bảng, cột FK), ...) được trỏ sang bản giữ lại thay vì xoá; rồi xoá bản trùng.
+    Mỗi nhóm 1 transaction; lỗi thì raise (bước migration không được ghi nhận).
+    Trả về số bản ghi đã xoá.
+    """
+    keys = ", ".join(f"{k} AS k{i}" for i, k in enumerate(key))
+    match = " AND ".join(f"{k} = :k{i}" for i, k in enumerate(key))
+    cols = ", ".join(("id",) + fill)
+    with engine.connect() as conn:
+        groups = conn.execute(
+            text(
+                f"SELECT {keys} FROM {table} WHERE {where} "
+                f"GROUP BY {', '.join(key)} HAVING COUNT(*) > 1"
+            )
+        ).all()
+    removed = 0
+    for g in groups:
+        params = {f"k{i}": v for i, v in enumerate(g)}
+        with engine.begin() as conn:
+            rows = conn.execute(
+                text(
+                    f"SELECT {cols} FROM {table} WHERE {where} AND {match} ORDER BY id DESC"
+                ),
+                params,
+            ).all()
+            if len(rows) < 2:
+                continue
+            keep, losers = rows[0], rows[1:]
+            patch = {}
+            for i, col in enumerate(fill, start=1):
+                if keep[i] is None:
+                    v = next((r[i] for r in losers if r[i] is not None), None)
+                    if v is not None:
+                        patch[col] = v
+            if patch:
+                sets = ", ".join(f"{c} = :{c}" for c in patch)
+                conn.execute(
+                    text(f"UPDATE {table} SET {sets} WHERE id = :keep_id"),
+                    {**patch, "keep_id": keep[0]},
+                )
+            ids = [r[0] for r in losers]
+            for child, fk in repoint:
+                conn.execute(
+                    text(
+                        f"UPDATE {child} SET {fk} = :keep_id WHERE {fk} IN :ids"
+                    ).bindparams(bindparam("ids", expanding=True)),
+                    {"keep_id": keep[0], "ids": ids},
+                )
+            conn.execute(
+                text(f"DELETE FROM {table} WHERE id IN :ids").bindparams(
+                    bindparam("ids", expanding=True)
+                ),
+                {"ids": ids},
+            )
+            removed += len(ids)
+    if removed:
+        logger.warning(
+            "Merged %d duplicate %s rows in %d groups", removed, table, len(groups)
+        )
+    return removed
+
+
+# Cột mà apply_simple_migrations phải thêm cho DB cũ; code ghi/đọc (bulk upsert, sweep) cần đủ
+_BASELINE_COLUMNS = {
+    "product_offers": (
+        "campaign_id",
+        "approval_status",
+        "eligible_commission",
+        "source_type",
+        "affiliate_link_available",
+        "product_id",
+        "extra",
+        "updated_at",
+        "content_hash",
+        "seen_run",
+        "retired_at",
+    ),
+    "affiliate_templates": ("platform",),
+}
+
+
+def _baseline(engine: Engine) -> None:
+    # Các bước cũ (thêm cột, dọn dữ liệu) — đã idempotent nhưng tự nuốt lỗi DDL, nên kiểm
+    # tra lại kết quả: thiếu cột thì raise để bước không được ghi nhận và chạy lại lần sau
+    apply_simple_migrations(engine)
+    insp = inspect(engine)
+    missing = [
+        f"{table}.{col}"
+        for table, cols in _BASELINE_COLUMNS.items()
+        if insp.has_table(table)
+        for col in sorted(set(cols) - {c["name"] for c in insp.get_columns(table)})
+    ]
+    if missing:
+        raise RuntimeError(f"Baseline migration thiếu cột: {', '.join(missing)}")
+    create_index(engine, "ix_product_offers_retired_at")
+
+
+def _composite_indexes(engine: Engine) -> None:
+    for name in (
+        "ix_product_offers_source_id",
+        "ix_product_offers_source_type_merchant",
+        "ix_campaigns_status_user_status",
+        "ix_promotions_lookup",
+        "ix_commission_policies_lookup",
+        "ix_shortlinks_created_at",
+        "ix_shortlinks_click_count",
+    ):
+        create_index(engine, name)
+
+
+def _normalize_user_status(engine: Engine) -> None:
+    # Dòng cũ trước khi crud chuẩn hoá khi ghi: " approved", "successful", ""...
+    # Sau bước này filter dùng so sánh bằng trực tiếp (dùng được index) thay vì UPPER(TRIM()).
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                """
+                UPDATE campaigns SET user_registration_status = CASE
+                    WHEN UPPER(TRIM(user_registration_status)) = 'SUCCESSFUL' THEN 'APPROVED'
+                    WHEN TRIM(user_registration_status) = '' THEN NULL
+                    ELSE UPPER(TRIM(user_registration_status)) END
+                WHERE user_registration_status IS NOT NULL
+                  AND (user_registration_status <> UPPER(TRIM(user_registration_status))
+                       OR user_registration_status IN ('', 'SUCCESSFUL'))
+                """
+            )
+        )
+
+
+def _offer_extra_columns(engine: Engine, batch_size: int = 1000) -> None:
+    # Cột desc/cate/shop_name/update_time_raw tách từ product_offers.extra (crud.offer_extra_fields)
+    from crud import _OFFER_EXTRA_COLS, offer_extra_fields
+
+    insp = inspect(engine)
+    if not insp.has_table("product_offers"):
+        return
+    tbl = models.ProductOffer.__table__
+    have = {c["name"] for c in insp.get_columns("product_offers")}
+    with engine.begin() as conn:
+        for key in _OFFER_EXTRA_COLS:
+            col = tbl.c[key]
+            if col.name not in have:
+                # Cột nullable không default: chỉ đổi metadata, không rewrite bảng
+                ddl_type = col.type.compile(dialect=engine.dialect)
+                conn.execute(
+                    text(f"ALTER TABLE product_offers ADD COLUMN {col.name} {ddl_type}")
+                )
+
+    # Backfill theo lô id tăng dần, mỗi lô 1 transaction ngắn
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select(tbl.c.id, tbl.c.extra)
+                .where(tbl.c.id > last_id, tbl.c.extra.is_not(None))
+                .order_by(tbl.c.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            params = []
+            for oid, extra in rows:
+                vals = offer_extra_fields(extra)
+                if any(v is not None for v in vals.values()):
+                    params.append({"oid": oid, **vals})
+            if params:
+                # executemany: SET theo key của params (desc/cate/shop_name/update_time_raw)
+                conn.execute(tbl.update().where(tbl.c.id == bindparam("oid")), params)
+
+    for name in ("ix_product_offers_cate", "ix_product_offers_shop_name"):
+        create_index(engine, name)
+
+
+def _keyset_indexes(engine: Engine) -> None:
+    # Index (cột sort, id) cho phân trang keyset /offers, /campaigns (pagination.keyset_page)
+    for name in (
+        "ix_product_offers_updated_at_id",
+        "ix_product_offers_price_id",
+        "ix_campaigns_updated_at_id",
+    ):
+        create_index(engine, name)
+
+
+def _offer_source_key_unique(engine: Engine) -> None:
+    # Khoá tự nhiên (source, source_id) cho bulk upsert ON CONFLICT: gộp bản trùng (giữ id lớn
+    # nhất, price_history chuyển sang bản giữ lại) rồi tạo unique index
+    insp = inspect(engine)
+    if not insp.has_table("product_offers"):
+        return
+    repoint = (
+        (("price_history", "offer_id"),) if insp.has_table("price_history") else ()
+    )
+    merge_duplicates(
+        engine,
+        "product_offers",
+        ["source", "source_id"],
+        (
+            "merchant",
+            "affiliate_url",
+            "image_url",
+            "price",
+            "campaign_id",
+            "approval_status",
+            "source_type",
+            "product_id",
+            "extra",
+        ),
+        where="source_id IS NOT NULL",
+        repoint=repoint,
+    )
+    create_index(engine, "uq_product_offers_source_source_id")
+
+
+def _commission_policy_key_unique(engine: Engine) -> None:
+    # Unique (campaign_id, reward_type, target_month) — NULL trùng NULL qua COALESCE —
+    # cho bulk upsert ON CONFLICT: gộp bản trùng về id lớn nhất rồi tạo index biểu thức
+    if not inspect(engine).has_table("commission_policies"):
+        return
+    merge_duplicates(
+        engine,
+        "commission_policies",
+        ["campaign_id", "COALESCE(reward_type, '')", "COALESCE(target_month, '')"],
+        ("sales_ratio", "sales_price"),
+        where="campaign_id IS NOT NULL",
+    )
+    create_index(engine, "uq_commission_policy_key")
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "baseline_simple_migrations", _baseline),
+    Migration(2, "composite_indexes", _composite_indexes),
+    Migration(3, "normalize_user_registration_status", _normalize_user_status),
+    Migration(4, "offer_extra_columns", _offer_extra_columns),
+    Migration(5, "keyset_indexes", _keyset_indexes),
+    Migration(6, "offer_source_key_unique", _offer_source_key_unique),
+    Migration(7, "commission_policy_key_unique", _commission_policy_key_unique),
+]
+
+
+def _applied(engine: Engine) -> set[int]:
+    with engine.connect() as conn:
+        return set(conn.execute(select(models.SchemaVersion.version)).scalars())
+
+
+@contextmanager
+def _runner_lock(engine: Engine) -> Iterator[None]:
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": _ADVISORY_KEY})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": _ADVISORY_KEY})
+
+
+def run_migrations(engine: Engine) -> list[dict]:
+    """Chạy các bước chưa áp dụng theo thứ tự version; trả danh sách bước vừa chạy."""
+    models.SchemaVersion.__table__.create(engine, checkfirst=True)
+    if not [m for m in MIGRATIONS if m.version not in _applied(engine)]:
+        return []
+    done: list[dict] = []
+    with _runner_lock(engine):
+        # Worker khác có thể vừa chạy xong trong lúc chờ khoá
+        applied = _applied(engine)
+        for m in MIGRATIONS:
+            if m.version in applied:
+                continue
+            t0 = time.perf_counter()
+            try:
+                m.fn(engine)
+            except Exception:
+                logger.exception("Migration %s (%s) failed", m.version, m.name)
+                break
+            ms = int((time.perf_counter() - t0) * 1000)
+            with engine.begin() as conn:
+                conn.execute(
+                    models.SchemaVersion.__table__.insert().values(
+                        version=m.version, name=m.name, duration_ms=ms
+                    )
+                )
+            logger.info("Migration %s (%s) applied in %d ms", m.version, m.name, ms)
+            done.append({"version": m.version, "name": m.name, "duration_ms": ms})
+    return done
+
+
+def migration_status(engine: Engine) -> dict:
+    applied = _applied(engine)
+    return {
+        "current": max(applied, default=0),
+        "latest": MIGRATIONS[-1].version,
+        "pending": [m.name for m in MIGRATIONS if m.version not in applied],
+    }
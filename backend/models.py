@@ -7,10 +7,11 @@ from sqlalchemy import (
     Text,
     Boolean,
     Float,
+    BigInteger,
 )
 from database import Base
 from datetime import datetime, UTC
-from sqlalchemy import JSON, UniqueConstraint
+from sqlalchemy import JSON, Index, UniqueConstraint, func, literal_column
 
 
 class AffiliateLink(Base):
@@ -65,6 +66,12 @@ class Shortlink(Base):
     last_click_at = Column(DateTime(timezone=True), nullable=True, index=True)
     click_count = Column(Integer, default=0)
 
+    __table_args__ = (
+        # /shortlinks sắp xếp theo created_at hoặc click_count
+        Index("ix_shortlinks_created_at", "created_at"),
+        Index("ix_shortlinks_click_count", "click_count"),
+    )
+
 
 # --- THÊM MỚI: bảng product_offers ---
 class ProductOffer(Base):
@@ -103,12 +110,35 @@ class ProductOffer(Base):
     )  # id sản phẩm theo nguồn (nếu có)
 
     extra = Column(Text, nullable=True)  # string JSON tuỳ ý
+    # Trường hay đọc/lọc tách từ extra lúc ghi (crud.offer_extra_fields), API không phải parse JSON.
+    # Cột "description" vì DESC là từ khoá SQL.
+    desc = Column("description", Text, key="desc", nullable=True)
+    cate = Column(String, index=True, nullable=True)
+    shop_name = Column(String, index=True, nullable=True)
+    update_time_raw = Column(String, nullable=True)
+    # Hash nội dung của lần bulk upsert gần nhất; trùng hash -> bỏ qua UPDATE không đổi.
+    # Các đường ghi khác (sửa tay, upsert từng dòng) đặt lại NULL.
+    content_hash = Column(String(32), nullable=True)
+    # Mark-and-sweep: thế hệ (run generation) của lần ingest datafeeds gần nhất thấy offer;
+    # retired_at != NULL = đã biến mất khỏi feed (ẩn khỏi danh sách, xoá hẳn sau retention)
+    seen_run = Column(BigInteger, nullable=True)
+    retired_at = Column(DateTime(timezone=True), nullable=True, index=True)
     updated_at = Column(
         DateTime(timezone=True),
         default=lambda: datetime.now(UTC),
         onupdate=lambda: datetime.now(UTC),
     )
 
+    __table_args__ = (
+        # Khoá tự nhiên cho bulk upsert (INSERT ... ON CONFLICT (source, source_id))
+        Index("uq_product_offers_source_source_id", "source", "source_id", unique=True),
+        # /offers lọc theo nhóm nguồn + merchant
+        Index("ix_product_offers_source_type_merchant", "source_type", "merchant"),
+        # Phân trang keyset /offers theo (updated_at, id) / (price, id) — pagination.keyset_page
+        Index("ix_product_offers_updated_at_id", "updated_at", "id"),
+        Index("ix_product_offers_price_id", "price", "id"),
+    )
+
 
 # --- NEW: bảng price_history (lưu lịch sử giá) ---
 class PriceHistory(Base):
@@ -137,7 +167,8 @@ class Campaign(Base):
     start_time = Column(String, nullable=True)
     end_time = Column(String, nullable=True)
 
-    # trạng thái đăng ký/duyệt của PUBLISHER (bạn)
+    # trạng thái đăng ký/duyệt của PUBLISHER (bạn); luôn lưu dạng chuẩn hoá (crud.upsert_campaign:
+    # trim + upper, SUCCESSFUL -> APPROVED, rỗng -> NULL) để filter so sánh bằng dùng được index
     user_registration_status = Column(
         String, index=True, nullable=True
     )  # NOT_REGISTERED/PENDING/APPROVED
@@ -148,6 +179,13 @@ class Campaign(Base):
         onupdate=lambda: datetime.now(UTC),
     )
 
+    __table_args__ = (
+        # campaign đang chạy + đã duyệt (ingest, /campaigns/approved-merchants)
+        Index("ix_campaigns_status_user_status", "status", "user_registration_status"),
+        # Phân trang keyset /campaigns (mặc định updated_at giảm dần)
+        Index("ix_campaigns_updated_at_id", "updated_at", "id"),
+    )
+
 
 # --- NEW: bảng commission_policies (chính sách hoa hồng theo campaign) ---
 class CommissionPolicy(Base):
@@ -166,6 +204,31 @@ class CommissionPolicy(Base):
         onupdate=lambda: datetime.now(UTC),
     )
 
+    __table_args__ = (
+        # upsert từng dòng tra theo đúng 3 cột (kể cả IS NULL) — index biểu thức không dùng được
+        Index(
+            "ix_commission_policies_lookup",
+            "campaign_id",
+            "reward_type",
+            "target_month",
+        ),
+    )
+
+
+def commission_policy_key(tbl=None) -> list:
+    """Khoá tự nhiên (campaign_id, reward_type, target_month) của commission_policies.
+    NULL được COALESCE về '' để NULL trùng NULL (unique index thường coi 2 NULL là khác nhau)."""
+    c = (tbl if tbl is not None else CommissionPolicy.__table__).c
+    return [
+        c.campaign_id,
+        func.coalesce(c.reward_type, literal_column("''")),
+        func.coalesce(c.target_month, literal_column("''")),
+    ]
+
+
+# Unique index theo biểu thức cho bulk upsert (INSERT ... ON CONFLICT (<khoá ở trên>))
+Index("uq_commission_policy_key", *commission_policy_key(), unique=True)
+
 
 # --- NEW: bảng promotions (khuyến mãi theo campaign) ---
 class Promotion(Base):
@@ -186,6 +249,11 @@ class Promotion(Base):
         onupdate=lambda: datetime.now(UTC),
     )
 
+    __table_args__ = (
+        # upsert_promotion tra bản ghi theo (campaign_id, name, start_time, end_time)
+        Index("ix_promotions_lookup", "campaign_id", "name", "start_time", "end_time"),
+    )
+
 
 # --- NEW: bảng web_vitals (lưu các chỉ số hiệu năng từ frontend) ---
 class WebVitalMetric(Base):
@@ -205,3 +273,99 @@ class WebVitalMetric(Base):
         DateTime(timezone=True), default=lambda: datetime.now(UTC), index=True
     )
     extra = Column(Text, nullable=True)  # JSON tuỳ ý (attribution, sources, ...)
+
+
+# --- NEW: bảng ingest_checkpoints (con trỏ resume theo phase của ingest định kỳ) ---
+class IngestCheckpoint(Base):
+    __tablename__ = "ingest_checkpoints"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, nullable=False)  # tên job, vd. ingest_refresh
+    phase = Column(String, nullable=False)  # promotions | datafeeds_all | top_products
+    merchant = Column(String, nullable=True)  # merchant chạy tiếp ở lần sau
+    page = Column(Integer, nullable=True)  # trang chạy tiếp của merchant đó
+    state = Column(Text, nullable=True)  # JSON: {"pages": {merchant: page}, ...}
+    updated_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(UTC),
+        onupdate=lambda: datetime.now(UTC),
+    )
+
+    __table_args__ = (UniqueConstraint("name", "phase", name="uq_ingest_checkpoint"),)
+
+
+# --- NEW: bảng jobs (tác vụ nền: ingest, cleanup, import Excel) ---
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(String, primary_key=True)  # uuid hex
+    type = Column(String, index=True, nullable=False)  # ingest | ingest_refresh | ...
+    status = Column(
+        String, index=True, default="queued"
+    )  # queued/running/succeeded/failed/cancelled
+    worker = Column(String, nullable=True)  # hostname:pid của tiến trình chạy job
+    params = Column(Text, nullable=True)  # JSON tham số gửi lên
+    progress = Column(Text, nullable=True)  # JSON tiến độ (cập nhật định kỳ)
+    result = Column(Text, nullable=True)  # JSON kết quả (một phần khi đang chạy/bị huỷ)
+    error = Column(Text, nullable=True)
+    cancel_requested = Column(Boolean, default=False)
+    created_at = Column(
+        DateTime(timezone=True), default=lambda: datetime.now(UTC), index=True
+    )
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    updated_at = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(UTC),
+        onupdate=lambda: datetime.now(UTC),
+    )
+
+
+# --- NEW: bảng ingest_leases (chia shard merchants cho nhiều worker/node) ---
+class IngestLease(Base):
+    __tablename__ = "ingest_leases"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, nullable=False)  # tên tác vụ, vd. datafeeds_all
+    shard = Column(Integer, nullable=False)  # 0..shards-1 (crc32(merchant) % shards)
+    shards = Column(Integer, nullable=False)  # tổng số shard của vòng hiện tại
+    round = Column(
+        Integer, nullable=False, default=1
+    )  # vòng quét; hết shard -> vòng mới
+    status = Column(String, nullable=False, default="pending")  # pending/running/done
+    owner = Column(String, nullable=True)  # hostname:pid[:task] đang giữ lease
+    attempts = Column(
+        Integer, nullable=False, default=0
+    )  # số lần được claim (kể cả steal)
+    # Thời điểm dạng epoch giây: so sánh thuần số, không phụ thuộc timezone của DB
+    heartbeat_at = Column(Float, nullable=True)
+    expires_at = Column(Float, nullable=True)
+    finished_at = Column(Float, nullable=True)
+    result = Column(Text, nullable=True)  # JSON kết quả shard
+
+    __table_args__ = (UniqueConstraint("name", "shard", name="uq_ingest_lease"),)
+
+
+class IngestLock(Base):
+    """Mutex cho tác vụ chạy định kỳ (vd. ingest_refresh): 1 dòng/khoá, chiếm nguyên tử
+    (Postgres SELECT ... FOR UPDATE SKIP LOCKED, SQLite BEGIN IMMEDIATE), giữ bằng heartbeat."""
+
+    __tablename__ = "ingest_locks"
+
+    name = Column(String, primary_key=True)  # tên khoá, vd. ingest_refresh
+    owner = Column(String, nullable=True)  # None = trống
+    ttl = Column(Integer, nullable=False, default=0)  # giây; gia hạn theo heartbeat
+    # Thời điểm dạng epoch giây (như ingest_leases)
+    acquired_at = Column(Float, nullable=True)
+    heartbeat_at = Column(Float, nullable=True)
+    expires_at = Column(Float, nullable=True)
+
+
+# --- Phiên bản schema: mỗi bước migration (migrations.py) đã chạy ghi 1 dòng ---
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    applied_at = Column(DateTime(timezone=True), default=lambda: datetime.now(UTC))
+    duration_ms = Column(Integer, nullable=True)
@@ -0,0 +1,145 @@
+"""
+Phân trang keyset (cursor) cho danh sách lớn (/offers, /campaigns).
+
+Thay OFFSET (quét lại toàn bộ phần đã bỏ qua) bằng điều kiện "sau bản ghi cuối trang trước"
+trên khoá sắp xếp ổn định `(cột, id)` — mỗi trang là 1 range scan trên index `(cột, id)`,
+chi phí không đổi dù trang sâu, và không lệch/lặp khi ingest ghi chen giữa các trang.
+
+Sort: "id", "updated_at", "price" (tiền tố "-" = giảm dần). NULL xếp như giá trị lớn nhất
+(tăng dần: NULLS LAST, giảm dần: NULLS FIRST — đúng thứ tự index B-tree của Postgres); phần
+NULL được đọc bằng truy vấn riêng khi phần có giá trị đã hết, để điều kiện keyset luôn là
+so sánh tuple dùng được index.
+
+Cursor là chuỗi opaque (base64url của JSON) gắn với sort đã dùng để tạo nó.
+
+Ví dụ:
+    rows = keyset_page(q, models.ProductOffer, "-price", after=None, limit=50)
+    token = next_cursor(rows, "-price", 50)           # None nếu đã hết
+    rows2 = keyset_page(q, models.ProductOffer, "-price",
+                        after=decode_cursor(token, "-price"), limit=50)
+"""
+
+from __future__ import annotations
+
+import base64
+import binascii
+from datetime import datetime
+from typing import Any, Sequence
+
+from sqlalchemy import tuple_
+
+import json_codec
+
+# Sort hợp lệ chung; endpoint có thể giới hạn tập con qua Literal
+SORT_KEYS = ("id", "updated_at", "price")
+
+
+def parse_sort(sort: str) -> tuple[str, bool]:
+    """Tách chiều sort: '-price' -> ('price', True). Sort không hỗ trợ -> ValueError."""
+    desc = sort.startswith("-")
+    key = sort[1:] if desc else sort
+    if key not in SORT_KEYS:
+        raise ValueError(f"sort không hỗ trợ: {sort}")
+    return key, desc
+
+
+def encode_cursor(sort: str, value: Any, pk: int) -> str:
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json_codec.dumps({"s": sort, "v": value, "id": pk}).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def decode_cursor(token: str, sort: str) -> tuple[Any, int]:
+    """Token -> (giá trị cột sort, id) của bản ghi cuối trang trước.
+    Token hỏng hoặc tạo với sort khác -> ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        data = json_codec.loads(raw)
+        s, value, pk = data["s"], data["v"], int(data["id"])
+    except (binascii.Error, ValueError, TypeError, KeyError) as e:
+        raise ValueError("cursor không hợp lệ") from e
+    if s != sort:
+        raise ValueError("cursor được tạo với sort khác")
+    key, _ = parse_sort(sort)
+    if value is not None and key == "updated_at":
+        value = datetime.fromisoformat(value)
+    return value, pk
+
+
+def next_cursor(rows: Sequence, sort: str, limit: int | None) -> str | None:
+    """Cursor trỏ sau bản ghi cuối; None nếu trang chưa đầy (đã hết dữ liệu)."""
+    if not rows or limit is None or len(rows) < limit:
+        return None
+    key, _ = parse_sort(sort)
+    last = rows[-1]
+    return encode_cursor(sort, getattr(last, key), last.id)
+
+
+def keyset_page(
+    q,
+    model,
+    sort: str,
+    *,
+    after: tuple[Any, int] | None = None,
+    limit: int | None = None,
+    skip: int = 0,
+):
+    """
+    Áp thứ tự `(sort, id)` lên query `q` và trả về 1 trang.
+    - after=(giá trị, id) từ decode_cursor: keyset, bỏ qua `skip`.
+    - after=None: trang đầu; `skip` > 0 vẫn dùng OFFSET (tương thích client cũ).
+    """
+    key, desc = parse_sort(sort)
+    pk = model.id
+    if key == "id":
+        if after is not None:
+            q = q.filter(pk < after[1] if desc else pk > after[1])
+        q = q.order_by(pk.desc() if desc else pk.asc())
+        if after is None and skip:
+            q = q.offset(skip)
+        return q.limit(limit).all() if limit is not None else q.all()
+
+    col = getattr(model, key)
+    if after is None and skip:
+        order = (
+            (col.desc().nulls_first(), pk.desc())
+            if desc
+            else (col.asc().nulls_last(), pk.asc())
+        )
+        q = q.order_by(*order).offset(skip)
+        return q.limit(limit).all() if limit is not None else q.all()
+
+    def _nulls(q2, after_pk):
+        q2 = q2.filter(col.is_(None))
+        if after_pk is not None:
+            q2 = q2.filter(pk < after_pk if desc else pk > after_pk)
+        return q2.order_by(pk.desc() if desc else pk.asc())
+
+    def _values(q2, after_key):
+        q2 = q2.filter(col.is_not(None))
+        if after_key is not None:
+            cmp = tuple_(col, pk)
+            q2 = q2.filter(cmp < after_key if desc else cmp > after_key)
+        return q2.order_by(
+            *((col.desc(), pk.desc()) if desc else (col.asc(), pk.asc()))
+        )
+
+    # Các pha theo thứ tự trả về: tăng dần [có giá trị, NULL]; giảm dần [NULL, có giá trị]
+    phases = ["null", "values"] if desc else ["values", "null"]
+    if after is not None:
+        phases = phases[phases.index("null" if after[0] is None else "values") :]
+    out: list = []
+    for i, phase in enumerate(phases):
+        first = i == 0 and after is not None
+        if phase == "null":
+            qp = _nulls(q, after[1] if first else None)
+        else:
+            qp = _values(q, tuple_(after[0], after[1]) if first else None)
+        if limit is None:
+            out.extend(qp.all())
+            continue
+        out.extend(qp.limit(limit - len(out)).all())
+        if len(out) >= limit:
+            break
+    return out
@@ -131,7 +131,7 @@ class ProductOfferOut(ProductOfferBase):
     id: int
     updated_at: datetime | None = None
 
-    # Hiển thị trực tiếp (bóc từ extra trong endpoint)
+    # Cột tách từ extra lúc ghi (models.ProductOffer)
     desc: str | None = None
     cate: str | None = None
     shop_name: str | None = None
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: so sánh chi phí/item giữa map_at_product_to_offer (từng item)
+và map_at_products_to_offers (batch, index promotion/commission dựng 1 lần).
+
+Usage:
+  python scripts/bench_mapper.py [--items 5000] [--promos 200] [--repeat 5]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(str(BASE_DIR))
+
+from accesstrade_service import map_at_product_to_offer, map_at_products_to_offers
+
+
+def make_data(n_items: int, n_promos: int):
+    merchants = [f"m{i}" for i in range(50)]
+    cates = [f"c{i}" for i in range(20)]
+    items = [
+        {
+            "id": f"322_{i}",
+            "merchant": merchants[i % len(merchants)],
+            "name": f"Sản phẩm {i}",
+            "price": str(1000 + i),
+            "cate": cates[i % len(cates)],
+            "domain": "example.vn",
+            "desc": "Mô tả " * 20,
+            "image": f"https://img.example.vn/{i}.jpg",
+            "aff_link": f"https://go.example.vn/{i}",
+            "update_time": "2024-01-01 00:00:00",
+        }
+        for i in range(n_items)
+    ]
+    promos = [
+        {
+            "merchant": merchants[i % len(merchants)],
+            "name": f"KM {i}",
+            "content": "Giảm giá",
+            "categories": [cates[(i * 7) % len(cates)]],
+        }
+        for i in range(n_promos)
+    ]
+    commission = {
+        "category": [{"category_id": c, "sales_ratio": 5} for c in cates],
+        "default": [{"sales_ratio": 2, "reward_type": "CPS"}],
+    }
+    return items, promos, commission
+
+
+def _best(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--items", type=int, default=5000)
+    ap.add_argument("--promos", type=int, default=200)
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    items, promos, commission = make_data(args.items, args.promos)
+
+    t_single = _best(
+        lambda: [map_at_product_to_offer(it, commission, promos) for it in items],
+        args.repeat,
+    )
+    t_batch = _best(
+        lambda: map_at_products_to_offers(items, commission, promos), args.repeat
+    )
+    n = len(items)
+    print(f"items={n} promos={len(promos)} repeat={args.repeat}")
+    print(f"single : {t_single / n * 1e6:8.2f} us/item")
+    print(f"batch  : {t_batch / n * 1e6:8.2f} us/item")
+    print(f"speedup: {t_single / t_batch:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import json
+
+from accesstrade_service import map_at_product_to_offer, map_at_products_to_offers
+
+
+PROMOS = [
+    {"merchant": "shopee", "name": "SP", "content": "x"},
+    {"merchant": "tikivn", "name": "TK-books", "categories": ["books"]},
+    {"merchant": "tikivn", "name": "TK-all", "description": "all"},
+]
+
+COMMISSION = {
+    "product": [{"product_id": "2062448047", "sales_ratio": 12}],
+    "category": [{"category_id": "books", "ratio": 7}],
+    "default": [{"sales_ratio": 3, "reward_type": "CPS"}],
+}
+
+
+def _items():
+    return [
+        {"id": "322_2062448047", "merchant": "tikivn", "name": "A", "price": "100"},
+        {"id": "P2", "merchant": "tikivn", "cate": "books", "name": "B"},
+        {"id": "P3", "merchant": "TikiVN", "cate": "toys", "name": "C"},
+        {"id": "P4", "merchant": "lazada", "name": "D", "price": "n/a"},
+        {"id": "P5", "domain": "shopee.vn", "name": "E", "update_time": "2024-01-01"},
+    ]
+
+
+def _comm(ratio, reward_type=None):
+    return {
+        "sales_ratio": ratio,
+        "sales_price": None,
+        "reward_type": reward_type,
+        "target_month": None,
+    }
+
+
+def _promo(name, content=None):
+    return {
+        "name": name,
+        "content": content,
+        "start_time": None,
+        "end_time": None,
+        "coupon": None,
+        "link": None,
+    }
+
+
+def _offer(source_id, merchant, title, extra, **kw):
+    out = {
+        "source": "accesstrade",
+        "source_id": source_id,
+        "merchant": merchant,
+        "title": title,
+        "url": None,
+        "affiliate_url": None,
+        "image_url": None,
+        "price": None,
+        "currency": "VND",
+        "campaign_id": "",
+        "product_id": source_id,
+        "affiliate_link_available": False,
+        "extra": extra,
+    }
+    out.update(kw)
+    return out
+
+
+# Output của mapper từng item trước khi có bản batch (baseline), giữ cố định.
+# Cột tách khỏi extra luôn có mặt (None nếu item không có)
+_COLS = {"desc": None, "cate": None, "shop_name": None, "update_time_raw": None}
+EXPECTED = [
+    _offer(
+        "322_2062448047",
+        "tikivn",
+        "A",
+        dict(
+            _COLS,
+            id="322_2062448047",
+            merchant="tikivn",
+            name="A",
+            price="100",
+            update_time=None,
+            commission=_comm(12),
+            promotion=_promo("TK-all", "all"),
+        ),
+        price=100.0,
+        product_id="2062448047",
+    ),
+    _offer(
+        "P2",
+        "tikivn",
+        "B",
+        dict(
+            _COLS,
+            id="P2",
+            merchant="tikivn",
+            cate="books",
+            name="B",
+            update_time=None,
+            commission=_comm(7),
+            promotion=_promo("TK-books"),
+        ),
+    ),
+    _offer(
+        "P3",
+        "tikivn",
+        "C",
+        dict(
+            _COLS,
+            id="P3",
+            merchant="TikiVN",
+            cate="toys",
+            name="C",
+            update_time=None,
+            commission=_comm(3, "CPS"),
+            promotion=_promo("TK-all", "all"),
+        ),
+    ),
+    _offer(
+        "P4",
+        "lazada",
+        "D",
+        dict(
+            _COLS,
+            id="P4",
+            merchant="lazada",
+            name="D",
+            price="n/a",
+            update_time=None,
+            commission=_comm(3, "CPS"),
+            promotion=_promo("SP", "x"),
+        ),
+    ),
+    _offer(
+        "P5",
+        "shopee",
+        "E",
+        dict(
+            _COLS,
+            id="P5",
+            domain="shopee.vn",
+            name="E",
+            update_time="2024-01-01",
+            update_time_raw="2024-01-01",
+            commission=_comm(3, "CPS"),
+            promotion=_promo("SP", "x"),
+        ),
+    ),
+]
+
+FULL_ITEM = {
+    "id": "P6",
+    "merchant": "shopee",
+    "name": "F",
+    "url": "https://shopee.vn/p6",
+    "aff_link": "https://go.at/p6",
+    "image": "https://img/p6.jpg",
+    "price": 5000,
+    "campaign_id": 77,
+    "desc": "mô tả",
+    "shop_name": "S",
+    "custom": {"k": [1, 2]},
+}
+EXPECTED_FULL = _offer(
+    "P6",
+    "shopee",
+    "F",
+    # key lạ giữ nguyên trong extra; không enrich thì không có commission/promotion
+    {**FULL_ITEM, "cate": None, "update_time_raw": None, "update_time": None},
+    url="https://shopee.vn/p6",
+    affiliate_url="https://go.at/p6",
+    image_url="https://img/p6.jpg",
+    price=5000.0,
+    campaign_id="77",
+    affiliate_link_available=True,
+)
+
+
+def _decoded(offers):
+    return [{**o, "extra": json.loads(o["extra"])} for o in offers]
+
+
+def test_mappers_match_baseline_output():
+    items = _items()
+    batch = map_at_products_to_offers(items, commission=COMMISSION, promotion=PROMOS)
+    single = [map_at_product_to_offer(it, COMMISSION, PROMOS) for it in items]
+    assert _decoded(batch) == EXPECTED
+    assert _decoded(single) == EXPECTED
+    assert _decoded(map_at_products_to_offers([FULL_ITEM])) == [EXPECTED_FULL]
+    assert _decoded([map_at_product_to_offer(FULL_ITEM)]) == [EXPECTED_FULL]
+
+
+def test_batch_indexed_lookups():
+    out = map_at_products_to_offers(_items(), commission=COMMISSION, promotion=PROMOS)
+    extras = [json.loads(o["extra"]) for o in out]
+    # commission: product -> category -> default
+    assert extras[0]["commission"]["sales_ratio"] == 12
+    assert extras[1]["commission"]["sales_ratio"] == 7
+    assert extras[2]["commission"]["reward_type"] == "CPS"
+    # promotion: merchant + categories, rồi fallback phần tử đầu
+    assert extras[1]["promotion"]["name"] == "TK-books"
+    assert extras[2]["promotion"]["name"] == "TK-all"
+    assert extras[2]["promotion"]["content"] == "all"
+    assert extras[3]["promotion"]["name"] == "SP"
+    assert extras[4]["update_time_raw"] == "2024-01-01"
+    assert out[0]["product_id"] == "2062448047"
+    assert out[3]["price"] is None
+    assert out[4]["merchant"] == "shopee"
+
+
+def test_batch_empty_and_no_enrichment():
+    assert map_at_products_to_offers([]) == []
+    (o,) = map_at_products_to_offers([{"id": "X", "name": "Tên"}])
+    ex = json.loads(o["extra"])
+    assert "commission" not in ex and "promotion" not in ex
+    assert "Tên" in o["extra"]  # ensure_ascii=False
@@ -0,0 +1,118 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import accesstrade_service as ats
+
+
+@pytest.fixture()
+def upstream(monkeypatch, tmp_path):
+    """API giả: 250 campaign đang chạy, trả theo page/limit; đếm số request."""
+    calls = []
+    camps = [{"campaign_id": f"C{i}", "merchant": f"M{i % 7}"} for i in range(250)]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        page = int(request.url.params.get("page", "1"))
+        limit = int(request.url.params.get("limit", "20"))
+        calls.append(page)
+        return httpx.Response(
+            200, json={"data": camps[(page - 1) * limit : page * limit]}
+        )
+
+    monkeypatch.delenv("AT_MOCK", raising=False)
+    monkeypatch.setattr(ats, "_LOG_DIR", str(tmp_path))
+    monkeypatch.setattr(
+        ats,
+        "_get_at_config",
+        lambda db: SimpleNamespace(base_url="http://at.test", api_key="k"),
+    )
+    monkeypatch.setattr(
+        ats,
+        "_at_client",
+        lambda **kw: httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+    ats.invalidate_active_campaigns()
+    yield calls
+    ats.invalidate_active_campaigns()
+
+
+def test_active_campaigns_paginated_and_cached(upstream):
+    async def run():
+        first = await ats.fetch_active_campaigns(None)
+        # các pha chạy song song chờ chung 1 lần quét
+        again = await asyncio.gather(
+            *(ats.fetch_active_campaigns(None) for _ in range(3))
+        )
+        return first, again
+
+    first, again = asyncio.run(run())
+    assert len(first) == 250 and first["C7"] == "m0"
+    assert upstream == [1, 2, 3]
+    assert all(a == first for a in again)
+
+    # TTL = 0: quét lại
+    asyncio.run(ats.fetch_active_campaigns(None, max_age=0))
+    assert len(upstream) == 6
+
+
+def test_refresh_hook_and_pinned_ttl(upstream, monkeypatch):
+    monkeypatch.setattr(ats, "ACTIVE_CAMPAIGNS_TTL_SEC", 0)
+    running = [
+        {"campaign_id": "X1", "merchant": "Shopee"},
+        {"id": "X2", "name": "Tiki"},
+    ]
+
+    async def run():
+        await ats.refresh_active_campaigns(None, running)
+        with ats.pin_active_campaigns(600):
+            pinned = await ats.fetch_active_campaigns(None)
+        # ra khỏi phạm vi pin: TTL mặc định (0) -> gọi API
+        fresh = await ats.fetch_active_campaigns(None)
+        return pinned, fresh
+
+    pinned, fresh = asyncio.run(run())
+    assert pinned == {"X1": "shopee", "X2": "tiki"}
+    assert len(fresh) == 250 and upstream == [1, 2, 3]
+
+
+@pytest.mark.parametrize(
+    "bad_page2",
+    [httpx.Response(500), httpx.Response(200, content=b"<html>oops</html>")],
+)
+def test_failed_later_page_is_not_cached(upstream, monkeypatch, bad_page2):
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        page = int(request.url.params.get("page", "1"))
+        calls.append(page)
+        if page == 2 and len(calls) == 2:
+            return bad_page2
+        limit = int(request.url.params.get("limit", "20"))
+        return httpx.Response(
+            200,
+            json={
+                "data": [
+                    {"campaign_id": f"P{page}-{i}", "merchant": "m"}
+                    for i in range(limit)
+                ]
+                if page < 3
+                else []
+            },
+        )
+
+    monkeypatch.setattr(
+        ats,
+        "_at_client",
+        lambda **kw: httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+    # Trang 2 lỗi: không trả/cache snapshot thiếu campaign của trang 2..N
+    assert asyncio.run(ats.fetch_active_campaigns(None)) == {}
+    assert calls == [1, 2]
+    # Lần sau quét lại đủ các trang
+    full = asyncio.run(ats.fetch_active_campaigns(None))
+    assert calls == [1, 2, 1, 2, 3] and len(full) == 2 * ats.ACTIVE_CAMPAIGNS_PAGE_LIMIT
@@ -0,0 +1,214 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import crud
+import models
+import schemas
+from database import Base
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine(
+        "sqlite:///:memory:",
+        future=True,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def _offer(sid, **kw):
+    base = {
+        "source": "accesstrade",
+        "source_id": sid,
+        "merchant": "shopee",
+        "title": f"T-{sid}",
+        "url": f"https://shopee.vn/{sid}",
+        "price": 100.0,
+    }
+    base.update(kw)
+    return base
+
+
+def _rows(db):
+    return {
+        o.source_id: o for o in db.execute(select(models.ProductOffer)).scalars().all()
+    }
+
+
+def test_insert_then_update_counts(db):
+    res = crud.bulk_upsert_offers(db, [_offer("a"), _offer("b")])
+    assert res == {"inserted": 2, "updated": 0, "unchanged": 0}
+
+    res = crud.bulk_upsert_offers(
+        db, [_offer("a", price=150.0), _offer("c")], batch_size=1
+    )
+    assert res == {"inserted": 1, "updated": 1, "unchanged": 0}
+    rows = _rows(db)
+    assert set(rows) == {"a", "b", "c"}
+    assert rows["a"].price == 150.0
+
+
+def test_blank_values_do_not_overwrite(db):
+    crud.bulk_upsert_offers(
+        db, [_offer("a", image_url="https://img/a.jpg", extra='{"k":1}')]
+    )
+    crud.bulk_upsert_offers(
+        db, [_offer("a", title="  ", image_url="", price=None, extra=None)]
+    )
+    db.expire_all()
+    o = _rows(db)["a"]
+    assert o.title == "T-a"
+    assert o.image_url == "https://img/a.jpg"
+    assert o.price == 100.0
+    assert o.extra == '{"k":1}'
+
+
+def test_duplicates_in_batch_are_merged(db):
+    res = crud.bulk_upsert_offers(
+        db,
+        [_offer("a", image_url="https://img/a.jpg"), _offer("a", price=7.0)],
+    )
+    assert res == {"inserted": 1, "updated": 0, "unchanged": 0}
+    o = _rows(db)["a"]
+    assert (o.price, o.image_url) == (7.0, "https://img/a.jpg")
+
+
+def test_match_any_source_prefers_excel(db):
+    crud.bulk_upsert_offers(
+        db, [_offer("x", source="manual"), _offer("x", source="excel")]
+    )
+    res = crud.bulk_upsert_offers(db, [_offer("x", title="New")], match_any_source=True)
+    assert res == {"inserted": 0, "updated": 1, "unchanged": 0}
+    db.expire_all()
+    by_source = {
+        o.source: o.title
+        for o in db.execute(select(models.ProductOffer)).scalars().all()
+    }
+    assert by_source == {"manual": "T-x", "excel": "New"}
+
+
+def test_unchanged_offers_are_skipped(db):
+    crud.bulk_upsert_offers(db, [_offer("a"), _offer("b")])
+    stamp = {sid: o.updated_at for sid, o in _rows(db).items()}
+
+    res = crud.bulk_upsert_offers(db, [_offer("a"), _offer("b", price=90.0)])
+    assert res == {"inserted": 0, "updated": 1, "unchanged": 1}
+    db.expire_all()
+    rows = _rows(db)
+    assert rows["a"].updated_at == stamp["a"]
+    assert rows["b"].price == 90.0
+
+    # chuỗi rỗng không ghi đè -> tương đương None, vẫn là không đổi
+    res = crud.bulk_upsert_offers(db, [_offer("a", image_url="")])
+    assert res["unchanged"] == 1
+
+
+def test_other_writers_reset_content_hash(db):
+    crud.bulk_upsert_offers(db, [_offer("a")])
+    o = _rows(db)["a"]
+    assert o.content_hash
+    crud.update_offer(db, o.id, schemas.ProductOfferUpdate(price=1.0))
+    assert o.content_hash is None
+    # payload cũ phải được ghi lại để khôi phục giá
+    res = crud.bulk_upsert_offers(db, [_offer("a")])
+    assert res == {"inserted": 0, "updated": 1, "unchanged": 0}
+    db.expire_all()
+    assert _rows(db)["a"].price == 100.0
+
+
+def _history(db, offer_id):
+    return [p for _, p in crud.get_price_history(db, offer_id)]
+
+
+def test_price_history_only_on_price_change(db):
+    crud.bulk_upsert_offers(db, [_offer("a"), _offer("b", price=None)])
+    rows = _rows(db)
+    assert _history(db, rows["a"].id) == [100.0]
+    assert _history(db, rows["b"].id) == []
+
+    crud.bulk_upsert_offers(db, [_offer("a", title="Đổi tên"), _offer("b", price=5.0)])
+    assert _history(db, rows["a"].id) == [100.0]
+    assert _history(db, rows["b"].id) == [5.0]
+
+    crud.bulk_upsert_offers(db, [_offer("a", price=80.0)])
+    assert _history(db, rows["a"].id) == [100.0, 80.0]
+
+    # xoá offer kéo theo lịch sử giá (FK price_history.offer_id)
+    crud.delete_offer(db, rows["a"].id)
+    assert _history(db, rows["a"].id) == []
+
+
+def test_mark_and_sweep_retires_unseen_then_purges(db):
+    from datetime import datetime, timedelta, UTC
+
+    feed = dict(source_type="datafeeds", campaign_id="C1")
+    crud.bulk_upsert_offers(db, [_offer("a", **feed), _offer("b", **feed)], run_gen=1)
+    crud.bulk_upsert_offers(db, [_offer("x", source_type="manual", campaign_id="C1")])
+
+    # lần chạy 2 chỉ thấy "a" (không đổi nội dung) -> "b" bị retire, offer manual giữ nguyên
+    res = crud.bulk_upsert_offers(db, [_offer("a", **feed)], run_gen=2)
+    assert res["unchanged"] == 1
+    assert crud.retire_unseen_offers(db, 2, ["C1"]) == 1
+    db.expire_all()
+    rows = _rows(db)
+    assert rows["a"].seen_run == 2 and rows["a"].retired_at is None
+    assert rows["b"].retired_at is not None
+    assert rows["x"].retired_at is None
+    assert {o.source_id for o in crud.list_offers(db)} == {"a", "x"}
+
+    # "b" xuất hiện lại trước khi bị xoá hẳn -> hết retired
+    crud.bulk_upsert_offers(db, [_offer("b", **feed)], run_gen=3)
+    db.expire_all()
+    assert _rows(db)["b"].retired_at is None
+
+    crud.retire_unseen_offers(db, 4, ["C1"])
+    future = datetime.now(UTC) + timedelta(days=1)
+    assert crud.purge_retired_offers(db, future, chunk_size=1) == 2
+    assert set(_rows(db)) == {"x"}
+
+
+def test_extra_fields_promoted_to_columns(db):
+    ex = '{"desc": "D", "cate": "books", "shop_name": "S", "update_time": "t1"}'
+    crud.bulk_upsert_offers(db, [_offer("a", extra=ex)])
+    o = _rows(db)["a"]
+    assert (o.desc, o.cate, o.shop_name, o.update_time_raw) == ("D", "books", "S", "t1")
+
+    # Không có extra mới -> giữ cột; extra mới -> cột đi theo extra
+    crud.bulk_upsert_offers(db, [_offer("a", price=120.0)])
+    db.expire_all()
+    assert _rows(db)["a"].cate == "books"
+    crud.bulk_upsert_offers(db, [_offer("a", extra='{"cate": "toys"}')])
+    db.expire_all()
+    o = _rows(db)["a"]
+    assert (o.desc, o.cate, o.shop_name) == (None, "toys", None)
+    assert [x.source_id for x in crud.list_offers(db, cate="toys")] == ["a"]
+    assert crud.list_offers(db, cate="books") == []
+
+
+def test_fallback_only_when_unique_index_missing(db, caplog):
+    from sqlalchemy import exc, text
+
+    # Lỗi dữ liệu (title NOT NULL) không bị nuốt thành fallback
+    with pytest.raises(exc.IntegrityError):
+        crud.bulk_upsert_offers(db, [_offer("a", title=None)])
+    db.rollback()
+
+    db.execute(text("DROP INDEX uq_product_offers_source_source_id"))
+    db.commit()
+    with caplog.at_level("WARNING", logger="affiliate_api"):
+        res = crud.bulk_upsert_offers(db, [_offer("a"), _offer("b")])
+    assert res["inserted"] == 2 and set(_rows(db)) == {"a", "b"}
+    assert "fallback upsert từng dòng" in caplog.text
@@ -177,6 +177,66 @@ def test_offers_category_top_products_list(client):
     # not asserting count because ingest could return 0 in some environments, but ensure type correctness
 
 
+def test_offers_filter_by_cate_and_shop(client):
+    TestingSessionLocal = getattr(app.state, "TestingSessionLocal")
+    with TestingSessionLocal() as db:
+        for sid, extra in (
+            ("cate:1", '{"cate": "books", "shop_name": "Shop A", "desc": "D1"}'),
+            ("cate:2", '{"cate": "toys", "shop_name": "Shop A"}'),
+        ):
+            crud.upsert_offer_by_source(
+                db,
+                schemas.ProductOfferCreate(
+                    source="test",
+                    source_id=sid,
+                    merchant="tikivn",
+                    title=sid,
+                    url="https://example.com/" + sid,
+                    source_type="manual",
+                    extra=extra,
+                ),
+            )
+
+    r = client.get("/offers", params={"cate": "books"})
+    assert r.status_code == 200
+    items = r.json()
+    assert [(i["title"], i["desc"]) for i in items] == [("cate:1", "D1")]
+    r = client.get("/offers", params={"shop_name": "Shop A", "cate": "toys"})
+    assert [i["title"] for i in r.json()] == ["cate:2"]
+
+
+def test_offers_and_campaigns_cursor_pagination(client):
+    everything = client.get("/offers", params={"limit": 1000, "sort": "-price"}).json()
+    ids: list[int] = []
+    params = {"limit": 2, "sort": "-price"}
+    for _ in range(len(everything) + 1):
+        r = client.get("/offers", params=params)
+        assert r.status_code == 200
+        ids += [i["id"] for i in r.json()]
+        token = r.headers.get("X-Next-Cursor")
+        if not token:
+            break
+        params = {**params, "cursor": token}
+    assert ids == [i["id"] for i in everything]
+
+    bad = client.get("/offers", params={"cursor": "zzz", "sort": "price"})
+    assert bad.status_code == 400
+
+    TestingSessionLocal = getattr(app.state, "TestingSessionLocal")
+    with TestingSessionLocal() as db:
+        for cid in ("PAGE1", "PAGE2", "PAGE3"):
+            crud.upsert_campaign(db, schemas.CampaignCreate(campaign_id=cid))
+    r = client.get("/campaigns", params={"limit": 2, "sort": "id"})
+    assert len(r.json()) == 2 and r.headers.get("X-Next-Cursor")
+    rest = client.get(
+        "/campaigns", params={"sort": "id", "cursor": r.headers["X-Next-Cursor"]}
+    ).json()
+    everything = client.get("/campaigns", params={"sort": "id"}).json()
+    assert [c["campaign_id"] for c in r.json() + rest] == [
+        c["campaign_id"] for c in everything
+    ]
+
+
 def test_delete_offers_from_promotions_by_campaign(client):
     # Create a ProductOffer that mimics old behavior (source_type='promotions')
     TestingSessionLocal = getattr(app.state, "TestingSessionLocal")
@@ -0,0 +1,116 @@
+import os
+import sys
+import threading
+
+import pytest
+from sqlalchemy import exc, text
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import database
+
+
+def test_db_profile_env_override(monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "3")
+    prof = database.db_profile("web")
+    assert prof["pool_size"] == 3 and prof["max_overflow"] == 20
+    assert database.db_profile("nope") == database.db_profile("default") | {
+        "pool_size": 3
+    }
+
+
+def test_sqlite_file_engine_uses_wal_and_times_pool(tmp_path, monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "1")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "0")
+    monkeypatch.setenv("DB_POOL_TIMEOUT", "1")
+    eng = database.make_engine(f"sqlite:///{tmp_path / 'wal.db'}", profile="worker")
+    with eng.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1
+        assert (
+            conn.execute(text("PRAGMA busy_timeout")).scalar()
+            == database.SQLITE_BUSY_TIMEOUT_MS
+        )
+        st = database.pool_status(eng)
+        assert st["class"] == "TimedQueuePool"
+        assert (st["size"], st["checked_out"], st["overflow"]) == (1, 1, 0)
+
+        # pool cạn: connection thứ 2 chờ pool_timeout rồi lỗi, được đếm là timeout
+        before = database.POOL_WAIT.snapshot()["timeouts"]
+        err: list = []
+        t = threading.Thread(target=lambda: _connect(eng, err))
+        t.start()
+        t.join()
+        assert err and isinstance(err[0], exc.TimeoutError)
+        assert database.POOL_WAIT.snapshot()["timeouts"] == before + 1
+    assert database.pool_status(eng)["checked_out"] == 0
+    eng.dispose()
+
+
+def _connect(eng, err: list) -> None:
+    try:
+        with eng.connect():
+            pass
+    except Exception as e:  # noqa: BLE001
+        err.append(e)
+
+
+def test_memory_engine_keeps_default_pool():
+    eng = database.make_engine("sqlite:///:memory:")
+    with eng.connect() as conn:
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() > 0
+    assert database.pool_status(eng)["class"] != "TimedQueuePool"
+    with pytest.raises(KeyError):
+        database.pool_status(eng)["checked_out"]
+
+
+def test_async_database_url():
+    assert (
+        database.async_database_url("sqlite:///./x.db") == "sqlite+aiosqlite:///./x.db"
+    )
+    assert (
+        database.async_database_url("postgresql+psycopg2://u:p@db:5432/app")
+        == "postgresql+asyncpg://u:p@db:5432/app"
+    )
+
+
+def test_async_engine_applies_sqlite_pragmas(tmp_path):
+    import asyncio
+
+    pytest.importorskip("aiosqlite")
+
+    async def run():
+        eng = database.make_async_engine(f"sqlite:///{tmp_path / 'async.db'}")
+        try:
+            async with eng.connect() as conn:
+                mode = (await conn.execute(text("PRAGMA journal_mode"))).scalar()
+                pool = database.pool_status(eng.sync_engine)
+            return mode, pool
+        finally:
+            await eng.dispose()
+
+    mode, pool = asyncio.run(run())
+    assert mode == "wal"
+    assert pool["class"] == "TimedAsyncQueuePool" and pool["checked_out"] == 1
+
+
+def test_worker_sessions_use_worker_profile_engine(tmp_path, monkeypatch):
+    made = []
+    real = database.make_engine
+
+    def spy(url=None, profile=None, **kw):
+        made.append(profile)
+        return real(url, profile=profile, **kw)
+
+    monkeypatch.setattr(database, "make_engine", spy)
+    monkeypatch.setattr(database, "DB_PROFILE", "web")
+    monkeypatch.setattr(database, "DATABASE_URL", f"sqlite:///{tmp_path / 'w.db'}")
+    monkeypatch.setattr(database, "_worker_sessionmaker", None)
+    factory = database.worker_session_factory()
+    # engine chính (web, statement_timeout) không dùng cho tác vụ nền
+    assert made == ["worker"] and factory.kw["bind"] is not database.engine
+    assert database.worker_session_factory() is factory
+
+    # :memory: -> engine khác là DB khác: dùng lại engine chính
+    monkeypatch.setattr(database, "DATABASE_URL", "sqlite:///:memory:")
+    monkeypatch.setattr(database, "_worker_sessionmaker", None)
+    assert database.worker_session_factory().kw["bind"] is database.engine
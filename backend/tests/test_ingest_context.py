@@ -0,0 +1,177 @@
+import asyncio
+
+from ingest_context import IngestRunContext
+
+
+def test_once_memoizes_per_key_and_dedupes_in_flight():
+    calls: list[str] = []
+
+    async def load(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return {"cid": key}
+
+    async def run():
+        ctx = IngestRunContext()
+        res = await asyncio.gather(
+            *(ctx.once("detail", k, lambda k=k: load(k)) for k in ["a", "a", "b", "a"])
+        )
+        # factory đồng bộ cũng được chấp nhận
+        assert await ctx.once("upsert", "a", lambda: 1) == 1
+        assert await ctx.once("upsert", "a", lambda: 2) == 1
+        return ctx, res
+
+    ctx, res = asyncio.run(run())
+    assert [r["cid"] for r in res] == ["a", "a", "b", "a"]
+    assert sorted(calls) == ["a", "b"]
+    assert ctx.stats() == {
+        "detail": {"calls": 2, "hits": 2},
+        "upsert": {"calls": 1, "hits": 1},
+    }
+
+
+def test_once_does_not_memoize_errors():
+    attempts = {"n": 0}
+
+    def flaky():
+        attempts["n"] += 1
+        if attempts["n"] == 1:
+            raise RuntimeError("boom")
+        return "ok"
+
+    async def run():
+        ctx = IngestRunContext()
+        try:
+            await ctx.once("k", 1, flaky)
+        except RuntimeError:
+            pass
+        return await ctx.once("k", 1, flaky)
+
+    assert asyncio.run(run()) == "ok"
+    assert attempts["n"] == 2
+
+
+def test_campaign_directory_single_query_and_refresh():
+    from types import SimpleNamespace
+
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import StaticPool
+
+    import crud
+    import schemas
+    from database import Base
+    from ingest_context import CampaignDirectory
+
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    for cid, m, st, us in [
+        ("c1", "shopee", "running", "successful"),
+        ("c2", "tiki", "paused", "APPROVED"),
+        ("c3", "lazada", "running", "PENDING"),
+    ]:
+        crud.upsert_campaign(
+            db,
+            schemas.CampaignCreate(
+                campaign_id=cid, merchant=m, status=st, user_registration_status=us
+            ),
+        )
+
+    queries: list[str] = []
+    event.listen(engine, "before_cursor_execute", lambda *a: queries.append(a[2]))
+    d = CampaignDirectory.load(db)
+    assert len(queries) == 1 and len(d) == 3
+    assert d.is_approved("c1") and d.eligible("c1")
+    assert d.is_approved("c2") and not d.eligible("c2")
+    assert not d.is_approved("c3") and d.merchant_for("c3") == "lazada"
+    assert not d.is_approved("missing") and d.merchant_for("missing") is None
+    assert len(queries) == 1  # tra cứu không chạm DB
+
+    d.refresh(
+        SimpleNamespace(
+            campaign_id="c3",
+            merchant="lazada",
+            status="running",
+            user_registration_status="Successful ",
+        )
+    )
+    assert d.eligible("c3")
+    db.close()
+
+
+def test_merchant_cursor_rotates_and_resumes():
+    from ingest_context import MerchantCursor
+
+    cur = MerchantCursor(merchant="shopee", pages={"shopee": 3})
+    assert cur.order(["tiki", "lazada", "shopee", "adayroi"]) == [
+        "shopee",
+        "tiki",
+        "adayroi",
+        "lazada",
+    ]
+    assert cur.start_page("shopee") == 3 and cur.start_page("tiki") == 1
+    cur.done("shopee")
+    cur.stopped("tiki", 4)
+    assert cur.state() == {
+        "merchant": "tiki",
+        "page": 4,
+        "pages": {"tiki": 4},
+        "pending": 3,
+        "done": 1,
+    }
+    for m in ("tiki", "adayroi", "lazada"):
+        cur.done(m)
+    assert cur.state() is None
+
+    # merchant đã lưu không còn trong danh sách -> bắt đầu từ merchant kế tiếp
+    assert MerchantCursor(merchant="m").order(["a", "z", "n"]) == ["n", "z", "a"]
+    assert MerchantCursor(deadline=0).expired()
+
+
+def test_merchant_resolver_priority_and_alias():
+    from ingest_context import MerchantResolver
+
+    r = MerchantResolver(
+        {
+            "C1": "vn_shopee",
+            "C2": "tikivn",
+            "C3": "lazada_official",
+            "C4": "shopee_mall",
+            "C5": "Shopee",  # exact thắng suffix/contains
+        }
+    )
+    assert r.resolve("shopee") == ("C5", "exact")
+    assert r.resolve("TIKIVN") == ("C2", "exact")
+    # alias tikivn -> tiki: không có exact "tiki" -> hậu tố/chứa của tên gốc trước
+    assert r.resolve("tiki") == ("C2", "contains(tikivn)")
+    assert r.resolve("official") == ("C3", "suffix(lazada_official)")
+    assert r.resolve("mall") == ("C4", "suffix(shopee_mall)")
+    # lazadacps -> alias lazada -> contains
+    assert r.resolve("lazadacps") == ("C3", "contains(lazada_official)")
+    assert r.resolve("unknown") == (None, "")
+    assert r.campaign_for("") is None
+    assert len(r) == 5
+
+
+def test_seen_keys_exact_then_bloom():
+    from ingest_context import SeenKeys
+
+    seen = SeenKeys(exact_max=100, fp_rate=1e-4)
+    assert seen.add(("tiki", "1")) and not seen.add(("tiki", "1"))
+    assert seen.exact and seen.duplicates == 1
+
+    keys = [("shopee", str(i)) for i in range(5000)]
+    assert all(seen.add(k) for k in keys[:100])
+    # vượt ngưỡng -> Bloom; không bao giờ bỏ sót key đã thấy
+    new = sum(seen.add(k) for k in keys[100:])
+    assert not seen.exact
+    assert new >= len(keys) - 100 - 5
+    assert all(k in seen for k in keys) and ("tiki", "1") in seen
+    before = seen.duplicates
+    assert not any(seen.add(k) for k in keys)
+    assert seen.duplicates == before + len(keys)
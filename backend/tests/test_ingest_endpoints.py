@@ -11,22 +11,24 @@ from fastapi.testclient import TestClient
 # Force SQLite DB before importing app/main
 os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from main import app, get_db
+from main import app, get_db, get_async_db
 import models, crud, schemas
 from sqlalchemy import create_engine
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool, StaticPool
 from sqlalchemy.orm import sessionmaker
 from database import Base
 
 
 @pytest.fixture(scope="module")
-def client():
-    # Use in-memory SQLite and override FastAPI dependency
+def client(tmp_path_factory):
+    # Use a temp SQLite file and override FastAPI dependencies
     os.environ["AT_MOCK"] = "1"  # force Accesstrade service to return mock data
 
-    # Use a single shared in-memory SQLite DB across threads
+    # File (không phải :memory:) để session sync và AsyncSession (aiosqlite) thấy cùng dữ liệu
+    db_path = tmp_path_factory.mktemp("ingest") / "ingest.db"
     engine = create_engine(
-        "sqlite:///:memory:",
+        f"sqlite:///{db_path}",
         future=True,
         connect_args={"check_same_thread": False},
         poolclass=StaticPool,
@@ -41,8 +43,19 @@ def client():
         finally:
             db.close()
 
+    # Mỗi request TestClient chạy trên event loop riêng: không giữ connection async giữa các loop
+    AsyncTestingSession = async_sessionmaker(
+        create_async_engine(f"sqlite+aiosqlite:///{db_path}", poolclass=NullPool),
+        expire_on_commit=False,
+    )
+
+    async def override_get_async_db():
+        async with AsyncTestingSession() as db:
+            yield db
+
     # Apply dependency override
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
 
     # Expose session factory for other tests via app.state
     app.state.TestingSessionLocal = TestingSessionLocal
@@ -99,6 +112,11 @@ def test_ingest_datafeeds_all_with_mock(client):
     body = r.json()
     assert body.get("ok") is True
     assert isinstance(body.get("imported"), int) and body.get("imported") >= 0
+    stages = [s["stage"] for s in body.get("stages", [])]
+    assert stages == ["fetch", "enrich", "map", "write"]
+    # campaign detail được enrich tối đa 1 lần/campaign trong lần chạy
+    for kind, st in body.get("memo", {}).items():
+        assert st["calls"] <= 1, kind
 
     # After ingest, offers endpoint should return items (mock may import >=0)
     r2 = client.get("/offers?limit=5")
@@ -310,3 +328,413 @@ def test_ingest_top_products_no_merchant_verbose_returns_skipped(client):
     # skipped_merchants should exist in verbose mode albeit possibly empty
     assert "skipped_merchants" in body
     assert isinstance(body.get("skipped_merchants"), list)
+
+
+def test_scheduler_refresh_resumes_from_checkpoint(client):
+    SessionLocal = app.state.TestingSessionLocal
+    with SessionLocal() as db:
+        crud.save_ingest_checkpoint(
+            db, "ingest_refresh", "datafeeds_all", "zzz", 2, {"pages": {"zzz": 2}}
+        )
+    st = client.get("/scheduler/ingest/lock/status").json()
+    (cp,) = [c for c in st["checkpoints"] if c["phase"] == "datafeeds_all"]
+    assert (cp["merchant"], cp["page"]) == ("zzz", 2)
+
+    r = client.post("/scheduler/ingest/refresh", json={"max_minutes": 1})
+    assert r.status_code == 200
+    body = r.json()
+    # hết vòng merchants trong ngân sách -> checkpoint được xoá
+    assert body["datafeeds_all"]["checkpoint"] is None
+    st = client.get("/scheduler/ingest/lock/status").json()
+    assert not [c for c in st["checkpoints"] if c["phase"] == "datafeeds_all"]
+    assert st["owner"] is None
+
+
+def test_offer_price_history_endpoint_downsamples(client):
+    from datetime import datetime, timedelta
+
+    SessionLocal = app.state.TestingSessionLocal
+    with SessionLocal() as db:
+        offer = crud.upsert_offer_by_source(
+            db,
+            schemas.ProductOfferCreate(
+                source="manual",
+                source_id="ph-1",
+                merchant="tikivn",
+                title="Price history",
+                url="https://tiki.vn/ph-1",
+                price=100.0,
+            ),
+        )
+        t0 = datetime(2025, 1, 1)
+        for i in range(20):
+            db.add(
+                models.PriceHistory(
+                    offer_id=offer.id,
+                    price=50.0 if i == 10 else 100.0 + i,
+                    recorded_at=t0 + timedelta(hours=i + 1),
+                )
+            )
+        db.commit()
+        offer_id = offer.id
+
+    r = client.get(f"/offers/{offer_id}/price-history?points=5")
+    assert r.status_code == 200
+    body = r.json()
+    assert body["total"] == 21  # 1 dòng lúc tạo offer + 20 dòng seed
+    assert body["downsampled"] is True and len(body["points"]) == 5
+    assert body["min"] == 50.0
+    assert 50.0 in [p["price"] for p in body["points"]]
+    assert client.get("/offers/999999/price-history").status_code == 404
+
+
+def test_datafeeds_all_retires_offers_missing_from_feed(client):
+    body = {
+        "provider": "accesstrade",
+        "max_pages": 5,
+        "limit_per_page": 100,
+        "params": {"merchant": "tikivn"},
+    }
+    assert client.post("/ingest/datafeeds/all", json=body).status_code == 200
+
+    SessionLocal = app.state.TestingSessionLocal
+    with SessionLocal() as db:
+        fed = (
+            db.query(models.ProductOffer)
+            .filter(models.ProductOffer.source_type == "datafeeds")
+            .first()
+        )
+        assert fed is not None
+        fed_id = fed.id
+        crud.bulk_upsert_offers(
+            db,
+            [
+                {
+                    "source": "accesstrade",
+                    "source_id": "gone-from-feed",
+                    "merchant": fed.merchant,
+                    "title": "Hết hàng",
+                    "url": "https://tiki.vn/gone",
+                    "campaign_id": fed.campaign_id,
+                    "source_type": "datafeeds",
+                }
+            ],
+        )
+
+    r = client.post("/ingest/datafeeds/all", json=body)
+    assert r.status_code == 200
+    assert r.json()["retired"] == 1
+    with SessionLocal() as db:
+        gone = (
+            db.query(models.ProductOffer)
+            .filter(models.ProductOffer.source_id == "gone-from-feed")
+            .one()
+        )
+        assert gone.retired_at is not None
+        assert fed_id not in {
+            o.id
+            for o in db.query(models.ProductOffer).filter(
+                models.ProductOffer.retired_at.is_not(None)
+            )
+        }
+
+
+def test_datafeeds_all_sharded_covers_all_shards(client):
+    body = {
+        "provider": "accesstrade",
+        "max_pages": 1,
+        "limit_per_page": 100,
+        "shards": 3,
+    }
+    r = client.post("/ingest/datafeeds/all", json=body)
+    assert r.status_code == 200
+    res = r.json()
+    assert res["shards"] == 3
+    assert sorted(p["shard"] for p in res["processed"]) == [0, 1, 2]
+    assert res["imported"] == sum(p["imported"] for p in res["processed"])
+
+    leases = client.get("/ingest/leases").json()["leases"]
+    assert [x["status"] for x in leases] == ["done"] * 3
+
+    # lần gọi sau mở vòng mới
+    assert client.post("/ingest/datafeeds/all", json=body).json()["round"] == 2
+
+
+def test_metrics_endpoint_exposes_ingest_counters(client):
+    r = client.post(
+        "/ingest/datafeeds/all",
+        json={
+            "provider": "accesstrade",
+            "max_pages": 1,
+            "params": {"merchant": "tikivn"},
+        },
+    )
+    assert r.status_code == 200
+    m = client.get("/metrics")
+    assert m.status_code == 200
+    assert m.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = m.text
+    assert "# TYPE at_upstream_request_seconds histogram" in text
+    assert 'ingest_items_total{pipeline="datafeeds_all",stage="fetch"}' in text
+    assert 'db_write_seconds_count{op="bulk_upsert_offers",outcome="ok"}' in text
+
+
+def test_campaign_details_fan_out_is_bounded(client, monkeypatch):
+    import asyncio
+
+    import accesstrade_service
+
+    inflight = {"now": 0, "max": 0}
+
+    async def fake_detail(db, cid):
+        inflight["now"] += 1
+        inflight["max"] = max(inflight["max"], inflight["now"])
+        await asyncio.sleep(0.01)
+        inflight["now"] -= 1
+        if cid == "bad":
+            raise RuntimeError("boom")
+        return {"campaign_id": cid, "approval": "successful"}
+
+    monkeypatch.setattr(accesstrade_service, "fetch_campaign_detail", fake_detail)
+    ids = [f"C{i}" for i in range(20)] + ["bad", "C1"]
+    with app.state.TestingSessionLocal() as db:
+        out = asyncio.run(
+            accesstrade_service.fetch_campaign_details(db, ids, concurrency=4)
+        )
+    assert len(out) == 21 and out["bad"] is None
+    assert out["C3"]["approval"] == "successful"
+    assert 1 < inflight["max"] <= 4
+
+
+def test_ingest_commissions_bulk_is_idempotent(client):
+    body = {"provider": "accesstrade", "campaign_ids": ["CAMP3", "CAMP3", "CAMP1"]}
+    first = client.post("/ingest/commissions", json=body).json()
+    assert first["ok"] is True and first["campaigns"] == 2
+    SessionLocal = app.state.TestingSessionLocal
+    with SessionLocal() as db:
+        n = db.query(models.CommissionPolicy).count()
+    client.post("/ingest/commissions", json=body)
+    with SessionLocal() as db:
+        assert db.query(models.CommissionPolicy).count() == n
+
+
+def test_datafeeds_all_drops_overlapping_page_items(client, monkeypatch):
+    import accesstrade_service
+
+    def item(i):
+        return {
+            "id": f"dup-{i}",
+            "name": f"SP {i}",
+            "url": f"https://tiki.vn/dup-{i}",
+            "merchant": "tikivn",
+            "price": 1000 + i,
+        }
+
+    # trang 2 lặp lại 50 item cuối của trang 1 (dữ liệu dịch chuyển khi phân trang)
+    pages = {1: [item(i) for i in range(100)], 2: [item(i) for i in range(50, 120)]}
+
+    async def fake_fetch(db, path, params):
+        return pages.get(int(params["page"]), [])
+
+    monkeypatch.setattr(accesstrade_service, "fetch_products", fake_fetch)
+    body = {
+        "provider": "accesstrade",
+        "max_pages": 5,
+        "limit_per_page": 100,
+        "params": {"merchant": "tikivn"},
+    }
+    out = client.post("/ingest/datafeeds/all", json=body).json()
+    assert out["duplicates"] == 50 and out["pages"] == 2
+    assert out["imported"] == 120
+    fetch = next(s for s in out["stages"] if s["stage"] == "fetch")
+    assert fetch["units"] == 120
+
+    out = client.post("/ingest/datafeeds/all", json={**body, "dedup": False}).json()
+    assert out["duplicates"] == 0 and out["imported"] == 170
+
+
+def test_campaign_extras_uses_async_session(client):
+    r = client.get("/campaigns/CAMP3/extras")
+    assert r.status_code == 200
+    body = r.json()
+    assert body["merchant"] == "tikivn"
+    assert body["detail"]["campaign_id"] == "CAMP3"
+    assert isinstance(body["commission_policies"], list)
+
+
+def test_datafeeds_all_survives_promotions_failure(client, monkeypatch):
+    import accesstrade_service
+
+    async def boom(db, merchant):
+        raise RuntimeError("promotions down")
+
+    monkeypatch.setattr(accesstrade_service, "fetch_promotions", boom)
+    out = client.post(
+        "/ingest/datafeeds/all",
+        json={
+            "provider": "accesstrade",
+            "max_pages": 1,
+            "params": {"merchant": "tikivn"},
+        },
+    ).json()
+    assert out["ok"] is True and out["imported"] > 0
+    assert all(s["errors"] == 0 for s in out["stages"])
+
+
+def test_datafeeds_all_empty_later_page_does_not_sweep(client, monkeypatch):
+    import accesstrade_service
+
+    SessionLocal = app.state.TestingSessionLocal
+    with SessionLocal() as db:
+        crud.bulk_upsert_offers(
+            db,
+            [
+                {
+                    "source": "accesstrade",
+                    "source_id": "on-page-3",
+                    "merchant": "tikivn",
+                    "title": "Vẫn còn bán",
+                    "url": "https://tiki.vn/on-page-3",
+                    "campaign_id": "CAMP3",
+                    "source_type": "datafeeds",
+                }
+            ],
+        )
+
+    full_page = [
+        {
+            "id": f"full-{i}",
+            "name": f"SP {i}",
+            "url": f"https://tiki.vn/full-{i}",
+            "merchant": "tikivn",
+            "campaign_id": "CAMP3",
+            "price": 1000 + i,
+        }
+        for i in range(100)
+    ]
+
+    # trang 1 đầy, trang 2 trả rỗng (upstream lỗi) -> chưa chắc đã hết feed
+    async def fake_fetch(db, path, params):
+        return full_page if params["page"] == "1" else []
+
+    monkeypatch.setattr(accesstrade_service, "fetch_products", fake_fetch)
+    out = client.post(
+        "/ingest/datafeeds/all",
+        json={
+            "provider": "accesstrade",
+            "max_pages": 5,
+            "limit_per_page": 100,
+            "params": {"merchant": "tikivn"},
+        },
+    ).json()
+    assert out["imported"] == 100 and out["retired"] == 0
+    with SessionLocal() as db:
+        kept = (
+            db.query(models.ProductOffer)
+            .filter(models.ProductOffer.source_id == "on-page-3")
+            .one()
+        )
+        assert kept.retired_at is None
+
+
+def test_datafeeds_all_retries_failed_batch_row_by_row(client, monkeypatch):
+    real = crud.bulk_upsert_offers
+
+    def flaky(db, payloads, **kw):
+        # cả batch lỗi (vd. deadlock); ghi từng dòng thì chỉ 1 dòng hỏng
+        if len(payloads) > 1:
+            raise RuntimeError("deadlock detected")
+        if payloads[0].source_id == "P12":
+            raise RuntimeError("bad row")
+        return real(db, payloads, **kw)
+
+    monkeypatch.setattr(crud, "bulk_upsert_offers", flaky)
+    out = client.post(
+        "/ingest/datafeeds/all",
+        json={
+            "provider": "accesstrade",
+            "max_pages": 1,
+            "params": {"merchant": "tikivn"},
+        },
+    ).json()
+    assert out["errors"] == 1 and out["imported"] == 4
+    assert out["inserted"] + out["updated"] + out["unchanged"] == 4
+
+
+def test_datafeeds_all_sweeps_merchant_with_empty_feed(client, monkeypatch):
+    import accesstrade_service
+
+    SessionLocal = app.state.TestingSessionLocal
+    with SessionLocal() as db:
+        crud.bulk_upsert_offers(
+            db,
+            [
+                {
+                    "source": "accesstrade",
+                    "source_id": "feed-now-empty",
+                    "merchant": "tikivn",
+                    "title": "Ngừng bán",
+                    "url": "https://tiki.vn/feed-now-empty",
+                    "campaign_id": "CAMP3",
+                    "source_type": "datafeeds",
+                }
+            ],
+        )
+
+    async def empty_feed(db, path, params):
+        return []
+
+    monkeypatch.setattr(accesstrade_service, "fetch_products", empty_feed)
+    out = client.post(
+        "/ingest/datafeeds/all",
+        json={
+            "provider": "accesstrade",
+            "max_pages": 5,
+            "params": {"merchant": "tikivn"},
+        },
+    ).json()
+    assert out["imported"] == 0 and out["retired"] >= 1
+    with SessionLocal() as db:
+        gone = (
+            db.query(models.ProductOffer)
+            .filter(models.ProductOffer.source_id == "feed-now-empty")
+            .one()
+        )
+        assert gone.retired_at is not None
+
+
+def test_datafeeds_all_skips_sweep_when_lease_lost(client):
+    import asyncio
+
+    import main
+
+    SessionLocal = app.state.TestingSessionLocal
+    with SessionLocal() as db:
+        crud.bulk_upsert_offers(
+            db,
+            [
+                {
+                    "source": "accesstrade",
+                    "source_id": "written-by-other-worker",
+                    "merchant": "tikivn",
+                    "title": "Worker khác vừa ghi",
+                    "url": "https://tiki.vn/other-worker",
+                    "campaign_id": "CAMP3",
+                    "source_type": "datafeeds",
+                }
+            ],
+        )
+        req = main.IngestAllDatafeedsReq(
+            provider="accesstrade", max_pages=5, params={"merchant": "tikivn"}
+        )
+        # shard đã bị worker khác nhận: không sweep theo thế hệ của lần chạy này
+        out = asyncio.run(
+            main.ingest_accesstrade_datafeeds_all(req, db, lease_held=lambda: False)
+        )
+        assert out["imported"] > 0 and out["retired"] == 0
+        kept = (
+            db.query(models.ProductOffer)
+            .filter(models.ProductOffer.source_id == "written-by-other-worker")
+            .one()
+        )
+        assert kept.retired_at is None
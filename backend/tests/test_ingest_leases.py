@@ -0,0 +1,84 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import crud
+import models
+from database import Base
+from ingest_context import LeaseHeartbeat, shard_of
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def test_shard_of_is_stable_and_in_range():
+    assert shard_of("tikivn", 4) == shard_of("tikivn", 4)
+    assert {shard_of(f"m{i}", 4) for i in range(100)} == {0, 1, 2, 3}
+
+
+def test_workers_claim_distinct_shards_and_round_advances(db):
+    rnd, shards = crud.begin_lease_round(db, "df", 3)
+    assert (rnd, shards) == (1, 3)
+    a = crud.claim_lease(db, "df", "w1", 60, rnd)
+    b = crud.claim_lease(db, "df", "w2", 60, rnd)
+    c = crud.claim_lease(db, "df", "w1", 60, rnd)
+    assert len({a.shard, b.shard, c.shard}) == 3
+    assert crud.claim_lease(db, "df", "w3", 60, rnd) is None
+
+    # vòng chưa xong -> không mở vòng mới, đổi số shard bị bỏ qua khi còn lease đang giữ
+    assert crud.begin_lease_round(db, "df", 5) == (1, 3)
+    for lease, owner in ((a, "w1"), (b, "w2"), (c, "w1")):
+        assert crud.complete_lease(db, "df", lease.shard, owner, {"imported": 1})
+    assert crud.begin_lease_round(db, "df", 3) == (2, 3)
+    assert {r["status"] for r in crud.list_leases(db, "df")} == {"pending"}
+
+
+def test_expired_lease_is_stolen(db):
+    rnd, _ = crud.begin_lease_round(db, "df", 1)
+    lease = crud.claim_lease(db, "df", "dead", 60, rnd)
+    assert crud.claim_lease(db, "df", "w2", 60, rnd) is None
+
+    db.query(models.IngestLease).update({"expires_at": time.time() - 1})
+    db.commit()
+    stolen = crud.claim_lease(db, "df", "w2", 60, rnd)
+    assert stolen.shard == lease.shard and stolen.attempts == 2
+    # worker cũ không gia hạn/hoàn tất được nữa
+    assert not crud.renew_lease(db, "df", lease.shard, "dead", 60)
+    assert not crud.complete_lease(db, "df", lease.shard, "dead")
+    assert crud.release_lease(db, "df", lease.shard, "w2")
+    assert crud.list_leases(db, "df")[0]["status"] == "pending"
+
+
+def test_lease_heartbeat_reports_lost():
+    calls = []
+
+    def renew():
+        calls.append(1)
+        return len(calls) < 2
+
+    async def run():
+        async with LeaseHeartbeat(renew, interval=0.01) as hb:
+            await asyncio.sleep(0.1)
+        return hb
+
+    hb = asyncio.run(run())
+    assert hb.lost is True and hb.beats == 1
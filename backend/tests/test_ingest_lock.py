@@ -0,0 +1,101 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import crud
+import models
+from database import Base
+
+
+@pytest.fixture()
+def Session(tmp_path):
+    # File SQLite: mỗi thread 1 connection riêng, BEGIN IMMEDIATE tuần tự hoá thật sự
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'lock.db'}",
+        connect_args={"check_same_thread": False, "timeout": 10},
+    )
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def test_lock_acquire_renew_release(Session):
+    with Session() as db:
+        assert crud.get_ingest_lock_status(db)["owner"] is None
+        assert crud.acquire_ingest_lock(db, "w1", 60)
+        # không re-entrant: cùng owner gọi lại cũng bị từ chối
+        assert not crud.acquire_ingest_lock(db, "w1", 60)
+        assert not crud.acquire_ingest_lock(db, "w2", 60)
+        st = crud.get_ingest_lock_status(db)
+        assert (st["owner"], st["ttl"], st["expired"]) == ("w1", 60, False)
+
+        assert crud.renew_ingest_lock(db, "w1", 120)
+        assert not crud.renew_ingest_lock(db, "w2", 120)
+        assert not crud.release_ingest_lock(db, "w2")
+        assert crud.release_ingest_lock(db, "w1")
+        assert crud.get_ingest_lock_status(db)["expired"] is True
+        assert crud.acquire_ingest_lock(db, "w2", 60)
+
+
+def test_expired_lock_is_taken_over_and_old_owner_loses_it(Session):
+    with Session() as db:
+        assert crud.acquire_ingest_lock(db, "dead", 60)
+        db.query(models.IngestLock).update({"expires_at": time.time() - 1})
+        db.commit()
+        assert crud.acquire_ingest_lock(db, "w2", 60)
+        # heartbeat của owner cũ báo mất khoá, release của nó không gỡ khoá mới
+        assert not crud.renew_ingest_lock(db, "dead", 60)
+        assert not crud.release_ingest_lock(db, "dead")
+        assert crud.get_ingest_lock_status(db)["owner"] == "w2"
+        # admin force
+        assert crud.release_ingest_lock(db, None)
+        assert crud.get_ingest_lock_status(db)["owner"] is None
+
+
+def test_concurrent_acquire_has_single_winner(Session):
+    barrier = threading.Barrier(8)
+    wins: list[str] = []
+
+    def worker(i: int) -> None:
+        with Session() as db:
+            barrier.wait()
+            if crud.acquire_ingest_lock(db, f"w{i}", 60):
+                wins.append(f"w{i}")
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(wins) == 1
+    with Session() as db:
+        assert crud.get_ingest_lock_status(db)["owner"] == wins[0]
+
+
+def test_concurrent_policy_flags_keep_all_keys(Session):
+    with Session() as db:
+        crud.set_policy_flag(db, "check_urls", True)
+
+    def writer(key: str) -> None:
+        with Session() as db:
+            for i in range(10):
+                crud.set_policy_flag(db, key, i)
+
+    keys = ["linkcheck_cursor", "linkcheck_mod", "linkcheck_limit", "linkcheck_last_ts"]
+    threads = [threading.Thread(target=writer, args=(k,)) for k in keys]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with Session() as db:
+        flags = crud.get_policy_flags(db)
+        model = crud.get_api_config(db, "ingest_policy").model
+    assert flags["check_urls"] is True
+    assert flags["linkcheck_cursor"] == 9
+    for k in keys:
+        assert f"{k}=9" in model
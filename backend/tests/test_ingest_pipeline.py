@@ -0,0 +1,100 @@
+import asyncio
+
+from ingest_pipeline import Pipeline, Stage, gather_limited
+
+
+def test_pipeline_fan_out_errors_and_stats():
+    written: list[int] = []
+
+    async def fetch(n):
+        for page in range(n):
+            await asyncio.sleep(0)
+            yield [n * 10 + page] * 2
+
+    async def enrich(batch):
+        if batch[0] == 21:
+            raise ValueError("boom")
+        return batch
+
+    def map_(batch):  # stage đồng bộ cũng được chấp nhận
+        return [x + 1 for x in batch] if batch[0] != 10 else None
+
+    async def write(batch):
+        written.extend(batch)
+        return len(batch)
+
+    pipe = Pipeline(
+        [
+            Stage("fetch", fetch, concurrency=2, count=len),
+            Stage("enrich", enrich, concurrency=2),
+            Stage("map", map_),
+            Stage("write", write, count=lambda n: n),
+        ],
+        queue_size=1,
+    )
+    report = asyncio.run(pipe.run([1, 2, 3]))
+    by_stage = {r["stage"]: r for r in report}
+
+    # 1+2+3 trang; trang 21 lỗi ở enrich, trang 10 bị map bỏ qua
+    assert by_stage["fetch"]["in"] == 3 and by_stage["fetch"]["out"] == 6
+    assert by_stage["fetch"]["units"] == 12
+    assert by_stage["enrich"]["errors"] == 1
+    assert "boom" in by_stage["enrich"]["last_error"]
+    assert by_stage["map"]["in"] == 5 and by_stage["map"]["out"] == 4
+    assert by_stage["write"]["units"] == 8
+    assert sorted(written) == sorted([21, 21, 31, 31, 32, 32, 33, 33])
+
+
+def test_pipeline_backpressure_bounds_in_flight_items():
+    produced = 0
+    max_ahead = 0
+    consumed = 0
+
+    async def source(_):
+        nonlocal produced
+        for i in range(50):
+            produced += 1
+            yield i
+
+    async def slow_write(_):
+        nonlocal consumed, max_ahead
+        max_ahead = max(max_ahead, produced - consumed)
+        await asyncio.sleep(0.001)
+        consumed += 1
+        return 1
+
+    pipe = Pipeline([Stage("fetch", source), Stage("write", slow_write)], queue_size=2)
+    asyncio.run(pipe.run([None]))
+    assert consumed == 50
+    # queue 2 + 1 item đang xử lý + 1 item fetch đang chờ put
+    assert max_ahead <= 4
+
+
+def test_pipeline_stop_and_gather_limited():
+    seen = []
+
+    async def work(x):
+        seen.append(x)
+        if x == 2:
+            pipe.stop()
+        return x
+
+    pipe = Pipeline([Stage("work", work)], queue_size=1)
+    asyncio.run(pipe.run(range(100)))
+    assert pipe.stopped and len(seen) < 10
+
+    running = 0
+    peak = 0
+
+    async def task(x):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.001)
+        running -= 1
+        return x * 2
+
+    assert asyncio.run(gather_limited(task, range(20), limit=3)) == [
+        x * 2 for x in range(20)
+    ]
+    assert peak <= 3
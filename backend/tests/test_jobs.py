@@ -0,0 +1,241 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import jobs
+import models  # noqa: F401 - đăng ký bảng jobs vào Base.metadata
+from database import Base
+
+
+def _wait(runner, job_id, statuses=jobs.TERMINAL, timeout=5.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        job = runner.get(job_id)
+        if job["status"] in statuses:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} stuck: {runner.get(job_id)}")
+
+
+def _sessionmaker(tmp_path):
+    # File SQLite (không dùng StaticPool): thread của job và thread test poll
+    # phải có connection riêng, giống môi trường thật.
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'jobs.db'}",
+        connect_args={"check_same_thread": False},
+    )
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@pytest.fixture()
+def runner(tmp_path):
+    Session = _sessionmaker(tmp_path)
+
+    @contextmanager
+    def session():
+        db = Session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    r = jobs.JobRunner(session, limits={"slow": 1})
+    yield r
+    r.shutdown(wait=True)
+
+
+def test_job_success_progress_and_result(runner):
+    async def work(db):
+        assert db is not None
+        jobs.report(step=1)
+        jobs.partial("phase1", {"n": 2})
+        await asyncio.sleep(0)
+        return {"ok": True, "imported": 3}
+
+    job = runner.submit("ingest", work, {"endpoint": "/x"})
+    assert job["status"] in ("queued", "running", "succeeded")
+    done = _wait(runner, job["id"])
+    assert done["status"] == "succeeded"
+    assert done["result"] == {"ok": True, "imported": 3}
+    assert done["progress"]["step"] == 1
+    assert done["params"] == {"endpoint": "/x"}
+    assert [j["id"] for j in runner.list(job_type="ingest")] == [job["id"]]
+
+
+def test_per_type_limit_queues_and_cancel(runner):
+    gate = threading.Event()
+
+    def blocking(db):
+        gate.wait(5)
+        return {"first": True}
+
+    first = runner.submit("slow", blocking)
+    second = runner.submit("slow", lambda db: {"second": True})
+    _wait(runner, first["id"], statuses=("running",))
+    # giới hạn 1 job "slow" cùng lúc -> job thứ 2 phải chờ
+    assert runner.get(second["id"])["status"] == "queued"
+    assert runner.cancel(second["id"])["status"] == "cancelled"
+    gate.set()
+    assert _wait(runner, first["id"])["status"] == "succeeded"
+    assert runner.get(second["id"])["status"] == "cancelled"
+
+
+def test_cancel_running_keeps_partial_result(runner):
+    async def long_job(db):
+        jobs.partial("phase1", {"imported": 5})
+        await asyncio.sleep(30)
+
+    job = runner.submit("ingest", long_job)
+    _wait(runner, job["id"], statuses=("running",))
+    time.sleep(0.05)
+    runner.cancel(job["id"])
+    done = _wait(runner, job["id"])
+    assert done["status"] == "cancelled"
+    assert done["cancel_requested"] is True
+    assert done["result"] == {"phase1": {"imported": 5}}
+
+
+def test_failed_job_records_http_error(runner):
+    from fastapi import HTTPException
+
+    def bad(db):
+        raise HTTPException(status_code=400, detail="Lỗi đọc file")
+
+    done = _wait(runner, runner.submit("excel_import", bad)["id"])
+    assert done["status"] == "failed"
+    assert "Lỗi đọc file" in done["error"]
+
+
+def _session_cm(Session):
+    @contextmanager
+    def session():
+        db = Session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    return session
+
+
+def test_cancel_from_another_worker_applies_on_heartbeat(tmp_path):
+    session = _session_cm(_sessionmaker(tmp_path))
+    owner, other = jobs.JobRunner(session), jobs.JobRunner(session)
+
+    async def long_job(db):
+        jobs.partial("phase1", {"imported": 5})
+        await asyncio.sleep(30)
+
+    try:
+        job = owner.submit("ingest", long_job)
+        _wait(owner, job["id"], statuses=("running",))
+        # POST /jobs/{id}/cancel rơi vào worker không giữ job: chỉ ghi cờ
+        out = other.cancel(job["id"])
+        assert out["status"] == "running" and out["cancel_requested"] is True
+        owner.heartbeat()
+        done = _wait(owner, job["id"])
+        assert done["status"] == "cancelled"
+        assert done["result"] == {"phase1": {"imported": 5}}
+    finally:
+        owner.shutdown(wait=True)
+        other.shutdown(wait=True)
+
+
+def test_mark_interrupted_by_heartbeat_age(runner):
+    import crud
+    from datetime import UTC, datetime, timedelta
+
+    old = datetime.now(UTC) - timedelta(seconds=jobs.JOB_STALE_SEC + 60)
+    with runner._session() as db:
+        # container cũ (hostname khác) chết khi đang chạy job: không so được pid
+        crud.create_job(db, "stale", "ingest", None, "old-container:7")
+        crud.create_job(db, "alive", "ingest", None, "other-node:8")
+        crud.update_job(db, "stale", status="running")
+        crud.update_job(db, "alive", status="running")
+        db.query(models.Job).filter(models.Job.id == "stale").update(
+            {"updated_at": old}, synchronize_session=False
+        )
+        db.commit()
+
+    assert runner.mark_interrupted() == 1
+    stale, alive = runner.get("stale"), runner.get("alive")
+    assert stale["status"] == "failed" and "no heartbeat" in stale["error"]
+    assert alive["status"] == "running"
+
+
+@pytest.fixture()
+def client(tmp_path):
+    pytest.importorskip("fastapi")
+    from fastapi.testclient import TestClient
+
+    import crud
+    import schemas
+    from main import app, get_db
+
+    os.environ["AT_MOCK"] = "1"
+    Session = _sessionmaker(tmp_path)
+
+    def override_get_db():
+        db = Session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    prev = app.dependency_overrides.get(get_db)
+    app.dependency_overrides[get_db] = override_get_db
+    with Session() as db:
+        crud.upsert_api_config_by_name(
+            db,
+            schemas.APIConfigCreate(
+                name="accesstrade",
+                base_url="mock://accesstrade",
+                api_key="dummy",
+                model="-",
+            ),
+        )
+    try:
+        yield TestClient(app)
+    finally:
+        if prev is None:
+            app.dependency_overrides.pop(get_db, None)
+        else:
+            app.dependency_overrides[get_db] = prev
+
+
+def test_ingest_background_returns_job_and_result(client):
+    r = client.post(
+        "/ingest/datafeeds/all?background=true",
+        json={
+            "provider": "accesstrade",
+            "max_pages": 1,
+            "limit_per_page": 100,
+            "params": {"merchant": "tikivn"},
+        },
+    )
+    assert r.status_code == 202
+    body = r.json()
+    assert body["ok"] is True and body["type"] == "ingest"
+    job_id = body["job_id"]
+    assert body["status_url"] == f"/jobs/{job_id}"
+
+    job = None
+    for _ in range(250):
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] in jobs.TERMINAL:
+            break
+        time.sleep(0.02)
+    assert job["status"] == "succeeded", job
+    assert isinstance(job["result"].get("imported"), int)
+    assert any(j["id"] == job_id for j in client.get("/jobs?type=ingest").json())
+    assert client.get("/jobs/does-not-exist").status_code == 404
@@ -0,0 +1,31 @@
+from datetime import datetime, UTC
+from decimal import Decimal
+
+import json_codec
+
+
+def test_codec_output_matches_stdlib_fallback():
+    np = __import__("numpy")
+    obj = {
+        "title": "Giày thể thao – ưu đãi",
+        "n": np.int64(3),
+        "f": 1.5,
+        "d": Decimal("2.5"),
+        "ts": datetime(2024, 1, 2, 3, 4, 5, tzinfo=UTC),
+        1: ["a", None, True],
+    }
+    out = json_codec.dumps(obj)
+    assert out == json_codec._STDLIB_ENCODER.encode(obj)
+    assert "Giày" in out  # không escape unicode
+    assert json_codec.loads(out)["ts"] == "2024-01-02T03:04:05+00:00"
+    assert json_codec.dumps_bytes(obj) == out.encode("utf-8")
+
+
+def test_codec_helpers_and_response():
+    assert json_codec.loads_dict('{"desc":"x"}') == {"desc": "x"}
+    assert json_codec.loads_dict("[1]") == {}
+    assert json_codec.loads_dict("{bad") == {}
+    assert json_codec.loads_dict(None) == {}
+    resp = json_codec.FastJSONResponse([{"name": "Tiki"}])
+    assert resp.body == '[{"name":"Tiki"}]'.encode()
+    assert resp.media_type == "application/json"
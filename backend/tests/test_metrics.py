@@ -0,0 +1,122 @@
+import asyncio
+import os
+import sys
+
+import httpx
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import metrics
+from accesstrade_service import _MetricsTransport
+
+
+def _registry(directory=None):
+    r = metrics.Registry(directory)
+    c = r.counter("jobs_total", "Jobs.")
+    h = r.histogram("work_seconds", "Work.", buckets=(0.1, 1.0))
+    return r, c, h
+
+
+def test_render_counters_and_cumulative_histogram():
+    r, c, h = _registry()
+    c.inc(kind="a")
+    c.inc(2, kind="a")
+    c.inc(kind='q"x')
+    for v in (0.05, 0.5, 5.0):
+        h.observe(v, op="w")
+    text = r.render()
+    assert "# TYPE jobs_total counter" in text
+    assert 'jobs_total{kind="a"} 3' in text
+    assert 'jobs_total{kind="q\\"x"} 1' in text
+    assert 'work_seconds_bucket{op="w",le="0.1"} 1' in text
+    assert 'work_seconds_bucket{op="w",le="1"} 2' in text
+    assert 'work_seconds_bucket{op="w",le="+Inf"} 3' in text
+    assert 'work_seconds_count{op="w"} 3' in text
+    assert 'work_seconds_sum{op="w"} 5.55' in text
+
+
+def test_multiprocess_dir_sums_all_workers(tmp_path):
+    # 2 registry cùng thư mục = 2 worker uvicorn
+    r1, c1, h1 = _registry(str(tmp_path))
+    r2, c2, h2 = _registry(str(tmp_path))
+    c1.inc(kind="a")
+    c2.inc(4, kind="a")
+    h1.observe(0.5, op="w")
+    h2.observe(0.5, op="w")
+    r2.flush()
+    text = r1.render()
+    assert 'jobs_total{kind="a"} 5' in text
+    assert 'work_seconds_count{op="w"} 2' in text
+    # worker nào nhận request scrape cũng thấy cùng tổng
+    assert r2.render() == text
+
+
+def test_upstream_transport_records_endpoint_and_status():
+    def handler(request):
+        if request.url.path.endswith("boom"):
+            raise httpx.ConnectError("down", request=request)
+        return httpx.Response(404 if "campaigns" in request.url.path else 200)
+
+    r, _, _ = _registry()
+    hist = r.histogram("at_upstream_request_seconds", "Upstream.")
+    orig = metrics.UPSTREAM_SECONDS
+    metrics.UPSTREAM_SECONDS = hist
+    try:
+
+        async def run():
+            transport = _MetricsTransport(httpx.MockTransport(handler))
+            async with httpx.AsyncClient(transport=transport) as client:
+                await client.get("https://api.test/v1/datafeeds?page=1")
+                await client.get("https://api.test/v1/campaigns/123")
+                try:
+                    await client.get("https://api.test/v1/boom")
+                except httpx.ConnectError:
+                    pass
+
+        asyncio.run(run())
+    finally:
+        metrics.UPSTREAM_SECONDS = orig
+    text = r.render()
+    assert (
+        'at_upstream_request_seconds_count{endpoint="datafeeds",status="200"} 1' in text
+    )
+    assert (
+        'at_upstream_request_seconds_count{endpoint="campaigns",status="404"} 1' in text
+    )
+    assert 'at_upstream_request_seconds_count{endpoint="boom",status="error"} 1' in text
+
+
+def test_upstream_budget_is_shared_across_event_loops(monkeypatch):
+    import threading
+
+    import accesstrade_service
+
+    monkeypatch.setattr(accesstrade_service, "_at_slots", threading.BoundedSemaphore(2))
+    lock = threading.Lock()
+    state = {"now": 0, "peak": 0}
+
+    async def handler(request):
+        with lock:
+            state["now"] += 1
+            state["peak"] = max(state["peak"], state["now"])
+        await asyncio.sleep(0.02)
+        with lock:
+            state["now"] -= 1
+        return httpx.Response(200)
+
+    async def run():
+        transport = _MetricsTransport(httpx.MockTransport(handler))
+        async with httpx.AsyncClient(transport=transport) as client:
+            await asyncio.gather(
+                *(
+                    client.get(f"https://api.test/v1/datafeeds?page={i}")
+                    for i in range(4)
+                )
+            )
+
+    # mỗi job nền chạy asyncio.run riêng: 2 loop vẫn chung 1 ngân sách
+    threads = [threading.Thread(target=asyncio.run, args=(run(),)) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert state["peak"] == 2
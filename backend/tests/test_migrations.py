@@ -0,0 +1,232 @@
+import os
+import sys
+
+from sqlalchemy import create_engine, inspect, text
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import migrations
+from database import Base
+
+
+def _index_names(eng, table):
+    return {ix["name"] for ix in inspect(eng).get_indexes(table)}
+
+
+def test_run_migrations_records_versions_and_is_noop_after(tmp_path):
+    eng = create_engine(f"sqlite:///{tmp_path / 'mig.db'}")
+    Base.metadata.create_all(bind=eng)
+
+    done = migrations.run_migrations(eng)
+    assert [d["version"] for d in done] == [m.version for m in migrations.MIGRATIONS]
+    assert migrations.migration_status(eng) == {
+        "current": migrations.MIGRATIONS[-1].version,
+        "latest": migrations.MIGRATIONS[-1].version,
+        "pending": [],
+    }
+    assert "ix_product_offers_source_type_merchant" in _index_names(
+        eng, "product_offers"
+    )
+    assert "ix_campaigns_status_user_status" in _index_names(eng, "campaigns")
+
+    # Lần khởi động sau: không còn bước nào
+    assert migrations.run_migrations(eng) == []
+
+
+def test_run_migrations_applies_only_pending_step(tmp_path):
+    eng = create_engine(f"sqlite:///{tmp_path / 'mig.db'}")
+    Base.metadata.create_all(bind=eng)
+    migrations.run_migrations(eng)
+
+    # Giả lập DB cũ: index chưa có và bước v2 chưa ghi nhận
+    with eng.begin() as conn:
+        conn.execute(text("DROP INDEX ix_promotions_lookup"))
+        conn.execute(text("DELETE FROM schema_version WHERE version = 2"))
+    assert migrations.migration_status(eng)["pending"] == ["composite_indexes"]
+
+    done = migrations.run_migrations(eng)
+    assert [d["name"] for d in done] == ["composite_indexes"]
+    assert "ix_promotions_lookup" in _index_names(eng, "promotions")
+
+
+def test_failed_step_is_not_recorded(tmp_path, monkeypatch):
+    eng = create_engine(f"sqlite:///{tmp_path / 'mig.db'}")
+    Base.metadata.create_all(bind=eng)
+
+    def boom(_engine):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(
+        migrations,
+        "MIGRATIONS",
+        [
+            migrations.MIGRATIONS[0],
+            migrations.Migration(2, "composite_indexes", boom),
+        ],
+    )
+    done = migrations.run_migrations(eng)
+    assert [d["version"] for d in done] == [1]
+    assert migrations.migration_status(eng)["pending"] == ["composite_indexes"]
+
+
+def test_normalize_user_status_backfill(tmp_path):
+    eng = create_engine(f"sqlite:///{tmp_path / 'mig.db'}")
+    Base.metadata.create_all(bind=eng)
+    migrations.run_migrations(eng)
+    with eng.begin() as conn:
+        conn.execute(text("DELETE FROM schema_version WHERE version = 3"))
+        for i, us in enumerate([" successful", "approved ", "PENDING", "  ", None]):
+            conn.execute(
+                text(
+                    "INSERT INTO campaigns (campaign_id, user_registration_status) "
+                    "VALUES (:c, :u)"
+                ),
+                {"c": f"c{i}", "u": us},
+            )
+
+    assert [d["version"] for d in migrations.run_migrations(eng)] == [3]
+    with eng.connect() as conn:
+        rows = conn.execute(
+            text("SELECT user_registration_status FROM campaigns ORDER BY campaign_id")
+        ).scalars()
+        assert list(rows) == ["APPROVED", "APPROVED", "PENDING", None, None]
+
+
+def test_offer_extra_columns_backfill(tmp_path):
+    eng = create_engine(f"sqlite:///{tmp_path / 'mig.db'}")
+    Base.metadata.create_all(bind=eng)
+    migrations.run_migrations(eng)
+    # Giả lập DB cũ: bảng chưa có các cột tách từ extra
+    with eng.begin() as conn:
+        conn.execute(text("DROP INDEX ix_product_offers_cate"))
+        conn.execute(text("DROP INDEX ix_product_offers_shop_name"))
+        for col in ("description", "cate", "shop_name", "update_time_raw"):
+            conn.execute(text(f"ALTER TABLE product_offers DROP COLUMN {col}"))
+        conn.execute(text("DELETE FROM schema_version WHERE version = 4"))
+        for i, extra in enumerate(
+            [
+                '{"desc": "d", "cate": "cat1", "shop_name": "S", "update_time": "t"}',
+                '{"cate": 7}',
+                "not-json",
+                None,
+            ]
+        ):
+            conn.execute(
+                text(
+                    "INSERT INTO product_offers (source, source_id, title, url, extra) "
+                    "VALUES ('x', :sid, 't', 'https://e.vn', :extra)"
+                ),
+                {"sid": f"s{i}", "extra": extra},
+            )
+
+    done = migrations.run_migrations(eng)
+    assert [d["name"] for d in done] == ["offer_extra_columns"]
+    assert {"ix_product_offers_cate", "ix_product_offers_shop_name"} <= _index_names(
+        eng, "product_offers"
+    )
+    with eng.connect() as conn:
+        rows = conn.execute(
+            text(
+                "SELECT description, cate, shop_name, update_time_raw "
+                "FROM product_offers ORDER BY source_id"
+            )
+        ).all()
+    assert [tuple(r) for r in rows] == [
+        ("d", "cat1", "S", "t"),
+        (None, "7", None, None),
+        (None, None, None, None),
+        (None, None, None, None),
+    ]
+
+
+def test_offer_duplicates_merged_before_unique_index(tmp_path, caplog):
+    eng = create_engine(f"sqlite:///{tmp_path / 'mig.db'}")
+    Base.metadata.create_all(bind=eng)
+    migrations.run_migrations(eng)
+    # Giả lập DB cũ: chưa có unique index nên còn offer trùng (source, source_id)
+    with eng.begin() as conn:
+        conn.execute(text("DROP INDEX uq_product_offers_source_source_id"))
+        conn.execute(text("DELETE FROM schema_version WHERE version = 6"))
+        for oid, img, price in ((1, "https://img/1.jpg", 10.0), (2, None, 20.0)):
+            conn.execute(
+                text(
+                    "INSERT INTO product_offers "
+                    "(id, source, source_id, title, url, image_url, price) "
+                    "VALUES (:id, 'at', 'dup', 't', 'https://e.vn', :img, :price)"
+                ),
+                {"id": oid, "img": img, "price": price},
+            )
+            conn.execute(
+                text(
+                    "INSERT INTO price_history (offer_id, price, currency) "
+                    "VALUES (:id, :price, 'VND')"
+                ),
+                {"id": oid, "price": price},
+            )
+
+    with caplog.at_level("WARNING", logger="affiliate_api"):
+        done = migrations.run_migrations(eng)
+    assert [d["name"] for d in done] == ["offer_source_key_unique"]
+    assert "Merged 1 duplicate product_offers rows" in caplog.text
+    assert "uq_product_offers_source_source_id" in _index_names(eng, "product_offers")
+    with eng.connect() as conn:
+        rows = conn.execute(
+            text("SELECT id, image_url, price FROM product_offers")
+        ).all()
+        # Giữ bản mới nhất, lấp cột NULL từ bản trùng; lịch sử giá không mất
+        assert [tuple(r) for r in rows] == [(2, "https://img/1.jpg", 20.0)]
+        hist = conn.execute(
+            text("SELECT offer_id FROM price_history ORDER BY price")
+        ).scalars()
+        assert list(hist) == [2, 2]
+
+
+def test_commission_duplicates_merged_before_unique_index(tmp_path, caplog):
+    eng = create_engine(f"sqlite:///{tmp_path / 'mig.db'}")
+    Base.metadata.create_all(bind=eng)
+    migrations.run_migrations(eng)
+    # Giả lập DB cũ: trùng khoá (NULL reward_type coi như '') khi chưa có unique index
+    with eng.begin() as conn:
+        conn.execute(text("DROP INDEX uq_commission_policy_key"))
+        conn.execute(text("DELETE FROM schema_version WHERE version = 7"))
+        for rt, ratio, price in (("", 5.0, None), (None, None, 1000.0)):
+            conn.execute(
+                text(
+                    "INSERT INTO commission_policies "
+                    "(campaign_id, reward_type, sales_ratio, sales_price) "
+                    "VALUES ('C1', :rt, :ratio, :price)"
+                ),
+                {"rt": rt, "ratio": ratio, "price": price},
+            )
+
+    with caplog.at_level("WARNING", logger="affiliate_api"):
+        done = migrations.run_migrations(eng)
+    assert [d["name"] for d in done] == ["commission_policy_key_unique"]
+    assert "Merged 1 duplicate commission_policies rows" in caplog.text
+    with eng.connect() as conn:
+        # index biểu thức: inspector không reflect được, tra thẳng catalog
+        assert conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = 'uq_commission_policy_key'")
+        ).first()
+        rows = conn.execute(
+            text("SELECT sales_ratio, sales_price FROM commission_policies")
+        ).all()
+    assert [tuple(r) for r in rows] == [(5.0, 1000.0)]
+
+
+def test_baseline_fails_when_columns_missing(tmp_path, monkeypatch):
+    eng = create_engine(f"sqlite:///{tmp_path / 'mig.db'}")
+    Base.metadata.create_all(bind=eng)
+    with eng.begin() as conn:
+        conn.execute(text("DROP INDEX ix_product_offers_retired_at"))
+        conn.execute(text("ALTER TABLE product_offers DROP COLUMN retired_at"))
+    # DDL lỗi bị apply_simple_migrations nuốt: giả lập bằng no-op
+    monkeypatch.setattr(migrations, "apply_simple_migrations", lambda engine: None)
+
+    done = migrations.run_migrations(eng)
+    assert done == []
+    assert "baseline_simple_migrations" in migrations.migration_status(eng)["pending"]
+
+    monkeypatch.undo()
+    done = migrations.run_migrations(eng)
+    assert done[0]["name"] == "baseline_simple_migrations"
+    assert "ix_product_offers_retired_at" in _index_names(eng, "product_offers")
@@ -67,6 +67,16 @@ def test_health_ok(client):
     assert r.json().get("ok") is True
 
 
+def test_health_db_reports_pool(client):
+    r = client.get("/health/db")
+    assert r.status_code == 200
+    body = r.json()
+    assert body["ok"] is True and body["dialect"] == "sqlite"
+    assert set(body["settings"]) >= {"pool_size", "max_overflow", "pool_timeout"}
+    assert body["pool"]["class"] == "StaticPool"
+    assert set(body["pool"]["wait"]) == {"count", "timeouts", "avg_ms", "max_ms"}
+
+
 def test_links_crud(client):
     # Create
     payload = {
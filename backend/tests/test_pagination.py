@@ -0,0 +1,82 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import models
+import pagination
+from database import Base
+
+
+@pytest.fixture()
+def db():
+    engine = create_engine(
+        "sqlite:///:memory:",
+        future=True,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    t0 = datetime(2026, 1, 1)
+    prices = [30.0, None, 10.0, 30.0, None, 20.0, 10.0, 30.0]
+    for i, price in enumerate(prices):
+        session.add(
+            models.ProductOffer(
+                source="t",
+                source_id=f"s{i}",
+                title=f"T{i}",
+                url="https://e.vn",
+                price=price,
+                # updated_at trùng nhau theo cặp để kiểm tra tie-break theo id
+                updated_at=t0 + timedelta(minutes=i // 2),
+            )
+        )
+    session.commit()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def _expected(rows, key, desc):
+    # NULL lớn nhất: tăng dần -> cuối, giảm dần -> đầu
+    def k(o):
+        v = getattr(o, key)
+        return (v is None, v if v is not None else 0, o.id)
+
+    return [o.id for o in sorted(rows, key=k, reverse=desc)]
+
+
+@pytest.mark.parametrize(
+    "sort", ["id", "-id", "price", "-price", "updated_at", "-updated_at"]
+)
+def test_keyset_pages_cover_all_rows_in_order(db, sort):
+    key, desc = pagination.parse_sort(sort)
+    q = db.query(models.ProductOffer)
+    seen: list[int] = []
+    after = None
+    for _ in range(10):
+        rows = pagination.keyset_page(
+            q, models.ProductOffer, sort, after=after, limit=3
+        )
+        seen += [o.id for o in rows]
+        token = pagination.next_cursor(rows, sort, 3)
+        if token is None:
+            break
+        after = pagination.decode_cursor(token, sort)
+    assert seen == _expected(q.all(), key, desc)
+
+
+def test_cursor_rejects_other_sort_and_garbage():
+    token = pagination.encode_cursor("price", 10.0, 3)
+    assert pagination.decode_cursor(token, "price") == (10.0, 3)
+    with pytest.raises(ValueError):
+        pagination.decode_cursor(token, "-price")
+    with pytest.raises(ValueError):
+        pagination.decode_cursor("not a cursor!", "price")
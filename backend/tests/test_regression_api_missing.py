@@ -68,3 +68,84 @@ def test_upsert_campaign_preserves_existing_when_placeholder(db):
     assert row.end_time == "2025-12-31"
     # user status should remain APPROVED
     assert (row.user_registration_status or "").upper() == "APPROVED"
+
+
+def test_bulk_upsert_campaigns_same_rules_as_single(db):
+    crud.upsert_campaign(
+        db,
+        schemas.CampaignCreate(
+            campaign_id="C1", merchant="tikivn", name="Tiki", status="running"
+        ),
+    )
+    n = crud.bulk_upsert_campaigns(
+        db,
+        [
+            # placeholder không ghi đè, user status được chuẩn hoá
+            schemas.CampaignCreate(
+                campaign_id="C1",
+                merchant="API_MISSING",
+                name="NO_DATA",
+                user_registration_status="successful",
+            ),
+            schemas.CampaignCreate(
+                campaign_id="C2", merchant="shopee", name="", status="paused"
+            ),
+            # trùng trong lô: bản sau gộp đè
+            schemas.CampaignCreate(
+                campaign_id="C2", user_registration_status="pending"
+            ),
+        ],
+    )
+    assert n == 2
+    c1 = crud.get_campaign_by_cid(db, "C1")
+    assert (c1.merchant, c1.name, c1.status) == ("tikivn", "Tiki", "running")
+    assert c1.user_registration_status == "APPROVED"
+    c2 = crud.get_campaign_by_cid(db, "C2")
+    assert (c2.merchant, c2.name, c2.status) == ("shopee", None, "paused")
+    assert c2.user_registration_status == "PENDING"
+    assert crud.bulk_upsert_campaigns(db, []) == 0
+
+
+def test_bulk_upsert_commission_policies_keyed_with_null_parts(db):
+    P = schemas.CommissionPolicyCreate
+    assert (
+        crud.bulk_upsert_commission_policies(
+            db,
+            [
+                P(campaign_id="C1", reward_type="CPS", sales_ratio=5),
+                P(campaign_id="C1", reward_type=None, sales_price=1000),
+                # trùng khoá trong lô: gộp, giá trị None không xoá giá trị trước
+                P(campaign_id="C1", reward_type="CPS", sales_ratio=None, sales_price=7),
+            ],
+        )
+        == 2
+    )
+    # lần 2: NULL reward_type/target_month vẫn khớp dòng cũ (không tạo dòng mới)
+    crud.bulk_upsert_commission_policies(
+        db,
+        [
+            P(campaign_id="C1", reward_type="", sales_price=2000),
+            P(campaign_id="C1", reward_type="CPS", sales_ratio=0),
+        ],
+    )
+    rows = {
+        r.reward_type: (r.sales_ratio, r.sales_price)
+        for r in db.query(models.CommissionPolicy).all()
+    }
+    assert rows == {"CPS": (0, 7), None: (None, 2000)}
+    assert crud.bulk_upsert_commission_policies(db, []) == 0
+
+
+def test_bulk_upsert_commission_policies_falls_back_without_unique_index(db, caplog):
+    from sqlalchemy import text
+
+    db.execute(text("DROP INDEX uq_commission_policy_key"))
+    db.commit()
+    P = schemas.CommissionPolicyCreate
+    with caplog.at_level("WARNING", logger="affiliate_api"):
+        for _ in range(2):
+            crud.bulk_upsert_commission_policies(
+                db, [P(campaign_id="C1", reward_type="CPS", sales_ratio=5)]
+            )
+    assert db.query(models.CommissionPolicy).count() == 1
+    assert "fallback upsert từng dòng" in caplog.text
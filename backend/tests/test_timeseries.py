@@ -0,0 +1,20 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from timeseries import lttb_indices
+
+
+def test_lttb_short_series_untouched():
+    assert lttb_indices([0, 1, 2], [5, 6, 7], 10) == [0, 1, 2]
+
+
+def test_lttb_keeps_ends_and_spike():
+    xs = list(range(1000))
+    ys = [100.0] * 1000
+    ys[537] = 10.0  # đợt giảm giá ngắn phải còn sau downsample
+    idx = lttb_indices(xs, ys, 50)
+    assert len(idx) == 50
+    assert idx[0] == 0 and idx[-1] == 999
+    assert idx == sorted(idx)
+    assert 537 in idx
@@ -0,0 +1,50 @@
+"""
+Downsample chuỗi thời gian phía server (vd. lịch sử giá) trước khi trả cho UI.
+
+`lttb_indices` cài đặt Largest-Triangle-Three-Buckets: giữ điểm đầu/cuối, chia phần
+giữa thành (threshold - 2) bucket và ở mỗi bucket chọn điểm tạo tam giác lớn nhất
+với điểm đã chọn trước đó và trung bình bucket kế tiếp. Hình dạng đường giá (đỉnh,
+đáy, bước nhảy) được giữ lại dù chỉ trả vài trăm điểm cho lịch sử rất dài.
+
+Ví dụ:
+    idx = lttb_indices(xs, ys, 200)
+    points = [rows[i] for i in idx]
+"""
+
+from __future__ import annotations
+
+from typing import List, Sequence
+
+
+def lttb_indices(xs: Sequence[float], ys: Sequence[float], threshold: int) -> List[int]:
+    """Chỉ số các điểm được giữ (tăng dần). xs phải tăng dần, cùng độ dài ys."""
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    out = [0]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # trung bình của bucket kế tiếp (điểm "C" của tam giác)
+        nxt_start = int((i + 1) * every) + 1
+        nxt_end = min(int((i + 2) * every) + 1, n)
+        if nxt_start >= nxt_end:
+            nxt_start, nxt_end = n - 1, n
+        cnt = nxt_end - nxt_start
+        avg_x = sum(xs[nxt_start:nxt_end]) / cnt
+        avg_y = sum(ys[nxt_start:nxt_end]) / cnt
+
+        # bucket hiện tại: chọn điểm có diện tích tam giác (a, p, avg) lớn nhất
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        ax, ay = xs[a], ys[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        out.append(best)
+        a = best
+    out.append(n - 1)
+    return out